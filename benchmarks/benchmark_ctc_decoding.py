@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Real-time factor of the CTC decoding modes (translate.py -ctc_decode) against the attention beam search,
+on the same randomly initialized speech model trained with -ctc_loss.
+
+The checkpoint and the translators are built like in benchmark_decoding.py. The attention beam search is forced
+to run for -decode_length steps (a random model does not emit EOS at a realistic point), the CTC decoding
+always processes every encoder frame.
+
+Reported per (decoding mode, beam size, batch size):
+    total_ms   : FastTranslator.translate for the whole batch (including building the batch)
+    rtf        : decoding time / duration of the audio (-frame_shift milliseconds per input frame)
+
+Example:
+    python benchmarks/benchmark_ctc_decoding.py -src_length 500 -decode_length 50 -batch_sizes 1,16
+"""
+from __future__ import division
+
+import os
+import sys
+import io
+import json
+import time
+import argparse
+import tempfile
+import contextlib
+
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from benchmark_decoding import save_random_checkpoint, build_translator, synthetic_batch, git_revision
+
+parser = argparse.ArgumentParser(description='benchmark_ctc_decoding.py')
+parser.add_argument('-model', default='speech_transformer',
+                    help='Speech model type (value of -model for train.py)')
+parser.add_argument('-modes', default='attention,greedy,prefix_beam',
+                    help='Comma-separated decoding modes: attention (beam search), greedy, prefix_beam')
+parser.add_argument('-beam_sizes', default='1,4',
+                    help='Comma-separated beam sizes (attention and prefix_beam)')
+parser.add_argument('-batch_sizes', default='1,16',
+                    help='Comma-separated numbers of utterances per batch')
+parser.add_argument('-layers', type=int, default=3,
+                    help='Number of encoder and decoder layers')
+parser.add_argument('-model_size', type=int, default=256,
+                    help='Size of the hidden states')
+parser.add_argument('-inner_size', type=int, default=1024,
+                    help='Size of the feed-forward layers')
+parser.add_argument('-n_heads', type=int, default=4,
+                    help='Number of attention heads')
+parser.add_argument('-vocab_size', type=int, default=1000,
+                    help='Size of the synthetic target vocabulary')
+parser.add_argument('-src_length', type=int, default=300,
+                    help='Number of input frames per utterance')
+parser.add_argument('-input_size', type=int, default=40,
+                    help='Feature size of the speech input')
+parser.add_argument('-frame_shift', type=float, default=10.0,
+                    help='Milliseconds of audio per input frame')
+parser.add_argument('-decode_length', type=int, default=40,
+                    help='Number of decoding steps of the attention beam search')
+parser.add_argument('-repeat', type=int, default=3,
+                    help='Number of timed runs per setting (after one warm-up run). The fastest run is kept.')
+parser.add_argument('-threads', type=int, default=0,
+                    help='Number of CPU threads (0 = torch default)')
+parser.add_argument('-gpu', type=int, default=-1,
+                    help='Device to run on')
+parser.add_argument('-fp16', action='store_true',
+                    help='Use half precision (GPU only)')
+parser.add_argument('-seed', type=int, default=1234,
+                    help='Random seed')
+parser.add_argument('-output', default='',
+                    help='Write the results to this JSON file')
+
+
+def run(opt, translator, batch_size, sync):
+
+    generator = torch.Generator().manual_seed(opt.seed)
+    src_data, data_type = synthetic_batch(opt, translator, opt.model, batch_size, generator)
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        # warm-up
+        translator.translate(src_data, None, type=data_type)
+
+        best = None
+        for _ in range(opt.repeat):
+            sync()
+            start = time.perf_counter()
+            translator.translate(src_data, None, type=data_type)
+            sync()
+            total = time.perf_counter() - start
+            best = total if best is None else min(best, total)
+
+    audio_seconds = batch_size * opt.src_length * opt.frame_shift / 1000
+
+    return {'total_ms': 1000 * best, 'rtf': best / audio_seconds}
+
+
+def main():
+    opt = parser.parse_args()
+
+    if opt.threads > 0:
+        torch.set_num_threads(opt.threads)
+
+    cuda = opt.gpu >= 0
+    if cuda:
+        torch.cuda.set_device(opt.gpu)
+    sync = torch.cuda.synchronize if cuda else (lambda: None)
+
+    beam_sizes = [int(b) for b in opt.beam_sizes.split(',')]
+    batch_sizes = [int(b) for b in opt.batch_sizes.split(',')]
+
+    results = list()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        checkpoint_path = os.path.join(tmp_dir, opt.model + '.pt')
+        torch.manual_seed(opt.seed)
+        with contextlib.redirect_stdout(io.StringIO()):
+            save_random_checkpoint(opt, opt.model, checkpoint_path, extra_args=['-ctc_loss', '0.5'])
+
+        for mode in opt.modes.split(','):
+            # greedy decoding has no beam
+            for beam_size in beam_sizes if mode != 'greedy' else [1]:
+                for batch_size in batch_sizes:
+                    translator = build_translator(opt, checkpoint_path, opt.model, beam_size, batch_size)
+                    if mode != 'attention':
+                        translator.ctc_decode = mode
+                        translator.opt.n_best = 1
+
+                    result = {'mode': mode, 'beam_size': beam_size, 'batch_size': batch_size}
+                    result.update(run(opt, translator, batch_size, sync))
+                    results.append(result)
+                    print("Done: %s beam %d batch %d (RTF %.4f)" % (mode, beam_size, batch_size, result['rtf']),
+                          file=sys.stderr)
+
+    header = "%-12s %4s %5s %10s %8s %9s" % ('mode', 'beam', 'batch', 'total ms', 'RTF', 'speed-up')
+    print(header)
+    print('-' * len(header))
+    attention = {(r['beam_size'], r['batch_size']): r['rtf'] for r in results if r['mode'] == 'attention'}
+    for r in results:
+        line = "%-12s %4d %5d %10.2f %8.4f" % (r['mode'], r['beam_size'], r['batch_size'], r['total_ms'], r['rtf'])
+        # compared to the attention beam search with the same beam size (beam 1 for greedy)
+        reference = attention.get((r['beam_size'], r['batch_size']))
+        if reference is not None and r['mode'] != 'attention':
+            line += " %8.1fx" % (reference / r['rtf'])
+        print(line)
+
+    if opt.output:
+        report = {
+            'meta': {
+                'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+                'git_revision': git_revision(),
+                'torch': torch.__version__,
+                'threads': torch.get_num_threads(),
+                'device': torch.cuda.get_device_name(opt.gpu) if cuda else 'cpu',
+                'args': vars(opt)
+            },
+            'results': results
+        }
+        with open(opt.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print("Results written to %s" % opt.output)
+
+
+if __name__ == "__main__":
+    main()
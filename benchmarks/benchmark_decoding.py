@@ -0,0 +1,356 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Throughput of the beam search hot path (FastTranslator) with small randomly initialized models.
+
+Each model is built with build_model from synthetic dictionaries, saved to a temporary checkpoint
+and loaded by FastTranslator exactly like translate.py does. The search is forced to run for
+-decode_length steps so that the numbers do not depend on when a random model emits EOS.
+
+Reported per (model, beam size, batch size):
+    encoder_ms       : create_decoder_state (encoder forward + expanding the state over the beam)
+    decoder_step_ms  : one call of FastTranslator._decode (decoder step + output projection)
+    reorder_step_ms  : one call of _reorder_incremental_state
+    search_step_ms   : the remaining per-step beam bookkeeping (top-k, finalizing, buffer copies)
+    sents_per_sec    : end-to-end FastTranslator.translate (including building the batch)
+
+Example:
+    python benchmarks/benchmark_decoding.py -beam_sizes 1,4 -batch_sizes 1,16 -output bench.json
+    python benchmarks/benchmark_decoding.py -compare bench.json -output bench_new.json
+"""
+from __future__ import division
+
+import os
+import sys
+import io
+import json
+import time
+import platform
+import argparse
+import tempfile
+import subprocess
+import contextlib
+from collections import defaultdict
+
+import torch
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import onmt
+import options
+import translate
+from onmt.model_factory import build_model, init_model_parameters
+from onmt.inference.fast_translator import FastTranslator
+
+parser = argparse.ArgumentParser(description='benchmark_decoding.py')
+parser.add_argument('-models', default='transformer,relative_transformer,conformer,speech_transformer',
+                    help='Comma-separated model types. Speech models get random filterbank inputs.')
+parser.add_argument('-beam_sizes', default='1,4,8',
+                    help='Comma-separated beam sizes')
+parser.add_argument('-batch_sizes', default='1,8,32',
+                    help='Comma-separated numbers of sentences per batch')
+parser.add_argument('-layers', type=int, default=3,
+                    help='Number of encoder and decoder layers')
+parser.add_argument('-model_size', type=int, default=256,
+                    help='Size of the hidden states')
+parser.add_argument('-inner_size', type=int, default=1024,
+                    help='Size of the feed-forward layers')
+parser.add_argument('-n_heads', type=int, default=4,
+                    help='Number of attention heads')
+parser.add_argument('-vocab_size', type=int, default=8000,
+                    help='Size of the synthetic source and target vocabularies')
+parser.add_argument('-src_length', type=int, default=32,
+                    help='Number of source tokens (text) or encoder frames (speech) per sentence')
+parser.add_argument('-input_size', type=int, default=40,
+                    help='Feature size of the speech input')
+parser.add_argument('-decode_length', type=int, default=32,
+                    help='Number of decoding steps (EOS is only allowed at the last step)')
+parser.add_argument('-repeat', type=int, default=3,
+                    help='Number of timed runs per setting (after one warm-up run). The fastest run is kept.')
+parser.add_argument('-threads', type=int, default=0,
+                    help='Number of CPU threads (0 = torch default)')
+parser.add_argument('-gpu', type=int, default=-1,
+                    help='Device to run on')
+parser.add_argument('-fp16', action='store_true',
+                    help='Use half precision (GPU only)')
+parser.add_argument('-seed', type=int, default=1234,
+                    help='Random seed')
+parser.add_argument('-output', default='',
+                    help='Write the results to this JSON file')
+parser.add_argument('-compare', default='',
+                    help='JSON file of a previous run to print the relative change against')
+
+
+def synthetic_dict(size):
+
+    words = [onmt.constants.PAD_WORD, onmt.constants.UNK_WORD,
+             onmt.constants.BOS_WORD, onmt.constants.EOS_WORD]
+    words += ['w%d' % i for i in range(size - len(words))]
+
+    return onmt.Dict(words, lower=False)
+
+
+def is_speech_model(model):
+    return model in ['conformer', 'speech_transformer', 'hybrid_transformer', 'speech_lstm']
+
+
+def save_random_checkpoint(opt, model_type, path, extra_args=()):
+    """
+    :param opt: benchmark options
+    :param model_type: value of -model for train.py
+    :param path: where to save the checkpoint
+    :param extra_args: additional train.py options of the model
+    :return: None
+    """
+    speech = is_speech_model(model_type)
+
+    model_args = ['-data', 'none', '-model', model_type,
+                  '-layers', str(opt.layers), '-model_size', str(opt.model_size),
+                  '-inner_size', str(opt.inner_size), '-n_heads', str(opt.n_heads)]
+    if speech:
+        model_args += ['-encoder_type', 'audio', '-input_size', str(opt.input_size)]
+    model_args += list(extra_args)
+    model_opt = options.backward_compatible(options.make_parser(argparse.ArgumentParser()).parse_args(model_args))
+
+    dicts = dict()
+    dicts['tgt'] = synthetic_dict(opt.vocab_size)
+    if not speech:
+        dicts['src'] = synthetic_dict(opt.vocab_size)
+    dicts['langs'] = {'src': 0, 'tgt': 1}
+
+    model = build_model(model_opt, dicts)
+    # same initialization as the trainer (some parameters are left uninitialized by the constructors)
+    init_model_parameters(model, model_opt)
+
+    checkpoint = {
+        'model': model.state_dict(),
+        'dicts': dicts,
+        'opt': model_opt,
+        'epoch': 0,
+        'itr': None,
+        'optim': None,
+        'amp': None
+    }
+    torch.save(checkpoint, path)
+
+
+def build_translator(opt, checkpoint_path, model_type, beam_size, batch_size):
+
+    args = ['-model', checkpoint_path, '-src', 'none', '-fast_translate',
+            '-beam_size', str(beam_size), '-batch_size', str(batch_size),
+            '-max_sent_length', str(opt.decode_length), '-gpu', str(opt.gpu)]
+    if is_speech_model(model_type):
+        args += ['-encoder_type', 'audio']
+    if opt.fp16:
+        args += ['-fp16']
+    translate_opt = translate.parser.parse_args(args)
+    translate_opt.cuda = opt.gpu > -1
+    translate_opt.n_best = beam_size
+
+    # the translator is quite talkative when loading models
+    with contextlib.redirect_stdout(io.StringIO()):
+        translator = FastTranslator(translate_opt)
+
+    # every hypothesis runs for the full length
+    translator.min_len = opt.decode_length
+
+    return translator
+
+
+def synthetic_batch(opt, translator, model_type, batch_size, generator):
+
+    if is_speech_model(model_type):
+        return [torch.randn(opt.src_length, opt.input_size, generator=generator) for _ in range(batch_size)], 'asr'
+
+    # skip the special symbols
+    n_special = 4
+    ids = torch.randint(n_special, translator.src_dict.size(), (batch_size, opt.src_length), generator=generator)
+    return [[translator.src_dict.getLabel(i) for i in sent] for sent in ids.tolist()], 'mt'
+
+
+class DecodingTimer(object):
+    """
+    Wraps the hot-path functions of a FastTranslator (as instance attributes) and accumulates their time
+    """
+
+    def __init__(self, translator, sync):
+        self.sync = sync
+        self.times = defaultdict(float)
+        self.calls = defaultdict(int)
+
+        translator._decode = self.wrap(translator._decode, 'decoder_step')
+        translator.translate_batch = self.wrap(translator.translate_batch, 'search')
+
+        for model in translator.models:
+            model.create_decoder_state = self.wrap(model.create_decoder_state, 'encoder',
+                                                   post=self.wrap_state)
+
+    def wrap_state(self, decoder_state):
+        decoder_state._reorder_incremental_state = self.wrap(decoder_state._reorder_incremental_state, 'reorder')
+        return decoder_state
+
+    def wrap(self, func, key, post=None):
+
+        def timed(*args, **kwargs):
+            self.sync()
+            start = time.perf_counter()
+            output = func(*args, **kwargs)
+            self.sync()
+            self.times[key] += time.perf_counter() - start
+            self.calls[key] += 1
+            return output if post is None else post(output)
+
+        return timed
+
+    def reset(self):
+        self.times.clear()
+        self.calls.clear()
+
+
+def run(opt, translator, model_type, batch_size, sync):
+
+    generator = torch.Generator().manual_seed(opt.seed)
+    src_data, data_type = synthetic_batch(opt, translator, model_type, batch_size, generator)
+    timer = DecodingTimer(translator, sync)
+
+    # the dataset and the model print a few lines for every batch
+    with contextlib.redirect_stdout(io.StringIO()):
+        # warm-up
+        translator.translate(src_data, None, type=data_type)
+
+        best = None
+        for _ in range(opt.repeat):
+            timer.reset()
+            sync()
+            start = time.perf_counter()
+            translator.translate(src_data, None, type=data_type)
+            sync()
+            total = time.perf_counter() - start
+
+            if best is None or total < best[0]:
+                best = (total, dict(timer.times), dict(timer.calls))
+
+    total, times, calls = best
+    steps = max(calls.get('decoder_step', 0), 1)
+    encoder = times.get('encoder', 0.)
+    decoder = times.get('decoder_step', 0.)
+    reorder = times.get('reorder', 0.)
+    search = times.get('search', 0.) - encoder - decoder - reorder
+
+    return {
+        'steps': calls.get('decoder_step', 0),
+        'total_ms': 1000 * total,
+        'encoder_ms': 1000 * encoder,
+        'decoder_step_ms': 1000 * decoder / steps,
+        'reorder_step_ms': 1000 * reorder / steps,
+        'search_step_ms': 1000 * search / steps,
+        'sents_per_sec': batch_size / total
+    }
+
+
+def git_revision():
+
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def result_key(result):
+    return result['model'], result['beam_size'], result['batch_size']
+
+
+def print_results(results, previous=None):
+
+    baseline = dict()
+    if previous is not None:
+        baseline = {result_key(r): r for r in previous['results'] if 'error' not in r}
+
+    header = "%-20s %4s %5s %10s %10s %10s %10s %10s" % ('model', 'beam', 'batch', 'enc ms', 'dec/step',
+                                                       'reorder', 'search', 'sents/s')
+    print(header)
+    print('-' * len(header))
+    for r in results:
+        if 'error' in r:
+            print("%-20s skipped: %s" % (r['model'], r['error']))
+            continue
+
+        line = "%-20s %4d %5d %10.2f %10.3f %10.3f %10.3f %10.1f" % (r['model'], r['beam_size'], r['batch_size'],
+                                                                   r['encoder_ms'], r['decoder_step_ms'],
+                                                                   r['reorder_step_ms'], r['search_step_ms'],
+                                                                   r['sents_per_sec'])
+        old = baseline.get(result_key(r))
+        if old is not None:
+            line += "  (%+.1f%% sents/s)" % (100 * (r['sents_per_sec'] / old['sents_per_sec'] - 1))
+        print(line)
+
+
+def main():
+    opt = parser.parse_args()
+
+    if opt.threads > 0:
+        torch.set_num_threads(opt.threads)
+
+    cuda = opt.gpu >= 0
+    if cuda:
+        torch.cuda.set_device(opt.gpu)
+    sync = torch.cuda.synchronize if cuda else (lambda: None)
+
+    beam_sizes = [int(b) for b in opt.beam_sizes.split(',')]
+    batch_sizes = [int(b) for b in opt.batch_sizes.split(',')]
+
+    results = list()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for model_type in opt.models.split(','):
+            checkpoint_path = os.path.join(tmp_dir, model_type + '.pt')
+            torch.manual_seed(opt.seed)
+
+            try:
+                with contextlib.redirect_stdout(io.StringIO()):
+                    save_random_checkpoint(opt, model_type, checkpoint_path)
+            except Exception as e:
+                # keep going with the other models, but leave a trace in the results
+                results.append({'model': model_type, 'error': '%s: %s' % (type(e).__name__, e)})
+                continue
+
+            for beam_size in beam_sizes:
+                for batch_size in batch_sizes:
+                    translator = build_translator(opt, checkpoint_path, model_type, beam_size, batch_size)
+                    result = {'model': model_type, 'beam_size': beam_size, 'batch_size': batch_size}
+                    result.update(run(opt, translator, model_type, batch_size, sync))
+                    results.append(result)
+                    print("Done: %s beam %d batch %d (%.1f sents/s)"
+                          % (model_type, beam_size, batch_size, result['sents_per_sec']), file=sys.stderr)
+
+    report = {
+        'meta': {
+            'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'git_revision': git_revision(),
+            'torch': torch.__version__,
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+            'processor': platform.processor(),
+            'threads': torch.get_num_threads(),
+            'device': torch.cuda.get_device_name(opt.gpu) if cuda else 'cpu',
+            'args': vars(opt)
+        },
+        'results': results
+    }
+
+    previous = None
+    if opt.compare:
+        with open(opt.compare) as f:
+            previous = json.load(f)
+
+    print_results(results, previous)
+
+    if opt.output:
+        with open(opt.output, 'w') as f:
+            json.dump(report, f, indent=2)
+        print("Results written to %s" % opt.output)
+
+
+if __name__ == "__main__":
+    main()
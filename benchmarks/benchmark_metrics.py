@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Throughput of the sentence level metrics (hypotheses per second): the per-sentence Python implementations
+against the batch n-gram statistics engine (onmt/metrics/ngram_stats.py), on random n-best lists.
+
+    sbleu : onmt.metrics.sbleu.sentence_bleu in a loop    vs  batch_sentence_bleu
+    gleu  : Counter of the n-grams (as nltk) in a loop     vs  batch_sentence_gleu
+
+The batch functions are timed with the words (strings) and with token ids (as the output of the translator).
+
+Example:
+    python benchmarks/benchmark_metrics.py -n_refs 2000 -n_best 50
+"""
+from __future__ import division
+
+import os
+import sys
+import time
+import argparse
+from collections import Counter
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from onmt.metrics.sbleu import sentence_bleu
+from onmt.metrics.ngram_stats import batch_sentence_bleu, batch_sentence_gleu
+
+parser = argparse.ArgumentParser(description='benchmark_metrics.py')
+parser.add_argument('-n_refs', type=int, default=1000,
+                    help='Number of references')
+parser.add_argument('-n_best', type=int, default=20,
+                    help='Number of hypotheses per reference')
+parser.add_argument('-length', type=int, default=25,
+                    help='Average number of tokens per sentence')
+parser.add_argument('-vocab_size', type=int, default=2000,
+                    help='Number of distinct words')
+parser.add_argument('-seed', type=int, default=1234,
+                    help='Random seed')
+
+
+def python_gleu(reference, hypothesis, min_len=1, max_len=4):
+
+    def everygrams(words):
+        return Counter(tuple(words[i:i + n]) for n in range(min_len, max_len + 1) for i in range(len(words) - n + 1))
+
+    hyp_ngrams, ref_ngrams = everygrams(hypothesis), everygrams(reference)
+    tp = sum((hyp_ngrams & ref_ngrams).values())
+    return tp / max(sum(hyp_ngrams.values()), sum(ref_ngrams.values()), 1)
+
+
+def synthetic_nbest(opt):
+    """ References and n-best lists made of edited copies of the references """
+    rng = np.random.RandomState(opt.seed)
+    words = np.array(['w%d' % i for i in range(opt.vocab_size)])
+
+    references = [list(words[rng.randint(0, opt.vocab_size, max(rng.poisson(opt.length), 1))])
+                  for _ in range(opt.n_refs)]
+    hypotheses, hyp_to_ref = list(), list()
+    for r, reference in enumerate(references):
+        for _ in range(opt.n_best):
+            hypothesis = list(reference)
+            for i in rng.randint(0, len(reference), rng.randint(0, 5)):
+                hypothesis[i] = words[rng.randint(opt.vocab_size)]
+            hypotheses.append(hypothesis)
+            hyp_to_ref.append(r)
+
+    return references, hypotheses, np.array(hyp_to_ref)
+
+
+def timed(func):
+
+    start = time.perf_counter()
+    output = func()
+    return output, time.perf_counter() - start
+
+
+def main():
+    opt = parser.parse_args()
+    references, hypotheses, hyp_to_ref = synthetic_nbest(opt)
+    n = len(hypotheses)
+
+    vocab = dict()
+    ref_ids = [[vocab.setdefault(word, len(vocab)) for word in reference] for reference in references]
+    hyp_ids = [[vocab.setdefault(word, len(vocab)) for word in hypothesis] for hypothesis in hypotheses]
+
+    header = "%-6s %14s %14s %9s %14s %9s %12s" % ('metric', 'python hyp/s', 'batch hyp/s', 'speed-up',
+                                                   'ids hyp/s', 'speed-up', 'max diff')
+    print(header)
+    print('-' * len(header))
+
+    for name, python_metric, batch_metric in [
+            ('sbleu', lambda ref, hyp: sentence_bleu(ref, hyp)[0], batch_sentence_bleu),
+            ('gleu', python_gleu, batch_sentence_gleu)]:
+        python_scores, python_time = timed(lambda: [python_metric(references[r], hyp)
+                                                    for r, hyp in zip(hyp_to_ref, hypotheses)])
+        batch_scores, batch_time = timed(lambda: batch_metric(references, hypotheses, hyp_to_ref=hyp_to_ref))
+        ids_scores, ids_time = timed(lambda: batch_metric(ref_ids, hyp_ids, hyp_to_ref=hyp_to_ref))
+
+        max_diff = max(np.abs(np.array(python_scores) - batch_scores).max(),
+                       np.abs(np.array(python_scores) - ids_scores).max())
+        print("%-6s %14.0f %14.0f %8.1fx %14.0f %8.1fx %12.2e" % (name, n / python_time, n / batch_time,
+                                                                python_time / batch_time, n / ids_time,
+                                                                python_time / ids_time, max_diff))
+
+
+if __name__ == "__main__":
+    main()
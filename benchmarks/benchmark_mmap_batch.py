@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Text batch assembly from a memory-mapped dataset (the -data_format mmap training data):
+one read per sample (MMapIndexedDataset.__getitem__ + merge_data) against one gather per batch
+(MMapIndexedDataset.get_batch, used by the Dataset collater).
+
+Reported per batch size:
+    per-sample : milliseconds per batch with the per-sample reads
+    batched    : milliseconds per batch with the batched reads
+    speed-up   : per-sample / batched
+
+Example:
+    python benchmarks/benchmark_mmap_batch.py -batch_sizes 32,128,512
+"""
+from __future__ import division
+
+import os
+import sys
+import time
+import argparse
+import tempfile
+
+import numpy as np
+import torch
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import onmt
+from onmt.data.dataset import IndexedSamples, merge_data
+from onmt.data.mmap_indexed_dataset import MMapIndexedDataset, MMapIndexedDatasetBuilder, \
+    index_file_path, data_file_path
+
+parser = argparse.ArgumentParser(description='benchmark_mmap_batch.py')
+parser.add_argument('-num_samples', type=int, default=200000,
+                    help='Number of sentences in the synthetic dataset')
+parser.add_argument('-max_length', type=int, default=64,
+                    help='Maximum sentence length')
+parser.add_argument('-batch_sizes', default='32,128,512',
+                    help='Comma-separated numbers of sentences per batch')
+parser.add_argument('-num_batches', type=int, default=200,
+                    help='Number of random batches per setting')
+parser.add_argument('-seed', type=int, default=1234,
+                    help='Random seed')
+
+
+def write_dataset(opt, prefix):
+
+    rng = np.random.RandomState(opt.seed)
+    builder = MMapIndexedDatasetBuilder(data_file_path(prefix), dtype=np.int32)
+    for length in rng.randint(1, opt.max_length, opt.num_samples):
+        builder.add_item(rng.randint(4, 32000, length).astype(np.int32))
+    builder.finalize(index_file_path(prefix))
+
+
+def run(batches, assemble):
+
+    start = time.perf_counter()
+    for indices in batches:
+        assemble(indices)
+    return (time.perf_counter() - start) * 1000 / len(batches)
+
+
+def main():
+    opt = parser.parse_args()
+    rng = np.random.RandomState(opt.seed)
+
+    results = list()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        prefix = os.path.join(tmp_dir, 'data')
+        write_dataset(opt, prefix)
+        dataset = MMapIndexedDataset(prefix)
+
+        for batch_size in [int(b) for b in opt.batch_sizes.split(',')]:
+            batches = [rng.randint(0, opt.num_samples, batch_size).tolist() for _ in range(opt.num_batches)]
+
+            per_sample = run(batches, lambda indices: merge_data([dataset[i] for i in indices],
+                                                                 dataname="target"))
+            batched = run(batches, lambda indices: merge_data(IndexedSamples(dataset, indices),
+                                                              dataname="target"))
+            results.append((batch_size, per_sample, batched))
+
+        del dataset
+
+    header = "%5s %11s %9s %9s" % ('batch', 'per-sample', 'batched', 'speed-up')
+    print(header)
+    print('-' * len(header))
+    for batch_size, per_sample, batched in results:
+        print("%5d %9.3fms %7.3fms %8.2fx" % (batch_size, per_sample, batched, per_sample / batched))
+
+
+if __name__ == "__main__":
+    main()
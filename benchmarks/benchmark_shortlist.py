@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Decoding speed with vocabulary shortlists (translate.py -shortlist) against the whole target vocabulary,
+on the same randomly initialized text model.
+
+The lexical table maps every source word to -per_word random target words, the shortlist of a batch is made of
+the translations of its source words and the -first most frequent target words. The checkpoint, the translators
+and the batches are built like in benchmark_decoding.py (every hypothesis runs for -decode_length steps).
+
+Reported per (shortlist, beam size, batch size):
+    words     : size of the shortlist of the batch (the whole vocabulary without shortlist)
+    sents/s   : FastTranslator.translate throughput
+    speed-up  : compared to the whole vocabulary
+
+Example:
+    python benchmarks/benchmark_shortlist.py -vocab_size 32000 -firsts 0,1000 -threads 1
+"""
+from __future__ import division
+
+import os
+import sys
+import io
+import time
+import argparse
+import tempfile
+import contextlib
+
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from benchmark_decoding import save_random_checkpoint, build_translator, synthetic_batch
+from onmt.inference.shortlist import Shortlist
+
+parser = argparse.ArgumentParser(description='benchmark_shortlist.py')
+parser.add_argument('-model', default='transformer',
+                    help='Text model type (value of -model for train.py)')
+parser.add_argument('-firsts', default='100,1000',
+                    help='Comma-separated numbers of frequent target words in the shortlist')
+parser.add_argument('-per_word', type=int, default=50,
+                    help='Number of target words per source word in the lexical table')
+parser.add_argument('-beam_sizes', default='1,4',
+                    help='Comma-separated beam sizes')
+parser.add_argument('-batch_sizes', default='1,16',
+                    help='Comma-separated numbers of sentences per batch')
+parser.add_argument('-layers', type=int, default=3,
+                    help='Number of encoder and decoder layers')
+parser.add_argument('-model_size', type=int, default=512,
+                    help='Size of the hidden states')
+parser.add_argument('-inner_size', type=int, default=2048,
+                    help='Size of the feed-forward layers')
+parser.add_argument('-n_heads', type=int, default=8,
+                    help='Number of attention heads')
+parser.add_argument('-vocab_size', type=int, default=32000,
+                    help='Size of the synthetic source and target vocabularies')
+parser.add_argument('-src_length', type=int, default=25,
+                    help='Number of source tokens per sentence')
+parser.add_argument('-decode_length', type=int, default=25,
+                    help='Number of decoding steps (EOS is only allowed at the last step)')
+parser.add_argument('-repeat', type=int, default=3,
+                    help='Number of timed runs per setting (after one warm-up run). The fastest run is kept.')
+parser.add_argument('-threads', type=int, default=0,
+                    help='Number of CPU threads (0 = torch default)')
+parser.add_argument('-gpu', type=int, default=-1,
+                    help='Device to run on')
+parser.add_argument('-fp16', action='store_true',
+                    help='Use half precision (GPU only)')
+parser.add_argument('-seed', type=int, default=1234,
+                    help='Random seed')
+
+
+def write_lexical_table(opt, translator, path):
+
+    generator = torch.Generator().manual_seed(opt.seed)
+    src_dict, tgt_dict = translator.src_dict, translator.tgt_dict
+    with open(path, 'w', encoding='utf-8') as f:
+        for i in range(4, src_dict.size()):
+            targets = torch.randint(4, tgt_dict.size(), (opt.per_word,), generator=generator).tolist()
+            for j in targets:
+                f.write("%s %s 1.0\n" % (src_dict.getLabel(i), tgt_dict.getLabel(j)))
+
+
+def run(opt, translator, src_data, sync):
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        # warm-up
+        translator.translate(src_data, None)
+
+        best = None
+        for _ in range(opt.repeat):
+            sync()
+            start = time.perf_counter()
+            translator.translate(src_data, None)
+            sync()
+            total = time.perf_counter() - start
+            best = total if best is None else min(best, total)
+
+    return len(src_data) / best
+
+
+def main():
+    opt = parser.parse_args()
+
+    if opt.threads > 0:
+        torch.set_num_threads(opt.threads)
+
+    cuda = opt.gpu >= 0
+    if cuda:
+        torch.cuda.set_device(opt.gpu)
+    sync = torch.cuda.synchronize if cuda else (lambda: None)
+
+    beam_sizes = [int(b) for b in opt.beam_sizes.split(',')]
+    batch_sizes = [int(b) for b in opt.batch_sizes.split(',')]
+    firsts = [int(n) for n in opt.firsts.split(',')]
+
+    results = list()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        checkpoint_path = os.path.join(tmp_dir, opt.model + '.pt')
+        lexical_table = os.path.join(tmp_dir, 'lex.txt')
+        torch.manual_seed(opt.seed)
+        with contextlib.redirect_stdout(io.StringIO()):
+            save_random_checkpoint(opt, opt.model, checkpoint_path)
+
+        for beam_size in beam_sizes:
+            for batch_size in batch_sizes:
+                translator = build_translator(opt, checkpoint_path, opt.model, beam_size, batch_size)
+                if not os.path.exists(lexical_table):
+                    write_lexical_table(opt, translator, lexical_table)
+                generator = torch.Generator().manual_seed(opt.seed)
+                src_data, _ = synthetic_batch(opt, translator, opt.model, batch_size, generator)
+
+                full = run(opt, translator, src_data, sync)
+                results.append(('none', beam_size, batch_size, translator.tgt_dict.size(), full, 1.0))
+
+                for first in firsts:
+                    # the same as translate.py -shortlist lex.txt -shortlist_first N
+                    translator.shortlist = Shortlist(translator.tgt_dict, path=lexical_table,
+                                                     src_dict=translator.src_dict, first=first,
+                                                     per_word=opt.per_word,
+                                                     always=[translator.tgt_pad, translator.tgt_unk,
+                                                             translator.tgt_eos])
+                    words = translator.shortlist(translator.build_data(src_data, None).get_batch(0)
+                                                 .get('source')).numel()
+                    speed = run(opt, translator, src_data, sync)
+                    results.append(('first %d' % first, beam_size, batch_size, words, speed, speed / full))
+
+                print("Done: beam %d batch %d" % (beam_size, batch_size), file=sys.stderr)
+
+    header = "%-12s %4s %5s %8s %9s %9s" % ('shortlist', 'beam', 'batch', 'words', 'sents/s', 'speed-up')
+    print(header)
+    print('-' * len(header))
+    for name, beam_size, batch_size, words, speed, speed_up in results:
+        print("%-12s %4d %5d %8d %9.2f %8.2fx" % (name, beam_size, batch_size, words, speed, speed_up))
+
+
+if __name__ == "__main__":
+    main()
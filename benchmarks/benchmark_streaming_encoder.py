@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Real-time factor and per-chunk latency of the chunk-wise (streaming) speech encoder
+compared to the full-utterance encoder. A randomly initialized model is used.
+
+Example:
+    python benchmarks/benchmark_streaming_encoder.py -layers 12 -model_size 512 -chunk_size 16 -chunk_right_context 4
+"""
+from __future__ import division
+
+import os
+import sys
+import time
+import argparse
+import torch
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import onmt
+import options
+from onmt.model_factory import build_model
+
+parser = argparse.ArgumentParser(description='benchmark_streaming_encoder.py')
+parser.add_argument('-model', default='speech_transformer',
+                    help='Model type (speech_transformer, hybrid_transformer)')
+parser.add_argument('-layers', type=int, default=12,
+                    help='Number of encoder layers')
+parser.add_argument('-model_size', type=int, default=512,
+                    help='Size of the hidden states')
+parser.add_argument('-inner_size', type=int, default=2048,
+                    help='Size of the feed-forward layers')
+parser.add_argument('-n_heads', type=int, default=8,
+                    help='Number of attention heads')
+parser.add_argument('-input_size', type=int, default=40,
+                    help='Size of the input features (before concatenation)')
+parser.add_argument('-concat', type=int, default=4,
+                    help='Number of concatenated feature frames per encoder frame')
+parser.add_argument('-frame_shift', type=float, default=10.0,
+                    help='Shift of the input feature frames in milliseconds')
+parser.add_argument('-learnable_position_encoding', action='store_true',
+                    help='Use learnable relative positions')
+parser.add_argument('-length', type=int, default=500,
+                    help='Number of encoder frames of the utterance')
+parser.add_argument('-batch_size', type=int, default=1,
+                    help='Number of utterances encoded together')
+parser.add_argument('-chunk_size', type=int, default=16,
+                    help='Number of encoder frames per chunk')
+parser.add_argument('-chunk_left_context', type=int, default=-1,
+                    help='Number of cached frames before each chunk (-1 = all)')
+parser.add_argument('-chunk_right_context', type=int, default=0,
+                    help='Number of look-ahead frames after each chunk')
+parser.add_argument('-repeat', type=int, default=5,
+                    help='Number of timed runs (after one warm-up run)')
+parser.add_argument('-threads', type=int, default=0,
+                    help='Number of CPU threads (0 = torch default)')
+parser.add_argument('-gpu', type=int, default=-1,
+                    help='Device to run on')
+parser.add_argument('-fp16', action='store_true',
+                    help='Use half precision (GPU only)')
+parser.add_argument('-seed', type=int, default=1234,
+                    help='Random seed')
+
+
+def build_encoder(opt):
+
+    model_parser = options.make_parser(argparse.ArgumentParser())
+    model_args = ['-data', 'none', '-model', opt.model, '-encoder_type', 'audio',
+                  '-layers', str(opt.layers), '-model_size', str(opt.model_size),
+                  '-inner_size', str(opt.inner_size), '-n_heads', str(opt.n_heads),
+                  '-input_size', str(opt.input_size * opt.concat)]
+    if opt.learnable_position_encoding:
+        model_args += ['-learnable_position_encoding']
+    model_opt = options.backward_compatible(model_parser.parse_args(model_args))
+
+    dicts = dict()
+    dicts['tgt'] = onmt.Dict([onmt.constants.PAD_WORD, onmt.constants.UNK_WORD,
+                              onmt.constants.BOS_WORD, onmt.constants.EOS_WORD], lower=False)
+    dicts['langs'] = {'src': 0, 'tgt': 1}
+
+    model = build_model(model_opt, dicts)
+    model.eval()
+
+    return model.encoder
+
+
+class ChunkTimer(object):
+    """
+    Time between entering the first layer and leaving the last layer, which is once per chunk
+    """
+
+    def __init__(self, encoder, sync):
+        self.sync = sync
+        self.start = 0
+        self.latencies = list()
+        self.handles = [encoder.layer_modules[0].register_forward_pre_hook(self.enter),
+                        encoder.layer_modules[-1].register_forward_hook(self.leave)]
+
+    def enter(self, module, inputs):
+        self.sync()
+        self.start = time.perf_counter()
+
+    def leave(self, module, inputs, outputs):
+        self.sync()
+        self.latencies.append(time.perf_counter() - self.start)
+
+    def remove(self):
+        for handle in self.handles:
+            handle.remove()
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(int(q / 100.0 * len(values)), len(values) - 1)]
+
+
+def run(encoder, src, src_lengths, repeat, sync):
+    # warm-up
+    encoder(src, src_lengths=src_lengths)
+
+    timings = list()
+    for _ in range(repeat):
+        sync()
+        start = time.perf_counter()
+        encoder(src, src_lengths=src_lengths)
+        sync()
+        timings.append(time.perf_counter() - start)
+
+    return min(timings)
+
+
+def main():
+    opt = parser.parse_args()
+    torch.manual_seed(opt.seed)
+
+    if opt.threads > 0:
+        torch.set_num_threads(opt.threads)
+
+    cuda = opt.gpu >= 0
+    if cuda:
+        torch.cuda.set_device(opt.gpu)
+    sync = torch.cuda.synchronize if cuda else (lambda: None)
+
+    encoder = build_encoder(opt)
+
+    src = torch.randn(opt.batch_size, opt.length, opt.input_size * opt.concat)
+    src_lengths = torch.full((opt.batch_size,), opt.length, dtype=torch.long)
+
+    if cuda:
+        encoder = encoder.cuda()
+        src = src.cuda()
+    if opt.fp16:
+        encoder = encoder.half()
+        src = src.half()
+
+    frame_duration = opt.frame_shift * opt.concat / 1000.0
+    audio_duration = opt.length * frame_duration * opt.batch_size
+
+    with torch.no_grad():
+        encoder.set_chunk_mode(0)
+        full_time = run(encoder, src, src_lengths, opt.repeat, sync)
+
+        encoder.set_chunk_mode(opt.chunk_size, opt.chunk_left_context, opt.chunk_right_context)
+        chunk_time = run(encoder, src, src_lengths, opt.repeat, sync)
+
+        timer = ChunkTimer(encoder, sync)
+        encoder(src, src_lengths=src_lengths)
+        timer.remove()
+
+    latencies = timer.latencies
+    # the encoder has to wait for the chunk and its look-ahead before processing
+    algorithmic_latency = (opt.chunk_size + opt.chunk_right_context) * frame_duration
+
+    print("Audio: %d utterance(s) x %d frames (%.2f seconds)" % (opt.batch_size, opt.length, audio_duration))
+    print("Full utterance    : %.4f s  RTF %.4f" % (full_time, full_time / audio_duration))
+    print("Chunk-wise        : %.4f s  RTF %.4f  (%d chunks of %d frames, left %d, right %d)"
+          % (chunk_time, chunk_time / audio_duration, len(latencies), opt.chunk_size,
+             opt.chunk_left_context, opt.chunk_right_context))
+    print("Per-chunk compute : mean %.2f ms  p50 %.2f ms  p95 %.2f ms  max %.2f ms"
+          % (1000 * sum(latencies) / len(latencies), 1000 * percentile(latencies, 50),
+             1000 * percentile(latencies, 95), 1000 * max(latencies)))
+    print("Algorithmic latency (chunk + look-ahead): %.2f ms" % (1000 * algorithmic_latency))
+    print("Expected latency per chunk (algorithmic + p95 compute): %.2f ms"
+          % (1000 * (algorithmic_latency + percentile(latencies, 95))))
+
+
+if __name__ == "__main__":
+    main()
@@ -53,7 +53,7 @@ class SpeechBinarizer:
 
         if output_format == 'scp':
             assert input_format in ['kaldi', 'scp']
-        if output_format == 'wav':
+        if output_format in ['wav', 'wavmem']:
             input_format = 'wav'
 
         # audio_data = iter(ReadHelper('scp:' + filename))
@@ -128,7 +128,8 @@ dataset (~torch.utils.data.Dataset)
 class DataIterator(EpochBatchIterating):
 
     def __init__(self, dataset, collate_fn, batch_sampler, seed=1, num_workers=0,
-                 epoch=1, buffer_size=0, timeout=0, num_shards=1, shard_id=0, fill_value=None):
+                 epoch=1, buffer_size=0, timeout=0, num_shards=1, shard_id=0, fill_value=None,
+                 pad_shards=True, shard_balance='none'):
         """
         :param dataset:
         :param collate_fn:
@@ -140,6 +141,12 @@ class DataIterator(EpochBatchIterating):
         :param timeout:
         :param shard_id: equivalent with rank
         :param num_shards: equivalent with world size
+        :param pad_shards: pad the shards to the same length by repeating the first mini-batch
+                           (training needs the same number of steps on every rank). When False, every
+                           mini-batch is visited exactly once over all shards (for evaluation)
+        :param shard_balance: none: the shards take the mini-batches round-robin. tokens / padded: the shards
+                              get mini-batches of similar cost (number of tokens / padded area) at every step
+                              (see BalancedShardedIterator)
         """
         assert isinstance(dataset, torch.utils.data.Dataset)
 
@@ -160,6 +167,13 @@ class DataIterator(EpochBatchIterating):
         self._next_epoch_itr = None
         self._support_prefetch = False
         self.fill_value = fill_value
+        self.pad_shards = pad_shards
+
+        self.shard_balance = shard_balance
+        if shard_balance != 'none' and num_shards > 1:
+            self.batch_costs = dataset.batch_costs(self.frozen_batches, padded=shard_balance == 'padded')
+        else:
+            self.batch_costs = None
 
     def __len__(self):
         # number of minibatches, or ???
@@ -208,17 +222,33 @@ class DataIterator(EpochBatchIterating):
         return 0
 
     def state_dict(self):
-        """Returns a dictionary containing a whole state of the iterator."""
+        """Returns a dictionary containing a whole state of the iterator.
+        The batch order of an epoch is a function of (seed, epoch, shuffle, sharding),
+        so together with the number of consumed batches it determines the rest of the epoch."""
         return {
             'epoch': self.epoch,
             'iterations_in_epoch': self.iterations_in_epoch,
             'shuffle': self.shuffle,
+            'seed': self.seed,
+            'num_shards': self.num_shards,
+            'shard_balance': self.shard_balance,
+            # all the batches of the epoch are consumed (e.g. saved after the last batch)
+            'end_of_epoch': self._cur_epoch_itr is not None and self.end_of_epoch(),
         }
 
-    def load_state_dict(self, state_dict):
-        """Copies the state of the iterator from the given *state_dict*."""
+    def load_state_dict(self, state_dict, pin_memory=False):
+        """Copies the state of the iterator from the given *state_dict*.
+        The next epoch iterator starts directly at the first unconsumed batch (the skipped batches are not loaded)."""
         if state_dict is not None:
             self.epoch = state_dict['epoch']
+            # the shuffled order depends on the seed
+            self.seed = state_dict.get('seed', self.seed)
+            if state_dict.get('num_shards', self.num_shards) != self.num_shards:
+                print("[WARNING] Resuming with %d instead of %d data shards: the batch order of the current "
+                      "epoch is not the same" % (self.num_shards, state_dict['num_shards']))
+            if state_dict.get('shard_balance', 'none') != self.shard_balance:
+                print("[WARNING] Resuming with -shard_balance %s instead of %s: the batch order of the current "
+                      "epoch is not the same" % (self.shard_balance, state_dict.get('shard_balance', 'none')))
             itr_pos = state_dict.get('iterations_in_epoch', 0)
             if itr_pos > 0:
                 # fast-forward epoch iterator
@@ -226,6 +256,7 @@ class DataIterator(EpochBatchIterating):
                     self.epoch,
                     shuffle=state_dict.get('shuffle', True),
                     offset=itr_pos,
+                    pin_memory=pin_memory
                 )
                 if self._next_epoch_itr is None:
                     # we finished the epoch, increment epoch counter
@@ -237,32 +268,55 @@ class DataIterator(EpochBatchIterating):
             itr_pos = 0
             self._next_epoch_itr = None
 
-    def _get_iterator_for_epoch(self, epoch, shuffle, offset=0, pin_memory=False):
-
+    def get_batches_for_epoch(self, epoch, shuffle, *addl_seeds):
+        """
+        :param epoch: the shuffled order of the mini-batches only depends on the seed and the epoch
+        :param shuffle: bool
+        :param addl_seeds: additional seeds for another order in the same epoch
+        :return: the list of mini-batches (lists of sample indices) of this shard, and whether it is empty
+        """
         def shuffle_batches(batches_, seed):
-            with data_utils.numpy_seed(seed):
+            with data_utils.numpy_seed(seed, *addl_seeds):
                 np.random.shuffle(batches_)
 
             return batches_
 
-        if self._support_prefetch:
-            raise NotImplementedError
-
+        # the shuffled positions of the mini-batches (the same order as shuffling the mini-batches themselves)
+        order = list(range(len(self.frozen_batches)))
         if shuffle:
-            batches = shuffle_batches(list(self.frozen_batches), self.seed + epoch)
-        else:
-            batches = self.frozen_batches
+            order = shuffle_batches(order, self.seed + epoch)
+        batches = [self.frozen_batches[i] for i in order]
 
         num_shards = self.num_shards
-        batches = list(ShardedIterator(batches, num_shards, self.shard_id, fill_value=batches[0]))
+        fill_value = batches[0] if self.pad_shards else None
+        if self.batch_costs is not None:
+            # the groups of similar mini-batches are shuffled with the seed of the epoch as well
+            with data_utils.numpy_seed(self.seed + epoch if shuffle else None, *addl_seeds):
+                batches = list(BalancedShardedIterator(batches, self.batch_costs[order], num_shards, self.shard_id,
+                                                       fill_value=fill_value, shuffle=shuffle))
+        else:
+            batches = list(ShardedIterator(batches, num_shards, self.shard_id, fill_value=fill_value))
+
+        if not self.pad_shards:
+            # the shards differ by at most one mini-batch
+            batches = [b for b in batches if b is not None]
 
         # catch the exception when the data is so small that one iterator is completely empty
-        if batches[0] is None:
+        if len(batches) == 0 or batches[0] is None:
             empty = True
             print("This iterator is empty")
         else:
             empty = False
 
+        return batches, empty
+
+    def _get_iterator_for_epoch(self, epoch, shuffle, offset=0, pin_memory=False):
+
+        if self._support_prefetch:
+            raise NotImplementedError
+
+        batches, empty = self.get_batches_for_epoch(epoch, shuffle)
+
         if offset > 0 and offset >= len(batches):
             return None
 
@@ -327,6 +381,57 @@ class ShardedIterator(CountingIterator):
         )
 
 
+class BalancedShardedIterator(CountingIterator):
+    """A sharded wrapper around a list of mini-batches, which balances the cost of the mini-batches
+    that the shards process at the same step (all shards wait for the slowest one at every all-reduce).
+    The mini-batches are sorted by cost and cut into groups of *num_shards* consecutive ones, the groups
+    are shuffled (except the last incomplete one), and the mini-batches of a group go to the shards
+    with the smallest total cost so far (the most expensive one to the least loaded shard).
+    The result only depends on the order of the input and the state of the numpy PRNG, so every shard
+    computes the same assignment.
+    Args:
+        iterable (list): mini-batches to split
+        costs (list): estimated cost of each mini-batch
+        num_shards (int): number of shards to split the iterable into
+        shard_id (int): which shard to iterator over
+        fill_value (Any, optional): padding value when the iterable doesn't
+            evenly divide *num_shards* (default: None).
+        shuffle (bool): shuffle the groups with the numpy PRNG
+    Attributes:
+        n (int): number of elements consumed from this iterator
+    """
+
+    def __init__(self, iterable, costs, num_shards, shard_id, fill_value=None, shuffle=True):
+
+        if shard_id < 0 or shard_id >= num_shards:
+            raise ValueError('shard_id must be between 0 and num_shards')
+        sharded_len = int(math.ceil(len(iterable) / float(num_shards)))
+
+        costs = np.asarray(costs)
+        # stable sort: the mini-batches with the same cost stay in the (shuffled) input order
+        by_cost = np.argsort(costs, kind='stable')
+        groups = [by_cost[i:i + num_shards] for i in range(0, len(by_cost), num_shards)]
+        if shuffle:
+            complete = len(iterable) // num_shards
+            groups = [groups[i] for i in np.random.permutation(complete)] + groups[complete:]
+
+        loads = np.zeros(num_shards, dtype=np.float64)
+        shard = list()
+        for group in groups:
+            # the most expensive mini-batches first, to the least loaded shards (the smallest id on ties)
+            group = group[np.argsort(-costs[group], kind='stable')]
+            shards = np.argsort(loads, kind='stable')[:len(group)]
+            loads[shards] += costs[group]
+            selected = group[shards == shard_id]
+            shard.append(iterable[selected[0]] if len(selected) > 0 else fill_value)
+
+        super().__init__(
+            shard,
+            start=int(math.ceil(getattr(iterable, 'n', 0) / float(num_shards))),
+            total=sharded_len,
+        )
+
+
 class BackgroundConsumer(Thread):
     def __init__(self, queue, source, max_len):
         Thread.__init__(self)
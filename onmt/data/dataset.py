@@ -5,7 +5,7 @@ import torch
 import torch.utils.data
 from collections import defaultdict
 import onmt
-from onmt.speech.Augmenter import Augmenter
+from onmt.speech.Augmenter import BatchAugmenter
 from onmt.modules.dropout import switchout
 import numpy as np
 from .batch_utils import allocate_batch
@@ -18,6 +18,20 @@ Two basic classes:
 """
 
 
+class IndexedSamples(object):
+    """
+    The text samples of a mini-batch before reading: the dataset (which supports batch fetching,
+    e.g. MMapIndexedDataset) and the indices. merge_data gathers them directly into the padded tensor.
+    """
+
+    def __init__(self, dataset, indices):
+        self.dataset = dataset
+        self.indices = indices
+
+    def __len__(self):
+        return len(self.indices)
+
+
 def merge_data(data, align_right=False, type='text', augmenter=None, upsampling=False,
                feature_size=40, dataname="source", wav_preprocessor=None):
     """
@@ -25,8 +39,8 @@ def merge_data(data, align_right=False, type='text', augmenter=None, upsampling=
             :param dataname:
             :param feature_size:
             :param upsampling:
-            :param data: the list of sequences
-            :param align_right: aligning the sequences w.r.t padding
+            :param data: the list of sequences (or IndexedSamples for text)
+            :param align_right: aligning the sequences w.r.t padding (text only, audio is always left-aligned)
             :param type: text or audio
             :param augmenter: for augmentation in audio models
             :return:
@@ -34,19 +48,25 @@ def merge_data(data, align_right=False, type='text', augmenter=None, upsampling=
     # initialize with batch_size * length
     # TODO: rewrite this function in Cython
     if type == "text":
+        if dataname == "source":
+            pad = onmt.constants.SRC_PAD
+        elif dataname == "target":
+            pad = onmt.constants.TGT_PAD
+        else:
+            print("Warning: check the dataname")
+            exit(-1)
+
+        if isinstance(data, IndexedSamples):
+            tensor, lengths = data.dataset.get_batch(data.indices, pad, align_right=align_right)
+            return tensor, None, lengths
+
         lengths = [x.size(0) for x in data]
         # positions = [torch.arange(length_) for length_ in lengths]
         max_length = max(lengths)
         # if max_length > 8:
         #     max_length = math.ceil(max_length / 8) * 8
 
-        if dataname == "source":
-            tensor = data[0].new(len(data), max_length).fill_(onmt.constants.SRC_PAD)
-        elif dataname == "target":
-            tensor = data[0].new(len(data), max_length).fill_(onmt.constants.TGT_PAD)
-        else:
-            print("Warning: check the dataname")
-            exit(-1)
+        tensor = data[0].new(len(data), max_length).fill_(pad)
         pos = None
 
         for i in range(len(data)):
@@ -66,7 +86,7 @@ def merge_data(data, align_right=False, type='text', augmenter=None, upsampling=
         for i in range(len(data)):
             sample = data[i]
 
-            if augmenter is not None:
+            if augmenter is not None and not augmenter.batched:
                 sample = augmenter.augment(sample)
 
             if upsampling:
@@ -84,18 +104,19 @@ def merge_data(data, align_right=False, type='text', augmenter=None, upsampling=
         feature_size = samples[0].size(1)
         batch_size = len(data)
 
-        # feature size + 1 because the last dimension is created for padding
-        tensor = data[0].float().new(batch_size, max_length, feature_size + 1).fill_(onmt.constants.PAD)
+        # the audio is always left-aligned and the padding mask is built from the lengths in the models
+        # (see onmt.utils.lengths_to_padding_mask)
+        tensor = data[0].float().new_zeros(batch_size, max_length, feature_size)
 
         for i in range(len(samples)):
             sample = samples[i]
 
             data_length = sample.size(0)
-            offset = max_length - data_length if align_right else 0
+            tensor[i].narrow(0, 0, data_length).copy_(sample)
 
-            tensor[i].narrow(0, offset, data_length).narrow(1, 1, sample.size(1)).copy_(sample)
-            # in padding dimension: 1 is not padded, 0 is padded
-            tensor[i].narrow(0, offset, data_length).narrow(1, 0, 1).fill_(1)
+        # the batch augmenter masks the padded batch at once (unless it is done on the GPU by the trainer)
+        if augmenter is not None and augmenter.batched and not augmenter.on_device:
+            tensor = augmenter.augment_batch(tensor, torch.LongTensor(lengths))
 
         return tensor, None, lengths
     elif type == 'wav':
@@ -107,20 +128,14 @@ def merge_data(data, align_right=False, type='text', augmenter=None, upsampling=
         assert feature_size == 1, "expecting feature size = 1 but get %2.f" % feature_size
         batch_size = len(data)
 
-        # feature size + 1 because the last dimension is created for padding
-        tensor = data[0].float().new(batch_size, max_length, feature_size + 1).fill_(0)
+        # left-aligned without the padding channel (same as the audio features)
+        tensor = data[0].float().new_zeros(batch_size, max_length, feature_size)
 
         for i in range(len(samples)):
             sample = samples[i]
 
-            # normalize
             data_length = sample.size(0)
-            offset = max_length - data_length if align_right else 0
-
-            channels = 1
-            tensor[i].narrow(0, offset, data_length).narrow(1, 1, channels).copy_(sample)
-            # in padding dimension: 1 is not padded, 0 is padded
-            tensor[i].narrow(0, offset, data_length).narrow(1, 0, 1).fill_(1)
+            tensor[i].narrow(0, 0, data_length).copy_(sample.view(data_length, feature_size))
 
         return tensor, None, lengths
 
@@ -156,7 +171,7 @@ def collect_fn(src_data, tgt_data,
         tensors['target_output'] = target_full[1:]
         if target_pos is not None:
             tensors['target_pos'] = target_pos.t().contiguous()[:-1]
-        tgt_size = sum([len(x) - 1 for x in tgt_data])
+        tgt_size = sum(tgt_lengths) - len(tgt_lengths)
         tensors['tgt_lengths'] = tgt_lengths
     else:
         tgt_size = 0
@@ -240,6 +255,44 @@ class Batch(object):
             else:
                 continue
 
+    def split(self, num_splits):
+        """
+        Split the minibatch along the batch dimension into micro-batches (for gradient accumulation).
+        The sequences of a minibatch have similar lengths, so the padding is kept as it is.
+        :param num_splits: number of micro-batches (at most the number of sequences)
+        :return: list of Batch
+        """
+        size = self.size
+        num_splits = min(num_splits, size)
+        if num_splits <= 1:
+            return [self]
+
+        bounds = [size * k // num_splits for k in range(num_splits + 1)]
+        batches = list()
+
+        for start, end in zip(bounds[:-1], bounds[1:]):
+            tensors = dict()
+            for key, value in self.tensors.items():
+                if key != 'vocab_mask' and isinstance(value, torch.Tensor) and value.dim() >= 2:
+                    # the data tensors are T x B (x F)
+                    value = value[:, start:end].contiguous()
+                elif key != 'vocab_mask' and isinstance(value, (torch.Tensor, list)) and len(value) == size:
+                    # the lengths and the languages (unless one language for the whole minibatch)
+                    value = value[start:end]
+                tensors[key] = value
+
+            tensors['size'] = end - start
+            if tensors.get('src_lengths', None) is not None:
+                tensors['src_size'] = int(sum(tensors['src_lengths']))
+            if tensors.get('tgt_lengths', None) is not None:
+                tensors['tgt_size'] = int(sum(tensors['tgt_lengths'])) - len(tensors['tgt_lengths'])
+            if tensors.get('past_src_lengths', None) is not None:
+                tensors['past_src_size'] = int(sum(tensors['past_src_lengths']))
+
+            batches.append(Batch(tensors))
+
+        return batches
+
     def switchout(self, swrate, src_vocab_size, tgt_vocab_size):
         # Switch out function ... currently works with only source text data
         # if self.src_type == 'text':
@@ -258,12 +311,10 @@ class Batch(object):
     # For later reconstruction
     def mask_mpc(self, p=0.5):
 
-        # the audio has size [T x B x (F+1)] the FIRST dimension is padding
+        # the audio has size [T x B x F]
         # need to sample a mask
         source = self.tensors['source']
         with torch.no_grad():
-            source = source.narrow(2, 1, source.size(2) - 1)
-
             # p drop -> 1 - p keeping probability
             masked_positions = source.new(source.size(0), source.size(1)).bernoulli_(1 - p)
             self.tensors['original_source'] = source.clone()
@@ -311,7 +362,7 @@ class Dataset(torch.utils.data.Dataset):
                  src_align_right=False, tgt_align_right=False,
                  verbose=False, cleaning=False, debug=False,
                  num_split=1,
-                 sa_f=8, sa_t=64,
+                 sa_f=8, sa_t=64, sa_input_size=None,
                  past_src_data=None,
                  past_src_data_sizes=None,
                  **kwargs):
@@ -326,6 +377,8 @@ class Dataset(torch.utils.data.Dataset):
         :param multiplier: The number of sequences must divide by this number (for fp16 when multiplier=8)
         :param reshape_speech: Put N frames together to reduce the length (this might be done already in preprocessing)
         :param augment: Speech Augmentation (currently only spec augmentation is implemented)
+        :param sa_input_size: number of features per frame for the frequency masks of the augmentation
+                              (None: the feature size of the source data, i.e. stacked frames as one frame)
         """
 
         """
@@ -373,6 +426,10 @@ class Dataset(torch.utils.data.Dataset):
         else:
             self.tgt = None
 
+        # text samples in a memory map are read batch by batch in the collater (see IndexedSamples)
+        self.src_batch_fetch = self._type == 'text' and getattr(self.src, 'supports_batch_fetch', False)
+        self.tgt_batch_fetch = getattr(self.tgt, 'supports_batch_fetch', False)
+
         self.order = np.arange(len(self.src))
 
         # Processing data sizes
@@ -468,7 +525,15 @@ class Dataset(torch.utils.data.Dataset):
         self.batchOrder = None
 
         if augment:
-            self.augmenter = Augmenter(F=sa_f, T=sa_t)
+            sample = self.src[0] if self.src is not None and len(self.src) > 0 else None
+            feature_size = sample.size(-1) if sample is not None and sample.dim() > 1 else None
+            if feature_size is not None and (sa_input_size is None or feature_size % sa_input_size != 0):
+                if sa_input_size is not None:
+                    print("[WARNING] The source features (%d) are not frames of %d features, "
+                          "the frequency masks cover all the features" % (feature_size, sa_input_size))
+                sa_input_size = feature_size
+            augmenter_options = {'input_size': sa_input_size} if sa_input_size is not None else {}
+            self.augmenter = BatchAugmenter(F=sa_f, T=sa_t, **augmenter_options)
         else:
             self.augmenter = None
 
@@ -482,7 +547,8 @@ class Dataset(torch.utils.data.Dataset):
 
     def set_epoch(self, epoch):
 
-        pass
+        if self.augmenter is not None:
+            self.augmenter.set_epoch(epoch)
 
     def set_mask(self, vocab_mask):
         self.vocab_mask = vocab_mask
@@ -491,6 +557,27 @@ class Dataset(torch.utils.data.Dataset):
 
         return self.get_batch(self.largest_batch_id)
 
+    def batch_costs(self, batches=None, padded=False):
+        """
+        Estimate the computation cost of mini-batches (to balance them over the GPUs)
+        :param batches: list of mini-batches (lists of sample indices), default: all mini-batches of the dataset
+        :param padded: the padded area (number of sequences x longest source and target) instead of
+                       the number of source and target tokens
+        :return: numpy array with one cost per mini-batch
+        """
+        if batches is None:
+            batches = self.batches
+
+        costs = np.zeros(len(batches), dtype=np.int64)
+        for sizes in [self.src_sizes, self.tgt_sizes]:
+            if sizes is None:
+                continue
+            for i, batch in enumerate(batches):
+                batch_sizes = sizes[batch]
+                costs[i] += batch_sizes.max() * len(batch) if padded else batch_sizes.sum()
+
+        return costs
+
     def __len__(self):
         return self.num_batches
 
@@ -517,8 +604,9 @@ class Dataset(torch.utils.data.Dataset):
             past_src = None
 
         sample = {
-            'src': self.src[index] if self.src is not None else None,
-            'tgt': self.tgt[index] if self.tgt is not None else None,
+            'index': index,
+            'src': self.src[index] if self.src is not None and not self.src_batch_fetch else None,
+            'tgt': self.tgt[index] if self.tgt is not None and not self.tgt_batch_fetch else None,
             'src_lang': src_lang,
             'tgt_lang': tgt_lang,
             'past_src': past_src
@@ -536,12 +624,16 @@ class Dataset(torch.utils.data.Dataset):
         assert index < self.num_batches, "%d > %d" % (index, self.num_batches)
 
         batch_ids = self.batches[index]
-        if self.src:
+        if self.src_batch_fetch:
+            src_data = IndexedSamples(self.src, batch_ids)
+        elif self.src:
             src_data = [self.src[i] for i in batch_ids]
         else:
             src_data = None
 
-        if self.tgt:
+        if self.tgt_batch_fetch:
+            tgt_data = IndexedSamples(self.tgt, batch_ids)
+        elif self.tgt:
             tgt_data = [self.tgt[i] for i in batch_ids]
         else:
             tgt_data = None
@@ -593,10 +685,14 @@ class Dataset(torch.utils.data.Dataset):
             src_lang_data, tgt_lang_data = None, None
             past_src_data = None
 
-            if self.src:
+            if self.src_batch_fetch:
+                src_data = IndexedSamples(self.src, [sample['index'] for sample in samples])
+            elif self.src:
                 src_data = [sample['src'] for sample in samples]
 
-            if self.tgt:
+            if self.tgt_batch_fetch:
+                tgt_data = IndexedSamples(self.tgt, [sample['index'] for sample in samples])
+            elif self.tgt:
                 tgt_data = [sample['tgt'] for sample in samples]
 
             if self.bilingual:
@@ -23,7 +23,7 @@ dtypes = {
     3: np.int16,
     4: np.int32,
     5: np.int64,
-    6: np.float,
+    6: float,
     7: np.double,
     8: np.uint16
 }
@@ -134,6 +134,10 @@ class MMapIndexedDataset(torch.utils.data.Dataset):
         def sizes(self):
             return self._sizes
 
+        @property
+        def pointers(self):
+            return self._pointers
+
         @lru_cache(maxsize=8)
         def __getitem__(self, i):
             return self._pointers[i], self._sizes[i]
@@ -163,9 +167,12 @@ class MMapIndexedDataset(torch.utils.data.Dataset):
         _warmup_mmap_file(data_file_path(self._path))
         self._bin_buffer_mmap = np.memmap(data_file_path(self._path), mode='r', order='C')
         self._bin_buffer = memoryview(self._bin_buffer_mmap)
+        # the whole data file as one flat array (no copy)
+        self._data = np.frombuffer(self._bin_buffer, dtype=self._index.dtype)
 
     def __del__(self):
         self._bin_buffer_mmap._mmap.close()
+        del self._data
         del self._bin_buffer_mmap
         del self._index
 
@@ -183,6 +190,30 @@ class MMapIndexedDataset(torch.utils.data.Dataset):
         # to avoid the warning
         return torch.from_numpy(np.array(np_array))
 
+    def get_batch(self, indices, pad, align_right=False):
+        """
+        Gather 1D samples (e.g. text) straight from the memory map into one padded tensor
+        :param indices: list of sample indices
+        :param pad: padding value
+        :param align_right: aligning the samples w.r.t padding (the padding is on the left side)
+        :return: LongTensor [len(indices) x max_length], list of lengths
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        sizes = self._index.sizes[indices].astype(np.int64)
+        starts = self._index.pointers[indices] // self._index.dtype().itemsize
+        max_length = int(sizes.max())
+
+        columns = np.arange(max_length)
+        shifts = max_length - sizes if align_right else np.zeros_like(sizes)
+        mask = (columns >= shifts[:, None]) & (columns < (shifts + sizes)[:, None])
+        positions = starts[:, None] + columns - shifts[:, None]
+
+        tensor = torch.full((len(indices), max_length), pad, dtype=torch.long)
+        # a single gather for the whole batch, which also converts the dtype
+        tensor.numpy()[mask] = self._data[positions[mask]]
+
+        return tensor, sizes.tolist()
+
     @property
     def sizes(self):
         return self._index.sizes
@@ -191,6 +222,10 @@ class MMapIndexedDataset(torch.utils.data.Dataset):
     def supports_prefetch(self):
         return False
 
+    @property
+    def supports_batch_fetch(self):
+        return True
+
     @staticmethod
     def exists(path):
         return (
@@ -6,118 +6,149 @@ import os
 import queue
 import time
 from threading import Thread
-from .data_iterator import EpochBatchIterating, DataIterator
+from .data_iterator import EpochBatchIterating, DataIterator, CountingIterator, BufferedIterator
+from onmt.data import data_utils
 
 import numpy as np
 import torch
 
 
-class MultiEpochIterator(object):
-    # this class stores N epoch iterators for N datasets
-    # init is called at the beginning of the epoch
+def sample_dataset_order(sizes, seed, epoch, temperature=1.0, round_robin=False):
+    """
+    Decides from which dataset each mini-batch of the epoch is taken
+    :param sizes: number of mini-batches of each dataset
+    :param seed: the order only depends on the seed and the epoch (and the sizes)
+    :param epoch:
+    :param temperature: 1.0: each mini-batch is used once, the datasets are sampled proportionally to their
+    remaining size. Otherwise the datasets are sampled with probabilities proportional to size^(1/T) and the
+    small datasets are repeated (T > 1) or the large ones truncated.
+    :param round_robin: take the datasets iteratively 1 to N (skipping the exhausted ones)
+    :return: numpy array with one dataset id for every mini-batch of the epoch
+    """
+    sizes = np.asarray(sizes, dtype=np.int64)
+    n_datasets = len(sizes)
+    total = int(sizes.sum())
+
+    if total == 0:
+        return np.zeros(0, dtype=np.int64)
+
+    if round_robin:
+        rounds = np.tile(np.arange(n_datasets), int(sizes.max()))
+        counts = np.repeat(np.arange(int(sizes.max())), n_datasets)
+        return rounds[counts < sizes[rounds]]
+
+    with data_utils.numpy_seed(seed, epoch):
+
+        if temperature != 1.0:
+            probs = (sizes / total) ** (1.0 / temperature)
+            return np.random.choice(n_datasets, size=total, p=probs / probs.sum())
+
+        # sampling without replacement: draw with the probabilities of the non-exhausted datasets until
+        # one dataset is exhausted (the draws after that point are discarded), then continue without it
+        remaining = sizes.copy()
+        chunks = list()
+        while remaining.sum() > 0:
+            probs = sizes * (remaining > 0)
+            draws = np.random.choice(n_datasets, size=int(remaining.sum()), p=probs / probs.sum())
+
+            cut = len(draws)
+            for dataset_id in np.flatnonzero(remaining > 0):
+                positions = np.flatnonzero(draws == dataset_id)
+                if len(positions) > remaining[dataset_id]:
+                    cut = min(cut, positions[remaining[dataset_id]])
+
+            draws = draws[:cut]
+            remaining -= np.bincount(draws, minlength=n_datasets)
+            chunks.append(draws)
+
+    return np.concatenate(chunks)
+
+
+class MultiDataset(torch.utils.data.Dataset):
+    """
+    View of several datasets for one DataLoader: indexed with (dataset_id, sample_id)
+    """
+
+    def __init__(self, datasets):
+        self.datasets = datasets
 
-    def __init__(self, iterators, round_robin=False):
-        """
-        :param iterators: a list of CountingIterators
-        :param round_robin: if the data is sampled iteratively 1 to N or randomly
-        """
+    def __getitem__(self, index):
+        dataset_id, sample_id = index
+        return dataset_id, self.datasets[dataset_id][sample_id]
 
-        self.iterators = iterators
-        self.round_robin = round_robin
-        self.n_iterators = len(iterators)
-        # self.total = sum([len(iterator) for iterator in self.iterators])
-        self.sizes = [len(iterator) for iterator in self.iterators]
-        self.total = sum(self.sizes)
-        self.itr = iter(self)
-
-        if self.round_robin:
-            self.itr_indices = torch.arange(self.n_iterators)
-        else:
-            # self.itr_indices = torch.randperm(self.n_iterators)
-            with torch.no_grad():
-                self.itr_indices = torch.Tensor(self.sizes).div(self.total)
+    def collater(self, samples):
+        # the samples of a mini-batch always come from the same dataset
+        dataset_id = samples[0][0]
+        batches = self.datasets[dataset_id].collater([sample for _, sample in samples])
 
-        self.idx = -1
-        self.n_yielded = 0
-
-    def iterations_in_epoch(self):
-        """
-        :return: a list of iterations in epoch for each iterator
-        """
-        return [iterator.n for iterator in self.iterators]
+        # (e.g. the trainer augments the batch with the augmenter of its dataset)
+        for batch in batches:
+            batch.tensors['dataset_id'] = dataset_id
 
-    def load_iterations(self, iteration_in_epochs):
+        return batches
 
-        for iterator, iter_in_epoch in zip(self.iterators, iteration_in_epochs):
-            iterator.n = iter_in_epoch
 
-    def __len__(self):
+class MultiBatchSampler(object):
+    """
+    Emits the mini-batches of the epoch as lists of (dataset_id, sample_id)
+    """
 
-        return sum([len(iterator) for iterator in self.iterators])
+    def __init__(self, order, dataset_batches, offset=0):
+        """
+        :param order: dataset id of every mini-batch of the epoch
+        :param dataset_batches: for each dataset, the list of its mini-batches in this epoch
+        :param offset: number of mini-batches already consumed
+        """
+        self.order = order
+        self.dataset_batches = dataset_batches
+        self.offset = offset
 
     def __iter__(self):
 
-        while True:
-
-            if self.n_yielded >= self.total:
-                return
-
-            if self.round_robin:
-                self.idx = self.idx + 1
-                if self.idx >= self.n_iterators:
-                    self.idx = 0
-
-                cur_iterator = self.iterators[self.itr_indices[self.idx]]
-
-                # if the current iterator is not exhausted, then yield
-                # otherwise go to the next one
-                if cur_iterator.has_next():
-                    self.n_yielded += 1
-                    yield next(cur_iterator)
-                else:
-                    continue
-            else:
-                # sample randomly from the iterators
-                # large datasets will be likely to generate more samples
-                # smaller datasets will be less likely
-                # but averaging-out, the model is more balanced than round-robin
-                sampled_itr = torch.multinomial(self.itr_indices, 1).unsqueeze(-1).item()
-
-                # if the current iterator is not exhausted, then yield
-                # otherwise resample
-                cur_iterator = self.iterators[sampled_itr]
-                if cur_iterator.has_next():
-                    self.n_yielded += 1
-                    yield next(cur_iterator)
-                else:
-                    # zero-out that index to avoid sampling into the same empty iterator
-                    with torch.no_grad():
-                        self.itr_indices[sampled_itr].zero_()
-                    continue
+        positions = np.bincount(self.order[:self.offset], minlength=len(self.dataset_batches)).tolist()
 
-    def __next__(self):
+        for dataset_id in self.order[self.offset:].tolist():
+            batch = self.dataset_batches[dataset_id][positions[dataset_id]]
+            positions[dataset_id] += 1
+            yield [(dataset_id, sample_id) for sample_id in batch]
 
-        return next(self.itr)
-
-    def has_next(self):
+    def __len__(self):
+        return len(self.order) - self.offset
 
-        return self.n_yielded < self.total
 
-    def skip(self, num_to_skip):
+class MultiEpochIterator(CountingIterator):
+    """
+    Counting iterator over the mini-batches of all datasets, which also knows the progress in each dataset
+    """
 
-        for iterator in self.iterators:
-            iterator.skip(num_to_skip)
+    def __init__(self, iterable, order, n_datasets, start=0):
+        """
+        :param iterable: data loader
+        :param order: dataset id of every mini-batch of the epoch
+        :param n_datasets: number of datasets
+        :param start: number of mini-batches already consumed
+        """
+        self.order = order
+        self.n_datasets = n_datasets
+        super(MultiEpochIterator, self).__init__(iterable, start=start, total=len(order))
 
-    def take(self, n):
+    @property
+    def n_yielded(self):
+        return self.n
 
+    def iterations_in_epoch(self):
         """
-        Truncates the iterator to n elements at most.
+        :return: a list of iterations in epoch for each dataset
         """
-        for iterator in self.iterators:
-            iterator.take(n)
+        return np.bincount(self.order[:self.n], minlength=self.n_datasets).tolist()
 
 
 class MultiDataIterator(EpochBatchIterating):
+    """
+    Iterates over several datasets with one DataLoader (one pool of num_workers processes):
+    the order of the datasets in the epoch is sampled first (deterministically, see sample_dataset_order)
+    and the sampler then emits the mini-batches of the corresponding datasets.
+    """
 
     def next_epoch_itr(self, shuffle=True, pin_memory=False):
         self.epoch = self.next_epoch_idx
@@ -133,23 +164,29 @@ class MultiDataIterator(EpochBatchIterating):
         self.shuffle = shuffle
         return self._cur_epoch_itr
 
-    # each dataset = dataiterator > generate 1 epoch iterator
-    # this class gen
     def __init__(self, datasets, seed=1., num_workers=0, epoch=1, buffer_size=0,
-                 timeout=0, round_robin=False, num_shards=1, shard_id=0):
+                 timeout=0, round_robin=False, num_shards=1, shard_id=0, pad_shards=True, temperature=1.0,
+                 shard_balance='none'):
 
         self.datasets = datasets
+        # the data iterators only provide the (shuffled and sharded) mini-batches of each dataset
         self.data_iterators = list()
         for dataset in datasets:
             self.data_iterators.append(DataIterator(dataset, dataset.collater, dataset.batches, seed=seed,
                                                     num_workers=num_workers, epoch=epoch, buffer_size=buffer_size,
-                                                    timeout=timeout, num_shards=num_shards, shard_id=shard_id))
+                                                    timeout=timeout, num_shards=num_shards, shard_id=shard_id,
+                                                    pad_shards=pad_shards, shard_balance=shard_balance))
 
+        self.num_workers = num_workers
+        self.buffer_size = buffer_size
+        self.timeout = timeout
         self.shuffle = True
         self._cur_epoch_itr = None
         self._next_epoch_itr = None
         self._support_prefetch = False
         self.round_robin = round_robin
+        self.temperature = temperature
+        self.seed = seed
         self.epoch = max(epoch, 1)
         self.n_samples = sum([dataset.num_batches for dataset in self.datasets])
 
@@ -170,17 +207,9 @@ class MultiDataIterator(EpochBatchIterating):
     def end_of_epoch(self) -> bool:
         return not self._cur_epoch_itr.has_next()
 
-    def state_dict(self):
-        """Returns a dictionary containing a whole state of the iterator."""
-        return {
-            'epoch': self.epoch,
-            'iterations_in_epoch': self.iterations_in_epoch,
-            'shuffle': self.shuffle,
-        }
-
     @property
     def iterations_in_epoch(self):
-        """ The number of consumed batches in the current epoch"""
+        """ The number of consumed batches of each dataset in the current epoch"""
         if self._cur_epoch_itr is not None:
             return self._cur_epoch_itr.iterations_in_epoch()
         elif self._next_epoch_itr is not None:
@@ -193,12 +222,22 @@ class MultiDataIterator(EpochBatchIterating):
             'epoch': self.epoch,
             'iterations_in_epoch': self.iterations_in_epoch,
             'shuffle': self.shuffle,
+            'seed': self.seed,
+            'temperature': self.temperature,
+            # all the batches of the epoch are consumed (e.g. saved after the last batch)
+            'end_of_epoch': self._cur_epoch_itr is not None and self.end_of_epoch(),
         }
 
-    def load_state_dict(self, state_dict):
+    def load_state_dict(self, state_dict, pin_memory=False):
         """Copies the state of the iterator from the given *state_dict*."""
         if state_dict is not None:
             self.epoch = state_dict['epoch']
+            self.seed = state_dict.get('seed', self.seed)
+            for data_iterator in self.data_iterators:
+                data_iterator.seed = self.seed
+            if state_dict.get('temperature', self.temperature) != self.temperature:
+                print("[WARNING] Resuming with the sampling temperature %s instead of %s: the order of the "
+                      "current epoch is not the same" % (self.temperature, state_dict['temperature']))
             itr_pos = state_dict.get('iterations_in_epoch', [0] * len(self.data_iterators))
 
             if sum(itr_pos) > 0:
@@ -206,41 +245,65 @@ class MultiDataIterator(EpochBatchIterating):
                 self._next_epoch_itr = self._get_iterator_for_epoch(
                     self.epoch,
                     shuffle=state_dict.get('shuffle', True),
-                    offsets=itr_pos
+                    offset=sum(itr_pos),
+                    pin_memory=pin_memory
                 )
                 if self._next_epoch_itr is None:
                     # we finished the epoch, increment epoch counter
                     self.epoch += 1
+                elif self._next_epoch_itr.iterations_in_epoch() != list(itr_pos):
+                    print("[WARNING] The progress in each dataset %s is different from the saved one %s"
+                          % (self._next_epoch_itr.iterations_in_epoch(), list(itr_pos)))
             else:
                 self._next_epoch_itr = None
         else:
             self.epoch = 1
-            itr_pos = list()
             self._next_epoch_itr = None
 
-    def _get_iterator_for_epoch(self, epoch, shuffle=False, offsets=None, pin_memory=False):
+    def _get_batches_for_epoch(self, epoch, shuffle):
 
-        epoch_iterators = list()
+        dataset_batches = list()
+        for data_iterator in self.data_iterators:
+            batches, empty = data_iterator.get_batches_for_epoch(epoch, shuffle)
+            dataset_batches.append(batches if not empty else list())
 
-        if offsets is not None and sum(offsets) >= self.n_samples:
-            return None
-
-        if offsets is None:
-            offsets = [0] * len(self.data_iterators)
+        sizes = [len(batches) for batches in dataset_batches]
+        order = sample_dataset_order(sizes, self.seed, epoch, temperature=self.temperature,
+                                     round_robin=self.round_robin)
 
-        # first, generate an iterator for each data iterator
-        for (data_iterator, offset) in zip(self.data_iterators, offsets):
-            epoch_iterator =  data_iterator._get_iterator_for_epoch(epoch, shuffle, offset, pin_memory=pin_memory)
-            epoch_iterators.append(epoch_iterator)
+        # with temperature sampling a dataset can be used more than once (in a different order each time)
+        counts = np.bincount(order, minlength=len(sizes))
+        for dataset_id, data_iterator in enumerate(self.data_iterators):
+            n_passes = 1
+            while len(dataset_batches[dataset_id]) < counts[dataset_id]:
+                next_pass, _ = data_iterator.get_batches_for_epoch(epoch, shuffle, n_passes)
+                dataset_batches[dataset_id] = dataset_batches[dataset_id] + next_pass
+                n_passes += 1
 
-        # next, use an multi epoch iterator
-        epoch_iterator = MultiEpochIterator(epoch_iterators, round_robin=self.round_robin)
-
-        return epoch_iterator
+        return order, dataset_batches
 
+    def _get_iterator_for_epoch(self, epoch, shuffle=False, offset=0, pin_memory=False):
 
+        order, dataset_batches = self._get_batches_for_epoch(epoch, shuffle)
 
+        if offset > 0 and offset >= len(order):
+            return None
 
+        if self.num_workers > 0:
+            os.environ['PYTHONWARNINGS'] = 'ignore:semaphore_tracker:UserWarning'
 
+        # one data loader (and worker pool) for all datasets
+        multi_dataset = MultiDataset(self.datasets)
+        itr = torch.utils.data.DataLoader(
+            multi_dataset,
+            collate_fn=multi_dataset.collater,
+            batch_sampler=MultiBatchSampler(order, dataset_batches, offset=offset),
+            num_workers=self.num_workers,
+            pin_memory=pin_memory,
+            timeout=self.timeout,
+        )
 
+        if self.buffer_size > 0:
+            itr = BufferedIterator(self.buffer_size, itr)
 
+        return MultiEpochIterator(itr, order, len(self.datasets), start=offset)
@@ -1,5 +1,4 @@
 import torch
-from kaldiio import load_mat
 from functools import lru_cache
 import numpy as np
 from .audio_utils import _parse_arkpath, ArkLoader
@@ -0,0 +1,185 @@
+import os
+from collections import OrderedDict
+
+import numpy as np
+import torch
+import torch.utils.data
+import torch.multiprocessing as mp
+
+import onmt
+
+
+def index_file_path(path):
+    return path + '.lines.npz'
+
+
+def find_line_offsets(filename, num_chunks):
+    """
+    :param filename: string
+    :param num_chunks: int
+    :return: a list of byte offsets (positions to start and stop reading), each one at the beginning of a line
+    """
+    with open(filename, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        chunk_size = size // num_chunks
+        offsets = [0 for _ in range(num_chunks + 1)]
+        for i in range(1, num_chunks):
+            f.seek(chunk_size * i)
+            f.readline()
+            offsets[i] = max(f.tell(), offsets[i - 1])
+        offsets[num_chunks] = size
+        return offsets
+
+
+def scan_lines(filename, start=0, end=-1):
+    """
+    Read the lines starting in the byte range [start, end)
+    :return: the byte offset of every line and its number of tokens (numpy arrays)
+    """
+    offsets = list()
+    sizes = list()
+
+    with open(filename, 'rb') as f:
+        f.seek(start)
+        position = start
+
+        for line in f:
+            if 0 <= end <= position:
+                break
+            offsets.append(position)
+            # the same tokenization as onmt.data.tokenizer.Tokenizer for words
+            sizes.append(len(line.decode('utf-8', errors='replace').split()))
+            position += len(line)
+
+    return np.asarray(offsets, dtype=np.int64), np.asarray(sizes, dtype=np.int32)
+
+
+def build_line_index(filename, num_workers=1):
+    """
+    :param filename: a text file with one (already segmented) sentence per line
+    :param num_workers: number of processes scanning the file
+    :return: the offsets of the lines ([n_lines + 1], the last one is the file size) and their number of tokens
+    """
+    chunks = find_line_offsets(filename, max(num_workers, 1))
+
+    if num_workers > 1:
+        pool = mp.Pool(processes=num_workers)
+        results = pool.starmap(scan_lines, [(filename, chunks[i], chunks[i + 1]) for i in range(num_workers)])
+        pool.close()
+        pool.join()
+    else:
+        results = [scan_lines(filename, chunks[0], chunks[1])]
+
+    offsets = np.concatenate([r[0] for r in results] + [np.asarray([chunks[-1]], dtype=np.int64)])
+    sizes = np.concatenate([r[1] for r in results])
+
+    return offsets, sizes
+
+
+class TextIndexDataset(torch.utils.data.Dataset):
+    """
+    Random access to the sentences of a raw text file without binarization.
+
+    Only the byte offset and the number of tokens of every line are computed in advance (and saved next to the
+    file). The sentences are read, split and converted to indices when they are requested, i.e. inside the
+    DataLoader workers, and every worker keeps the latest sentences in its own LRU cache.
+    """
+
+    def __init__(self, path, vocab, bos_word=None, eos_word=None, cache_size=1024, num_workers=1,
+                 verbose=False):
+        """
+        :param path: text file (one sentence per line, tokens separated by spaces)
+        :param vocab: onmt.Dict used to convert the tokens
+        :param bos_word: added to the beginning of every sentence (None: no BOS)
+        :param eos_word: added to the end of every sentence (None: no EOS)
+        :param cache_size: maximum number of converted sentences kept by each process. 0 means no cache
+        :param num_workers: number of processes building the index if it doesn't exist
+        """
+        super().__init__()
+
+        self.path = path
+        self.vocab = vocab
+        self.bos_word = bos_word
+        self.eos_word = eos_word
+        self.cache_size = cache_size
+
+        self._offsets, n_tokens = self._load_index(path, num_workers, verbose)
+        self._sizes = n_tokens + int(bos_word is not None) + int(eos_word is not None)
+
+        self._file = None
+        self._pid = None
+        self.cache = OrderedDict() if cache_size > 0 else None
+
+    @staticmethod
+    def _load_index(path, num_workers, verbose):
+
+        stat = os.stat(path)
+        index_path = index_file_path(path)
+
+        # the index is reused as long as the text file is not modified
+        if os.path.exists(index_path):
+            index = np.load(index_path)
+            if index['file_size'] == stat.st_size and index['mtime'] == stat.st_mtime_ns:
+                return index['offsets'], index['sizes']
+
+        if verbose:
+            print("[INFO] Indexing the lines of %s with %d workers ..." % (path, num_workers))
+        offsets, sizes = build_line_index(path, num_workers=num_workers)
+
+        try:
+            with open(index_path, 'wb') as f:
+                np.savez(f, offsets=offsets, sizes=sizes,
+                         file_size=np.int64(stat.st_size), mtime=np.int64(stat.st_mtime_ns))
+        except OSError:
+            # read-only data directory: the index is rebuilt next time
+            pass
+
+        return offsets, sizes
+
+    def __getstate__(self):
+        # the workers open the file themselves and start with an empty cache
+        state = self.__dict__.copy()
+        state['_file'] = None
+        state['_pid'] = None
+        if self.cache is not None:
+            state['cache'] = OrderedDict()
+        return state
+
+    def __del__(self):
+        if getattr(self, '_file', None) is not None:
+            self._file.close()
+
+    @property
+    def sizes(self):
+        return self._sizes
+
+    def __len__(self):
+        return len(self._sizes)
+
+    def read_line(self, i):
+
+        # a forked worker must not share the file position with the parent process
+        if self._file is None or self._pid != os.getpid():
+            self._file = open(self.path, 'rb')
+            self._pid = os.getpid()
+
+        start, end = self._offsets[i], self._offsets[i + 1]
+        self._file.seek(start)
+        return self._file.read(end - start).decode('utf-8', errors='replace')
+
+    def __getitem__(self, i):
+
+        if self.cache is not None and i in self.cache:
+            self.cache.move_to_end(i)
+            return self.cache[i]
+
+        tokens = self.read_line(i).split()
+        tensor = self.vocab.convertToIdx(tokens, onmt.constants.UNK_WORD,
+                                         bos_word=self.bos_word, eos_word=self.eos_word)
+
+        if self.cache is not None:
+            self.cache[i] = tensor
+            if len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+
+        return tensor
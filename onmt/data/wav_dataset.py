@@ -1,20 +1,31 @@
+import os
+import math
+import struct
 import torch
 import torchaudio as taudio
+from collections import OrderedDict
 from functools import lru_cache
 from onmt.utils import safe_readaudio
 import numpy as np
 
+# int16 samples are stored in the range [-32768, 32767]
+# dividing by this number gives the same values as torchaudio.load(normalize=True)
+INT16_SCALE = 32768.0
+
 
 class WavDataset(torch.utils.data.Dataset):
-    def __init__(self, wav_path_list, cache=False):
+    def __init__(self, wav_path_list, cache=False, cache_size=256):
         """
-        :param scp_path_list: list of path to the ark matrices
+        :param wav_path_list: list of tuples (wav_file, start, end, sample_rate)
+        :param cache: keep the recently read segments in memory
+        :param cache_size: maximum number of segments in the cache (LRU). <= 0 means unbounded
         """
         self.wav_path_list = wav_path_list
         self._sizes = len(self.wav_path_list)
         self._dtype = torch.float32
+        self.cache_size = cache_size
         if cache:
-            self.cache = dict()
+            self.cache = OrderedDict()
         else:
             self.cache = None
 
@@ -35,6 +46,8 @@ class WavDataset(torch.utils.data.Dataset):
         # it should be a tuple (wav_file, start, end)
 
         if self.cache is not None and wav_info in self.cache:
+            # mark as the most recently used
+            self.cache.move_to_end(wav_info)
             return self.cache[wav_info]
 
         wavpath, start, end, sample_rate = wav_info
@@ -42,5 +55,234 @@ class WavDataset(torch.utils.data.Dataset):
 
         if self.cache is not None:
             self.cache[wav_info] = data
+            # evict the least recently used segment
+            if 0 < self.cache_size < len(self.cache):
+                self.cache.popitem(last=False)
 
         return data
+
+
+def index_file_path(prefix_path):
+    return prefix_path + '.idx'
+
+
+def data_file_path(prefix_path):
+    return prefix_path + '.bin'
+
+
+class MMapWavDataset(torch.utils.data.Dataset):
+    """
+    Waveforms decoded once during preprocessing and stored as one int16 memory-mapped array.
+    The index stores the pointer, the number of samples and the sample rate of every segment.
+    __getitem__ returns a [length x 1] float tensor (same as safe_readaudio) without touching the audio files.
+    """
+
+    class Index(object):
+        _HDR_MAGIC = b'MMWAVIDX\x00'
+
+        @classmethod
+        def writer(cls, path):
+            class _Writer(object):
+                def __enter__(self):
+                    self._file = open(path, 'wb')
+
+                    self._file.write(cls._HDR_MAGIC)
+                    self._file.write(struct.pack('<Q', 1))
+
+                    return self
+
+                def write(self, sizes, pointers, sample_rates):
+                    self._file.write(struct.pack('<Q', len(sizes)))
+
+                    self._file.write(np.array(sizes, dtype=np.int64).tobytes(order='C'))
+                    self._file.write(np.array(pointers, dtype=np.int64).tobytes(order='C'))
+                    self._file.write(np.array(sample_rates, dtype=np.int32).tobytes(order='C'))
+
+                def __exit__(self, exc_type, exc_val, exc_tb):
+                    self._file.close()
+
+            return _Writer()
+
+        def __init__(self, path):
+            with open(path, 'rb') as stream:
+                magic_test = stream.read(9)
+                assert self._HDR_MAGIC == magic_test, (
+                    'Index file doesn\'t match expected format. '
+                    'Make sure that the wav data is preprocessed with -format wavmem.'
+                )
+                version = struct.unpack('<Q', stream.read(8))
+                assert (1,) == version
+
+                self._len = struct.unpack('<Q', stream.read(8))[0]
+                offset = stream.tell()
+
+            self._bin_buffer_mmap = np.memmap(path, mode='r', order='C')
+            self._bin_buffer = memoryview(self._bin_buffer_mmap)
+            self._sizes = np.frombuffer(self._bin_buffer, dtype=np.int64, count=self._len, offset=offset)
+            offset += self._sizes.nbytes
+            self._pointers = np.frombuffer(self._bin_buffer, dtype=np.int64, count=self._len, offset=offset)
+            offset += self._pointers.nbytes
+            self._sample_rates = np.frombuffer(self._bin_buffer, dtype=np.int32, count=self._len, offset=offset)
+
+        def __del__(self):
+            self._bin_buffer_mmap._mmap.close()
+            del self._bin_buffer_mmap
+
+        @property
+        def sizes(self):
+            return self._sizes
+
+        @property
+        def sample_rates(self):
+            return self._sample_rates
+
+        def __getitem__(self, i):
+            return self._pointers[i], self._sizes[i]
+
+        def __len__(self):
+            return self._len
+
+    def __init__(self, path):
+        super().__init__()
+
+        self._path = None
+        self._index = None
+        self._bin_buffer = None
+        self._dtype = torch.float32
+
+        self._do_init(path)
+
+    def __getstate__(self):
+        return self._path
+
+    def __setstate__(self, state):
+        self._do_init(state)
+
+    def _do_init(self, path):
+        self._path = path
+        self._index = self.Index(index_file_path(self._path))
+        self._dtype = torch.float32
+
+        self._bin_buffer_mmap = np.memmap(data_file_path(self._path), mode='r', order='C')
+        self._bin_buffer = memoryview(self._bin_buffer_mmap)
+
+    def __del__(self):
+        self._bin_buffer_mmap._mmap.close()
+        del self._bin_buffer_mmap
+        del self._index
+
+    @property
+    def dtype(self):
+        return self._dtype
+
+    @property
+    def sizes(self):
+        return self._index.sizes
+
+    def sample_rate(self, i):
+        return int(self._index.sample_rates[i])
+
+    def __len__(self):
+        return len(self._index)
+
+    def get_int16(self, i):
+        """
+        :param i: segment index
+        :return: a read-only int16 tensor [length] viewing the memory map (no copy)
+        """
+        ptr, size = self._index[i]
+        np_array = np.frombuffer(self._bin_buffer, dtype=np.int16, count=size, offset=ptr)
+
+        return torch.from_numpy(np_array)
+
+    def __getitem__(self, i):
+        # the only allocation is the int16 -> float conversion, which is the normalization as well
+        data = self.get_int16(i).float().div_(INT16_SCALE)
+
+        # size [length, 1] (one channel for wav2vec)
+        return data.unsqueeze(1)
+
+    @staticmethod
+    def exists(path):
+        return (
+            os.path.exists(index_file_path(path)) and os.path.exists(data_file_path(path))
+        )
+
+
+class MMapWavDatasetBuilder(object):
+    """
+    Decode the wav segments once and write them as int16 into a single binary file.
+    Segments cut from the same recording are read with one torchaudio.load call.
+    """
+
+    def __init__(self, out_file):
+        self._data_file = open(out_file, 'wb')
+        self._address = 0
+        self._sizes = []
+        self._pointers = []
+        self._sample_rates = []
+
+    def _write(self, samples):
+        """
+        :param samples: float tensor in [-1, 1]
+        :return: pointer (in bytes) to the written samples
+        """
+        samples = samples.reshape(-1).mul(INT16_SCALE).round_().clamp_(-INT16_SCALE, INT16_SCALE - 1)
+        np_array = samples.numpy().astype(np.int16)
+        self._data_file.write(np_array.tobytes(order='C'))
+
+        pointer = self._address
+        self._address += np_array.nbytes
+
+        return pointer, np_array.size
+
+    def add_item(self, tensor, sample_rate=16000):
+
+        pointer, size = self._write(tensor)
+        self._pointers.append(pointer)
+        self._sizes.append(size)
+        self._sample_rates.append(sample_rate)
+
+    def add_wav_list(self, wav_path_list, verbose=False):
+        """
+        :param wav_path_list: list of tuples (wav_file, start, end, sample_rate) from the wav preprocessing
+        The segments keep the order of the list. Each audio file is decoded only once.
+        """
+        n = len(wav_path_list)
+        start_index = len(self._sizes)
+        self._pointers += [0] * n
+        self._sizes += [0] * n
+        self._sample_rates += [0] * n
+
+        # group the segments by recording
+        groups = OrderedDict()
+        for i, (wavpath, start, end, sample_rate) in enumerate(wav_path_list):
+            groups.setdefault(wavpath, list()).append(i)
+
+        for count, (wavpath, indices) in enumerate(groups.items()):
+            tensor, file_sample_rate = taudio.load(wavpath, normalize=True, channels_first=False)
+            tensor = tensor[:, 0]
+
+            for i in indices:
+                _, start, end, sample_rate = wav_path_list[i]
+                assert sample_rate == file_sample_rate, \
+                    "Sample rate mismatch for %s: %d vs %d" % (wavpath, sample_rate, file_sample_rate)
+
+                # the same boundaries as safe_readaudio
+                offset = math.floor(sample_rate * start)
+                num_frames = tensor.size(0) - offset if end <= start else math.ceil(sample_rate * (end - start))
+                num_frames = min(num_frames, tensor.size(0) - offset)
+
+                pointer, size = self._write(tensor.narrow(0, offset, num_frames))
+                self._pointers[start_index + i] = pointer
+                self._sizes[start_index + i] = size
+                self._sample_rates[start_index + i] = sample_rate
+
+            if verbose and (count + 1) % 1000 == 0:
+                print("[INFO] Decoded %d audio files." % (count + 1))
+
+    def finalize(self, index_file):
+        self._data_file.close()
+
+        with MMapWavDataset.Index.writer(index_file) as index:
+            index.write(self._sizes, self._pointers, self._sample_rates)
@@ -359,13 +359,8 @@ class EnsembleTranslator(object):
             hyps, attn, length = zip(*[beam[b].getHyp(k) for k in ks[:n_best]])
             all_hyp += [hyps]
             all_lengths += [length]
-            # if(src_data.data.dim() == 3):
-            if self.opt.encoder_type == 'audio':
-                valid_attn = decoder_states[0].original_src.narrow(2,0,1).squeeze(2)[:, b].ne(onmt.constants.PAD) \
-                                            .nonzero().squeeze(1)
-            else:
-                valid_attn = decoder_states[0].original_src[:, b].ne(onmt.constants.PAD) \
-                                            .nonzero().squeeze(1)
+            valid_attn = decoder_states[0].original_src[:, b].ne(onmt.constants.PAD) \
+                                        .nonzero().squeeze(1)
             attn = [a.index_select(1, valid_attn) for a in attn]
             all_attn += [attn]
 
@@ -0,0 +1,149 @@
+""" Non-autoregressive decoding with the CTC head (ctc_linear) of speech models trained with -ctc_loss """
+import torch
+import torch.nn.functional as F
+
+import onmt
+
+# multiplier of the rolling hash identifying the prefixes (int64 arithmetic wraps around)
+_HASH_BASE = 1000003
+
+
+def ctc_log_probs(model, batch):
+    """
+    Run only the encoder and the CTC projection of a model (the attention decoder is skipped)
+    :param model: model with a ctc_linear layer
+    :param batch: Batch object (the same as for beam search)
+    :return: log probabilities [B x T x V] (float) and the number of valid encoder frames [B]
+    """
+    if getattr(model, 'ctc_linear', None) is None:
+        raise ValueError("CTC decoding needs a model trained with -ctc_loss > 0 (%s has no ctc_linear layer)"
+                         % type(model).__name__)
+
+    src = batch.get('source')
+    encoder_output = model.encoder(src.transpose(0, 1), input_pos=batch.get('source_pos'),
+                                   input_lang=batch.get('source_lang'), src_lengths=batch.src_lengths)
+
+    context = encoder_output['context']  # T x B x H
+    logits = model.ctc_linear(context).float().transpose(0, 1)
+
+    # the same lengths as for the CTC loss: the mask is B x T or B x 1 x T with 1 for padding
+    src_mask = encoder_output['src_mask'].long()
+    if src_mask.dim() == 3:
+        src_mask = src_mask.squeeze(1)
+    lengths = (1 - src_mask).sum(1)
+
+    return F.log_softmax(logits, dim=-1), lengths
+
+
+def ctc_greedy_search(log_probs, lengths, blank=onmt.constants.PAD):
+    """
+    Best path decoding: the most probable label of every frame, repetitions collapsed and blanks removed
+    :param log_probs: [B x T x V]
+    :param lengths: [B] number of valid frames
+    :param blank: index of the blank label
+    :return: list (for each sentence) of (token list, score of the best path)
+    """
+    bsz, time = log_probs.size(0), log_probs.size(1)
+    best_scores, best_labels = log_probs.max(dim=-1)  # B x T
+
+    valid = torch.arange(time, device=log_probs.device).unsqueeze(0) < lengths.unsqueeze(1)
+    previous = F.pad(best_labels[:, :-1], (1, 0), value=blank)
+    keep = valid & best_labels.ne(blank) & best_labels.ne(previous)
+    scores = best_scores.masked_fill(~valid, 0).sum(dim=1)
+
+    # one transfer to the host for the whole batch
+    best_labels, keep, scores = best_labels.cpu(), keep.cpu(), scores.tolist()
+
+    return [(best_labels[b][keep[b]].tolist(), scores[b]) for b in range(bsz)]
+
+
+def ctc_prefix_beam_search(log_probs, lengths, beam_size, blank=onmt.constants.PAD):
+    """
+    CTC prefix beam search, vectorized over the batch and the beam.
+
+    Every hypothesis is a label prefix with two log probabilities: of the paths ending with a blank (p_b)
+    and of the paths ending with its last label (p_nb). At each frame a prefix is either kept (blank or repeated
+    last label) or extended by one of the beam_size most probable labels of the frame. Equal prefixes reached
+    in different ways are merged (they are identified with a rolling hash) and the beam_size best are kept.
+
+    :param log_probs: [B x T x V]
+    :param lengths: [B] number of valid frames
+    :param beam_size: number of prefixes kept after each frame
+    :param blank: index of the blank label
+    :return: list (for each sentence) of the beam_size (token list, log probability) sorted by probability
+    """
+    bsz, time, vocab_size = log_probs.size()
+    device = log_probs.device
+    n_labels = min(beam_size, vocab_size - 1)
+    n_cands = beam_size * (1 + n_labels)
+    neg_inf = float('-inf')
+
+    # only the empty prefix exists at the beginning
+    p_b = log_probs.new_full((bsz, beam_size), neg_inf)
+    p_b[:, 0] = 0
+    p_nb = log_probs.new_full((bsz, beam_size), neg_inf)
+    hashes = torch.zeros(bsz, beam_size, dtype=torch.long, device=device)
+    last = torch.full((bsz, beam_size), -1, dtype=torch.long, device=device)
+    prefix_lengths = torch.zeros(bsz, beam_size, dtype=torch.long, device=device)
+    tokens = torch.full((bsz, beam_size, max(time, 1)), blank, dtype=torch.long, device=device)
+
+    beams = torch.arange(beam_size, device=device)
+    parents = torch.cat([beams, beams.repeat_interleave(n_labels)]).unsqueeze(0).expand(bsz, n_cands)
+    cand_range = torch.arange(n_cands, device=device)
+
+    for t in range(time):
+        lp = log_probs[:, t]
+        active = (lengths > t).unsqueeze(1)
+
+        # the prefix is kept: a blank, or the last label repeated (collapsed)
+        p_total = torch.logaddexp(p_b, p_nb)
+        stay_b = p_total + lp[:, blank].unsqueeze(1)
+        lp_last = lp.gather(1, last.clamp(min=0)).masked_fill(last.lt(0), neg_inf)
+        stay_nb = p_nb + lp_last
+
+        # the prefix is extended with one of the most probable labels of the frame
+        label_lp, labels = lp.index_fill(1, lp.new_tensor([blank], dtype=torch.long), neg_inf).topk(n_labels, dim=1)
+        labels = labels.unsqueeze(1).expand(bsz, beam_size, n_labels)
+        # a repeated label is only a new label after a blank
+        ext_nb = torch.where(labels.eq(last.unsqueeze(2)), p_b.unsqueeze(2), p_total.unsqueeze(2)) \
+            + label_lp.unsqueeze(1)
+        ext_hashes = hashes.unsqueeze(2) * _HASH_BASE + labels + 1
+
+        cand_b = torch.cat([stay_b, torch.full_like(ext_nb, neg_inf).view(bsz, -1)], dim=1)
+        cand_nb = torch.cat([stay_nb, ext_nb.reshape(bsz, -1)], dim=1)
+        cand_hashes = torch.cat([hashes, ext_hashes.reshape(bsz, -1)], dim=1)
+        cand_labels = torch.cat([torch.full_like(last, -1), labels.reshape(bsz, -1)], dim=1)
+
+        # merge the equal prefixes into the first candidate holding them
+        same = cand_hashes.unsqueeze(2).eq(cand_hashes.unsqueeze(1))  # B x C x C
+        first = same.long().argmax(dim=2).eq(cand_range)
+        cand_b = torch.where(same, cand_b.unsqueeze(1), cand_b.new_tensor(neg_inf)).logsumexp(dim=2)
+        cand_nb = torch.where(same, cand_nb.unsqueeze(1), cand_nb.new_tensor(neg_inf)).logsumexp(dim=2)
+        cand_b = cand_b.masked_fill(~first, neg_inf)
+        cand_nb = cand_nb.masked_fill(~first, neg_inf)
+
+        _, selected = torch.logaddexp(cand_b, cand_nb).topk(beam_size, dim=1)
+        parent = parents.gather(1, selected)
+        new_labels = cand_labels.gather(1, selected)
+        extended = new_labels.ge(0)
+
+        new_tokens = tokens.gather(1, parent.unsqueeze(2).expand_as(tokens))
+        new_lengths = prefix_lengths.gather(1, parent)
+        new_tokens.scatter_(2, new_lengths.unsqueeze(2), torch.where(extended, new_labels, blank).unsqueeze(2))
+
+        # the finished sentences (t >= length) keep their beams
+        p_b = torch.where(active, cand_b.gather(1, selected), p_b)
+        p_nb = torch.where(active, cand_nb.gather(1, selected), p_nb)
+        hashes = torch.where(active, cand_hashes.gather(1, selected), hashes)
+        last = torch.where(active, torch.where(extended, new_labels, last.gather(1, parent)), last)
+        tokens = torch.where(active.unsqueeze(2), new_tokens, tokens)
+        prefix_lengths = torch.where(active, new_lengths + extended.long(), prefix_lengths)
+
+    scores, order = torch.logaddexp(p_b, p_nb).sort(dim=1, descending=True)
+    tokens = tokens.gather(1, order.unsqueeze(2).expand_as(tokens)).cpu()
+    prefix_lengths = prefix_lengths.gather(1, order).tolist()
+    scores = scores.tolist()
+
+    return [[(tokens[b, k, :prefix_lengths[b][k]].tolist(), scores[b][k])
+             for k in range(beam_size) if scores[b][k] > neg_inf]
+            for b in range(bsz)]
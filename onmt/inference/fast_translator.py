@@ -7,6 +7,9 @@ import math
 from onmt.model_factory import build_model, optimize_model
 import torch.nn.functional as F
 from onmt.inference.search import BeamSearch, DiverseBeamSearch
+from onmt.inference.ctc_decoder import ctc_log_probs, ctc_greedy_search, ctc_prefix_beam_search
+from onmt.inference.shortlist import Shortlist
+from onmt.modules.base_seq2seq import Generator
 from onmt.inference.translator import Translator
 from onmt.constants import add_tokenidx
 from options import backward_compatible
@@ -58,6 +61,25 @@ class FastTranslator(Translator):
         else:
             self.dynamic_max_len_scale = 1.2
 
+        # document-level models reuse the encoder outputs of the previous utterances (as past context)
+        if hasattr(opt, 'past_cache_size') and opt.past_cache_size > 0:
+            for model in self.models:
+                if hasattr(model.encoder, 'set_past_cache'):
+                    model.encoder.set_past_cache(opt.past_cache_size)
+
+        # shallow fusion: the log-probs of the language model are added to the scores of the models
+        self.lm_weight = getattr(opt, 'lm_weight', 0.3)
+        self.lm_length_bonus = getattr(opt, 'lm_length_bonus', 0.0)
+        if self.lm_model is not None:
+            assert self.get_generator(self.lm_model).output_size == self.tgt_dict.size(), \
+                "The language model must use the target dictionary of the models"
+
+        # non-autoregressive decoding with the CTC layer of the encoder
+        self.ctc_decode = getattr(opt, 'ctc_decode', 'none')
+        if self.ctc_decode == 'greedy' and opt.n_best > 1:
+            print("[WARNING] Greedy CTC decoding gives only one hypothesis, n_best is set to 1")
+            opt.n_best = 1
+
         if opt.verbose:
             # print('* Current bos id is: %d, default bos id is: %d' % (self.tgt_bos, onmt.constants.BOS))
             print("src bos id is %d; src eos id is %d;  src pad id is %d; src unk id is %d"
@@ -89,6 +111,19 @@ class FastTranslator(Translator):
         else:
             self.use_filter = False
 
+        # the output layers only project onto a shortlist of the target vocabulary for each batch
+        if getattr(opt, 'shortlist', '') or getattr(opt, 'shortlist_first', 0) > 0:
+            self.shortlist = Shortlist(self.tgt_dict, path=getattr(opt, 'shortlist', '') or None,
+                                       src_dict=getattr(self, 'src_dict', None),
+                                       first=getattr(opt, 'shortlist_first', 0),
+                                       per_word=getattr(opt, 'shortlist_per_word', 50),
+                                       always=[self.tgt_pad, self.tgt_unk, self.tgt_eos])
+            for model in self.models:
+                assert isinstance(self.get_generator(model), Generator), \
+                    "Vocabulary shortlists require the linear output layer (onmt.modules.base_seq2seq.Generator)"
+        else:
+            self.shortlist = None
+
         # Sub-model is used for ensembling Speech and Text models
         if opt.sub_model:
             self.sub_models = list()
@@ -103,7 +138,7 @@ class FastTranslator(Translator):
 
             for i, model_path in enumerate(sub_models):
                 checkpoint = torch.load(model_path,
-                                        map_location=lambda storage, loc: storage)
+                                        map_location=lambda storage, loc: storage, weights_only=False)
 
                 model_opt = checkpoint['opt']
                 model_opt = backward_compatible(model_opt)
@@ -193,7 +228,7 @@ class FastTranslator(Translator):
 
             for i, model_path in enumerate(clfs_models):
                 checkpoint = torch.load(model_path,
-                                        map_location=lambda storage, loc: storage)
+                                        map_location=lambda storage, loc: storage, weights_only=False)
 
                 model_opt = checkpoint['opt']
                 model_opt = backward_compatible(model_opt)
@@ -240,10 +275,75 @@ class FastTranslator(Translator):
 
         print(self.main_model_opt)
 
+    @staticmethod
+    def get_generator(model):
+
+        if isinstance(model.generator, nn.ModuleList):
+            return model.generator[0]
+        return model.generator
+
+    def set_shortlist(self, shortlist):
+        """
+        :param shortlist: sorted LongTensor of the target words projected by the output layers, None for all
+        """
+        for model in self.models + self.sub_models:
+            self.get_generator(model).shortlist = shortlist
+        if self.lm_model is not None:
+            self.get_generator(self.lm_model).shortlist = shortlist
+
     def translate_batch(self, batches, sub_batches=None):
 
         with torch.no_grad():
-            return self._translate_batch(batches, sub_batches=sub_batches)
+            if self.ctc_decode != 'none':
+                return self._ctc_translate_batch(batches)
+            try:
+                return self._translate_batch(batches, sub_batches=sub_batches)
+            finally:
+                if self.shortlist is not None:
+                    self.set_shortlist(None)
+
+    def _ctc_translate_batch(self, batches):
+        """
+        Decode with the CTC layers of the models (greedy or prefix beam search), the attention decoders are skipped
+        :param batches: one batch for each model of the ensemble
+        :return: the same as _translate_batch
+        """
+        batch = batches[0]
+        beam_size = self.opt.beam_size
+
+        gold_scores = batch.get('source').data.new(batch.size).float().zero_()
+        gold_words = 0
+        allgold_scores = []
+
+        if batch.has_target:
+            gold_words, gold_scores, allgold_scores = self.models[0].decode(batch)
+
+        outs = dict()
+        lengths = None
+        with self.encoder_cache.caching():
+            for i in range(self.n_models):
+                log_probs, lengths_ = ctc_log_probs(self.models[i], batches[i])
+                assert lengths is None or torch.equal(lengths, lengths_), \
+                    "The models of a CTC ensemble must have the same encoder frame rate"
+                lengths = lengths_
+                bsz, time = log_probs.size(0), log_probs.size(1)
+                outs[i] = log_probs.view(bsz * time, -1)
+
+        log_probs = self._combine_outputs(outs, weight=self.ensemble_weight).view(bsz, time, -1)
+
+        if self.ctc_decode == 'greedy':
+            hypotheses = [[hypothesis] for hypothesis in ctc_greedy_search(log_probs, lengths, blank=self.tgt_pad)]
+        else:
+            hypotheses = ctc_prefix_beam_search(log_probs, lengths, beam_size, blank=self.tgt_pad)
+            # very short inputs can have fewer distinct prefixes than the beam size
+            hypotheses = [hyps + [([], float('-inf'))] * (beam_size - len(hyps)) for hyps in hypotheses]
+
+        # the same hypotheses as the beam search (ending with EOS, which is removed by build_target_tokens)
+        finalized = [[{'tokens': torch.LongTensor(tokens + [self.tgt_eos]), 'score': score, 'attention': None,
+                       'alignment': None, 'positional_scores': None} for tokens, score in hyps]
+                     for hyps in hypotheses]
+
+        return finalized, gold_scores, gold_words, allgold_scores
 
     def _translate_batch(self, batches, sub_batches):
         batch = batches[0]
@@ -268,6 +368,20 @@ class FastTranslator(Translator):
 
         # initialize buffers
         src = batch.get('source')
+
+        # the log-probs are computed over the shortlist: the search works with the positions in the shortlist
+        eos_index, pad_index = self.tgt_eos, self.tgt_pad
+        shortlist = None
+        vocab_filter = self.filter if self.use_filter else None
+        if self.shortlist is not None:
+            # the lexical table is only used for text inputs (the models are on the device of the batch)
+            shortlist = self.shortlist(src if not src.is_floating_point() else None, device=src.device)
+            self.set_shortlist(shortlist)
+            eos_index = int(torch.searchsorted(shortlist, shortlist.new_tensor(self.tgt_eos)))
+            pad_index = int(torch.searchsorted(shortlist, shortlist.new_tensor(self.tgt_pad)))
+            if vocab_filter is not None:
+                vocab_filter = vocab_filter[shortlist]
+
         scores = src.new(bsz * beam_size, max_len + 1).float().fill_(0)
         scores_buf = scores.clone()
         tokens = src.new(bsz * beam_size, max_len + 2).long().fill_(self.tgt_pad)
@@ -399,18 +513,24 @@ class FastTranslator(Translator):
 
         decoder_states = dict()
         sub_decoder_states = dict()  # for sub-model
-        for i in range(self.n_models):
-            if self.opt.pretrained_classifier:
-                pretrained_layer_states = self.pretrained_clfs[i].encode(batches[i])
-            else:
-                pretrained_layer_states = None
-            decoder_states[i] = self.models[i].create_decoder_state(batches[i], beam_size, type=2,
-                                                                    buffering=self.buffering,
-                                                                    pretrained_layer_states=pretrained_layer_states)
+        # (the members sharing an encoder build their states from the same context)
+        with self.encoder_cache.caching():
+            for i in range(self.n_models):
+                if self.opt.pretrained_classifier:
+                    pretrained_layer_states = self.pretrained_clfs[i].encode(batches[i])
+                else:
+                    pretrained_layer_states = None
+                decoder_states[i] = self.models[i].create_decoder_state(batches[i], beam_size, type=2,
+                                                                        buffering=self.buffering,
+                                                                        pretrained_layer_states=pretrained_layer_states)
         if self.opt.sub_model:
             for i in range(self.n_sub_models):
                 sub_decoder_states[i] = self.sub_models[i].create_decoder_state(sub_batches[i], beam_size, type=2,
                                                                                 buffering=self.buffering)
+        # the language model decodes incrementally, its buffers are reordered with the beams
+        lm_decoder_state = None
+        if self.lm_model is not None:
+            lm_decoder_state = self.lm_model.create_decoder_state(batch, beam_size)
 
         if self.dynamic_max_len:
             src_len = src.size(0)
@@ -428,25 +548,28 @@ class FastTranslator(Translator):
                     decoder_states[i]._reorder_incremental_state(reorder_state)
                 for i, model in enumerate(self.sub_models):
                     sub_decoder_states[i]._reorder_incremental_state(reorder_state)
+                if lm_decoder_state is not None:
+                    lm_decoder_state._reorder_incremental_state(reorder_state)
 
             decode_input = tokens[:, :step + 1]
 
             lprobs, avg_attn_scores = self._decode(decode_input, decoder_states,
-                                                   sub_decoder_states=sub_decoder_states)
+                                                   sub_decoder_states=sub_decoder_states,
+                                                   lm_decoder_state=lm_decoder_state)
             avg_attn_scores = None
 
-            if self.use_filter:
+            if vocab_filter is not None:
                 # the marked words are 1, so fill the reverse to inf
-                lprobs.masked_fill_(~self.filter.unsqueeze(0), -math.inf)
-            lprobs[:, self.tgt_pad] = -math.inf  # never select pad
+                lprobs.masked_fill_(~vocab_filter.unsqueeze(0), -math.inf)
+            lprobs[:, pad_index] = -math.inf  # never select pad
 
             # handle min and max length constraints
 
             if step >= max_len:
-                lprobs[:, :self.tgt_eos] = -math.inf
-                lprobs[:, self.tgt_eos + 1:] = -math.inf
+                lprobs[:, :eos_index] = -math.inf
+                lprobs[:, eos_index + 1:] = -math.inf
             elif step < self.min_len:
-                lprobs[:, self.tgt_eos] = -math.inf
+                lprobs[:, eos_index] = -math.inf
 
             # handle prefix tokens (possibly with different lengths)
             # here prefix tokens is a list of word-ids
@@ -524,14 +647,21 @@ class FastTranslator(Translator):
                     banned_tokens = [[] for bbsz_idx in range(bsz * beam_size)]
 
                 for bbsz_idx in range(bsz * beam_size):
-                    lprobs[bbsz_idx, banned_tokens[bbsz_idx]] = -math.inf
+                    banned = banned_tokens[bbsz_idx]
+                    if shortlist is not None and len(banned) > 0:
+                        banned = torch.searchsorted(shortlist, shortlist.new_tensor(banned))
+                    lprobs[bbsz_idx, banned] = -math.inf
 
             cand_scores, cand_indices, cand_beams = self.search.step(
                 step,
-                lprobs.view(bsz, -1, self.vocab_size),
+                lprobs.view(bsz, -1, lprobs.size(-1)),
                 scores.view(bsz, beam_size, -1)[:, :, :step],
             )
 
+            if shortlist is not None:
+                # back to the indices in the target vocabulary
+                cand_indices = shortlist[cand_indices]
+
             # cand_bbsz_idx contains beam indices for the top candidate
             # hypotheses, with a range of values: [0, bsz*beam_size),
             # and dimensions: [bsz, cand_size]
@@ -673,7 +803,7 @@ class FastTranslator(Translator):
 
         return finalized, gold_scores, gold_words, allgold_scores
 
-    def _decode(self, tokens, decoder_states, sub_decoder_states=None):
+    def _decode(self, tokens, decoder_states, sub_decoder_states=None, lm_decoder_state=None):
 
         # require batch first for everything
         outs = dict()
@@ -693,7 +823,15 @@ class FastTranslator(Translator):
         out = self._combine_outputs(outs, weight=self.ensemble_weight)
         # attn = self._combine_attention(attns)
 
-        if self.vocab_size > out.size(-1):
+        if lm_decoder_state is not None:
+            # the language model was trained on sentences separated by EOS: EOS replaces BOS as first input
+            lm_input = tokens[:, -1:]
+            if tokens.size(1) == 1:
+                lm_input = torch.full_like(lm_input, self.tgt_eos)
+            lm_out = self.lm_model.step(lm_input, lm_decoder_state)['log_prob']
+            out = out + self.lm_weight * lm_out.type_as(out) + self.lm_length_bonus
+
+        if self.shortlist is None and self.vocab_size > out.size(-1):
             self.vocab_size = out.size(-1)  # what the hell ?
         # attn = attn[:, -1, :] # I dont know what this line does
         attn = None  # attn is never used in decoding probably
@@ -751,7 +889,12 @@ class FastTranslator(Translator):
                             src_align_right=self.opt.src_align_right,
                             past_src_data=past_src_data)
 
-    def translate(self, src_data, tgt_data, past_src_data=None, sub_src_data=None, type='mt'):
+    def translate(self, src_data, tgt_data, past_src_data=None, sub_src_data=None, type='mt',
+                  utterance_ids=None, past_utterance_ids=None):
+        """
+        :param utterance_ids: ids of the source utterances (optional, document-level models cache their encodings)
+        :param past_utterance_ids: ids of the past source utterances
+        """
         if past_src_data is None or len(past_src_data) == 0:
             past_src_data = None
 
@@ -780,6 +923,12 @@ class FastTranslator(Translator):
         else:
             sub_batches, sub_src_data = None, None
 
+        if past_src_data is not None and utterance_ids and past_utterance_ids:
+            for batch in batches:
+                # not tensors: kept on the host by batch.cuda()
+                batch.tensors['utterance_ids'] = list(utterance_ids)
+                batch.tensors['past_utterance_ids'] = list(past_utterance_ids)
+
         batch_size = batches[0].size
         if self.cuda:
             for i, _ in enumerate(batches):
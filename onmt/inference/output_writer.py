@@ -0,0 +1,134 @@
+""" Background (non-blocking) writing of the translation output """
+from __future__ import division
+import atexit
+import queue
+import sys
+import threading
+
+
+class _OrderedStream(object):
+    """
+    Stands for a stream (sys.stdout) while the writer runs: the writes of the other threads are submitted to
+    the writer, so that they appear in order with the output of the jobs submitted before
+    """
+
+    def __init__(self, writer, stream):
+        self._writer = writer
+        self._stream = stream
+
+    def _direct(self):
+
+        # on the writer thread, or when it is stopped
+        thread = self._writer._thread
+        return thread is None or not thread.is_alive() or threading.current_thread() is thread
+
+    def write(self, text):
+
+        if self._direct():
+            return self._stream.write(text)
+
+        self._writer.submit(self._stream.write, text)
+        return len(text)
+
+    def flush(self):
+
+        if self._direct():
+            self._stream.flush()
+        else:
+            self._writer.submit(self._stream.flush)
+
+    def __getattr__(self, name):
+
+        return getattr(self._stream, name)
+
+
+class AsyncOutputWriter(object):
+    """
+    Runs the formatting and the writing of the translated batches on a background thread, so that the next
+    batch is decoded in the meantime. The jobs run one after the other in the order of submission: the output
+    (and everything else printed through the writer) is the same as when written from the main thread.
+
+    Until the writer is closed, sys.stdout is replaced so that the messages printed by the other threads
+    (e.g. by the translator) are written by the writer thread as well, after the jobs submitted before them.
+
+    At most max_queue jobs wait to be written, a new submission waits for the oldest one to be written.
+    With max_queue 0 every job runs immediately on the calling thread.
+    """
+
+    def __init__(self, max_queue=16):
+        """
+        :param max_queue: maximum number of jobs that are not written yet (0: no background thread)
+        """
+        self.max_queue = max_queue
+        self._error = None
+        self._failed = False
+
+        if self.max_queue > 0:
+            self._jobs = queue.Queue(maxsize=self.max_queue)
+            self._thread = threading.Thread(target=self._run, name='output-writer', daemon=True)
+            self._thread.start()
+            self._stdout = sys.stdout
+            sys.stdout = _OrderedStream(self, self._stdout)
+            atexit.register(self.close)
+        else:
+            self._jobs = None
+            self._thread = None
+            self._stdout = None
+
+    def submit(self, function, *args):
+        """
+        :param function: called with args on the writer thread, after the jobs submitted before
+        :return:
+        """
+        self._raise_error()
+
+        if self._thread is None:
+            function(*args)
+        else:
+            self._jobs.put((function, args))
+
+    def _run(self):
+
+        while True:
+            job = self._jobs.get()
+            if job is None:
+                self._jobs.task_done()
+                return
+
+            function, args = job
+            try:
+                # the output after a failed job would be incomplete or out of order
+                if not self._failed:
+                    function(*args)
+            except Exception as e:
+                self._failed = True
+                self._error = e
+            finally:
+                del function, args
+                self._jobs.task_done()
+
+    def _raise_error(self):
+
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise RuntimeError("Writing the translations in the background failed") from error
+
+    def wait(self):
+        """
+        Block until every submitted job is done
+        :return:
+        """
+        if self._thread is not None:
+            self._jobs.join()
+        self._raise_error()
+
+    def close(self):
+
+        if self._thread is not None and self._thread.is_alive():
+            self._jobs.put(None)
+            self._thread.join()
+        if self._stdout is not None:
+            if isinstance(sys.stdout, _OrderedStream) and sys.stdout._writer is self:
+                sys.stdout = self._stdout
+            self._stdout = None
+        self._raise_error()
@@ -0,0 +1,126 @@
+""" Sharing the encoder of the ensemble members with identical encoders """
+from __future__ import division
+import contextlib
+import copy
+
+import torch
+
+SCALAR_TYPES = (bool, int, float, str, type(None))
+
+
+def _same(a, b):
+    """
+    :return: whether a and b are the same inputs (tensors with equal values, or equal nested containers / scalars)
+    """
+    if a is b:
+        return True
+
+    if torch.is_tensor(a) or torch.is_tensor(b):
+        return torch.is_tensor(a) and torch.is_tensor(b) and a.size() == b.size() and a.dtype == b.dtype \
+               and a.device == b.device and torch.equal(a, b)
+
+    if isinstance(a, (list, tuple)) and isinstance(b, (list, tuple)):
+        return type(a) == type(b) and len(a) == len(b) and all(_same(x, y) for x, y in zip(a, b))
+
+    if isinstance(a, dict) and isinstance(b, dict):
+        return a.keys() == b.keys() and all(_same(a[k], b[k]) for k in a)
+
+    return isinstance(a, SCALAR_TYPES) and isinstance(b, SCALAR_TYPES) and type(a) == type(b) and a == b
+
+
+def identical_modules(a, b):
+    """
+    :return: whether the modules compute the same function: the same submodules with the same configuration
+             (scalar attributes) and the same parameters and buffers
+    """
+    modules_a, modules_b = list(a.named_modules()), list(b.named_modules())
+    if len(modules_a) != len(modules_b):
+        return False
+
+    for (name_a, module_a), (name_b, module_b) in zip(modules_a, modules_b):
+        if name_a != name_b or type(module_a) != type(module_b):
+            return False
+
+        config_a = {k: v for k, v in vars(module_a).items() if isinstance(v, SCALAR_TYPES)}
+        config_b = {k: v for k, v in vars(module_b).items() if isinstance(v, SCALAR_TYPES)}
+        if config_a != config_b:
+            return False
+
+    state_a, state_b = a.state_dict(), b.state_dict()
+    if state_a.keys() != state_b.keys():
+        return False
+
+    # (the packed weights of the quantized layers are not tensors: such encoders are not shared)
+    return all(torch.is_tensor(state_a[k]) and _same(state_a[k], state_b[k]) for k in state_a)
+
+
+class EncoderCache(object):
+    """
+    The ensemble members whose encoders are identical (e.g. checkpoints of one run with a frozen pretrained
+    encoder) use the same encoder module. Within caching(), a call of a shared encoder with the same inputs
+    as its previous call returns the previous output, so that the encoder runs once per batch and the members
+    build their decoding states from the same context.
+    """
+
+    def __init__(self, models):
+        """
+        :param models: the ensemble members, the encoders of the identical ones are replaced by the first one
+        """
+        self.enabled = False
+        self.num_hits = 0
+        self._outputs = dict()
+
+        # groups of the indices of the members sharing an encoder
+        groups = list()
+        for i, model in enumerate(models):
+            encoder = getattr(model, 'encoder', None)
+            if not isinstance(encoder, torch.nn.Module):
+                continue
+
+            for group in groups:
+                shared = models[group[0]].encoder
+                if shared is encoder or identical_modules(shared, encoder):
+                    model.encoder = shared
+                    group.append(i)
+                    break
+            else:
+                groups.append([i])
+
+        self.groups = [group for group in groups if len(group) > 1]
+        for group in self.groups:
+            self._cache_forward(models[group[0]].encoder)
+
+    def _cache_forward(self, encoder):
+
+        forward = encoder.forward
+        key = id(encoder)
+
+        def cached_forward(*args, **kwargs):
+            if not self.enabled:
+                return forward(*args, **kwargs)
+
+            cached = self._outputs.get(key)
+            if cached is not None and _same(cached[0], args) and _same(cached[1], kwargs):
+                self.num_hits += 1
+                output = cached[2]
+            else:
+                output = forward(*args, **kwargs)
+                self._outputs[key] = (args, kwargs, output)
+
+            # (the members may add keys to the output dictionary)
+            return copy.copy(output)
+
+        # an instance attribute: nn.Module.__call__ (and the hooks) run it instead of the forward of the class
+        encoder.forward = cached_forward
+
+    @contextlib.contextmanager
+    def caching(self):
+        """
+        The encoder outputs are kept until the end of the context (e.g. the creation of the decoding states)
+        """
+        self.enabled = True
+        try:
+            yield
+        finally:
+            self.enabled = False
+            self._outputs.clear()
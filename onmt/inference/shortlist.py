@@ -0,0 +1,89 @@
+"""
+Vocabulary shortlists for decoding: the output layer only projects onto the target words that are likely to be
+needed for the current batch, i.e. the most frequent target words and the lexical translations of the source words.
+"""
+import torch
+
+
+def load_lexical_table(path, src_dict, tgt_dict, per_word=50):
+    """
+    :param path: text file with lines "source_word target_word score" (e.g. a lexical translation table of
+        an aligner), the score is optional
+    :param src_dict: onmt.Dict of the source language
+    :param tgt_dict: onmt.Dict of the target language
+    :param per_word: number of target words kept for each source word (the ones with the highest scores)
+    :return: LongTensor [src_vocab_size x per_word] of target word indices, -1 for the empty entries
+    """
+    translations = dict()
+
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) < 2:
+                continue
+            src_idx = src_dict.lookup(parts[0])
+            tgt_idx = tgt_dict.lookup(parts[1])
+            if src_idx is None or tgt_idx is None:
+                continue
+            score = float(parts[2]) if len(parts) > 2 else 0.0
+            translations.setdefault(src_idx, list()).append((score, tgt_idx))
+
+    table = torch.full((src_dict.size(), per_word), -1, dtype=torch.long)
+    for src_idx, candidates in translations.items():
+        candidates = sorted(candidates, key=lambda candidate: -candidate[0])[:per_word]
+        table[src_idx, :len(candidates)] = torch.LongTensor([tgt_idx for _, tgt_idx in candidates])
+
+    return table
+
+
+def most_frequent(tgt_dict, n):
+    """
+    :param tgt_dict: onmt.Dict
+    :param n: number of words
+    :return: LongTensor of the indices of the n most frequent words (the first entries when the counts are equal)
+    """
+    counts = torch.Tensor([tgt_dict.frequencies.get(i, 0) for i in range(tgt_dict.size())])
+    _, order = torch.sort(-counts, stable=True)
+    return order[:n]
+
+
+class Shortlist(object):
+
+    def __init__(self, tgt_dict, path=None, src_dict=None, first=100, per_word=50, always=()):
+        """
+        :param tgt_dict: onmt.Dict of the target language
+        :param path: lexical table (see load_lexical_table), None to use only the frequent words
+        :param src_dict: onmt.Dict of the source language (required with a lexical table)
+        :param first: number of the most frequent target words, always in the shortlist
+        :param per_word: maximum number of target words for each source word
+        :param always: other target word indices always in the shortlist (e.g. EOS and UNK)
+        """
+        self.vocab_size = tgt_dict.size()
+
+        self.fixed = torch.cat([most_frequent(tgt_dict, first), torch.LongTensor(list(always))])
+
+        if path is not None:
+            assert src_dict is not None, "The lexical table of the shortlist needs the source dictionary"
+            self.table = load_lexical_table(path, src_dict, tgt_dict, per_word=per_word)
+        else:
+            self.table = None
+
+    def __call__(self, src=None, device=None):
+        """
+        :param src: indices of the source words of the batch (any shape), None for non-text inputs
+        :param device: the device of the output layers (default: the device of src)
+        :return: sorted LongTensor of the target word indices of the batch (on the device)
+        """
+        if device is None:
+            device = src.device if src is not None else self.fixed.device
+        if self.fixed.device != device:
+            self.fixed = self.fixed.to(device)
+        candidates = [self.fixed]
+
+        if self.table is not None and src is not None:
+            if self.table.device != device:
+                self.table = self.table.to(device)
+            translations = self.table.index_select(0, src.reshape(-1).unique().to(device)).view(-1)
+            candidates.append(translations[translations.ge(0)])
+
+        return torch.cat(candidates).unique()
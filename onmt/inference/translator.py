@@ -8,6 +8,7 @@ from ae.Autoencoder import Autoencoder
 import torch.nn.functional as F
 import sys
 from onmt.constants import add_tokenidx
+from onmt.inference.shared_encoder import EncoderCache
 from options import backward_compatible
 
 model_list = ['transformer', 'stochastic_transformer', 'fusion_network']
@@ -42,8 +43,9 @@ class Translator(object):
         self._type = 'text'
 
         for i, model_path in enumerate(models):
+            # (the checkpoints also pickle the options and the dictionaries)
             checkpoint = torch.load(model_path,
-                                    map_location=lambda storage, loc: storage)
+                                    map_location=lambda storage, loc: storage, weights_only=False)
 
             model_opt = checkpoint['opt']
             model_opt = backward_compatible(model_opt)
@@ -114,21 +116,48 @@ class Translator(object):
                     model, {torch.nn.LSTM, torch.nn.Linear}, dtype=torch.qint8
                 )
 
+            # chunk-wise encoding for streaming speech recognition
+            if hasattr(model, 'encoder') and hasattr(model.encoder, 'set_chunk_mode'):
+                if getattr(opt, 'encoder_chunk_size', 0) > 0:
+                    chunks = (opt.encoder_chunk_size, opt.encoder_left_context, opt.encoder_right_context)
+                else:
+                    # the chunks of the training (if any), with the block mask
+                    chunks = (model.encoder.chunk_size, model.encoder.chunk_left_context,
+                              model.encoder.chunk_right_context)
+
+                # encoding the chunks incrementally is only exact without look-ahead frames
+                # (the look-ahead frames are recomputed with each chunk)
+                cached = getattr(opt, 'encoder_cached_chunks', False)
+                if cached and chunks[0] > 0 and chunks[2] > 0:
+                    raise ValueError("-encoder_cached_chunks requires chunks without look-ahead frames "
+                                     "(right context: %d)" % chunks[2])
+
+                if chunks[0] > 0:
+                    model.encoder.set_chunk_mode(*chunks, cached=cached)
+
             model.eval()
 
             self.models.append(model)
             self.model_types.append(model_opt.model)
 
+        # the members with identical encoders share one, computed once per batch (within encoder_cache.caching())
+        self.encoder_cache = EncoderCache(self.models if not getattr(opt, 'no_encoder_sharing', False) else [])
+        for group in self.encoder_cache.groups:
+            print('[INFO] The models %s have identical encoders: the encoder is computed once per batch'
+                  % ', '.join(str(i) for i in group))
+
         # language model
         if opt.lm is not None:
             if opt.verbose:
                 print('Loading language model from %s' % opt.lm)
 
-            lm_chkpoint = torch.load(opt.lm, map_location=lambda storage, loc: storage)
+            lm_chkpoint = torch.load(opt.lm, map_location=lambda storage, loc: storage, weights_only=False)
 
             lm_opt = lm_chkpoint['opt']
 
             lm_model = build_language_model(lm_opt, checkpoint['dicts'])
+            lm_model.load_state_dict(lm_chkpoint['model'])
+            lm_model.eval()
 
             if opt.fp16:
                 lm_model = lm_model.half()
@@ -139,6 +168,8 @@ class Translator(object):
                 lm_model = lm_model.cpu()
 
             self.lm_model = lm_model
+        else:
+            self.lm_model = None
 
         self.cuda = opt.cuda
         self.ensemble_op = opt.ensemble_op
@@ -147,7 +178,7 @@ class Translator(object):
             if opt.verbose:
                 print('Loading autoencoder from %s' % opt.autoencoder)
             checkpoint = torch.load(opt.autoencoder,
-                                    map_location=lambda storage, loc: storage)
+                                    map_location=lambda storage, loc: storage, weights_only=False)
             model_opt = checkpoint['opt']
 
             # posSize= checkpoint['autoencoder']['nmt.decoder.positional_encoder.pos_emb'].size(0)
@@ -347,8 +378,9 @@ class Translator(object):
 
         decoder_states = dict()
 
-        for i in range(self.n_models):
-            decoder_states[i] = self.models[i].create_decoder_state(batch, beam_size)
+        with self.encoder_cache.caching():
+            for i in range(self.n_models):
+                decoder_states[i] = self.models[i].create_decoder_state(batch, beam_size)
 
         if self.opt.lm:
             lm_decoder_states = self.lm_model.create_decoder_state(batch, beam_size)
@@ -437,13 +469,9 @@ class Translator(object):
             hyps, attn, length = zip(*[beam[b].getHyp(k) for k in ks[:n_best]])
             all_hyp += [hyps]
             all_lengths += [length]
-            # if(src_data.data.dim() == 3):
-            if self.opt.encoder_type == 'audio':
-                valid_attn = decoder_states[0].original_src.narrow(2, 0, 1).squeeze(2)[:, b].ne(onmt.constants.PAD) \
-                    .nonzero().squeeze(1)
-            else:
-                valid_attn = decoder_states[0].original_src[:, b].ne(onmt.constants.PAD) \
-                    .nonzero().squeeze(1)
+            # for audio the decoding state keeps the padding flags of the input instead of the features
+            valid_attn = decoder_states[0].original_src[:, b].ne(onmt.constants.PAD) \
+                .nonzero().squeeze(1)
             # print(valid_attn)
             # for a in attn:
             #     print(a.shape)
@@ -1,6 +1,7 @@
 from onmt.metrics.bleu import *
 from onmt.metrics.gleu import *
 from onmt.metrics.sbleu import sentence_bleu
+from onmt.metrics.ngram_stats import ngram_statistics, batch_sentence_bleu, batch_sentence_gleu
 
 # For flake8 compatibility.
 __all__ = []
@@ -11,14 +11,13 @@
 from __future__ import division
 from collections import Counter
 
-from nltk.util import ngrams, everygrams
-from nltk.compat import string_types
 
-try:
-    from fractions import Fraction
-    Fraction(0, 1000, _normalize=False)
-except TypeError:
-    from nltk.compat import Fraction
+def everygrams(words, min_len=1, max_len=4):
+    """
+    :return: Counter of the n-grams (tuples) of the orders min_len to max_len
+    """
+    return Counter(tuple(words[i:i + n]) for n in range(min_len, max_len + 1) for i in range(len(words) - n + 1))
+
 
 def sentence_gleu(reference, hypothesis, min_len=1, max_len=4):
     """
@@ -87,15 +86,16 @@ def sentence_gleu(reference, hypothesis, min_len=1, max_len=4):
     :return: the sentence level GLEU score.
     :rtype: float
     """
-    hyp_ngrams = Counter(everygrams(hypothesis, min_len, max_len))
-    ref_ngrams = Counter(everygrams(reference, min_len, max_len))
-    tpfp = sum(hyp_ngrams.values()) 
+    # (for a single pair the Counters are faster than onmt.metrics.ngram_stats.batch_sentence_gleu,
+    # which gives the same scores for whole batches)
+    hyp_ngrams = everygrams(hypothesis, min_len, max_len)
+    ref_ngrams = everygrams(reference, min_len, max_len)
+    tpfp = sum(hyp_ngrams.values())
     tpfn = sum(ref_ngrams.values())
-    
-    overlap_ngrams = ref_ngrams & hyp_ngrams
-    tp = sum(overlap_ngrams.values())  # True positives, i.e. numerator.
-    n_all = max(tpfp, tpfn) # denominator.
-    this_gleu = Fraction(tp, n_all, _normalize=False)
+
+    tp = sum((ref_ngrams & hyp_ngrams).values())  # True positives, i.e. numerator.
+    n_all = max(tpfp, tpfn, 1)  # denominator (0 when both sentences have no n-gram).
+    this_gleu = tp / n_all
     return (float(this_gleu),)
     
     # While GLEU is defined as the minimum of precision and
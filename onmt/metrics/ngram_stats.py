@@ -0,0 +1,182 @@
+"""
+N-gram statistics of whole batches of hypotheses and references with numpy.
+
+The tokens are mapped to integer ids and every n-gram to one integer key (exact mixed-radix encoding when the
+vocabulary is small enough, a 64-bit rolling hash otherwise), so that the clipped n-gram matches of all the
+hypotheses are computed with a few sorts (np.unique / np.searchsorted) instead of string joins and dictionaries
+in Python loops.
+"""
+import numpy as np
+
+# multiplier of the rolling hash (int64 arithmetic wraps around)
+_HASH_BASE = np.int64(1000003)
+
+
+def _to_ids(hypotheses, references):
+    """
+    :param hypotheses: list of token lists (strings) or of integer sequences
+    :param references: list of token lists (the same type as the hypotheses)
+    :return: concatenated ids (int64) and the length of every sentence, for the hypotheses and the references
+    """
+    sentences = list(hypotheses) + list(references)
+    lengths = np.fromiter((len(sentence) for sentence in sentences), dtype=np.int64, count=len(sentences))
+    tokens = [token for sentence in sentences for token in sentence]
+
+    if len(tokens) == 0 or isinstance(tokens[0], (int, np.integer)):
+        ids = np.asarray(tokens, dtype=np.int64)
+    else:
+        # the strings are replaced by their index in the sorted vocabulary of the batch
+        _, ids = np.unique(np.asarray(tokens), return_inverse=True)
+        ids = ids.astype(np.int64).reshape(-1)
+
+    n_hyp_tokens = int(lengths[:len(hypotheses)].sum())
+    return (ids[:n_hyp_tokens], lengths[:len(hypotheses)]), (ids[n_hyp_tokens:], lengths[len(hypotheses):])
+
+
+class NgramStatistics(object):
+    """
+    N-gram keys of a batch of sentences: for every n-gram its sentence, its order (0 for unigrams) and its key.
+    The digits of the keys are the ids + 1, so the n-grams of different orders never have the same key.
+    """
+
+    def __init__(self, ids, lengths, max_order, radix):
+        """
+        :param ids: concatenated token ids of the sentences
+        :param lengths: number of tokens of every sentence
+        :param max_order: highest n-gram order
+        :param radix: number of distinct token ids + 1 (exact keys if radix ** max_order fits into int64)
+        """
+        self.lengths = lengths
+        self.max_order = max_order
+
+        sentence = np.repeat(np.arange(len(lengths)), lengths)
+        position = np.arange(len(ids)) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        self.hashed = radix ** max_order >= 2 ** 63
+        base = _HASH_BASE if self.hashed else np.int64(radix)
+
+        sentences, orders, keys = list(), list(), list()
+        key = np.zeros(len(ids), dtype=np.int64)
+        for n in range(max_order):
+            # the n-gram starting at i is extended with the token i + n (positions crossing sentences are dropped)
+            key = key[:len(ids) - n] * base + ids[n:] + 1
+            valid = position[:len(key)] + n < lengths[sentence[:len(key)]]
+            sentences.append(sentence[:len(key)][valid])
+            orders.append(np.full(int(valid.sum()), n, dtype=np.int64))
+            keys.append(key[valid])
+
+        self.sentences = np.concatenate(sentences)
+        self.orders = np.concatenate(orders)
+        self.keys = np.concatenate(keys)
+
+    def totals(self):
+        """
+        :return: number of n-grams of every sentence and order [n_sentences x max_order]
+        """
+        n = np.arange(self.max_order)
+        return np.maximum(self.lengths[:, None] - n[None, :], 0)
+
+
+def ngram_statistics(hypotheses, references, max_order=4, hyp_to_ref=None):
+    """
+    Clipped n-gram matches between every hypothesis and its reference
+    :param hypotheses: list of token lists (strings or integer ids)
+    :param references: list of token lists (the same type as the hypotheses)
+    :param max_order: highest n-gram order
+    :param hyp_to_ref: index of the reference of every hypothesis (e.g. for n-best lists), default: the same index
+    :return: dictionary of numpy arrays
+        matches:     clipped matches [n_hyps x max_order]
+        hyp_totals:  number of n-grams of the hypotheses [n_hyps x max_order]
+        ref_totals:  number of n-grams of their references [n_hyps x max_order]
+        hyp_lengths, ref_lengths: [n_hyps]
+    """
+    if hyp_to_ref is None:
+        assert len(hypotheses) == len(references), "The number of hypotheses and references must be the same"
+        hyp_to_ref = np.arange(len(hypotheses))
+    hyp_to_ref = np.asarray(hyp_to_ref, dtype=np.int64)
+
+    (hyp_ids, hyp_lengths), (ref_ids, ref_lengths) = _to_ids(hypotheses, references)
+    radix = int(max(hyp_ids.max(initial=-1), ref_ids.max(initial=-1))) + 2
+
+    hyp_stats = NgramStatistics(hyp_ids, hyp_lengths, max_order, radix)
+    ref_stats = NgramStatistics(ref_ids, ref_lengths, max_order, radix)
+
+    # one integer for every (sentence, n-gram) pair: the keys are replaced by their dense ranks if needed
+    hyp_keys, ref_keys = hyp_stats.keys, ref_stats.keys
+    n_sentences = max(len(hyp_lengths), len(ref_lengths), 1)
+    n_keys = radix ** max_order
+    if hyp_stats.hashed or n_sentences * n_keys >= 2 ** 63:
+        keys, ranks = np.unique(np.concatenate([hyp_keys, ref_keys]), return_inverse=True)
+        ranks = ranks.reshape(-1)
+        hyp_keys, ref_keys = ranks[:len(hyp_keys)], ranks[len(hyp_keys):]
+        n_keys = max(len(keys), 1)
+
+    # count every distinct n-gram of every sentence
+    ref_items, ref_counts = np.unique(ref_stats.sentences * n_keys + ref_keys, return_counts=True)
+    hyp_items, first, hyp_counts = np.unique(hyp_stats.sentences * n_keys + hyp_keys,
+                                             return_index=True, return_counts=True)
+    hyp_sents = hyp_items // n_keys
+    hyp_orders = hyp_stats.orders[first]
+
+    # the count of a hypothesis n-gram is clipped by its count in the reference
+    queries = hyp_to_ref[hyp_sents] * n_keys + hyp_items % n_keys
+    in_ref = np.zeros_like(queries)
+    if len(ref_items) > 0:
+        positions = np.minimum(np.searchsorted(ref_items, queries), len(ref_items) - 1)
+        in_ref = np.where(ref_items[positions] == queries, ref_counts[positions], 0)
+    clipped = np.minimum(hyp_counts, in_ref)
+
+    matches = np.bincount(hyp_sents * max_order + hyp_orders, weights=clipped,
+                          minlength=len(hypotheses) * max_order).astype(np.int64)
+
+    return {
+        'matches': matches.reshape(len(hypotheses), max_order),
+        'hyp_totals': hyp_stats.totals(),
+        'ref_totals': ref_stats.totals()[hyp_to_ref],
+        'hyp_lengths': hyp_lengths,
+        'ref_lengths': ref_lengths[hyp_to_ref]
+    }
+
+
+def batch_sentence_bleu(references, hypotheses, hyp_to_ref=None, max_order=4,
+                        smoothing=0.1, bp_smoothing=1.5):
+    """
+    The smoothed sentence BLEU of onmt.metrics.sbleu.sentence_bleu for a whole batch
+    :param references: list of token lists
+    :param hypotheses: list of token lists
+    :param hyp_to_ref: index of the reference of every hypothesis, default: the same index
+    :param max_order: highest n-gram order
+    :param smoothing: added to the matches and to the number of n-grams of each precision
+    :param bp_smoothing: added to the reference length in the brevity penalty
+    :return: numpy array with the score of every hypothesis
+    """
+    stats = ngram_statistics(hypotheses, references, max_order=max_order, hyp_to_ref=hyp_to_ref)
+    hyp_lengths = stats['hyp_lengths'].astype(np.float64)
+    ref_lengths = stats['ref_lengths'].astype(np.float64)
+
+    # the precisions of the orders longer than the hypothesis are skipped
+    precisions = (stats['matches'] + smoothing) / (stats['hyp_totals'] + smoothing)
+    precisions = np.where(stats['hyp_totals'] > 0, precisions, 1.0)
+    scores = np.prod(precisions, axis=1) ** (1.0 / max_order)
+
+    brevity_penalty = np.exp(1.0 - (ref_lengths + bp_smoothing) / np.maximum(hyp_lengths, 1))
+
+    return np.where(hyp_lengths > ref_lengths, scores, brevity_penalty * scores)
+
+
+def batch_sentence_gleu(references, hypotheses, hyp_to_ref=None, min_len=1, max_len=4):
+    """
+    The sentence GLEU of onmt.metrics.gleu.sentence_gleu for a whole batch
+    :param references: list of token lists
+    :param hypotheses: list of token lists
+    :param hyp_to_ref: index of the reference of every hypothesis, default: the same index
+    :param min_len: lowest n-gram order
+    :param max_len: highest n-gram order
+    :return: numpy array with the score of every hypothesis (0 when both sentences have no n-gram)
+    """
+    stats = ngram_statistics(hypotheses, references, max_order=max_len, hyp_to_ref=hyp_to_ref)
+
+    orders = slice(min_len - 1, max_len)
+    tp = stats['matches'][:, orders].sum(axis=1)
+    n_all = np.maximum(stats['hyp_totals'][:, orders].sum(axis=1), stats['ref_totals'][:, orders].sum(axis=1))
+
+    return tp / np.maximum(n_all, 1)
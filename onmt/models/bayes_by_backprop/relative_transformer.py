@@ -9,7 +9,7 @@ import onmt
 from onmt.modules.base_seq2seq import NMTModel, Reconstructor, DecoderState
 from onmt.modules.dropout import embedded_dropout
 from onmt.models.transformer_layers import PrePostProcessing
-from onmt.utils import flip, expected_length
+from onmt.utils import flip, expected_length, lengths_to_padding_mask
 from collections import defaultdict
 import math
 import sys
@@ -120,15 +120,13 @@ class RelativeTransformerEncoder(TransformerEncoder):
 
         else:
             if not self.cnn_downsampling:
-                mask_src = input.narrow(2, 0, 1).squeeze(2).transpose(0, 1).eq(onmt.constants.PAD).unsqueeze(0)
-                dec_attn_mask = input.narrow(2, 0, 1).squeeze(2).eq(onmt.constants.PAD).unsqueeze(1)
-                input = input.narrow(2, 1, input.size(2) - 1)
-                emb = self.audio_trans(input.contiguous().view(-1, input.size(2))).view(input.size(0),
-                                                                                        input.size(1), -1)
+                long_mask = lengths_to_padding_mask(kwargs['src_lengths'], input.size(1), device=input.device)
+                mask_src = long_mask.transpose(0, 1).unsqueeze(0)
+                dec_attn_mask = long_mask.unsqueeze(1)
+                emb = self.audio_trans(input)
                 emb = emb.type_as(input)
             else:
-                long_mask = input.narrow(2, 0, 1).squeeze(2).eq(onmt.constants.PAD)
-                input = input.narrow(2, 1, input.size(2) - 1)
+                long_mask = lengths_to_padding_mask(kwargs['src_lengths'], input.size(1), device=input.device)
 
                 # first resizing to fit the CNN format
                 input = input.view(input.size(0), input.size(1), -1, self.channels)
@@ -316,10 +314,10 @@ class RelativeTransformerDecoder(TransformerDecoder):
 
         if context is not None:
             if self.encoder_type == "audio":
+                long_mask = lengths_to_padding_mask(kwargs['src_lengths'], src.size(1), device=src.device)
                 if not self.encoder_cnn_downsampling:
-                    mask_src = src.narrow(2, 0, 1).squeeze(2).eq(onmt.constants.PAD).unsqueeze(1)
+                    mask_src = long_mask.unsqueeze(1)
                 else:
-                    long_mask = src.data.narrow(2, 0, 1).squeeze(2).eq(onmt.constants.PAD)
                     mask_src = long_mask[:, 0:context.size(0) * 4:4].unsqueeze(1)
             else:
                     mask_src = src.eq(onmt.constants.PAD).unsqueeze(1)
@@ -435,10 +433,10 @@ class RelativeTransformerDecoder(TransformerDecoder):
 
         if context is not None:
             if self.encoder_type == "audio":
+                long_mask = src.eq(onmt.constants.PAD)
                 if not self.encoder_cnn_downsampling:
-                    mask_src = src.narrow(2, 0, 1).squeeze(2).eq(onmt.constants.PAD).unsqueeze(1)
+                    mask_src = long_mask.unsqueeze(1)
                 else:
-                    long_mask = src.data.narrow(2, 0, 1).squeeze(2).eq(onmt.constants.PAD)
                     mask_src = long_mask[:, 0:context.size(0) * 4:4].unsqueeze(1)
             else:
 
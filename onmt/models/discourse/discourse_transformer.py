@@ -1,5 +1,5 @@
 # Transformer with discourse information
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 import onmt
 import torch
 import torch.nn as nn
@@ -8,6 +8,7 @@ from ..speech_recognizer.relative_transformer_layers import \
     RelativeTransformerEncoderLayer, RelativeTransformerDecoderLayer
 from onmt.models.transformers import Transformer, TransformerDecodingState
 from onmt.modules.pre_post_processing import PrePostProcessing
+from onmt.utils import lengths_to_padding_mask
 
 from .gate_layer import RelativeGateEncoderLayer
 
@@ -28,28 +29,131 @@ class DiscourseTransformerEncoder(nn.Module):
 
         self.postprocess_layer = PrePostProcessing(opt.model_size, 0.0, sequence='n')
 
-    def forward(self, input, past_input=None, input_lang=None, factorize=False):
+        # training: reuse the encoding of a current utterance that is also the past input of another sample
+        self.reuse_past_encoding = opt.reuse_past_encoding
+        # inference: encoder outputs of the latest utterances (by utterance id), see set_past_cache
+        self.past_cache = None
+        self.past_cache_size = 0
 
+    def set_past_cache(self, cache_size):
+        """
+        Keep the encoder outputs of the last cache_size utterances during inference,
+        so that the past context of an utterance is not encoded again if it was translated before
+        :param cache_size: 0 to disable the cache
+        :return:
+        """
+        self.past_cache_size = cache_size
+        self.past_cache = OrderedDict() if cache_size > 0 else None
+
+    def _match_current_inputs(self, input, src_lengths, past_input, past_src_lengths):
+        """
+        :return: for each past input, the index of the identical current input in the batch (or -1)
+        """
+        # fingerprints of the inputs (the padded positions are zero) to find the candidates
+        weights = torch.arange(1, input.size(1) + 1, device=input.device, dtype=torch.float)
+        fingerprints = (input.float().sum(-1) * weights.unsqueeze(0)).sum(-1).tolist()
+        past_weights = torch.arange(1, past_input.size(1) + 1, device=past_input.device, dtype=torch.float)
+        past_fingerprints = (past_input.float().sum(-1) * past_weights.unsqueeze(0)).sum(-1).tolist()
+        lengths, past_lengths = src_lengths.tolist(), past_src_lengths.tolist()
+
+        matches = list()
+        for b, (past_length, past_fingerprint) in enumerate(zip(past_lengths, past_fingerprints)):
+            match = -1
+            for k, (length, fingerprint) in enumerate(zip(lengths, fingerprints)):
+                # (the fingerprints are only approximately equal for different padded lengths)
+                if length == past_length and abs(fingerprint - past_fingerprint) <= 1e-4 * (abs(fingerprint) + 1) \
+                        and torch.equal(input[k, :length], past_input[b, :length]):
+                    match = k
+                    break
+            matches.append(match)
+
+        return matches
+
+    def encode_past(self, past_input, past_src_lengths, reused, input_lang=None, factorize=False):
+        """
+        Encode the past inputs, except the ones with an already known encoder output
+        :param past_input: [B x T x F] tensor
+        :param past_src_lengths: [B] tensor
+        :param reused: list (for each past input) of [length x H] encoder outputs, or None to encode the input
+        :return: [T x B x H] past context
+        """
+        missing = [b for b, context in enumerate(reused) if context is None]
+
+        if len(missing) == len(reused):
+            return self.encoder(past_input, input_lang=input_lang, factorize=factorize,
+                                src_lengths=past_src_lengths)['context']
+
+        contexts = list(reused)
+        if len(missing) > 0:
+            index = torch.tensor(missing, dtype=torch.long, device=past_input.device)
+            missing_lengths = past_src_lengths.index_select(0, index)
+            missing_input = past_input.index_select(0, index).narrow(1, 0, int(missing_lengths.max()))
+            missing_context = self.encoder(missing_input, input_lang=input_lang, factorize=factorize,
+                                           src_lengths=missing_lengths)['context']
+
+            for j, (b, length) in enumerate(zip(missing, missing_lengths.tolist())):
+                contexts[b] = missing_context[:length, j]
+
+        past_context = nn.utils.rnn.pad_sequence(contexts)
+        if past_context.size(0) < past_input.size(1):
+            past_context = F.pad(past_context, (0, 0, 0, 0, 0, past_input.size(1) - past_context.size(0)))
+
+        return past_context
+
+    def forward(self, input, past_input=None, input_lang=None, factorize=False,
+                src_lengths=None, past_src_lengths=None, utterance_ids=None, past_utterance_ids=None):
+        """
+        :param input: [B x T x F] current utterances
+        :param past_input: [B x T' x F] previous utterances
+        :param utterance_ids: ids of the current utterances (to fill the cache during inference)
+        :param past_utterance_ids: ids of the previous utterances (to look up the cache during inference)
+        """
         assert past_input is not None
 
         # the same encoder is used to encode the previous and current segment
-        past_encoder_output = self.encoder(past_input, input_lang=input_lang, factorize=factorize)
-        #
-        past_context = past_encoder_output['context']
-        past_pos_emb = past_encoder_output['pos_emb']
+        encoder_output = self.encoder(input, input_lang=input_lang, factorize=factorize, src_lengths=src_lengths)
+
+        current_context = encoder_output['context']
+        current_pos_emb = encoder_output['pos_emb']
 
-        encoder_output = self.encoder(input, input_lang=input_lang, factorize=factorize)
+        reused = [None] * past_input.size(0)
+        use_cache = self.past_cache is not None and not self.training and \
+            utterance_ids is not None and past_utterance_ids is not None
+        if use_cache:
+            # the past utterance is in the batch (e.g. consecutive utterances of a stream), or was translated before
+            current_index = {utterance_id: k for k, utterance_id in enumerate(utterance_ids)}
+            lengths = src_lengths.tolist()
+            for b, utterance_id in enumerate(past_utterance_ids):
+                k = current_index.get(utterance_id)
+                if k is not None:
+                    reused[b] = current_context[:lengths[k], k]
+                elif utterance_id in self.past_cache:
+                    self.past_cache.move_to_end(utterance_id)
+                    reused[b] = self.past_cache[utterance_id]
+        elif self.training and self.reuse_past_encoding:
+            matches = self._match_current_inputs(input, src_lengths, past_input, past_src_lengths)
+            for b, (k, length) in enumerate(zip(matches, past_src_lengths.tolist())):
+                if k >= 0:
+                    reused[b] = current_context[:length, k]
+
+        past_context = self.encode_past(past_input, past_src_lengths, reused,
+                                        input_lang=input_lang, factorize=factorize)
+
+        if use_cache:
+            for b, (utterance_id, length) in enumerate(zip(utterance_ids, src_lengths.tolist())):
+                self.past_cache[utterance_id] = current_context[:length, b].detach()
+                self.past_cache.move_to_end(utterance_id)
+            while len(self.past_cache) > self.past_cache_size:
+                self.past_cache.popitem(last=False)
 
         # past_mask_src = past_input.narrow(2, 0, 1).squeeze(2).transpose(0, 1).eq(onmt.constants.PAD).unsqueeze(0)
         # past_context = self.past_layer(past_context, past_pos_emb, past_mask_src,
         #                                src_lang=input_lang, factorize=factorize)
 
-        current_context = encoder_output['context']
-        current_pos_emb = encoder_output['pos_emb']
-
-        mask_src = input.narrow(2, 0, 1).squeeze(2).transpose(0, 1).eq(onmt.constants.PAD).unsqueeze(0)
-        past_mask = past_input.narrow(2, 0, 1).squeeze(2).eq(onmt.constants.PAD).unsqueeze(1)
-        dec_attn_mask = input.narrow(2, 0, 1).squeeze(2).eq(onmt.constants.PAD).unsqueeze(1)
+        long_mask = lengths_to_padding_mask(src_lengths, input.size(1), device=input.device)
+        mask_src = long_mask.transpose(0, 1).unsqueeze(0)
+        past_mask = lengths_to_padding_mask(past_src_lengths, past_input.size(1), device=past_input.device).unsqueeze(1)
+        dec_attn_mask = long_mask.unsqueeze(1)
         context = self.gate_layer(current_context, past_context, current_pos_emb, mask_src, past_mask,
                                    src_lang=input_lang, factorize=factorize)
         # context = current_context
@@ -60,8 +164,6 @@ class DiscourseTransformerEncoder(nn.Module):
         output_dict = defaultdict(lambda: None, {'context': context, 'src_mask': dec_attn_mask,
                                                  'src': input, 'pos_emb': current_pos_emb})
 
-        del past_encoder_output
-
         return output_dict
 
 
@@ -102,7 +204,8 @@ class DiscourseTransformer(Transformer):
 
         # Encoder has to receive different inputs
         encoder_output = self.encoder(src, past_input=past_src, input_lang=src_lang,
-                                      factorize=factorize)
+                                      factorize=factorize, src_lengths=src_lengths,
+                                      past_src_lengths=batch.get('past_src_lengths'))
 
         encoder_output = defaultdict(lambda: None, encoder_output)
         context = encoder_output['context']
@@ -208,16 +311,20 @@ class DiscourseTransformer(Transformer):
         src_lang = batch.get('source_lang')
         tgt_lang = batch.get('target_lang')
         past_src = batch.get('past_source')
+        src_lengths = batch.src_lengths
 
         src_transposed = src.transpose(0, 1)
         # encoder_output = self.encoder(src_transposed, input_pos=src_pos, input_lang=src_lang)
         encoder_output = self.encoder(src_transposed, past_input=past_src.transpose(0, 1), input_lang=src_lang,
-                                      factorize=factorize)
+                                      factorize=factorize, src_lengths=src_lengths,
+                                      past_src_lengths=batch.get('past_src_lengths'),
+                                      utterance_ids=batch.get('utterance_ids'),
+                                      past_utterance_ids=batch.get('past_utterance_ids'))
 
         # The decoding state is still the same?
         print("[INFO] create Transformer decoding state with buffering", buffering)
         decoder_state = TransformerDecodingState(src, tgt_lang, encoder_output['context'], src_lang,
                                                  beam_size=beam_size, model_size=self.model_size,
-                                                 type=type, buffering=buffering)
+                                                 type=type, buffering=buffering, src_lengths=src_lengths)
 
         return decoder_state
\ No newline at end of file
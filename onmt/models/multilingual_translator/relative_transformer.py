@@ -14,7 +14,7 @@ from .relative_transformer_layers import RelativeTransformerEncoderLayer, Relati
 from .reversible_transformers import ReversibleTransformerEncoderLayer, reversible_encoder
 from .reversible_transformers import ReversibleTransformerDecoderLayer, reversible_decoder
 from onmt.modules.identity import Identity
-from onmt.utils import flip, expected_length
+from onmt.utils import flip, expected_length, lengths_to_padding_mask
 from collections import defaultdict
 import math
 import sys
@@ -440,10 +440,10 @@ class RelativeTransformerDecoder(TransformerDecoder):
 
         if context is not None:
             if self.encoder_type == "audio":
+                long_mask = src.eq(onmt.constants.PAD)
                 if not self.encoder_cnn_downsampling:
-                    mask_src = src.narrow(2, 0, 1).squeeze(2).eq(onmt.constants.PAD).unsqueeze(1)
+                    mask_src = long_mask.unsqueeze(1)
                 else:
-                    long_mask = src.data.narrow(2, 0, 1).squeeze(2).eq(onmt.constants.PAD)
                     mask_src = long_mask[:, 0:context.size(0) * 4:4].unsqueeze(1)
             else:
                 mask_src = src.eq(onmt.constants.PAD).unsqueeze(1)
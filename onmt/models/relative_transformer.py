@@ -12,7 +12,7 @@ from onmt.models.transformer_layers import XavierLinear, MultiHeadAttention, Fee
 from onmt.models.relative_transformer_layers import RelativeTransformerEncoderLayer, RelativeTransformerDecoderLayer
 from onmt.reversible_models.relative_transformers import ReversibleEncoderFunction, ReversibleDecoderFunction, \
     ReversibleTransformerDecoderLayer, ReversibleTransformerEncoderLayer
-from onmt.utils import flip, expected_length
+from onmt.utils import flip, expected_length, lengths_to_padding_mask
 from collections import defaultdict
 import math
 import sys
@@ -186,15 +186,13 @@ class RelativeTransformerEncoder(TransformerEncoder):
                 raise NotImplementedError
 
             if not self.cnn_downsampling:
-                mask_src = input.narrow(2, 0, 1).squeeze(2).transpose(0, 1).eq(onmt.constants.PAD).unsqueeze(0)
-                dec_attn_mask = input.narrow(2, 0, 1).squeeze(2).eq(onmt.constants.PAD).unsqueeze(1)
-                input = input.narrow(2, 1, input.size(2) - 1)
-                emb = self.audio_trans(input.contiguous().view(-1, input.size(2))).view(input.size(0),
-                                                                                        input.size(1), -1)
+                long_mask = lengths_to_padding_mask(kwargs['src_lengths'], input.size(1), device=input.device)
+                mask_src = long_mask.transpose(0, 1).unsqueeze(0)
+                dec_attn_mask = long_mask.unsqueeze(1)
+                emb = self.audio_trans(input)
                 emb = emb.type_as(input)
             else:
-                long_mask = input.narrow(2, 0, 1).squeeze(2).eq(onmt.constants.PAD)
-                input = input.narrow(2, 1, input.size(2) - 1)
+                long_mask = lengths_to_padding_mask(kwargs['src_lengths'], input.size(1), device=input.device)
 
                 # first resizing to fit the CNN format
                 input = input.view(input.size(0), input.size(1), -1, self.channels)
@@ -521,10 +519,10 @@ class RelativeTransformerDecoder(TransformerDecoder):
 
         if context is not None:
             if self.encoder_type == "audio":
+                long_mask = lengths_to_padding_mask(kwargs['src_lengths'], src.size(1), device=src.device)
                 if not self.encoder_cnn_downsampling:
-                    mask_src = src.narrow(2, 0, 1).squeeze(2).eq(onmt.constants.PAD).unsqueeze(1)
+                    mask_src = long_mask.unsqueeze(1)
                 else:
-                    long_mask = src.data.narrow(2, 0, 1).squeeze(2).eq(onmt.constants.PAD)
                     mask_src = long_mask[:, 0:context.size(0) * 4:4].unsqueeze(1)
             else:
                 if streaming:
@@ -686,10 +684,10 @@ class RelativeTransformerDecoder(TransformerDecoder):
 
         if context is not None:
             if self.encoder_type == "audio":
+                long_mask = src.eq(onmt.constants.PAD)
                 if not self.encoder_cnn_downsampling:
-                    mask_src = src.narrow(2, 0, 1).squeeze(2).eq(onmt.constants.PAD).unsqueeze(1)
+                    mask_src = long_mask.unsqueeze(1)
                 else:
-                    long_mask = src.data.narrow(2, 0, 1).squeeze(2).eq(onmt.constants.PAD)
                     mask_src = long_mask[:, 0:context.size(0) * 4:4].unsqueeze(1)
             else:
                 mask_src = src.eq(onmt.constants.PAD).unsqueeze(1)
@@ -860,7 +858,7 @@ class RelativeTransformer(Transformer):
             # if the previous stream is None (the first segment in the stream)
             # then proceed normally like normal translation
             # init a new stream state
-            self.init_stream() if streaming else None
+            streaming_state = self.init_stream() if streaming else None
 
             encoder_output = self.encoder(src_transposed, input_pos=src_pos,
                                           input_lang=src_lang, src_lengths=src_lengths,
@@ -875,7 +873,8 @@ class RelativeTransformer(Transformer):
             else:
                 decoder_state = TransformerDecodingState(src, tgt_lang, encoder_output['context'],
                                                          encoder_output['src_mask'],
-                                                         beam_size=beam_size, model_size=self.model_size, type=type)
+                                                         beam_size=beam_size, model_size=self.model_size, type=type,
+                                                         src_lengths=src_lengths)
         else:
             streaming_state = previous_decoding_state.streaming_state
 
@@ -14,6 +14,7 @@ from onmt.modules.attention import MultiHeadAttention
 from onmt.modules.optimized.encdec_attention import EncdecMultiheadAttn
 from onmt.modules.dropout import embedded_dropout
 from onmt.models.discourse.relative_transformer_layers import LIDFeedForward_small
+from onmt.utils import lengths_to_padding_mask
 
 
 class SpeechLSTMEncoder(nn.Module):
@@ -127,18 +128,16 @@ class SpeechLSTMEncoder(nn.Module):
     #
     #     return seq_2, hid
 
-    def forward(self, input, hid=None):
+    def forward(self, input, hid=None, src_lengths=None):
         # print(input)
         if not self.cnn_downsampling:
-            mask_src = input.narrow(2, 0, 1).squeeze(2).gt(onmt.constants.PAD)
-            input = input.narrow(2, 1, input.size(2) - 1)
+            mask_src = lengths_to_padding_mask(src_lengths, input.size(1), device=input.device).logical_not()
             emb = self.audio_trans(input.contiguous().view(-1, input.size(2))).view(input.size(0),
                                                                                     input.size(1), -1)
             emb = emb.type_as(input)
         else:
 
-            long_mask = input.narrow(2, 0, 1).squeeze(2).gt(onmt.constants.PAD)
-            input = input.narrow(2, 1, input.size(2) - 1)
+            long_mask = lengths_to_padding_mask(src_lengths, input.size(1), device=input.device).logical_not()
             # first resizing to fit the CNN format
             input = input.view(input.size(0), input.size(1), -1, self.channels)
             input = input.permute(0, 3, 1, 2)
@@ -456,14 +455,13 @@ class SpeechAE(nn.Module):
         src_lengths_org = batch.get('src_lengths_org')
         src = src.transpose(0, 1)  # transpose to have batch first
 
-        encoder_output = self.encoder(src)
+        encoder_output = self.encoder(src, src_lengths=src_lengths)
         encoder_output = defaultdict(lambda: None, encoder_output)
         context = encoder_output['context']
         src_mask = encoder_output['src_mask']
         context = context.transpose(0, 1)
 
-        decoder_input = src_org.narrow(2, 1, src_org.size(2) - 1)
-        decoder_input = decoder_input.permute(1, 2, 0)
+        decoder_input = src_org.permute(1, 2, 0)
         mel_outputs, gate_outputs, alignments = self.tacotron_decoder(
             src_mask, context, decoder_input)
 
@@ -474,8 +472,11 @@ class SpeechAE(nn.Module):
             [mel_outputs, mel_outputs_postnet, gate_outputs, alignments],
             src_lengths_org)
 
-    def inference(self, input):
-        encoder_output = self.encoder(input)
+    def inference(self, input, src_lengths=None):
+        if src_lengths is None:
+            # a single unpadded utterance (or a batch of equal length)
+            src_lengths = torch.full((input.size(0),), input.size(1), dtype=torch.long)
+        encoder_output = self.encoder(input, src_lengths=src_lengths)
         context = encoder_output['context']
         context = context.transpose(0, 1)
         mel_outputs, gate_outputs, alignments = self.tacotron_decoder.inference(
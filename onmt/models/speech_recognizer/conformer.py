@@ -11,7 +11,7 @@ from onmt.modules.convolution import Conv2dSubsampling
 from onmt.models.transformer_layers import PrePostProcessing
 from onmt.models.discourse.relative_transformer_layers import RelativeTransformerEncoderLayer, RelativeTransformerDecoderLayer
 from .conformer_layers import ConformerEncoderLayer
-from onmt.utils import flip, expected_length
+from onmt.utils import flip, expected_length, lengths_to_padding_mask
 from collections import defaultdict
 import math
 import sys
@@ -67,18 +67,18 @@ class ConformerEncoder(TransformerEncoder):
             block = ConformerEncoderLayer(self.opt, death_rate=death_r)
             self.layer_modules.append(block)
 
-    def forward(self, input, input_pos=None, input_lang=None, streaming=False, **kwargs):
+    def forward(self, input, input_pos=None, input_lang=None, streaming=False, src_lengths=None, **kwargs):
         """
         :param input: [B x T x Input_Size]
         :param input_pos: [B x T] positions
         :param input_lang: [B] language ids of each sample
         :param streaming: connect different segments in transformer-xl style
+        :param src_lengths: [B] lengths of the (left-aligned) input
         :param kwargs:
         :return:
         """
 
-        long_mask = input.narrow(2, 0, 1).squeeze(2).eq(onmt.constants.PAD)
-        input = input.narrow(2, 1, input.size(2) - 1)
+        long_mask = lengths_to_padding_mask(src_lengths, input.size(1), device=input.device)
 
         # first subsampling
         input = input.view(input.size(0), input.size(1), -1, self.channels)
@@ -187,7 +187,7 @@ class Conformer(NMTModel):
         src = src.transpose(0, 1)  # transpose to have batch first
         tgt = tgt.transpose(0, 1)
 
-        encoder_output = self.encoder(src, input_lang=src_lang)
+        encoder_output = self.encoder(src, input_lang=src_lang, src_lengths=src_lengths)
         encoder_output = defaultdict(lambda: None, encoder_output)
 
         context = encoder_output['context']
@@ -256,14 +256,15 @@ class Conformer(NMTModel):
         src_pos = batch.get('source_pos')
         src_lang = batch.get('source_lang')
         tgt_lang = batch.get('target_lang')
+        src_lengths = batch.src_lengths
 
         # TxB -> BxT
         src_transposed = src.transpose(0, 1)
 
-        encoder_output = self.encoder(src_transposed, input_lang=src_lang)
+        encoder_output = self.encoder(src_transposed, input_lang=src_lang, src_lengths=src_lengths)
         decoder_state = LSTMDecodingState(src, tgt_lang, encoder_output['context'],
                                                  beam_size=beam_size, model_size=self.model_size,
-                                                 type=type, buffering=buffering)
+                                                 type=type, buffering=buffering, src_lengths=src_lengths)
 
         return decoder_state
 
@@ -276,19 +277,20 @@ class Conformer(NMTModel):
         # tgt_atb = batch.get('target_atb')  # a dictionary of attributes
         src_lang = batch.get('source_lang')
         tgt_lang = batch.get('target_lang')
+        src_lengths = batch.src_lengths
 
         src = src.transpose(0, 1)
         tgt_input = tgt_input.transpose(0, 1)
         batch_size = tgt_input.size(0)
 
-        context = self.encoder(src)['context']
+        context = self.encoder(src, src_lengths=src_lengths)['context']
 
         gold_scores = context.new(batch_size).zero_()
         gold_words = 0
         allgold_scores = list()
 
         decoder_output = self.decoder(tgt_input, context, src, tgt_lang=tgt_lang, src_lang=src_lang,
-                                      input_pos=tgt_pos)['hidden']
+                                      input_pos=tgt_pos, src_lengths=src_lengths)['hidden']
 
         output = decoder_output
 
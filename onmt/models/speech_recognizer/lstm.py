@@ -13,6 +13,7 @@ from onmt.modules.attention import MultiHeadAttention
 from onmt.modules.optimized.encdec_attention import EncdecMultiheadAttn
 from onmt.modules.dropout import embedded_dropout, switchout
 from onmt.models.transformer_layers import EncoderLayer, DecoderLayer
+from onmt.utils import lengths_to_padding_mask
 import random
 import time
 
@@ -114,19 +115,18 @@ class SpeechLSTMEncoder(nn.Module):
         return seq, hid
 
     def forward(self, input, input_pos=None, input_lang=None, hid=None,
-                return_states=False, pretrained_layer_states=None, **kwargs):
+                return_states=False, pretrained_layer_states=None, src_lengths=None, **kwargs):
+
+        pad_mask = lengths_to_padding_mask(src_lengths, input.size(1), device=input.device)
 
         if not self.cnn_downsampling:
-            mask_src = input.narrow(2, 0, 1).squeeze(2).gt(onmt.constants.PAD)
-            dec_attn_mask = input.narrow(2, 0, 1).squeeze(2).eq(onmt.constants.PAD)
-            input = input.narrow(2, 1, input.size(2) - 1)
-            emb = self.audio_trans(input.contiguous().view(-1, input.size(2))).view(input.size(0),
-                                                                                    input.size(1), -1)
+            mask_src = pad_mask.logical_not()
+            dec_attn_mask = pad_mask
+            emb = self.audio_trans(input)
             emb = emb.type_as(input)
         else:
-            long_mask = input.narrow(2, 0, 1).squeeze(2).gt(onmt.constants.PAD)
+            long_mask = pad_mask.logical_not()
 
-            input = input.narrow(2, 1, input.size(2) - 1)
             # first resizing to fit the CNN format
             input = input.view(input.size(0), input.size(1), -1, self.channels)
             input = input.permute(0, 3, 1, 2)
@@ -294,13 +294,8 @@ class SpeechLSTMDecoder(nn.Module):
 
         if context is not None:
             if self.encoder_type == "audio":
-                if src.data.dim() == 3:
-                    if self.encoder_cnn_downsampling:
-                        long_mask = src.data.narrow(2, 0, 1).squeeze(2).eq(onmt.constants.PAD)
-                        mask_src = long_mask[:, 0:context.size(0) * 4:4].unsqueeze(1)
-                    else:
-                        mask_src = src.narrow(2, 0, 1).squeeze(2).eq(onmt.constants.PAD).unsqueeze(1)
-                elif self.encoder_cnn_downsampling:
+                # the decoding state only keeps the padding information of the audio input
+                if self.encoder_cnn_downsampling:
                     long_mask = src.eq(onmt.constants.PAD)
                     mask_src = long_mask[:, 0:context.size(0) * 4:4].unsqueeze(1)
                 else:
@@ -384,10 +379,10 @@ class SpeechLSTMDecoder(nn.Module):
 
         if enc_out is not None:
             if self.encoder_type == "audio":
+                long_mask = lengths_to_padding_mask(kwargs['src_lengths'], src.size(1), device=src.device)
                 if not self.encoder_cnn_downsampling:
-                    mask_src = src.data.narrow(2, 0, 1).squeeze(2).eq(onmt.constants.PAD).unsqueeze(1)
+                    mask_src = long_mask.unsqueeze(1)
                 else:
-                    long_mask = src.data.narrow(2, 0, 1).squeeze(2).eq(onmt.constants.PAD)
                     mask_src = long_mask[:, 0: enc_out.size(0) * 4:4].unsqueeze(1)
             else:
 
@@ -538,7 +533,7 @@ class SpeechLSTMSeq2Seq(NMTModel):
         encoder_output = self.encoder(src_transposed, input_pos=src_pos, input_lang=src_lang, src_lengths=src_lengths)
         decoder_state = LSTMDecodingState(src, tgt_lang, encoder_output['context'],
                                                  beam_size=beam_size, model_size=self.model_size,
-                                                 type=type, buffering=buffering)
+                                                 type=type, buffering=buffering, src_lengths=src_lengths)
 
         return decoder_state
 
@@ -564,7 +559,7 @@ class SpeechLSTMSeq2Seq(NMTModel):
         allgold_scores = list()
 
         decoder_output = self.decoder(tgt_input, context, src, tgt_lang=tgt_lang, src_lang=src_lang,
-                                      input_pos=tgt_pos)['hidden']
+                                      input_pos=tgt_pos, src_lengths=src_lengths)['hidden']
 
         output = decoder_output
 
@@ -594,7 +589,13 @@ class SpeechLSTMSeq2Seq(NMTModel):
 class LSTMDecodingState(DecoderState):
 
     def __init__(self, src, tgt_lang, context, beam_size=1, model_size=512, type=2,
-                 cloning=True, buffering=False):
+                 cloning=True, buffering=False, src_lengths=None):
+
+        # for audio only the padding information is kept (1 for frames and 0 for padding) instead of the features
+        if src is not None and src.dim() == 3:
+            assert src_lengths is not None, "The lengths of the audio input are required for decoding."
+            src = lengths_to_padding_mask(src_lengths, src.size(0), device=src.device).t().logical_not().long()
+
         self.beam_size = beam_size
         self.model_size = model_size
         self.lstm_buffer = dict()
@@ -604,17 +605,11 @@ class LSTMDecodingState(DecoderState):
         self.attention_buffers = defaultdict(lambda: None)
 
         if type == 1:
-            # if audio only take one dimension since only used for mask
-            # raise NotImplementedError
-            self.original_src = src  # TxBxC
+            self.original_src = src  # TxB
             self.concat_input_seq = True
 
             if src is not None:
-                if src.dim() == 3:
-                    self.src = src.narrow(2, 0, 1).squeeze(2).repeat(1, beam_size)
-                    # self.src = src.repeat(1, beam_size, 1) # T x Bb x c
-                else:
-                    self.src = src.repeat(1, beam_size)
+                self.src = src.repeat(1, beam_size)
             else:
                 self.src = None
 
@@ -10,7 +10,7 @@ import onmt
 from onmt.modules.base_seq2seq import NMTModel, Reconstructor, DecoderState
 from onmt.modules.dropout import embedded_dropout
 from .relative_transformer_layers import RelativeTransformerEncoderLayer, RelativeTransformerDecoderLayer
-from onmt.utils import flip, expected_length
+from onmt.utils import flip, expected_length, lengths_to_padding_mask
 from collections import defaultdict
 import math
 import sys
@@ -28,6 +28,34 @@ def create_forward_function(module):
     return forward_pass
 
 
+def streaming_chunk_mask(pad_mask, chunk_size, left_context=-1, right_context=0):
+    """
+    Block mask for chunk-wise (streaming) encoding
+    A frame in a chunk attends to the frames of the same chunk, to right_context frames after the chunk
+    and to left_context frames before the chunk (all previous frames if left_context < 0)
+    :param pad_mask: [B x T] bool tensor, True at the padded positions
+    :param chunk_size: number of frames per chunk
+    :param left_context:
+    :param right_context:
+    :return: [B x T x T] bool tensor, True at the masked positions
+    """
+    seq_len = pad_mask.size(1)
+    pos = torch.arange(seq_len, device=pad_mask.device)
+    chunk_start = pos - pos.remainder(chunk_size)
+
+    # [T_q x T_k]
+    visible = pos.unsqueeze(0).lt((chunk_start + chunk_size + right_context).unsqueeze(1))
+    if left_context >= 0:
+        visible = visible & pos.unsqueeze(0).ge((chunk_start - left_context).unsqueeze(1))
+
+    mask = pad_mask.unsqueeze(1) | ~visible.unsqueeze(0)
+
+    # a frame always attends to itself so that the padded queries don't have fully masked rows
+    mask[:, pos, pos] = False
+
+    return mask
+
+
 class SpeechTransformerEncoder(TransformerEncoder):
 
     def __init__(self, opt, dicts, positional_encoder, encoder_type='text', language_embeddings=None):
@@ -69,6 +97,9 @@ class SpeechTransformerEncoder(TransformerEncoder):
 
         self.d_head = self.model_size // self.n_heads
 
+        # chunk-wise streaming encoding (0 = full utterance). Training uses the block mask
+        self.set_chunk_mode(opt.chunk_size, opt.chunk_left_context, opt.chunk_right_context, cached=False)
+
         if self.multilingual_linear_projection:
             self.linear_proj = nn.Parameter(torch.Tensor(opt.n_languages, self.model_size, self.model_size))
 
@@ -99,8 +130,106 @@ class SpeechTransformerEncoder(TransformerEncoder):
             block = RelativeTransformerEncoderLayer(self.opt, death_rate=death_r)
             self.layer_modules.append(block)
 
+        if self.opt.chunk_size > 0:
+            print("* Chunk-wise encoding with %d frames per chunk, left context %d and right context %d"
+                  % (self.opt.chunk_size, self.opt.chunk_left_context, self.opt.chunk_right_context))
+
+    def set_chunk_mode(self, chunk_size, left_context=-1, right_context=0, cached=True):
+        """
+        Encode the input chunk by chunk (streaming)
+        :param chunk_size: number of encoder frames per chunk. 0 disables chunking
+        :param left_context: number of frames before the chunk that can be attended (-1 = all)
+        :param right_context: number of look-ahead frames after the chunk
+        :param cached: in evaluation, encode one chunk after another and reuse the cached keys/values
+                       of the left context instead of masking the whole utterance
+        :return:
+        """
+        if chunk_size > 0:
+            assert not self.unidirectional, "Chunk-wise encoding and unidirectional encoder are exclusive."
+            assert not self.reversible, "Chunk-wise encoding is not supported with the reversible encoder."
+            assert not self.opt.depthwise_conv, "Chunk-wise encoding is not supported with depthwise convolution."
+
+        self.chunk_size = chunk_size
+        self.chunk_left_context = left_context
+        self.chunk_right_context = right_context
+        self.chunk_cached = cached
+
+    def chunk_position_encoding(self, qlen, klen, emb):
+        """
+        Relative positions between qlen queries and klen keys, the queries are the last qlen keys
+        """
+        if not self.learnable_position_encoding:
+            pos = torch.arange(klen - 1, -qlen, -1.0, device=emb.device, dtype=emb.dtype)
+            pos_emb = self.positional_encoder(pos, bsz=emb.size(1))
+            pos_emb = self.preprocess_layer(pos_emb)
+        else:
+            range_k = torch.arange(klen, device=emb.device)
+            range_q = range_k[klen - qlen:]
+            distance_mat = range_k.unsqueeze(0) - range_q.unsqueeze(1)
+            distance_mat.clamp_(-self.max_pos_length, self.max_pos_length).add_(self.max_pos_length)
+            pos_emb = distance_mat
+
+        return pos_emb
+
+    def forward_chunks(self, context, pad_mask, input_lang=None, factorize=False):
+        """
+        Encode the chunks one after another with the keys/values of the left context cached in each layer.
+        Each chunk is encoded together with its look-ahead frames, but only the outputs and keys/values of
+        the chunk frames are kept. The result is the same as the block-masked forward when right_context is 0,
+        otherwise the look-ahead frames are recomputed without their own look-ahead.
+        :param context: [T x B x H] (after the input layer)
+        :param pad_mask: [B x T] bool tensor
+        :param input_lang:
+        :param factorize:
+        :return: [T x B x H] outputs of the last layer
+        """
+        seq_len, bsz = context.size(0), context.size(1)
+        chunk_size = self.chunk_size
+        right_context = max(self.chunk_right_context, 0)
+
+        caches = [dict() for _ in self.layer_modules]
+        cache_pad = pad_mask.new_zeros(bsz, 0)
+        outputs = list()
+
+        for start in range(0, seq_len, chunk_size):
+            chunk_len = min(chunk_size, seq_len - start)
+            window_len = min(chunk_len + right_context, seq_len - start)
+            mem_len = cache_pad.size(1)
+            klen = mem_len + window_len
+
+            x = context.narrow(0, start, window_len)
+            key_pad = torch.cat([cache_pad, pad_mask.narrow(1, start, window_len)], dim=1)
+
+            # [B x T_q x T_k], a frame always attends to itself to avoid fully masked rows
+            chunk_mask = key_pad.unsqueeze(1).repeat(1, window_len, 1)
+            diag = torch.arange(window_len, device=chunk_mask.device)
+            chunk_mask[:, diag, diag + mem_len] = False
+            chunk_mask = chunk_mask if chunk_mask.any() else None
+
+            pos_emb = self.chunk_position_encoding(window_len, klen, x)
+
+            # only the chunk frames (not the look-ahead) within the left context remain in the cache
+            keep = mem_len + chunk_len if self.chunk_left_context < 0 else min(self.chunk_left_context,
+                                                                               mem_len + chunk_len)
+            begin = mem_len + chunk_len - keep
+
+            for layer, cache in zip(self.layer_modules, caches):
+                x, cache = layer(x, pos_emb, None, src_lang=input_lang, factorize=factorize,
+                                 incremental=True, incremental_cache=cache, chunk_mask=chunk_mask)
+
+                if keep > 0:
+                    cache['k'] = cache['k'].narrow(0, begin, keep)
+                    cache['v'] = cache['v'].narrow(0, begin, keep)
+                else:
+                    cache.clear()
+
+            cache_pad = key_pad.narrow(1, begin, keep)
+            outputs.append(x.narrow(0, 0, chunk_len))
+
+        return torch.cat(outputs, dim=0)
+
     def forward(self, input, input_pos=None, input_lang=None, streaming=False, factorize=True,
-                return_states=False, pretrained_layer_states=None, **kwargs):
+                return_states=False, pretrained_layer_states=None, src_lengths=None, **kwargs):
         """
         :param pretrained_layer_states:
         :param return_states: also return the (unnormalized) outputs of each state
@@ -109,21 +238,20 @@ class SpeechTransformerEncoder(TransformerEncoder):
         :param input_pos: [B x T] positions
         :param input_lang: [B] language ids of each sample
         :param streaming: connect different segments in transformer-xl style
+        :param src_lengths: [B] lengths of the (left-aligned) input
         :param kwargs:
         :return:
         """
 
+        long_mask = lengths_to_padding_mask(src_lengths, input.size(1), device=input.device)
+
         if not self.cnn_downsampling:
-            mask_src = input.narrow(2, 0, 1).squeeze(2).transpose(0, 1).eq(onmt.constants.PAD).unsqueeze(0)
-            dec_attn_mask = input.narrow(2, 0, 1).squeeze(2).eq(onmt.constants.PAD).unsqueeze(1)
-            input = input.narrow(2, 1, input.size(2) - 1)
-            emb = self.audio_trans(input.contiguous().view(-1, input.size(2))).view(input.size(0),
-                                                                                    input.size(1), -1)
+            mask_src = long_mask.transpose(0, 1).unsqueeze(0)
+            dec_attn_mask = long_mask.unsqueeze(1)
+            # the linear layer is applied on the (non-contiguous) batch-first view directly
+            emb = self.audio_trans(input)
             emb = emb.type_as(input)
         else:
-            long_mask = input.narrow(2, 0, 1).squeeze(2).eq(onmt.constants.PAD)
-            input = input.narrow(2, 1, input.size(2) - 1)
-
             # first resizing to fit the CNN format
             # note that this is actually conv2d so channel=1, f=40
             input = input.view(input.size(0), input.size(1), -1, self.channels)
@@ -199,18 +327,31 @@ class SpeechTransformerEncoder(TransformerEncoder):
             input_lang = self.factor_embeddings(input_lang).squeeze(0)
             assert input_lang.ndim == 1
 
-        if self.reversible:
+        if self.chunk_size > 0:
+            assert not streaming, "Chunk-wise encoding and streaming are exclusive."
+
+        if self.chunk_size > 0 and self.chunk_cached and not self.training:
+            context = self.forward_chunks(context, mask_src.squeeze(0).transpose(0, 1),
+                                          input_lang=input_lang, factorize=factorize)
+        elif self.reversible:
             context = torch.cat([context, context], dim=-1)
 
             assert streaming is not True, "Streaming and Reversible is not usable yet."
             context = ReversibleEncoderFunction.apply(context, pos_emb, self.layer_modules, mask_src)
         else:
+            if self.chunk_size > 0:
+                chunk_mask = streaming_chunk_mask(mask_src.squeeze(0).transpose(0, 1), self.chunk_size,
+                                                  self.chunk_left_context, self.chunk_right_context)
+            else:
+                chunk_mask = None
+
             for i, layer in enumerate(self.layer_modules):
                 # src_len x batch_size x d_model
 
                 mems_i = mems[i] if mems is not None and streaming and self.max_memory_size > 0 else None
 
-                context = layer(context, pos_emb, mask_src, mems=mems_i, src_lang=input_lang, factorize=factorize)
+                context = layer(context, pos_emb, mask_src, mems=mems_i, src_lang=input_lang, factorize=factorize,
+                                chunk_mask=chunk_mask)
 
                 # Summing the context
                 # if pretrained_layer_states is not None and i == (self.layers - 1):
@@ -344,10 +485,10 @@ class SpeechTransformerDecoder(TransformerDecoder):
 
         if context is not None:
             if self.encoder_type == "audio":
+                long_mask = lengths_to_padding_mask(kwargs['src_lengths'], src.size(1), device=src.device)
                 if not self.encoder_cnn_downsampling:
-                    mask_src = src.narrow(2, 0, 1).squeeze(2).eq(onmt.constants.PAD).unsqueeze(1)
+                    mask_src = long_mask.unsqueeze(1)
                 else:
-                    long_mask = src.data.narrow(2, 0, 1).squeeze(2).eq(onmt.constants.PAD)
                     mask_src = long_mask[:, 0:context.size(0) * 4:4].unsqueeze(1)
             elif self.encoder_type == "wav2vec2":
                 mask_src = src
@@ -482,15 +623,8 @@ class SpeechTransformerDecoder(TransformerDecoder):
 
         if context is not None:
             if self.encoder_type == "audio":
-                # The "slow" version of translator only keeps the source mask of audio as src
-                # Thats why we need to check if the src has already been narrowed before
-                if src.dim() == 3:
-                    if not self.encoder_cnn_downsampling:
-                        mask_src = src.narrow(2, 0, 1).squeeze(2).eq(onmt.constants.PAD).unsqueeze(1)
-                    else:
-                        long_mask = src.data.narrow(2, 0, 1).squeeze(2).eq(onmt.constants.PAD)
-                        mask_src = long_mask[:, 0:context.size(0) * 4:4].unsqueeze(1)
-                elif self.encoder_cnn_downsampling:
+                # the decoding state only keeps the padding information of the audio input
+                if self.encoder_cnn_downsampling:
                     long_mask = src.eq(onmt.constants.PAD)
                     mask_src = long_mask[:, 0:context.size(0) * 4:4].unsqueeze(1)
                 else:
@@ -576,7 +710,8 @@ class RelativeTransformer(Transformer):
             else:
                 decoder_state = TransformerDecodingState(src, tgt_lang, encoder_output['context'],
                                                          encoder_output['src_mask'],
-                                                         beam_size=beam_size, model_size=self.model_size, type=type)
+                                                         beam_size=beam_size, model_size=self.model_size, type=type,
+                                                         src_lengths=src_lengths)
         else:
             streaming_state = previous_decoding_state.streaming_state
 
@@ -150,7 +150,7 @@ class RelativeTransformerEncoderLayer(nn.Module):
                                                 dropout=opt.dropout)
 
     def forward(self, input, pos_emb, attn_mask, src_lang=None, factorize=False,
-                incremental=False, incremental_cache=None, mems=None):
+                incremental=False, incremental_cache=None, mems=None, chunk_mask=None):
         """
         :param factorize:
         :param input: tensor [T x B x H]
@@ -160,6 +160,7 @@ class RelativeTransformerEncoderLayer(nn.Module):
         :param incremental: None
         :param incremental_cache:
         :param mems: None
+        :param chunk_mask: tensor [B x T_q x T_k] or None. Streaming block mask replacing the padding mask
         :return:
         """
 
@@ -193,8 +194,12 @@ class RelativeTransformerEncoderLayer(nn.Module):
             query = self.preprocess_attn(input, factor=src_lang)
 
             if self.mfw or self.mpw:
+                assert chunk_mask is None, "Chunk-wise encoding is not supported with MFW/MPW attention."
                 out, _ = self.multihead(query, pos_emb, src_lang, attn_mask, None, factorize=factorize,
                                         incremental=incremental, incremental_cache=incremental_cache, )
+            elif chunk_mask is not None:
+                out, _ = self.multihead(query, pos_emb, None, chunk_mask, mems=mems,
+                                        incremental=incremental, incremental_cache=incremental_cache)
             else:
                 out, _ = self.multihead(query, pos_emb, attn_mask, None, mems=mems,
                                         incremental=incremental, incremental_cache=incremental_cache)
@@ -4,6 +4,7 @@ from onmt.models.transformers import Transformer, TransformerDecodingState
 from typing import List, Optional, Union
 from collections import defaultdict
 import onmt
+from onmt.utils import lengths_to_padding_mask
 
 
 # defining a Wav2vec2 encoder wrapping the HuggingFace model here
@@ -50,17 +51,18 @@ class FairseqWav2Vec(nn.Module):
         for param in self.wav2vec_encoder.feature_extractor.parameters():
             param.requires_grad = False
 
-    def forward(self, input, batch_first_output=False, **kwargs):
+    def forward(self, input, batch_first_output=False, src_lengths=None, **kwargs):
         """
         :param batch_first_output: [bsz, seq_len, hidden_size] as output size, else transpose(0, 1)
-        :param input: torch.Tensor [batch_size, sequence_length, 2]
+        :param input: torch.Tensor [batch_size, sequence_length, 1]
+        :param src_lengths: torch.Tensor [batch_size] number of samples of each (left-aligned) input
         :param kwargs:
         :return:
         """
 
         # 0 for tokens that are not masked, 1 for tokens that are masked
-        long_mask = input.narrow(2, 0, 1).squeeze(2).eq(0).long()
-        input = input.narrow(2, 1, input.size(2) - 1).squeeze(-1)
+        long_mask = lengths_to_padding_mask(src_lengths, input.size(1), device=input.device).long()
+        input = input.squeeze(-1)
 
         attn_mask = long_mask
         wav2vec_output = self.wav2vec_encoder.extract_features(input, attn_mask, mask=self.training)
@@ -134,7 +136,7 @@ class Wav2vecTransformer(Transformer):
         src = src.transpose(0, 1)  # transpose to have batch first
         tgt = tgt.transpose(0, 1)
 
-        encoder_output = self.encoder(src)
+        encoder_output = self.encoder(src, src_lengths=src_lengths)
         # src = src.new(src.size(0), 100).zero_()
         # context = src.new_zeros(100, src.size(0), 1024)
 
@@ -224,9 +226,10 @@ class Wav2vecTransformer(Transformer):
         tgt_atb = batch.get('target_atb')
         src_lang = batch.get('source_lang')
         tgt_lang = batch.get('target_lang')
+        src_lengths = batch.src_lengths
 
         src_transposed = src.transpose(0, 1)  # transpose -> batch first
-        encoder_output = self.encoder(src_transposed)
+        encoder_output = self.encoder(src_transposed, src_lengths=src_lengths)
 
         src = encoder_output['src'].transpose(0, 1)
 
@@ -289,7 +292,7 @@ class Wav2vecBERT(Wav2vecTransformer):
         src = src.transpose(0, 1)  # transpose to have batch first
         tgt = tgt.transpose(0, 1)
 
-        encoder_output = self.encoder(src, batch_first_output=True)
+        encoder_output = self.encoder(src, batch_first_output=True, src_lengths=src_lengths)
 
         encoder_output = defaultdict(lambda: None, encoder_output)
 
@@ -397,8 +400,9 @@ class Wav2vecBERT(Wav2vecTransformer):
         src_pos = batch.get('source_pos')
         src_lang = batch.get('source_lang')
         tgt_lang = batch.get('target_lang')
+        src_lengths = batch.src_lengths
 
-        encoder_output = self.encoder(src.transpose(0, 1), batch_first_output=False)
+        encoder_output = self.encoder(src.transpose(0, 1), batch_first_output=False, src_lengths=src_lengths)
         src_attention_mask = encoder_output['src']
 
         dec_pretrained_model = self.decoder.dec_pretrained_model
@@ -416,7 +420,8 @@ class Wav2vecBERT(Wav2vecTransformer):
         decoder_state = TransformerDecodingState(src, tgt_lang, encoder_output['context'], src_lang,
                                                  beam_size=beam_size, model_size=self.model_size,
                                                  type=type, buffering=buffering, src_mask=src_attention_mask,
-                                                 dec_pretrained_model=self.decoder.dec_pretrained_model)
+                                                 dec_pretrained_model=self.decoder.dec_pretrained_model,
+                                                 src_lengths=src_lengths)
 
         return decoder_state
 
@@ -108,6 +108,28 @@ class TransformerXLDecoderLayer(nn.Module):
         return input_, coverage
 
 
+class TransformerXLDecodingState(object):
+    """
+    Incremental decoding state of the language model: the keys and values of the previous tokens in every layer
+    """
+
+    def __init__(self, tgt_lang=None):
+        self.attention_buffers = dict()
+        self.tgt_lang = tgt_lang
+        # number of tokens already decoded
+        self.length = 0
+
+    def _reorder_incremental_state(self, reorder_state):
+
+        for l in self.attention_buffers:
+            buffer_ = self.attention_buffers[l]
+            for k in buffer_.keys():
+                buffer_[k] = buffer_[k].index_select(1, reorder_state)  # 1 for time first
+
+        if self.tgt_lang is not None and self.tgt_lang.numel() > 1:
+            self.tgt_lang = self.tgt_lang.index_select(0, reorder_state)
+
+
 class TransformerXL(RelativeTransformerDecoder):
     """
     This class combines the encoder and the decoder into one single sequence
@@ -118,6 +140,7 @@ class TransformerXL(RelativeTransformerDecoder):
                  language_embeddings=None, **kwargs):
         # self.tgt_embedding = tgt_embedding
         self.model_size = opt.model_size
+        self.inner_size = opt.inner_size
 
         # build_modules will be called from the inherited constructor
         super().__init__(opt, tgt_embedding,
@@ -243,6 +266,63 @@ class TransformerXL(RelativeTransformerDecoder):
 
         return output_dict
 
+    def create_decoder_state(self, batch, beam_size=1, **kwargs):
+        """
+        :param batch: Batch object (only the target language is used)
+        :param beam_size: Size of beam used in beam search
+        :return: TransformerXLDecodingState
+        """
+        tgt_lang = batch.get('target_lang')
+        if tgt_lang is not None and tgt_lang.numel() > 1:
+            tgt_lang = tgt_lang.repeat_interleave(beam_size, dim=0)
+
+        return TransformerXLDecodingState(tgt_lang=tgt_lang)
+
+    def step(self, input, decoder_state, **kwargs):
+        """
+        Decode one token: only the last input token is processed, the previous ones are read from the buffers
+        :param input: the input word indices: batch_size x len_tgt (only the last one is used)
+        :param decoder_state: TransformerXLDecodingState (updated in the process)
+        :return: a dictionary containing the log-prob output: batch_size x vocab_size
+        """
+        input_ = input[:, -1:].transpose(0, 1)  # 1 x B
+
+        emb = self.tgt_embedding(input_) * math.sqrt(self.model_size)
+
+        if self.use_language_embedding:
+            lang_emb = self.language_embeddings(decoder_state.tgt_lang)  # B x H
+
+            if self.language_embedding_type in ['sum', 'all_sum']:
+                emb = emb + lang_emb
+            else:
+                raise NotImplementedError
+
+        # the same relative positions as the last row of forward()
+        klen = decoder_state.length + 1
+        pos = torch.arange(klen - 1, -1, -1.0, device=emb.device, dtype=emb.dtype)
+        pos_emb = self.preprocess_layer(self.positional_encoder(pos))
+
+        output = self.preprocess_layer(emb)
+
+        for i, layer in enumerate(self.layer_modules):
+            buffer = decoder_state.attention_buffers.get(i, dict())
+            output, coverage, buffer = layer(output, None, pos_emb, None, None,
+                                             incremental=True, incremental_cache=buffer)
+            decoder_state.attention_buffers[i] = buffer
+
+        decoder_state.length = klen
+
+        output = self.postprocess_layer(output)
+
+        output_dict = {'hidden': output, 'coverage': None, 'context': None, 'src': None,
+                       'target_mask': None}
+        output_dict = defaultdict(lambda: None, output_dict)
+
+        log_prob = self.generator[0](output_dict)['logits'].squeeze(0)
+        output_dict['log_prob'] = F.log_softmax(log_prob.float(), dim=-1)
+
+        return output_dict
+
     def init_stream(self):
 
         param = next(self.parameters())
@@ -15,7 +15,7 @@ from onmt.modules.dropout import embedded_dropout, switchout
 from onmt.modules.linear import FeedForward, FeedForwardSwish
 from onmt.reversible_models.transformers import ReversibleTransformerEncoderLayer, ReversibleEncoderFunction, \
     ReversibleDecoderFunction, ReversibleTransformerDecoderLayer
-from onmt.utils import flip, expected_length
+from onmt.utils import flip, expected_length, lengths_to_padding_mask
 
 torch_version = float(torch.__version__[:3])
 
@@ -145,10 +145,11 @@ class TransformerEncoder(nn.Module):
 
             self.layer_modules.append(block)
 
-    def forward(self, input, input_lang=None, **kwargs):
+    def forward(self, input, input_lang=None, src_lengths=None, **kwargs):
         """
         Inputs Shapes:
-            input: batch_size x len_src (to be transposed)
+            input: batch_size x len_src (to be transposed) or batch_size x len_src x feature_size for audio
+            src_lengths: batch_size (the padding mask of audio is built from the lengths)
 
         Outputs Shapes:
             out: batch_size x len_src x d_model
@@ -162,16 +163,13 @@ class TransformerEncoder(nn.Module):
 
             emb = embedded_dropout(self.word_lut, input, dropout=self.word_dropout if self.training else 0)
         else:
+            long_mask = lengths_to_padding_mask(src_lengths, input.size(1), device=input.device)
             if not self.cnn_downsampling:
-                mask_src = input.narrow(2, 0, 1).squeeze(2).eq(onmt.constants.SRC_PAD).unsqueeze(1)
-                input = input.narrow(2, 1, input.size(2) - 1)
-                emb = self.audio_trans(input.contiguous().view(-1, input.size(2))).view(input.size(0),
-                                                                                        input.size(1), -1)
+                mask_src = long_mask.unsqueeze(1)
+                # the linear layer is applied on the (non-contiguous) batch-first view directly
+                emb = self.audio_trans(input)
                 emb = emb.type_as(input)
             else:
-                long_mask = input.narrow(2, 0, 1).squeeze(2).eq(onmt.constants.SRC_PAD)
-                input = input.narrow(2, 1, input.size(2) - 1)
-
                 # first resizing to fit the CNN format
                 input = input.view(input.size(0), input.size(1), -1, self.channels)
                 input = input.permute(0, 3, 1, 2)
@@ -350,10 +348,10 @@ class TransformerDecoder(nn.Module):
 
         if context is not None:
             if self.encoder_type == "audio":
+                long_mask = lengths_to_padding_mask(kwargs['src_lengths'], src.size(1), device=src.device)
                 if not self.encoder_cnn_downsampling:
-                    mask_src = src.data.narrow(2, 0, 1).squeeze(2).eq(onmt.constants.SRC_PAD).unsqueeze(1)
+                    mask_src = long_mask.unsqueeze(1)
                 else:
-                    long_mask = src.data.narrow(2, 0, 1).squeeze(2).eq(onmt.constants.SRC_PAD)
                     mask_src = long_mask[:, 0:context.size(0) * 4:4].unsqueeze(1)
             else:
 
@@ -452,13 +450,8 @@ class TransformerDecoder(nn.Module):
         # batch_size x 1 x len_src
         if context is not None:
             if self.encoder_type == "audio":
-                if src.dim() == 3:
-                    if self.encoder_cnn_downsampling:
-                        long_mask = src.data.narrow(2, 0, 1).squeeze(2).eq(onmt.constants.SRC_PAD)
-                        mask_src = long_mask[:, 0:context.size(0) * 4:4].unsqueeze(1)
-                    else:
-                        mask_src = src.narrow(2, 0, 1).squeeze(2).eq(onmt.constants.SRC_PAD).unsqueeze(1)
-                elif self.encoder_cnn_downsampling:
+                # the decoding state only keeps the padding information of the audio input
+                if self.encoder_cnn_downsampling:
                     long_mask = src.eq(onmt.constants.SRC_PAD)
                     mask_src = long_mask[:, 0:context.size(0) * 4:4].unsqueeze(1)
                 else:
@@ -624,7 +617,8 @@ class Transformer(NMTModel):
             tgt_reverse_input = tgt_reverse_input.transpose(0, 1)
             # perform an additional backward pass
             reverse_decoder_output = self.mirror_decoder(tgt_reverse_input, context, src, src_lang=src_lang,
-                                                         tgt_lang=tgt_lang, input_pos=tgt_pos)
+                                                         tgt_lang=tgt_lang, input_pos=tgt_pos,
+                                                         src_lengths=src_lengths)
 
             reverse_decoder_output['src'] = src
             reverse_decoder_output['context'] = context
@@ -693,13 +687,14 @@ class Transformer(NMTModel):
         # tgt_atb = batch.get('target_atb')  # a dictionary of attributes
         src_lang = batch.get('source_lang')
         tgt_lang = batch.get('target_lang')
+        src_lengths = batch.src_lengths
 
         # transpose to have batch first
         src = src.transpose(0, 1)
         tgt_input = tgt_input.transpose(0, 1)
         batch_size = tgt_input.size(0)
 
-        context = self.encoder(src, input_pos=src_pos, input_lang=src_lang,
+        context = self.encoder(src, input_pos=src_pos, input_lang=src_lang, src_lengths=src_lengths,
                                pretrained_layer_states=pretrained_layer_states)['context']
 
         if hasattr(self, 'autoencoder') and self.autoencoder \
@@ -710,7 +705,7 @@ class Transformer(NMTModel):
         gold_words = 0
         allgold_scores = list()
         decoder_output = self.decoder(tgt_input, context, src, tgt_lang=tgt_lang, src_lang=src_lang,
-                                      input_pos=tgt_pos)['hidden']
+                                      input_pos=tgt_pos, src_lengths=src_lengths)['hidden']
 
         output = decoder_output
 
@@ -800,15 +795,17 @@ class Transformer(NMTModel):
         tgt_atb = batch.get('target_atb')
         src_lang = batch.get('source_lang')
         tgt_lang = batch.get('target_lang')
+        src_lengths = batch.src_lengths
 
         src_transposed = src.transpose(0, 1)
         encoder_output = self.encoder(src_transposed, input_pos=src_pos, input_lang=src_lang,
+                                      src_lengths=src_lengths,
                                       pretrained_layer_states=pretrained_layer_states)
 
         print("[INFO] create Transformer decoding state with buffering", buffering)
         decoder_state = TransformerDecodingState(src, tgt_lang, encoder_output['context'], src_lang,
                                                  beam_size=beam_size, model_size=self.model_size,
-                                                 type=type, buffering=buffering)
+                                                 type=type, buffering=buffering, src_lengths=src_lengths)
 
         return decoder_state
 
@@ -825,10 +822,10 @@ class TransformerDecodingState(DecoderState):
 
     def __init__(self, src, tgt_lang, context, src_lang, beam_size=1, model_size=512, type=2,
                  cloning=True, buffering=False, src_mask=None,
-                 dec_pretrained_model="", ):
+                 dec_pretrained_model="", src_lengths=None):
 
         """
-        :param src:
+        :param src: T x B (text) or T x B x F (audio, requires src_lengths)
         :param tgt_lang:
         :param context:
         :param src_lang:
@@ -837,8 +834,14 @@ class TransformerDecodingState(DecoderState):
         :param type: Type 1 is for old translation code. Type 2 is for fast buffering. (Type 2 default).
         :param cloning:
         :param buffering:
+        :param src_lengths: B
         """
 
+        # for audio only the padding information is kept (1 for frames and 0 for padding) instead of the features
+        if src is not None and src.dim() == 3:
+            assert src_lengths is not None, "The lengths of the audio input are required for decoding."
+            src = lengths_to_padding_mask(src_lengths, src.size(0), device=src.device).t().logical_not().long()
+
         self.beam_size = beam_size
         self.model_size = model_size
         self.attention_buffers = dict()
@@ -846,20 +849,11 @@ class TransformerDecodingState(DecoderState):
         self.dec_pretrained_model = dec_pretrained_model
 
         if type == 1:
-            # if audio only take one dimension since only used for mask
-            # raise NotImplementedError
-            self.original_src = src  # TxBxC
+            self.original_src = src  # TxB
             self.concat_input_seq = True
 
             if src is not None:
-                if src.dim() == 3:
-                    # print(self.src.size())
-                    self.src = src.narrow(2, 0, 1).squeeze(2).repeat(1, beam_size)
-                    # self.src = src.repeat(1, beam_size, 1)
-                    # print(self.src.size())
-                    # self.src = src.repeat(1, beam_size, 1) # T x Bb x c
-                else:
-                    self.src = src.repeat(1, beam_size)
+                self.src = src.repeat(1, beam_size)
             else:
                 self.src = None
 
@@ -14,7 +14,9 @@ class Generator(nn.Module):
         self.linear = nn.Linear(hidden_size, output_size)
         self.fix_norm = fix_norm
         self.must_softmax = False
-        
+        # indices of the output words (vocabulary shortlist for decoding), None: the whole vocabulary
+        self.shortlist = None
+
         stdv = 1. / math.sqrt(self.linear.weight.size(1))
         
         torch.nn.init.uniform_(self.linear.weight, -stdv, stdv)
@@ -31,7 +33,14 @@ class Generator(nn.Module):
         fix_norm = self.fix_norm
         target_mask = output_dicts['target_mask']
 
-        if not fix_norm:
+        if self.shortlist is not None:
+            # only the rows of the shortlisted words are projected
+            weight = self.linear.weight.index_select(0, self.shortlist)
+            bias = self.linear.bias.index_select(0, self.shortlist)
+            if fix_norm:
+                weight = F.normalize(weight, dim=-1)
+            logits = F.linear(input, weight, bias)
+        elif not fix_norm:
             logits = self.linear(input)
         else:
             normalized_weights = F.normalize(self.linear.weight, dim=-1)
@@ -110,7 +110,7 @@ class RelativeSelfMultiheadAttn(nn.Module):
         :param input: [T x B x H]
         :param pos: [T x 1 x H] or [T x T x H]
         :param key_padding_mask: [1 x T x B]
-        :param attn_mask: [T x T]
+        :param attn_mask: [T x T] or [B x T_q x T_k]
         :param mems:
         :param incremental:
         :param incremental_cache:
@@ -125,7 +125,7 @@ class RelativeSelfMultiheadAttn(nn.Module):
                 mask = mask.squeeze(0).transpose(0, 1)
         elif attn_mask is not None:
             mask = attn_mask
-            if len(mask.shape) == 3:
+            if len(mask.shape) == 3 and mask.size(-1) == 1:
                 mask = mask.squeeze(-1)
         else:
             mask = None
@@ -151,8 +151,8 @@ class RelativeSelfMultiheadAttn(nn.Module):
                 mask = mask.to(torch.bool)
                 # Self Attention Time Mask
                 if use_time_mask:
-                    assert (len(mask.size()) == 2), "Timing mask is not 2D!"
-                    mask = mask.unsqueeze(0).unsqueeze(0)
+                    assert (len(mask.size()) in [2, 3]), "Timing mask is not 2D or 3D!"
+                    mask = mask.unsqueeze(0).unsqueeze(0) if mask.dim() == 2 else mask.unsqueeze(1)
                 # Key Padding Mask
                 else:
                     mask = mask.unsqueeze(1).unsqueeze(2)
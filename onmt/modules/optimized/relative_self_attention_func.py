@@ -106,7 +106,7 @@ class RelativeSelfAttnFunc(torch.autograd.Function):
         :param pos_weights:
         :param r_w_bias:
         :param r_r_bias:
-        :param mask: None or [B x T] or [T x T]
+        :param mask: None or [B x T] or [T x T] or [B x T_q x T_k] (time mask per sample)
         :param dropout_prob:
         :param incremental:
         :param incremental_cache:
@@ -133,16 +133,18 @@ class RelativeSelfAttnFunc(torch.autograd.Function):
             mask = mask.to(torch.bool)
             # Self Attention Time Mask
             if use_time_mask:
-                assert (len(mask.size()) == 2), "Timing mask is not 2D!"
+                assert (len(mask.size()) in [2, 3]), "Timing mask is not 2D or 3D!"
                 # assert (mask.size(0) == mask.size(1)), "Sequence length should match!"
-                mask = mask.unsqueeze(0).unsqueeze(0)
+                # [T_q x T_k] is shared across the batch, [B x T_q x T_k] is broadcasted over the heads
+                mask = mask.unsqueeze(0).unsqueeze(0) if mask.dim() == 2 else mask.unsqueeze(1)
             # Key Padding Mask
             else:
                 # attn_score = attn_score.view(bsz, heads, len_q, len_k)
                 mask = mask.unsqueeze(1).unsqueeze(2)
 
         if rel_self_attn_cuda is not None and not incremental and len_k <= 2048 and \
-                inputs.type() == 'torch.cuda.HalfTensor' and learnable_pos:
+                inputs.type() == 'torch.cuda.HalfTensor' and learnable_pos and \
+                not (use_time_mask and mask is not None and mask.dim() == 3):
 
             input_lin_results, rr_head_q, rw_head_q, \
             softmax_results, dropout_results, dropout_mask, \
@@ -1,6 +1,7 @@
 import math
 import torch
 import torch.optim as optim
+import torch.distributed as dist
 from torch.optim.optimizer import Optimizer
 
 
@@ -275,20 +276,30 @@ class Optim(object):
 
         params_ = filter(lambda p: p.requires_grad, params)
         self.params = list(params_)  # careful: params may be a generator
+
+        if self.zeror_optim and dist.is_available() and dist.is_initialized() and dist.get_world_size() > 1:
+            from onmt.zero_optim import ShardedOptimizer
+            # every rank only creates the optimizer (states) for its partition of the parameters
+            self.optimizer = ShardedOptimizer(self.params, self.build_optimizer)
+        else:
+            self.optimizer = self.build_optimizer(self.params)
+
+    def build_optimizer(self, params):
+
         if self.method == 'sgd':
-            self.optimizer = optim.SGD(self.params, lr=self.lr, weight_decay=self.weight_decay, momentum=0.0)
+            optimizer = optim.SGD(params, lr=self.lr, weight_decay=self.weight_decay, momentum=0.0)
         elif self.method == 'adam':
-            self.optimizer = optim.Adam(self.params, lr=self.lr, betas=(self.beta1, self.beta2), eps=1e-9,
-                                        weight_decay=self.weight_decay, amsgrad=self.amsgrad)
+            optimizer = optim.Adam(params, lr=self.lr, betas=(self.beta1, self.beta2), eps=1e-9,
+                                   weight_decay=self.weight_decay, amsgrad=self.amsgrad)
         elif self.method == 'adafactor':
 
             relative_step = False if self.lr > 0 else True
-            self.optimizer = Adafactor(self.params, lr=self.lr if self.lr > 0 else None,
-                                       eps=(1e-30, 1e-3), beta1=None,
-                                       weight_decay=self.weight_decay,
-                                       relative_step=relative_step,
-                                       scale_parameter=False if self.lr > 0 else True,
-                                       warmup_init=relative_step)
+            optimizer = Adafactor(params, lr=self.lr if self.lr > 0 else None,
+                                  eps=(1e-30, 1e-3), beta1=None,
+                                  weight_decay=self.weight_decay,
+                                  relative_step=relative_step,
+                                  scale_parameter=False if self.lr > 0 else True,
+                                  warmup_init=relative_step)
         elif self.method in ['fused_adam']:
 
             fast_adam = True
@@ -297,30 +308,32 @@ class Optim(object):
                 if self.amsgrad:
                     print("Note: AMSGRAD is not compatible with Fused Adam")
                 from onmt.modules.optimized.fused_adam import FusedAdam
-                self.optimizer = FusedAdam(self.params, lr=self.lr,
-                                           betas=(self.beta1, self.beta2), eps=1e-9,
-                                           weight_decay=self.weight_decay, amsgrad=False,
-                                           set_grad_none=False)
+                optimizer = FusedAdam(params, lr=self.lr,
+                                      betas=(self.beta1, self.beta2), eps=1e-9,
+                                      weight_decay=self.weight_decay, amsgrad=False,
+                                      set_grad_none=False)
             except (RuntimeError, ModuleNotFoundError):
                 fast_adam = False
 
             if not fast_adam:
-                self.optimizer = optim.Adam(self.params, lr=self.lr, betas=(self.beta1, self.beta2), eps=1e-9,
-                                            weight_decay=self.weight_decay, amsgrad=self.amsgrad)
+                optimizer = optim.Adam(params, lr=self.lr, betas=(self.beta1, self.beta2), eps=1e-9,
+                                       weight_decay=self.weight_decay, amsgrad=self.amsgrad)
         elif self.method in ['novograd']:
             try:
                 import apex
                 if self.amsgrad:
                     print("Note: AMSGRAD is not compatible with Fused Novograd")
-                self.optimizer = apex.optimizers.FusedNovoGrad(self.params, lr=self.lr,
-                                                               betas=(self.beta1, self.beta2), eps=1e-9,
-                                                               weight_decay=self.weight_decay, amsgrad=False,
-                                                               set_grad_none=False)
+                optimizer = apex.optimizers.FusedNovoGrad(params, lr=self.lr,
+                                                          betas=(self.beta1, self.beta2), eps=1e-9,
+                                                          weight_decay=self.weight_decay, amsgrad=False,
+                                                          set_grad_none=False)
             except RuntimeError as e:
                 raise e
         else:
             raise RuntimeError("Invalid optim method: " + self.method)
 
+        return optimizer
+
     def __init__(self, opt):
         self.optimizer = None
         self.params = None
@@ -329,6 +342,7 @@ class Optim(object):
         self.max_grad_norm = opt.max_grad_norm
         self.update_method = opt.update_method
         self.method = opt.optim
+        self.zeror_optim = opt.zeror_optim
 
         if self.lr > 0:
             if 'noam' in self.update_method:
@@ -389,12 +403,33 @@ class Optim(object):
 
     """Reset the denom for normalization"""
 
-    def normalize_grad(self, denom=None):
+    def reduce_gradients(self):
+        """
+        With the zero redundancy optimizer (and no DistributedDataParallel) the gradients are averaged here,
+        otherwise they are already synchronized.
+        """
+        if hasattr(self.optimizer, 'reduce_gradients'):
+            self.optimizer.reduce_gradients()
 
+    def clip_grad_norm(self, max_norm):
+        """
+        Clips the norm of the gradients of all parameters (also when the gradients are sharded over the ranks)
+        """
+        if hasattr(self.optimizer, 'clip_grad_norm'):
+            return self.optimizer.clip_grad_norm(max_norm)
+
+        return torch.nn.utils.clip_grad_norm_(self.params, max_norm)
+
+    def normalize_grad(self, denom=None):
+        """
+        Divides the gradients used by the optimizer (with the zero redundancy optimizer: the reduced gradients
+        of the fp32 master parameters of the partition, not the ones of the model)
+        """
         if denom is None:
             denom = 1
 
-        normalize_gradients(self.params, denom)
+        params = [p for group in self.optimizer.param_groups for p in group['params']]
+        normalize_gradients(params, denom)
 
     def updateLearningRate(self):
         """
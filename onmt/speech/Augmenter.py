@@ -21,6 +21,7 @@ class Augmenter(object):
         self.mt = mt
         self.input_size = input_size
         self.concat = concat
+        self.batched = False
         print("[INFO] Spec-Augmentation with F=%d, T=%d" % (F, T))
 
     def augment(self, tensor):
@@ -62,5 +63,111 @@ class Augmenter(object):
         return tensor__
 
 
+class BatchAugmenter(object):
+    """
+    Spec Augmentation of a whole (padded) batch with the same masks as Augmenter:
+    the widths and offsets of all masks are drawn as tensors, the frequency and time masks of every sample
+    (within its length) are built as vectors and applied in place on the padded batch with broadcasting.
 
+    The random numbers come from a generator seeded with (seed, epoch, data loader worker id),
+    so the augmentation is reproducible for the same seed and number of workers.
+    The masks are built on the device of the batch: the augmentation can be done after the transfer to the GPU.
+    """
 
+    def __init__(self, F=8, mf=2, T=64, max_t=0.2, mt=2,
+                 input_size=40, seed=1234):
+        """
+        :param F: maximum width of the frequency masks
+        :param mf: number of frequency masks
+        :param T: maximum width of the time masks
+        :param max_t: maximum width of the time masks relative to the length of the sample
+        :param mt: number of time masks
+        :param input_size: number of features per frame (stacked frames are masked in the same bands)
+        :param seed: base seed of the random generators
+        """
+        self.F = F
+        self.mf = mf
+        self.T = T
+        self.max_t = max_t
+        self.mt = mt
+        self.input_size = input_size
+        self.seed = seed
+        self.epoch = 1
+        self.batched = True
+        # apply the augmentation in the training loop instead of the data loader (see -augment_on_device)
+        self.on_device = False
+
+        self._generator = None
+        self._generator_key = None
+        print("[INFO] Batch Spec-Augmentation with F=%d, T=%d" % (F, T))
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __getstate__(self):
+        # every worker process creates its own generator
+        state = self.__dict__.copy()
+        state['_generator'], state['_generator_key'] = None, None
+        return state
+
+    def generator(self):
+
+        worker_info = torch.utils.data.get_worker_info()
+        key = (self.seed, self.epoch, worker_info.id if worker_info is not None else -1)
+
+        if self._generator is None or self._generator_key != key:
+            self._generator = torch.Generator()
+            self._generator.manual_seed(hash(key) % (2 ** 63))
+            self._generator_key = key
+
+        return self._generator
+
+    def masks(self, lengths, max_length, feature_size, device=None):
+        """
+        :param lengths: [B] number of frames of every sample
+        :param max_length: number of frames of the batch
+        :param feature_size: number of features per frame
+        :param device: device of the masks
+        :return: time mask [B x T] and frequency mask [B x F] (True for the masked positions)
+        """
+        generator = self.generator()
+        lengths = lengths.cpu().long()
+        bsz = lengths.size(0)
+
+        # frequency masks: f ~ U[0, F), f_0 ~ U[0, input_size - f)
+        f = (torch.rand(bsz, self.mf, generator=generator) * self.F).long()
+        f_0 = (torch.rand(bsz, self.mf, generator=generator) * (self.input_size - f)).long()
+
+        # time masks: t ~ U[0, T) (at most max_t of the sample), t_0 ~ U[0, length - t - 1)
+        t = (torch.rand(bsz, self.mt, generator=generator) * self.T).long()
+        t = torch.min(t, (self.max_t * lengths.double()).long().unsqueeze(1))
+        t_0 = (torch.rand(bsz, self.mt, generator=generator) * (lengths.unsqueeze(1) - t - 1).clamp(min=0)).long()
+
+        f, f_0, t, t_0 = [x.to(device).unsqueeze(2) for x in [f, f_0, t, t_0]]
+
+        bands = (torch.arange(feature_size, device=device) % self.input_size).view(1, 1, -1)
+        freq_mask = ((bands >= f_0) & (bands < f_0 + f)).any(dim=1)
+
+        frames = torch.arange(max_length, device=device).view(1, 1, -1)
+        time_mask = ((frames >= t_0) & (frames < t_0 + t)).any(dim=1)
+
+        return time_mask, freq_mask
+
+    def augment_batch(self, tensor, lengths, time_first=False):
+        """
+        :param tensor: padded features [B x T x F] (or [T x B x F] if time_first), modified in place
+        :param lengths: [B] number of frames of every sample
+        :param time_first:
+        :return: the augmented features (the same tensor)
+        """
+        time_dim = 0 if time_first else 1
+        time_mask, freq_mask = self.masks(lengths, tensor.size(time_dim), tensor.size(2), device=tensor.device)
+
+        time_keep = time_mask.logical_not().to(tensor.dtype)
+        freq_keep = freq_mask.logical_not().to(tensor.dtype)
+        if time_first:
+            time_keep = time_keep.t()
+
+        # in place with broadcasting: no full size mask (or copy of the batch) is allocated
+        return tensor.mul_(time_keep.unsqueeze(2)).mul_(freq_keep.unsqueeze(1) if not time_first
+                                                         else freq_keep.unsqueeze(0))
@@ -120,7 +120,6 @@ class SpeechAETrainer(BaseTrainer):
                 gate_padded = gate_padded[:, slice]
 
             src_org = batch.get('source_org')
-            src_org = src_org.narrow(2, 1, src_org.size(2) - 1)
             target = [src_org.permute(1,2,0).contiguous(), gate_padded]
             loss = self.loss_function(outputs, target)
             # loss_dict = self.loss_function(outputs, targets, model=self.model)
@@ -325,7 +324,6 @@ class SpeechAETrainer(BaseTrainer):
                     gate_padded = gate_padded[:, slice]
 
                 src_org = batch.get('source_org')
-                src_org = src_org.narrow(2, 1, src_org.size(2) - 1)
                 target = [src_org.permute(1, 2, 0).contiguous(), gate_padded]
                 loss = self.loss_function(outputs, target)
                 loss_data = loss.data.item()
@@ -415,7 +413,6 @@ class SpeechAETrainer(BaseTrainer):
                     gate_padded = gate_padded[:, slice]
 
                 src_org = batch.get('source_org')
-                src_org = src_org.narrow(2, 1, src_org.size(2) - 1)
 
                 target = [src_org.permute(1, 2, 0).contiguous(), gate_padded]
                 loss = self.loss_function(outputs, target)
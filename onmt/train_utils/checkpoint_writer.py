@@ -0,0 +1,178 @@
+""" Background (non-blocking) checkpoint writing """
+from __future__ import division
+import atexit
+import os
+import queue
+import threading
+import time
+import torch
+
+from onmt.train_utils.meters import AverageMeter
+from onmt.utils import checkpoint_paths
+
+
+class AsyncCheckpointWriter(object):
+    """
+    Saves checkpoints without stalling the training loop:
+
+    1. snapshot: every tensor of the checkpoint is copied (asynchronously for GPU tensors) into a CPU buffer,
+       pinned when CUDA is available. The buffers are reused by later saves.
+    2. write: a background thread waits for the copies, serializes the snapshot into a temporary file,
+       renames it atomically to the final name and then deletes the checkpoints beyond the retention limit.
+
+    At most max_in_flight snapshots exist at the same time, a new save waits for the oldest one to be written.
+    """
+
+    def __init__(self, keep_save_files=5, max_in_flight=1, verbose=True):
+        """
+        :param keep_save_files: number of checkpoints kept in the save directory (the ones with the lowest ppl)
+        :param max_in_flight: maximum number of snapshots that are not written yet
+        :param verbose: print the timing of every save
+        """
+        self.keep_save_files = keep_save_files
+        self.max_in_flight = max(max_in_flight, 1)
+        self.verbose = verbose
+        self.pin_memory = torch.cuda.is_available()
+
+        # every slot holds one set of snapshot buffers
+        self._free_slots = queue.Queue()
+        for _ in range(self.max_in_flight):
+            self._free_slots.put(dict())
+        self._jobs = queue.Queue()
+        self._error = None
+
+        self.meters = {'snapshot': AverageMeter(), 'wait': AverageMeter(), 'write': AverageMeter()}
+
+        self._thread = threading.Thread(target=self._run, name='checkpoint-writer', daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def _snapshot(self, obj, buffers, seen, key=()):
+        """
+        Copy the tensors of (nested dicts / lists / tuples) obj into the buffers of one slot
+        Tensors sharing the same memory (e.g. tied embeddings) are copied only once
+        """
+        if torch.is_tensor(obj):
+            tensor_id = (obj.data_ptr(), obj.dtype, tuple(obj.size()), obj.stride())
+            if obj.numel() > 0 and tensor_id in seen:
+                return seen[tensor_id]
+
+            buffer = buffers.get(key)
+            if buffer is None or buffer.size() != obj.size() or buffer.dtype != obj.dtype:
+                buffer = torch.empty(obj.size(), dtype=obj.dtype, pin_memory=self.pin_memory and obj.is_cuda)
+                buffers[key] = buffer
+            buffer.copy_(obj.detach(), non_blocking=True)
+
+            seen[tensor_id] = buffer
+            return buffer
+        elif isinstance(obj, dict):
+            # copy() keeps the type (OrderedDict for the state dicts)
+            snapshot = obj.copy()
+            for k, v in obj.items():
+                snapshot[k] = self._snapshot(v, buffers, seen, key + (k,))
+            if hasattr(obj, '_metadata'):
+                # version information of the module state dicts
+                snapshot._metadata = obj._metadata
+            return snapshot
+        elif isinstance(obj, list):
+            return [self._snapshot(v, buffers, seen, key + (i,)) for i, v in enumerate(obj)]
+        elif isinstance(obj, tuple) and not hasattr(obj, '_fields'):
+            return tuple(self._snapshot(v, buffers, seen, key + (i,)) for i, v in enumerate(obj))
+        else:
+            # options, dictionaries and numbers are not modified by training
+            return obj
+
+    def save(self, checkpoint, file_name):
+        """
+        Snapshot the checkpoint and return as soon as the copies are enqueued
+        :param checkpoint: dictionary (the same as for torch.save)
+        :param file_name: final path of the checkpoint
+        :return:
+        """
+        self._raise_error()
+
+        start = time.perf_counter()
+        buffers = self._free_slots.get()
+        wait_time = time.perf_counter() - start
+        self._raise_error()
+
+        start = time.perf_counter()
+        snapshot = self._snapshot(checkpoint, buffers, dict())
+
+        # the copies are ordered before the next updates of the parameters on the same stream,
+        # only the writer thread has to wait for them
+        event = None
+        if torch.cuda.is_available() and torch.cuda.is_initialized():
+            event = torch.cuda.Event()
+            event.record()
+        snapshot_time = time.perf_counter() - start
+
+        self.meters['wait'].update(wait_time)
+        self.meters['snapshot'].update(snapshot_time)
+        self._jobs.put((snapshot, buffers, event, file_name, wait_time, snapshot_time))
+
+    def _run(self):
+
+        while True:
+            job = self._jobs.get()
+            if job is None:
+                self._jobs.task_done()
+                return
+
+            snapshot, buffers, event, file_name, wait_time, snapshot_time = job
+            try:
+                start = time.perf_counter()
+                if event is not None:
+                    event.synchronize()
+
+                tmp_name = file_name + '.tmp'
+                torch.save(snapshot, tmp_name)
+                os.replace(tmp_name, file_name)
+                write_time = time.perf_counter() - start
+                self.meters['write'].update(write_time)
+
+                if self.verbose:
+                    print('[INFO] Checkpoint %s written in %.2fs (snapshot %.3fs, waited %.3fs for a free slot)'
+                          % (file_name, write_time, snapshot_time, wait_time), flush=True)
+
+                self._remove_old_files(os.path.dirname(file_name))
+            except Exception as e:
+                self._error = e
+            finally:
+                del snapshot
+                self._free_slots.put(buffers)
+                self._jobs.task_done()
+
+    def _remove_old_files(self, checkpoint_dir):
+
+        existed_save_files = checkpoint_paths(checkpoint_dir if checkpoint_dir else '.')
+        for save_file in existed_save_files[self.keep_save_files:]:
+            print(" * Deleting old save file %s ...." % save_file, flush=True)
+            os.remove(save_file)
+
+    def _raise_error(self):
+
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise RuntimeError("Writing a checkpoint in the background failed") from error
+
+    def wait(self):
+        """
+        Block until every submitted checkpoint is written
+        :return:
+        """
+        self._jobs.join()
+        self._raise_error()
+
+    def close(self):
+
+        if self._thread.is_alive():
+            self._jobs.put(None)
+            self._thread.join()
+        self._raise_error()
+
+    def log_string(self):
+
+        return ("checkpoint snapshot %.3fs ; wait %.3fs ; write %.2fs (avg over %d saves)"
+                % (self.meters['snapshot'].avg or 0, self.meters['wait'].avg or 0,
+                   self.meters['write'].avg or 0, self.meters['write'].count))
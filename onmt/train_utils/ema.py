@@ -0,0 +1,115 @@
+""" Exponential moving average of the model weights during training """
+from __future__ import division
+import contextlib
+
+import torch
+
+
+def averaged_state_dict(state_dict, ema_state_dict):
+    """
+    :param state_dict: state dict of the model (e.g. checkpoint['model'])
+    :param ema_state_dict: state dict of the ExponentialMovingAverage (e.g. checkpoint['ema'])
+    :return: the same state dict with the averaged weights (in the dtype and on the device of the original)
+    """
+    averaged = state_dict.copy()
+    for name, shadow in ema_state_dict['shadow'].items():
+        if name in averaged:
+            averaged[name] = shadow.to(device=averaged[name].device, dtype=averaged[name].dtype)
+
+    return averaged
+
+
+class ExponentialMovingAverage(object):
+    """
+    Keeps a shadow copy of the floating point parameters and buffers of a model:
+        shadow = decay * shadow + (1 - decay) * weight
+    updated every *every* optimizer steps (the decay is applied once per update).
+    The shadow weights are kept in float32, on the device of the model or on another one (e.g. the CPU
+    to save GPU memory, at the cost of a copy of the weights at every update).
+    """
+
+    def __init__(self, model, decay=0.9999, every=1, device=None):
+        """
+        :param model: the model (not wrapped into DistributedDataParallel)
+        :param decay: weight of the previous average at every update
+        :param every: number of optimizer steps between two updates
+        :param device: device of the shadow weights, None: the device of the model
+        """
+        self.model = model
+        self.decay = decay
+        self.every = max(every, 1)
+        self.device = device
+        self.num_updates = 0
+
+        self.shadow = dict()
+        for name, tensor in self.averaged_tensors():
+            self.shadow[name] = tensor.detach().to(device=device, dtype=torch.float32, copy=True)
+
+    def averaged_tensors(self):
+        """
+        :return: the (name, tensor) pairs of the floating point parameters and buffers of the model
+        """
+        for name, tensor in self.model.state_dict(keep_vars=True).items():
+            if tensor.is_floating_point():
+                yield name, tensor
+
+    @torch.no_grad()
+    def update(self, step):
+        """
+        :param step: number of optimizer steps so far
+        :return: whether the average was updated
+        """
+        if step % self.every != 0:
+            return False
+
+        for name, tensor in self.averaged_tensors():
+            shadow = self.shadow[name]
+            shadow.mul_(self.decay).add_(tensor.detach().to(device=shadow.device, dtype=torch.float32),
+                                         alpha=1 - self.decay)
+        self.num_updates += 1
+
+        return True
+
+    @torch.no_grad()
+    def copy_to(self, model):
+        """
+        :param model: a model with the same parameters (e.g. built from the options of the checkpoint)
+        """
+        tensors = model.state_dict(keep_vars=True)
+        for name, shadow in self.shadow.items():
+            tensors[name].data.copy_(shadow)
+
+    @contextlib.contextmanager
+    def average_weights(self):
+        """
+        Puts the averaged weights into the model (e.g. for validation), the training weights are restored
+        on exit (they are kept on the device of the shadow weights in the meantime)
+        """
+        backup = {name: tensor.detach().to(device=self.shadow[name].device, copy=True)
+                  for name, tensor in self.averaged_tensors()}
+        self.copy_to(self.model)
+        try:
+            yield self.model
+        finally:
+            with torch.no_grad():
+                tensors = self.model.state_dict(keep_vars=True)
+                for name, tensor in backup.items():
+                    tensors[name].data.copy_(tensor)
+
+    def state_dict(self):
+
+        return {
+            'decay': self.decay,
+            'every': self.every,
+            'num_updates': self.num_updates,
+            'shadow': self.shadow,
+        }
+
+    def load_state_dict(self, state_dict):
+        """
+        Restores the average (the decay and the update interval are the ones of the current options)
+        """
+        self.num_updates = state_dict['num_updates']
+        for name, shadow in state_dict['shadow'].items():
+            if name in self.shadow:
+                self.shadow[name].copy_(shadow)
@@ -0,0 +1,221 @@
+""" Recovery from out-of-memory errors by splitting the minibatches into micro-batches """
+from __future__ import division
+import math
+
+import torch
+
+
+def is_oom_error(e):
+
+    return isinstance(e, RuntimeError) and 'out of memory' in str(e)
+
+
+def batch_shape(batch):
+    """
+    :param batch: onmt.data.dataset.Batch
+    :return: (number of sequences, padded source length, padded target length)
+    """
+    source = batch.get('source')
+    target = batch.get('target')
+
+    return (batch.size, source.size(0) if source is not None else 0,
+            target.size(0) if target is not None else 0)
+
+
+def restore_gradients(accumulated):
+    """
+    :param accumulated: list of (parameter, gradient) put aside, added back to the gradients (and emptied)
+    """
+    for p, grad in accumulated:
+        if p.grad is None:
+            p.grad = grad
+        else:
+            p.grad.add_(grad)
+    del accumulated[:]
+
+
+class MemoryLimitSimulator(object):
+    """
+    Raises the same error as the CUDA allocator when the padded minibatch is larger than a fixed number of tokens
+    (to exercise the recovery without a GPU). The error is raised before the forward pass, or with in_backward
+    in the middle of the backward pass, when the gradients of half of the parameters are accumulated already.
+    """
+
+    def __init__(self, max_tokens, in_backward=False):
+        self.max_tokens = max_tokens
+        self.in_backward = in_backward
+        self.num_errors = 0
+
+        self._parameters = list()
+        self._message = None
+        self._num_ready = 0
+
+    def attach(self, parameters):
+        """
+        :param parameters: the parameters of the model (their gradient hooks raise the errors inside backward)
+        """
+        if not self.in_backward:
+            return
+
+        known = set(id(p) for p in self._parameters)
+        for p in parameters:
+            if p.requires_grad and id(p) not in known:
+                p.register_post_accumulate_grad_hook(self._gradient_ready)
+                self._parameters.append(p)
+
+    def _gradient_ready(self, parameter):
+
+        if self._message is None:
+            return
+
+        self._num_ready += 1
+        if self._num_ready >= max(len(self._parameters) // 2, 1):
+            message, self._message = self._message, None
+            raise RuntimeError(message)
+
+    def __call__(self, batch):
+        size, src_length, tgt_length = batch_shape(batch)
+        tokens = size * (src_length + tgt_length)
+        self._message = None
+
+        if tokens > self.max_tokens:
+            self.num_errors += 1
+            message = "CUDA out of memory (simulated: %d padded tokens > %d)" % (tokens, self.max_tokens)
+            if not self.in_backward:
+                raise RuntimeError(message)
+
+            # raised by the gradient hooks
+            self._message = message
+            self._num_ready = 0
+
+
+class MicroBatchSplitter(object):
+    """
+    Runs the forward and backward passes of a minibatch, and splits it into micro-batches along the batch
+    dimension when it runs out of memory (the gradients of the micro-batches are accumulated, the loss being
+    a sum over the tokens the update is the same).
+
+    A pass can run out of memory after some gradients are accumulated already (in backward): the gradients of
+    the minibatch are then dropped and the whole minibatch runs again with more micro-batches. The gradients
+    accumulated before the minibatch (with -update_frequency) are put aside meanwhile and added back at the end,
+    or before the last micro-batch when its backward pass all-reduces the gradients (DDP): that pass cannot run
+    again, its out-of-memory error is raised.
+
+    The shapes that ran out of memory are remembered: a later minibatch with at least as many sequences
+    and at least as long source and target as one of them is split before running.
+    """
+
+    def __init__(self, simulator=None):
+        """
+        :param simulator: callable raising an out-of-memory error for a minibatch (e.g. MemoryLimitSimulator),
+                          called before each micro-batch
+        """
+        self.simulator = simulator
+        # the minimal shapes (sequences, source length, target length) that ran out of memory
+        self.failed_shapes = list()
+        self.num_ooms = 0
+        self.num_presplit = 0
+
+    def record_failure(self, batch):
+
+        shape = batch_shape(batch)
+        if any(all(f <= s for f, s in zip(failed, shape)) for failed in self.failed_shapes):
+            return
+
+        self.failed_shapes = [failed for failed in self.failed_shapes
+                              if not all(s <= f for f, s in zip(failed, shape))]
+        self.failed_shapes.append(shape)
+
+    def splits_for(self, batch):
+        """
+        :param batch:
+        :return: the number of micro-batches, with at most half of the sequences of the shapes that ran out
+                 of memory and that are not larger than the batch
+        """
+        size, src_length, tgt_length = shape = batch_shape(batch)
+        num_splits = 1
+
+        for failed in self.failed_shapes:
+            if all(f <= s for f, s in zip(failed, shape)):
+                # at most half of the sequences (the size of the micro-batches after the failure)
+                num_splits = max(num_splits, math.ceil(size / max(failed[0] // 2, 1)))
+
+        return min(num_splits, size)
+
+    def run(self, batch, step, parameters=(), synchronize=None):
+        """
+        :param batch: the minibatch
+        :param step: function(micro_batch, last) running the forward and backward passes of a micro-batch,
+                     last: the last micro-batch of the minibatch
+        :param parameters: the parameters accumulating the gradients
+        :param synchronize: optional function called before the last micro-batch, returning whether its backward
+                            pass all-reduces the gradients
+        :return: the list of the outputs of step for the micro-batches
+        """
+        parameters = list(parameters)
+        if self.simulator is not None and hasattr(self.simulator, 'attach'):
+            self.simulator.attach(parameters)
+
+        # the gradients of the earlier minibatches (the .grad tensors are moved, not copied)
+        accumulated = list()
+        for p in parameters:
+            if p.grad is not None:
+                accumulated.append((p, p.grad))
+                p.grad = None
+
+        num_splits = self.splits_for(batch)
+        if num_splits > 1:
+            self.num_presplit += 1
+
+        try:
+            while True:
+                outputs, failed = self._run_splits(batch, step, num_splits, accumulated, synchronize)
+                if failed is None:
+                    return outputs
+
+                # (outside of the except block: the traceback does not hold the tensors of the failed pass anymore)
+                del outputs
+                for p in parameters:
+                    p.grad = None
+                self.num_ooms += 1
+                self.record_failure(failed)
+                if torch.cuda.is_available():
+                    torch.cuda.empty_cache()
+
+                num_splits = min(max(self.splits_for(batch), 2 * num_splits), batch.size)
+        except BaseException:
+            # the minibatch is skipped: only the gradients of the earlier minibatches remain
+            for p in parameters:
+                p.grad = None
+            raise
+        finally:
+            restore_gradients(accumulated)
+
+    def _run_splits(self, batch, step, num_splits, accumulated, synchronize=None):
+        """
+        :return: the outputs of the micro-batches and None, or the micro-batch that ran out of memory
+        """
+        micro_batches = batch.split(num_splits)
+        outputs = list()
+
+        for i, micro_batch in enumerate(micro_batches):
+            last = i == len(micro_batches) - 1
+            if last and synchronize is not None and synchronize():
+                # the all-reduced gradients include the earlier minibatches
+                restore_gradients(accumulated)
+                if self.simulator is not None:
+                    self.simulator(micro_batch)
+                outputs.append(step(micro_batch, last))
+                break
+
+            try:
+                if self.simulator is not None:
+                    self.simulator(micro_batch)
+                outputs.append(step(micro_batch, last))
+            except RuntimeError as e:
+                # a single sequence cannot be split any further
+                if not is_oom_error(e) or micro_batch.size <= 1:
+                    raise
+                return outputs, micro_batch
+
+        return outputs, None
@@ -21,13 +21,92 @@ from onmt.model_factory import build_model, build_language_model, optimize_model
 from onmt.model_factory import init_model_parameters
 from onmt.modules.loss import NMTLossFunc, NMTAndCTCLossFunc
 from onmt.train_utils.stats import Logger
-from onmt.utils import checkpoint_paths, normalize_gradients
+from onmt.train_utils.profiler import TrainingProfiler, CommunicationTimer
+from onmt.train_utils.checkpoint_writer import AsyncCheckpointWriter
+from onmt.train_utils.micro_batches import MicroBatchSplitter, MemoryLimitSimulator
+from onmt.train_utils.ema import ExponentialMovingAverage
+from onmt.utils import checkpoint_paths
 from onmt.model_factory import build_model, optimize_model, init_model_parameters
 import torch.distributed as dist
 from torch.nn.parallel import DistributedDataParallel as DDP_model
 from torch.cuda.amp import autocast
 import warnings
 
+
+def gradient_sync(model, sync):
+    """
+    :param model: the model, possibly wrapped into DistributedDataParallel
+    :param sync: whether the backward passes in the context all-reduce the gradients
+    :return: a context manager, in which DDP only accumulates the gradients locally when sync is False
+             (they are all-reduced in the next backward pass with sync, overlapped with its computation)
+    """
+    if not sync and isinstance(model, DDP_model):
+        return model.no_sync()
+    else:
+        return contextlib.ExitStack()  # dummy contextmanager
+
+
+def all_reduce_gradients(parameters, bucket_cap_mb=25, comm_timer=None):
+    """
+    Average the gradients over the ranks after the backward passes, instead of DDP during the last one (in the
+    updates in which a rank ran out of memory). The gradients are flattened into buckets of about
+    bucket_cap_mb megabytes, whose all-reduces run asynchronously.
+    :param parameters: the parameters, in the same order on every rank (missing gradients count as zeros)
+    :param bucket_cap_mb: the size of the buckets
+    :param comm_timer: optional CommunicationTimer measuring the all-reduces
+    :return:
+    """
+    cap = bucket_cap_mb * 1024 * 1024
+    buckets = list()
+    size = 0
+
+    for p in parameters:
+        if not p.requires_grad:
+            continue
+        if p.grad is None:
+            p.grad = torch.zeros_like(p)
+
+        grad = p.grad
+        if len(buckets) == 0 or buckets[-1][0].dtype != grad.dtype or size + grad.numel() * grad.element_size() > cap:
+            buckets.append(list())
+            size = 0
+        buckets[-1].append(grad)
+        size += grad.numel() * grad.element_size()
+
+    world_size = dist.get_world_size()
+    with torch.no_grad():
+        reduced = list()
+        for grads in buckets:
+            flat = torch.cat([grad.view(-1) for grad in grads])
+            if comm_timer is not None:
+                future = comm_timer.all_reduce_tensor(flat)
+            else:
+                flat.div_(world_size)
+                future = dist.all_reduce(flat, async_op=True).get_future()
+            reduced.append((grads, flat, future))
+
+        for grads, flat, future in reduced:
+            future.wait()
+            offset = 0
+            for grad in grads:
+                grad.view(-1).copy_(flat[offset:offset + grad.numel()])
+                offset += grad.numel()
+
+
+def no_rank_out_of_memory(ran_out_of_memory, device=None):
+    """
+    :param ran_out_of_memory: whether this rank ran out of memory since the last update
+    :param device: the device of the flag (all-reduced over the ranks)
+    :return: whether no rank ran out of memory (the same on all the ranks)
+    """
+    flag = zero_tensor(device)
+    if ran_out_of_memory:
+        flag.fill_(1)
+    dist.all_reduce(flag)
+
+    return flag.item() == 0
+
+
 # ignore the pytorch -> numpy conversion warnings
 warnings.filterwarnings("ignore", category=UserWarning)
 
@@ -48,21 +127,43 @@ def prepare_sample(batch, device=None):
 
 
 def generate_data_iterator(dataset, rank, world_size, seed,
-                           num_workers=1, epoch=1., buffer_size=0):
+                           num_workers=1, epoch=1., buffer_size=0, pad_shards=True, temperature=1.0,
+                           shard_balance='none'):
     # check if dataset is a list:
     if isinstance(dataset, list):
-        # this is a multidataset
+        # this is a multidataset: one data loader (with num_workers processes) for all datasets
         data_iterator = MultiDataIterator(dataset, seed=seed, num_workers=num_workers,
                                           epoch=epoch, buffer_size=buffer_size,
-                                          num_shards=world_size, shard_id=rank)
+                                          num_shards=world_size, shard_id=rank, pad_shards=pad_shards,
+                                          temperature=temperature, shard_balance=shard_balance)
     else:
         data_iterator = DataIterator(dataset, dataset.collater, dataset.batches, seed=seed,
                                      num_workers=num_workers, epoch=epoch, buffer_size=buffer_size,
-                                     num_shards=world_size, shard_id=rank)
+                                     num_shards=world_size, shard_id=rank, pad_shards=pad_shards,
+                                     shard_balance=shard_balance)
 
     return data_iterator
 
 
+def resume_point(checkpoint):
+    """
+    :param checkpoint: the loaded checkpoint
+    :return: the epoch to start from, and the state of the data iterator in this epoch (None: from its beginning)
+    """
+    itr_progress = checkpoint.get('itr', None)
+
+    if itr_progress is not None:
+        if itr_progress.get('end_of_epoch', False):
+            # saved after the last batch of the epoch: continue with the next epoch
+            return itr_progress['epoch'] + 1, None
+
+        # saved in the middle of an epoch: the iterator knows the epoch and the position in it
+        return itr_progress['epoch'], itr_progress
+
+    # saved at the end of an epoch
+    return math.floor(checkpoint['epoch']) + 1 if checkpoint.get('epoch', None) is not None else 1, None
+
+
 def zero_tensor(device=None):
     if device is None:
         return torch.Tensor([0]).cuda()
@@ -150,7 +251,7 @@ class Trainer(object):
 
         self.print("[INFO] Training Options:", opt)
         if self.world_size > 1:
-            dist.init_process_group(backend='nccl', init_method='env://', world_size=self.world_size, rank=self.rank)
+            dist.init_process_group(backend=opt.dist_backend, init_method='env://', world_size=self.world_size, rank=self.rank)
 
         self.model = None
 
@@ -166,6 +267,24 @@ class Trainer(object):
         self.opt = opt
         self.cuda = (len(opt.gpus) >= 1 and opt.gpus[0] >= 0)
 
+        # the spec augmentation is seeded with the training seed (and the epoch and the worker id)
+        # on the GPU, each batch is augmented by the augmenter of its dataset (with its own options)
+        self.augmenters = dict()
+        for dataset_id, dataset in enumerate(self.train_data if isinstance(self.train_data, list)
+                                             else [self.train_data]):
+            augmenter = getattr(dataset, 'augmenter', None)
+            if augmenter is not None and augmenter.batched:
+                augmenter.seed = opt.seed
+                augmenter.on_device = opt.augment_on_device
+                if opt.augment_on_device:
+                    self.augmenters[dataset_id] = augmenter
+
+        # the minibatches that run out of memory are split into micro-batches
+        simulator = MemoryLimitSimulator(opt.simulate_oom_tokens) if opt.simulate_oom_tokens > 0 else None
+        self.micro_batches = MicroBatchSplitter(simulator=simulator)
+        # whether DDP all-reduces the gradients of the current update in its last backward pass (None: not decided)
+        self.sync_in_backward = None
+
         assert self.cuda, "[ERROR] Training is only available on GPUs."
 
         self.start_time = 0
@@ -268,12 +387,39 @@ class Trainer(object):
                 print("[INFO] Optimizer starting from state %d " % opt.starting_step)
                 self.optim.set_starting_step(opt.starting_step)
 
-        if self.world_size > 1:
+        # every rank keeps the average (the validation data is sharded), only the main one saves it
+        if opt.ema_decay > 0:
+            self.ema = ExponentialMovingAverage(self.model, decay=opt.ema_decay, every=opt.ema_every,
+                                                device=torch.device('cpu') if opt.ema_on_cpu else None)
+            if opt.load_from and checkpoint.get('ema', None) is not None:
+                self.ema.load_state_dict(checkpoint['ema'])
+        else:
+            self.ema = None
+
+        # the zero redundancy optimizer synchronizes the gradients and the parameters itself
+        if self.world_size > 1 and not opt.zeror_optim:
             find_unused_parameters = opt.find_unused_parameters
 
             self.model = torch.nn.parallel.DistributedDataParallel(self.model, device_ids=[self.rank],
                                                                    output_device=self.rank,
-                                                                   find_unused_parameters=find_unused_parameters)
+                                                                   find_unused_parameters=find_unused_parameters,
+                                                                   bucket_cap_mb=opt.ddp_bucket_cap_mb)
+
+            # the time of the gradient all-reduces is reported next to the phases
+            if opt.profile_phases:
+                self.comm_timer = CommunicationTimer(cuda=self.cuda)
+                self.model.register_comm_hook(state=None, hook=self.comm_timer.all_reduce)
+            else:
+                self.comm_timer = None
+        else:
+            self.comm_timer = None
+
+        # only the main process writes checkpoints
+        if opt.async_save and self.is_main():
+            self.checkpoint_writer = AsyncCheckpointWriter(keep_save_files=opt.keep_save_files,
+                                                           max_in_flight=opt.async_save_max_inflight)
+        else:
+            self.checkpoint_writer = None
 
         print("[INFO] Process %d ready." % self.rank, flush=True)
 
@@ -302,6 +448,41 @@ class Trainer(object):
         else:
             return
 
+    def augment_batch(self, batch):
+        """
+        Spec augmentation of the (source and past source) features of a batch already on the GPU
+        :param batch: the features are T x B x F
+        :return:
+        """
+        # (a single training set: no dataset id)
+        dataset_id = batch.get('dataset_id')
+        augmenter = self.augmenters.get(dataset_id if dataset_id is not None else 0)
+        if augmenter is None or batch.get('src_type') != 'audio':
+            return
+
+        batch.tensors['source'] = augmenter.augment_batch(batch.get('source'), batch.src_lengths, time_first=True)
+        if batch.get('past_source') is not None:
+            batch.tensors['past_source'] = augmenter.augment_batch(batch.get('past_source'),
+                                                                   batch.get('past_src_lengths'),
+                                                                   time_first=True)
+
+    def synchronize_in_backward(self, ran_out_of_memory):
+        """
+        Whether DDP all-reduces the gradients of the update during the last backward pass before it (overlapped
+        with it). All the ranks decide once per update: not if one of them ran out of memory during the update, as
+        a backward pass failing in the middle of the DDP all-reduces would leave the ranks with different
+        all-reduces. The gradients are then all-reduced after the backward passes (all_reduce_gradients).
+        :param ran_out_of_memory: this rank ran out of memory since the last update
+        :return:
+        """
+        if not isinstance(self.model, DDP_model):
+            return False
+
+        if self.sync_in_backward is None:
+            self.sync_in_backward = no_rank_out_of_memory(ran_out_of_memory, device=self.device)
+
+        return self.sync_in_backward
+
     def load_encoder_weight(self, checkpoint_file, wav2vec=False):
 
         if not wav2vec:
@@ -311,13 +492,13 @@ class Trainer(object):
             pretrained_model = build_model(checkpoint['opt'], checkpoint['dicts'])
             pretrained_model.load_state_dict(checkpoint['model'])
 
-            model = self.model.module if self.world_size > 1 else self.model
+            model = self.model.module if isinstance(self.model, DDP_model) else self.model
 
             model.load_encoder_weights(pretrained_model)
 
         else:
             checkpoint = torch.load(checkpoint_file, map_location=lambda storage, loc: storage)
-            model = self.model.module if self.world_size > 1 else self.model
+            model = self.model.module if isinstance(self.model, DDP_model) else self.model
             model.load_encoder_weights(checkpoint)
 
         return
@@ -462,16 +643,22 @@ class Trainer(object):
 
 
     def save(self, epoch, valid_ppl, itr=None):
-
+        """
+        Called by every rank, only the main process writes the checkpoint
+        """
         opt = self.opt
         model = self.model
         dicts = self.dicts
 
+        # collective with the zero redundancy optimizer
+        optim_state_dict = self.optim.state_dict()
+        if not self.is_main():
+            return
+
         if isinstance(model, torch.nn.parallel.DistributedDataParallel):
             model_state_dict = self.model.module.state_dict()
         else:
             model_state_dict = self.model.state_dict()
-        optim_state_dict = self.optim.state_dict()
 
         if itr:
             itr_state_dict = itr.state_dict()
@@ -486,11 +673,18 @@ class Trainer(object):
             'epoch': epoch,
             'itr': itr_state_dict,
             'optim': optim_state_dict,
-            'scaler': self.grad_scaler.state_dict()
+            'scaler': self.grad_scaler.state_dict(),
+            'ema': self.ema.state_dict() if self.ema is not None else None
         }
 
         file_name = '%s_ppl_%.6f_e%.2f.pt' % (opt.save_model, valid_ppl, epoch)
         print('Writing to %s' % file_name)
+
+        if self.checkpoint_writer is not None:
+            # snapshot to CPU memory, the file is written (and old files are deleted) in the background
+            self.checkpoint_writer.save(checkpoint, file_name)
+            return
+
         torch.save(checkpoint, file_name)
 
         # check the save directory here
@@ -500,26 +694,48 @@ class Trainer(object):
             print(" * Deleting old save file %s ...." % save_file)
             os.remove(save_file)
 
-    def eval(self, data):
+    def validate(self):
+        """
+        Called by every rank
+        :return: the validation perplexity of the training weights (the ones saved in the checkpoints as 'model'),
+                 with -ema_decay the perplexity of the averaged weights is printed as well
+        """
+        valid_loss = self.eval(self.valid_data)
+        valid_ppl = math.exp(min(valid_loss, 100))
+
+        if self.is_main():
+            print('[INFO] Validation perplexity: %g' % valid_ppl)
+
+        if self.ema is not None:
+            with self.ema.average_weights():
+                ema_loss = self.eval(self.valid_data)
+            if self.is_main():
+                print('[INFO] Validation perplexity of the moving average: %g' % math.exp(min(ema_loss, 100)))
 
-        # using one process for evaluation only
-        # if self.rank != 0:
-        #     return 0
+        return valid_ppl
+
+    def eval(self, data):
+        """
+        Cross-entropy evaluation, sharded over the processes: every mini-batch is evaluated by exactly one
+        process and the loss and the number of words are summed over all processes.
+        The validation data is allocated from the length-sorted order, so the batches have little padding.
+        """
 
         self.print("[INFO] Running cross-entropy evaluation...", flush=True)
         opt = self.opt
-        rank = 0
-        world_size = 1
-        finished = zero_tensor()
 
-        # the data iterator creates an epoch iterator
-        data_iterator = generate_data_iterator(data, rank, world_size, seed=self.opt.seed,
-                                               num_workers=1, epoch=1, buffer_size=opt.buffer_size)
+        # the data iterator creates an epoch iterator (not shuffled and without repeated batches)
+        data_iterator = generate_data_iterator(data, self.rank, self.world_size, seed=self.opt.seed,
+                                               num_workers=1, epoch=1, buffer_size=opt.buffer_size,
+                                               pad_shards=False)
         epoch_iterator = data_iterator.next_epoch_itr(False, pin_memory=False)
 
         data_size = len(epoch_iterator)
         i = 0
 
+        # the shards can have different numbers of batches: bypass DDP so that no collective is issued per batch
+        model = self.model.module if isinstance(self.model, DDP_model) else self.model
+
         self.model.eval()
         self.loss_function.eval()
         if opt.load_pretrained_classifier:
@@ -537,42 +753,33 @@ class Trainer(object):
             while not data_iterator.end_of_epoch():
                 samples = next(epoch_iterator)
 
-                def maybe_no_sync():
-                    if isinstance(self.model, DDP_model):
-                        return self.model.no_sync()
-                    else:
-                        return contextlib.ExitStack()  # dummy contextmanager
-
                 if samples:
-                    with maybe_no_sync():
-                        with autocast():
-                            batch = prepare_sample(samples, device=self.device)
-                            targets = batch.get('target_output')
-                            tgt_mask = targets.ne(onmt.constants.PAD)
+                    with autocast():
+                        batch = prepare_sample(samples, device=self.device)
+                        targets = batch.get('target_output')
+                        tgt_mask = targets.ne(onmt.constants.PAD)
 
-                            if opt.load_pretrained_classifier:
-                                layer_states = self.classifier.encode(batch)
-                            else:
-                                layer_states = None
+                        if opt.load_pretrained_classifier:
+                            layer_states = self.classifier.encode(batch)
+                        else:
+                            layer_states = None
 
-                            outputs = self.model(batch, streaming=opt.streaming, target_mask=tgt_mask,
-                                                 mirror=opt.mirror_loss, streaming_state=streaming_state, nce=opt.nce,
-                                                 pretrained_layer_states=layer_states)
+                        outputs = model(batch, streaming=opt.streaming, target_mask=tgt_mask,
+                                        mirror=opt.mirror_loss, streaming_state=streaming_state, nce=opt.nce,
+                                        pretrained_layer_states=layer_states)
 
-                            outputs['tgt_mask'] = tgt_mask
-                            loss_dict = self.loss_function(outputs, targets, model=self.model, eval=True)
-                            loss_data = loss_dict['data']
+                        outputs['tgt_mask'] = tgt_mask
+                        loss_dict = self.loss_function(outputs, targets, model=model, eval=True)
+                        loss_data = loss_dict['data']
 
                     total_loss.add_(loss_data)
                     total_words.add_(batch.tgt_size)
                     i = i + 1
 
         # allreduce the total loss and total words from other processes
-        # self.all_reduce(total_loss, op=dist.ReduceOp.SUM, group=self.group)
-        # self.all_reduce(total_words, op=dist.ReduceOp.SUM, group=self.group)
-        finished.fill_(1)
-        # one synchronization call to avoid deadlock
-        self.all_reduce(finished, op=dist.ReduceOp.SUM, group=self.group)
+        # (this is also the only synchronization point of the evaluation)
+        self.all_reduce(total_loss, op=dist.ReduceOp.SUM, group=self.group)
+        self.all_reduce(total_words, op=dist.ReduceOp.SUM, group=self.group)
 
         self.model.train()
         self.loss_function.train()
@@ -595,11 +802,13 @@ class Trainer(object):
         dataset = train_data
         data_iterator = generate_data_iterator(dataset, self.rank, self.world_size,
                                                seed=self.opt.seed, num_workers=opt.num_workers,
-                                               epoch=epoch, buffer_size=opt.buffer_size)
+                                               epoch=epoch, buffer_size=opt.buffer_size,
+                                               temperature=opt.data_sampling_temperature,
+                                               shard_balance=opt.shard_balance)
 
-        # TODO: fix resume which is currently buggy
         if resume:
-            data_iterator.load_state_dict(itr_progress)
+            # continue the interrupted epoch at the first batch that was not trained on
+            data_iterator.load_state_dict(itr_progress, pin_memory=opt.pin_memory)
 
         epoch_iterator = data_iterator.next_epoch_itr(not streaming, pin_memory=opt.pin_memory)
 
@@ -613,6 +822,9 @@ class Trainer(object):
         n_samples = len(data_iterator)
 
         counter = 0
+        # the out-of-memory errors since the last update
+        ooms_at_update = self.micro_batches.num_ooms
+        skipped = False
         num_accumulated_words = zero_tensor()
         num_accumulated_sents = zero_tensor()
 
@@ -621,6 +833,9 @@ class Trainer(object):
         else:
             streaming_state = None
 
+        profiler = TrainingProfiler(opt, device=self.device, rank=self.rank, cuda=self.cuda,
+                                    comm_timer=self.comm_timer)
+
         i = data_iterator.iterations_in_epoch if not isinstance(train_data, list) else epoch_iterator.n_yielded
         i = i * self.world_size
 
@@ -630,9 +845,14 @@ class Trainer(object):
 
             # this batch generator is not very clean atm
             # TODO: move everything to the multiGPU trainer
+            profiler.mark('data')
             samples = next(epoch_iterator)
 
+            profiler.mark('h2d')
             batch = prepare_sample(samples, device=self.device)
+            if len(self.augmenters) > 0:
+                self.augment_batch(batch)
+            profiler.count_tokens(batch)
 
             if opt.streaming:
                 if train_data.is_new_stream():
@@ -640,114 +860,117 @@ class Trainer(object):
             else:
                 streaming_state = None
 
-            # TODO: dealing with oom during distributed training
-            oom = zero_tensor()
+            counter = counter + 1
 
-            try:
-
-                counter = counter + 1
-                reduce = True if counter >= opt.update_frequency or i == (n_samples - 1) else False
-
-                def maybe_no_sync():
-                    if not reduce and isinstance(self.model, DDP_model):
-                        return self.model.no_sync()
-                    else:
-                        # when we dont reach the updating step, we do not need to synchronize the gradients
-                        # thus disabling the backward grad sync to improve speed
-                        return contextlib.ExitStack()  # dummy contextmanager
-
-                # with maybe_no_sync():
-                with autocast():
-                    targets = batch.get('target_output')
-                    tgt_mask = targets.ne(onmt.constants.PAD)
-                    if opt.load_pretrained_classifier:
-                        with torch.no_grad():
-                            layer_states = self.classifier.encode(batch)
-                    else:
-                        layer_states = None
-
-                    outputs = self.model(batch, streaming=opt.streaming, target_mask=tgt_mask,
-                                         zero_encoder=opt.zero_encoder,
-                                         mirror=opt.mirror_loss, streaming_state=streaming_state,
-                                         nce=opt.nce, pretrained_layer_states=layer_states)
-
-                    batch_size = batch.size
-                    # outputs is a dictionary containing keys/values necessary for loss function
-                    # can be flexibly controlled within models for easier extensibility
-                    outputs['tgt_mask'] = tgt_mask
-
-                    loss_dict = self.loss_function(outputs, targets, model=self.model)
-                    loss_data = loss_dict['data']
-                    loss = loss_dict['loss']  # a little trick to avoid gradient overflow with fp16
-                    full_loss = loss
+            # We only update the parameters after getting gradients from n mini-batches
+            update_flag = False
+            if counter >= opt.update_frequency:
+                update_flag = True
+            elif i == n_samples - 1:  # update for the last minibatch
+                update_flag = True
 
-                    if opt.ctc_loss > 0.0:
-                        ctc_loss = self.ctc_loss_function(outputs, targets)
-                        ctc_loss_data = ctc_loss.item()
-                        full_loss = full_loss + opt.ctc_loss * ctc_loss
+            def synchronize():
+                # called before the last micro-batch of the minibatch
+                ran_out_of_memory = skipped or self.micro_batches.num_ooms > ooms_at_update
+                return update_flag and self.synchronize_in_backward(ran_out_of_memory)
+
+            def forward_backward(micro_batch, last):
+                """
+                The forward and backward passes of a (micro-)batch, the gradients are accumulated
+                :param micro_batch:
+                :param last: the last micro-batch of the minibatch
+                :return: the loss values of the micro-batch
+                """
+                # the gradients are all-reduced once per update: during the backward pass of the last
+                # micro-batch of the last minibatch before the update (the earlier ones only accumulate locally)
+                profiler.mark('forward')
+                with gradient_sync(self.model, last and update_flag and self.sync_in_backward is True):
+                    with autocast():
+                        targets = micro_batch.get('target_output')
+                        tgt_mask = targets.ne(onmt.constants.PAD)
+                        if opt.load_pretrained_classifier:
+                            with torch.no_grad():
+                                layer_states = self.classifier.encode(micro_batch)
+                        else:
+                            layer_states = None
+
+                        outputs = self.model(micro_batch, streaming=opt.streaming, target_mask=tgt_mask,
+                                             zero_encoder=opt.zero_encoder,
+                                             mirror=opt.mirror_loss, streaming_state=streaming_state,
+                                             nce=opt.nce, pretrained_layer_states=layer_states)
+
+                        # outputs is a dictionary containing keys/values necessary for loss function
+                        # can be flexibly controlled within models for easier extensibility
+                        outputs['tgt_mask'] = tgt_mask
+
+                        profiler.mark('loss')
+                        loss_dict = self.loss_function(outputs, targets, model=self.model)
+                        losses = {'loss': loss_dict['data']}
+                        full_loss = loss_dict['loss']  # a little trick to avoid gradient overflow with fp16
+
+                        if opt.ctc_loss > 0.0:
+                            ctc_loss = self.ctc_loss_function(outputs, targets)
+                            losses['ctc'] = ctc_loss.item()
+                            full_loss = full_loss + opt.ctc_loss * ctc_loss
+
+                        if opt.mirror_loss:
+                            full_loss = full_loss + loss_dict['rev_loss'] + loss_dict['mirror_loss']
+                            losses['rev'] = loss_dict['rev_loss_data']
+                            losses['mirror'] = loss_dict['mirror_loss'].item()
+
+                        # reconstruction loss
+                        if opt.reconstruct:
+                            full_loss = full_loss + loss_dict['rec_loss']
+                            losses['rec'] = loss_dict['rec_loss_data']
+
+                        if opt.lfv_multilingual:
+                            lid_logits = outputs['lid_logits']
+                            lid_labels = micro_batch.get('target_lang')
+                            lid_loss_function = self.loss_function.get_loss_function('lid_loss')
+                            lid_loss = lid_loss_function(lid_logits, lid_labels)
+                            full_loss = full_loss + lid_loss
+
+                    # grad scaler has to be done outside of the autocast
+                    # (with DDP the gradient all-reduce overlaps with and is counted in the backward phase)
+                    profiler.mark('backward')
+                    self.grad_scaler.scale(full_loss).backward()
 
-                    if opt.mirror_loss:
-                        rev_loss = loss_dict['rev_loss']
-                        rev_loss_data = loss_dict['rev_loss_data']
-                        mirror_loss = loss_dict['mirror_loss']
-                        full_loss = full_loss + rev_loss + mirror_loss
-                        mirror_loss_data = loss_dict['mirror_loss'].item()
-                    else:
-                        rev_loss_data = None
-                        mirror_loss_data = 0
-
-                    # reconstruction loss
-                    if opt.reconstruct:
-                        rec_loss = loss_dict['rec_loss']
-                        rec_loss = rec_loss
-                        full_loss = full_loss + rec_loss
-                        rec_loss_data = loss_dict['rec_loss_data']
-                    else:
-                        rec_loss_data = None
+                del outputs
+                return losses
 
-                    if opt.lfv_multilingual:
-                        lid_logits = outputs['lid_logits']
-                        lid_labels = batch.get('target_lang')
-                        lid_loss_function = self.loss_function.get_loss_function('lid_loss')
-                        lid_loss = lid_loss_function(lid_logits, lid_labels)
-                        full_loss = full_loss + lid_loss
+            try:
+                if opt.streaming:
+                    # the streaming state cannot be split
+                    synchronize()
+                    micro_losses = [forward_backward(batch, True)]
+                else:
+                    micro_losses = self.micro_batches.run(batch, forward_backward, self.model.parameters(),
+                                                          synchronize=synchronize)
+                profiler.mark('other')
 
-                    optimizer = self.optim.optimizer
+            except RuntimeError as e:
+                # only when a single sequence does not fit in memory
+                # (not in the synchronized backward pass: the other ranks wait for its all-reduces)
+                if 'out of memory' in str(e) and not (update_flag and self.sync_in_backward):
+                    print('[WARNING]: ran out of memory on GPU %d, the minibatch is skipped' % self.rank, flush=True)
+                    skipped = True
+                    micro_losses = list()
+                else:
+                    raise
 
-                # grad scaler has to be done outside of the autocast
-                self.grad_scaler.scale(full_loss).backward()
+            if len(micro_losses) == 0:
+                torch.cuda.empty_cache()
+                if opt.streaming:  # reset stream in this case ...
+                    streaming_state = self.model.init_stream()
 
-                del outputs
+            def total(name):
+                return sum(losses[name] for losses in micro_losses)
 
-            except RuntimeError as e:
-                if 'out of memory' in str(e):
-                    print('[WARNING]: ran out of memory on GPU %d' % self.rank, flush=True)
-                    loss = 0
-                    # for p in self.model.parameters():
-                    #     if p.grad is not None:
-                    #         del p.grad  # free some memory
-                    #     loss = loss + p.sum() * 0
-
-                    torch.cuda.empty_cache()
-
-                    if opt.streaming:  # reset stream in this case ...
-                        streaming_state = self.model.init_stream()
-
-
-                    # backward to actually free the graph
-                    # self.grad_scaler.scale(loss).backward()
-                    oom.add_(1)
-
-            # connecting the oom signal from different gpus
-            # self.all_reduce(oom, op=dist.ReduceOp.SUM, group=self.group)
-            # # if OOM: all gpus reset grad and reset counter
-            # # or maybe all-reduce grad?
-            # if oom.item() > 0:
-            #     # reset counter
-            #     self.model.zero_grad()
-            #     self.optim.zero_grad()
-            #     counter = 0
-            #     oom.zero_()
+            loss_data = total('loss')
+            ctc_loss_data = total('ctc') if opt.ctc_loss > 0.0 else 0
+            rev_loss_data = total('rev') if opt.mirror_loss else None
+            mirror_loss_data = total('mirror') if opt.mirror_loss else 0
+            rec_loss_data = total('rec') if opt.reconstruct else None
 
             batch_size = batch.size
 
@@ -756,14 +979,8 @@ class Trainer(object):
             num_accumulated_words.add_(tgt_size)
             num_accumulated_sents.add_(batch_size)
 
-            # We only update the parameters after getting gradients from n mini-batches
-            update_flag = False
-            if counter >= opt.update_frequency:
-                update_flag = True
-            elif i == n_samples - 1:  # update for the last minibatch
-                update_flag = True
-
             if update_flag:
+                profiler.mark('optim')
                 # accumulated gradient case, in this case the update frequency
                 # self.all_reduce(num_accumulated_words, op=dist.ReduceOp.SUM, group=self.group)
 
@@ -778,31 +995,43 @@ class Trainer(object):
                 # we rescale the model parameters w.r.t the world size
                 # grad_denom = grad_denom / self.world_size
 
+                # not synchronized in backward: every rank takes part, also when its last minibatch was skipped
+                if isinstance(self.model, DDP_model):
+                    if not self.synchronize_in_backward(True):
+                        all_reduce_gradients(self.model.parameters(), bucket_cap_mb=opt.ddp_bucket_cap_mb,
+                                             comm_timer=self.comm_timer)
+                    self.sync_in_backward = None
+                ooms_at_update = self.micro_batches.num_ooms
+                skipped = False
+
+                # with -zeror_optim: each rank receives the averaged gradients of its partition
+                self.optim.reduce_gradients()
+
                 # When we accumulate the gradients, each gradient is already normalized by a constant grad_scaler
                 if grad_denom > 1.0:
-                    normalize_gradients(self.model.parameters(), grad_denom)
+                    self.optim.normalize_grad(grad_denom)
 
                 # Update the parameters.
                 if self.opt.max_grad_norm > 0:
                     self.grad_scaler.unscale_(self.optim.optimizer)
-                    torch.nn.utils.clip_grad_norm_(self.model.parameters(), self.opt.max_grad_norm)
+                    self.optim.clip_grad_norm(self.opt.max_grad_norm)
                 self.optim.step(scaler=self.grad_scaler)
                 self.grad_scaler.update()
                 self.optim.zero_grad()
                 self.model.zero_grad()
+                if self.ema is not None:
+                    self.ema.update(self.optim._step)
                 counter = 0
                 num_accumulated_words.zero_()
                 num_accumulated_sents.zero_()
+                profiler.mark('other')
 
                 num_updates = self.optim._step
                 if opt.save_every > 0 and num_updates % opt.save_every == -1 % opt.save_every:
-                    valid_loss = self.eval(self.valid_data)
-                    valid_ppl = math.exp(min(valid_loss, 100))
-
-                    if self.is_main():
-                        print('Validation perplexity: %g' % valid_ppl)
-                        ep = float(epoch) - 1. + ((float(i) + 1.) / n_samples)
-                        self.save(ep, valid_ppl, itr=data_iterator)
+                    valid_ppl = self.validate()
+                    ep = float(epoch) - 1. + ((float(i) + 1.) / n_samples)
+                    # all ranks take part in gathering the (sharded) optimizer states
+                    self.save(ep, valid_ppl, itr=data_iterator)
 
             num_words = tgt_size
             report_loss.add_(loss_data)
@@ -810,9 +1039,6 @@ class Trainer(object):
             report_src_words.add_(src_size)
             total_loss.add_(loss_data)
             total_words.add_(num_words)
-            # total_tokens += batch.get('target_output').nelement()
-            # total_non_pads += batch.get('target_output').ne(onmt.constants.PAD).sum().item()
-            # batch_efficiency = total_non_pads / total_tokens
 
             if opt.reconstruct:
                 report_rec_loss.add_(rec_loss_data)
@@ -830,6 +1056,8 @@ class Trainer(object):
                 self.all_reduce(report_loss, op=dist.ReduceOp.SUM, group=self.group)
                 self.all_reduce(report_tgt_words, op=dist.ReduceOp.SUM, group=self.group)
                 self.all_reduce(report_src_words, op=dist.ReduceOp.SUM, group=self.group)
+                # local to this process (the main one is printed)
+                profile_string = profiler.log_string()
 
                 if self.is_main():
                     log_string = ("Epoch %2d, %5d/%5d; ; ppl: %6.2f ; " %
@@ -862,6 +1090,11 @@ class Trainer(object):
                                    (report_src_words.item() / (time.time() - start),
                                     report_tgt_words.item() / (time.time() - start)))
 
+                    if self.micro_batches.num_ooms > 0:
+                        log_string += ("oom splits: %d ; " % self.micro_batches.num_ooms)
+
+                    log_string += profile_string
+
                     log_string += ("%s elapsed" %
                                    str(datetime.timedelta(seconds=int(time.time() - self.start_time))))
 
@@ -878,6 +1111,9 @@ class Trainer(object):
 
             # increase i by world size
             i = i + self.world_size
+            profiler.step()
+
+        profiler.close()
 
         return total_loss / total_words
 
@@ -892,12 +1128,8 @@ class Trainer(object):
 
             if not opt.reset_optim:
 
-                itr_progress = None
-
-                resume = True
-                start_epoch = math.floor(checkpoint['epoch']) if 'epoch' in checkpoint else 1
-                if start_epoch is None:
-                    start_epoch = 1
+                start_epoch, itr_progress = resume_point(checkpoint)
+                resume = itr_progress is not None
             else:
                 itr_progress = None
                 resume = False
@@ -939,12 +1171,12 @@ class Trainer(object):
             self.print('[INFO] Train perplexity: %g' % train_ppl)
 
             #  (2) evaluate on the validation set
-            valid_loss = self.eval(self.valid_data)
-            valid_ppl = math.exp(min(valid_loss, 100))
-
-            if self.is_main():
-                print('[INFO] Validation perplexity: %g' % valid_ppl)
-                self.save(epoch, valid_ppl)
+            valid_ppl = self.validate()
+            self.save(epoch, valid_ppl)
 
             itr_progress = None
-            resume = False
\ No newline at end of file
+            resume = False
+
+        if self.checkpoint_writer is not None:
+            self.checkpoint_writer.wait()
+            self.print("[INFO] " + self.checkpoint_writer.log_string(), flush=True)
@@ -0,0 +1,240 @@
+""" Per-phase timing of the training loop (opt-in) """
+from __future__ import division
+import os
+import time
+import torch
+import torch.distributed as dist
+
+from onmt.train_utils.meters import AverageMeter
+
+PHASES = ['data', 'h2d', 'forward', 'loss', 'backward', 'optim', 'other']
+
+
+class CommunicationTimer(object):
+    """
+    all_reduce is a DDP communication hook: the default all-reduce of the gradient buckets (averaged over the
+    ranks), which also records when the all-reduce of every bucket starts and finishes. The all-reduces run
+    asynchronously and overlap with the rest of the backward pass, so the communication time is the union of
+    these intervals. all_reduce_tensor does the same for the buckets all-reduced after the backward passes
+    (in the updates in which a rank ran out of memory).
+    On the GPU the intervals are measured with CUDA events (recorded on the streams waiting for the reduction).
+    """
+
+    def __init__(self, cuda=True):
+        self.cuda = cuda and torch.cuda.is_available()
+        self.intervals = list()
+
+    def _now(self):
+
+        if self.cuda:
+            event = torch.cuda.Event(enable_timing=True)
+            event.record()
+            return event
+
+        return time.perf_counter()
+
+    def all_reduce(self, process_group, bucket):
+
+        return self.all_reduce_tensor(bucket.buffer(), process_group)
+
+    def all_reduce_tensor(self, tensor, group=None):
+        """
+        :param tensor: averaged over the ranks in place
+        :param group: the process group (default: all the ranks)
+        :return: a future holding the tensor
+        """
+        group = group if group is not None else dist.group.WORLD
+        tensor.div_(dist.get_world_size(group))
+
+        start = self._now()
+        future = dist.all_reduce(tensor, group=group, async_op=True).get_future()
+
+        def finish(fut):
+            self.intervals.append((start, self._now()))
+            return fut.value()[0]
+
+        return future.then(finish)
+
+    def pop(self):
+        """
+        :return: the communication time (seconds) and the number of all-reduces since the last call
+        """
+        intervals, self.intervals = self.intervals, list()
+        if len(intervals) == 0:
+            return 0.0, 0
+
+        if self.cuda:
+            torch.cuda.synchronize()
+            reference = intervals[0][0]
+            intervals = [(reference.elapsed_time(start) / 1000, reference.elapsed_time(end) / 1000)
+                         for start, end in intervals]
+
+        total, current_start, current_end = 0.0, None, None
+        for start, end in sorted(intervals):
+            if current_end is None or start > current_end:
+                if current_end is not None:
+                    total += current_end - current_start
+                current_start, current_end = start, end
+            else:
+                current_end = max(current_end, end)
+        total += current_end - current_start
+
+        return total, len(intervals)
+
+
+class TrainingProfiler(object):
+    """
+    Splits every training iteration into consecutive phases and accumulates the time of each of them.
+    The trainer calls mark(name) at each phase boundary (which closes the previous phase)
+    and step() at the end of the iteration.
+
+    With -profile_phases the device is synchronized at every boundary, so that the (asynchronous) GPU work
+    is attributed to the phase that launched it. Without it all calls return immediately.
+    With -profile_trace_dir a torch.profiler trace of a window of iterations is written (viewable in TensorBoard).
+    With a CommunicationTimer (multi-GPU training), the time of the gradient all-reduces is reported separately
+    (it mostly overlaps with the backward phase).
+    """
+
+    def __init__(self, opt, device=None, rank=0, cuda=True, comm_timer=None):
+
+        self.timing = opt.profile_phases
+        self.tracing = len(opt.profile_trace_dir) > 0
+        self.enabled = self.timing or self.tracing
+        self.cuda = cuda and torch.cuda.is_available()
+        self.device = device
+
+        self.meters = {phase: AverageMeter() for phase in PHASES}
+        self.src_tokens, self.src_total = AverageMeter(), AverageMeter()
+        self.tgt_tokens, self.tgt_total = AverageMeter(), AverageMeter()
+        self.current = None
+        self.current_start = 0
+        self.record = None
+        self.comm_timer = comm_timer if self.timing else None
+        self.profiler = None
+
+        if self.tracing:
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if self.cuda:
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+
+            os.makedirs(opt.profile_trace_dir, exist_ok=True)
+            # skip the first iterations (warm up of the allocator and the data workers)
+            schedule = torch.profiler.schedule(wait=max(opt.profile_trace_start - 1, 0), warmup=1,
+                                               active=opt.profile_trace_steps, repeat=1)
+            handler = torch.profiler.tensorboard_trace_handler(opt.profile_trace_dir,
+                                                               worker_name='rank%d' % rank)
+            self.profiler = torch.profiler.profile(activities=activities, schedule=schedule,
+                                                   on_trace_ready=handler, record_shapes=True)
+            self.profiler.__enter__()
+
+    def _sync(self):
+
+        if self.cuda:
+            torch.cuda.synchronize(self.device)
+
+    def mark(self, phase):
+        """
+        :param phase: name of the phase that starts now (one of PHASES)
+        :return:
+        """
+        if not self.enabled:
+            return
+
+        if self.timing:
+            self._sync()
+            now = time.perf_counter()
+            if self.current is not None:
+                self.meters[self.current].update(now - self.current_start)
+            self.current_start = now
+
+        if self.tracing:
+            if self.record is not None:
+                self.record.__exit__(None, None, None)
+            self.record = torch.profiler.record_function('train/' + phase)
+            self.record.__enter__()
+
+        self.current = phase
+
+    def step(self):
+        """
+        End of one training iteration
+        :return:
+        """
+        if not self.enabled:
+            return
+
+        self.mark('other')
+
+        if self.tracing:
+            self.record.__exit__(None, None, None)
+            self.record = None
+            self.profiler.step()
+
+        self.current = None
+
+    def count_tokens(self, batch):
+        """
+        Padding efficiency of the batch (only uses host-side sizes, no synchronization)
+        :param batch: Batch object on the device
+        :return:
+        """
+        if not self.timing:
+            return
+
+        src = batch.get('source')
+        if src is not None:
+            self.src_tokens.update(batch.src_size)
+            self.src_total.update(src.size(0) * src.size(1))
+
+        tgt = batch.get('target_output')
+        if tgt is not None:
+            self.tgt_tokens.update(batch.tgt_size)
+            self.tgt_total.update(tgt.numel())
+
+    def reset(self):
+
+        for meter in self.meters.values():
+            meter.reset()
+        for meter in [self.src_tokens, self.src_total, self.tgt_tokens, self.tgt_total]:
+            meter.reset()
+
+    def log_string(self, reset=True):
+        """
+        :param reset: start a new reporting window
+        :return: a string to append to the training log (empty if the phases are not timed)
+        """
+        if not self.timing:
+            return ""
+
+        total = sum(meter.sum for meter in self.meters.values())
+        n_iters = self.meters['data'].count
+        if total <= 0 or n_iters == 0:
+            return ""
+
+        log_string = "; ".join("%s %4.1f%%" % (phase, 100 * self.meters[phase].sum / total) for phase in PHASES)
+        log_string = "phases [%s] %.1f ms/it ; " % (log_string, 1000 * total / n_iters)
+        log_string += "data wait: %4.1f%% ; " % (100 * self.meters['data'].sum / total)
+
+        if self.comm_timer is not None:
+            comm_time, num_all_reduces = self.comm_timer.pop()
+            log_string += "comm %.1f ms/it (%4.1f%%, %.1f all-reduces/it) ; " % \
+                          (1000 * comm_time / n_iters, 100 * comm_time / total, num_all_reduces / n_iters)
+
+        if self.src_total.sum > 0:
+            log_string += "pad eff src: %.3f " % (self.src_tokens.sum / self.src_total.sum)
+        if self.tgt_total.sum > 0:
+            log_string += "tgt: %.3f ; " % (self.tgt_tokens.sum / self.tgt_total.sum)
+
+        if reset:
+            self.reset()
+
+        return log_string
+
+    def close(self):
+
+        if self.profiler is not None:
+            if self.record is not None:
+                self.record.__exit__(None, None, None)
+                self.record = None
+            self.profiler.__exit__(None, None, None)
+            self.profiler = None
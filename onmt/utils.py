@@ -1,9 +1,7 @@
 import logging, traceback
 import os, re
 import torch
-import torchaudio
 import math
-import soundfile as sf
 
 
 # this function is borrowed from Facebook
@@ -21,6 +19,9 @@ def safe_readline(f):
 # this function reads wav file based on the timestamp in seconds
 def safe_readaudio(wav_path, start=0.0, end=0.0, sample_rate=16000):
 
+    # (imported here: the audio back-ends are slow to load and not needed for text models)
+    import torchaudio
+
     offset = math.floor(sample_rate * start)
     num_frames = -1 if end <= start else math.ceil(sample_rate * (end - start))
 
@@ -95,3 +96,23 @@ def expected_length(length, death_rate):
         e_length += survival_rate
 
     return e_length
+
+
+# padding mask of left-aligned sequences (audio batches don't carry a padding channel)
+def lengths_to_padding_mask(lengths, max_len=None, device=None):
+    """
+    :param lengths: LongTensor [B] or list of lengths
+    :param max_len: length of the padded batch (default: the longest sequence)
+    :param device: device of the mask (the lengths are moved there)
+    :return: BoolTensor [B x T], True at the padded positions
+    """
+    if not torch.is_tensor(lengths):
+        lengths = torch.as_tensor(lengths, dtype=torch.long)
+
+    if device is not None:
+        lengths = lengths.to(device=device, non_blocking=True)
+
+    if max_len is None:
+        max_len = int(lengths.max())
+
+    return torch.arange(max_len, device=lengths.device).unsqueeze(0).ge(lengths.unsqueeze(1))
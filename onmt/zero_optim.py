@@ -0,0 +1,324 @@
+""" Zero redundancy (ZeRO) optimizer: the optimizer states are sharded over the data-parallel ranks """
+import torch
+import torch.distributed as dist
+
+
+def _to_cpu(obj):
+
+    if torch.is_tensor(obj):
+        return obj.cpu()
+    elif isinstance(obj, dict):
+        return {k: _to_cpu(v) for k, v in obj.items()}
+    else:
+        return obj
+
+
+class ShardedOptimizer(object):
+    """
+    Wraps an optimizer so that each of the N data-parallel ranks only keeps the states (and the fp32 master weights
+    for low precision parameters) of 1/N of the parameters:
+
+    1. reduce_gradients(): the gradients of every partition are summed on the rank owning the partition
+       (reduce-scatter), the other gradients are released
+    2. step(): every rank updates its partition, then the updated partitions are all-gathered
+       so that all ranks hold the same full parameters again
+
+    The parameters of each dtype are laid out as one flat shard per rank (the partition of the rank, padded to the
+    size of the largest one): the collectives exchange chunks of all the shards at once, independently of the
+    number of ranks, and run asynchronously until the last one is waited for.
+
+    The model must not be wrapped with DistributedDataParallel, which would all-reduce all the gradients.
+    The interface is the one of the torch optimizers (param_groups, step, zero_grad, state_dict ...)
+    so that the learning rate schedules of Optim and the amp GradScaler work unchanged.
+    """
+
+    def __init__(self, params, build_optimizer, bucket_size=2 ** 24):
+        """
+        :param params: list of parameters (in the same order on every rank)
+        :param build_optimizer: function creating the optimizer for a list of parameters
+        :param bucket_size: maximum number of elements (of all the shards) communicated in one collective
+        """
+        self.params = list(params)
+        self.rank = dist.get_rank()
+        self.world_size = dist.get_world_size()
+        self.bucket_size = bucket_size
+
+        if len(self.params) < self.world_size:
+            raise ValueError("The zero redundancy optimizer needs at least one parameter per rank "
+                             "(%d parameters for %d ranks)" % (len(self.params), self.world_size))
+
+        self.partitions = self.partition_parameters([p.numel() for p in self.params], self.world_size)
+        self.local_indices = self.partitions[self.rank]
+        self.local_params = [self.params[i] for i in self.local_indices]
+        self.layouts = self.shard_layouts()
+
+        # the optimizer updates fp32 copies of the half precision parameters
+        self.master_params = [p.detach().float().requires_grad_(True) if p.dtype != torch.float32 else p
+                              for p in self.local_params]
+        self.optimizer = build_optimizer(self.master_params)
+
+        # start from the parameters of the first rank (as DistributedDataParallel does)
+        self.broadcast_parameters(src=0)
+
+    @staticmethod
+    def partition_parameters(sizes, world_size):
+        """
+        Greedy partitioning by size: the largest parameters first, each to the currently smallest partition
+        :param sizes: number of elements of each parameter
+        :param world_size: number of partitions
+        :return: a list (for each rank) of the sorted indices of its parameters
+        """
+        partitions = [list() for _ in range(world_size)]
+        totals = [0] * world_size
+
+        for i in sorted(range(len(sizes)), key=lambda j: -sizes[j]):
+            rank = totals.index(min(totals))
+            partitions[rank].append(i)
+            totals[rank] += sizes[i]
+
+        return [sorted(partition) for partition in partitions]
+
+    @property
+    def param_groups(self):
+        return self.optimizer.param_groups
+
+    @property
+    def state(self):
+        return self.optimizer.state
+
+    def shard_layouts(self):
+        """
+        :return: for each dtype (and device) of the parameters: (the dtype, the device, the entries
+                 (parameter index, offset, numel) of the flat shard of every rank, the size of the shards)
+        """
+        keys = list()
+        for p in self.params:
+            if (p.dtype, p.device) not in keys:
+                keys.append((p.dtype, p.device))
+
+        layouts = list()
+        for dtype, device in keys:
+            shards = list()
+            for indices in self.partitions:
+                entries, offset = list(), 0
+                for i in indices:
+                    if self.params[i].dtype == dtype and self.params[i].device == device:
+                        entries.append((i, offset, self.params[i].numel()))
+                        offset += self.params[i].numel()
+                shards.append(entries)
+
+            shard_size = max(sum(numel for _, _, numel in entries) for entries in shards)
+            layouts.append((dtype, device, shards, shard_size))
+
+        return layouts
+
+    def _chunks(self):
+        """
+        :return: the chunks [start, end) of the shards exchanged by one collective: (dtype, device, shards, start, end)
+        """
+        chunk_size = max(self.bucket_size // self.world_size, 1)
+        for dtype, device, shards, shard_size in self.layouts:
+            for start in range(0, shard_size, chunk_size):
+                yield dtype, device, shards, start, min(start + chunk_size, shard_size)
+
+    @staticmethod
+    def _views(tensors, entries, start, end):
+        """
+        :param tensors: a tensor for each parameter (the gradient or the parameter itself)
+        :param entries: the entries of a shard
+        :return: the flat views of the tensors in the chunk [start, end) of the shard, and their offsets in the chunk
+        """
+        for i, offset, numel in entries:
+            if offset < end and offset + numel > start:
+                low, high = max(start, offset), min(end, offset + numel)
+                yield tensors[i].view(-1)[low - offset:high - offset], low - start
+
+    def _pack(self, flat, tensors, entries, start, end):
+        """
+        Copy the chunk [start, end) of a shard into flat (zero padded)
+        """
+        flat.zero_()
+        for view, offset in self._views(tensors, entries, start, end):
+            flat[offset:offset + view.numel()].copy_(view)
+
+        return flat
+
+    def _unpack(self, flat, tensors, entries, start, end):
+        """
+        Copy flat back into the chunk [start, end) of a shard
+        """
+        for view, offset in self._views(tensors, entries, start, end):
+            view.copy_(flat[offset:offset + view.numel()])
+
+    @torch.no_grad()
+    def reduce_gradients(self):
+        """
+        Average the gradients over the ranks, each rank only receives (and keeps) the gradients of its partition.
+        The ranks must have the same sequence of parameters with gradients, unused parameters get zero gradients.
+        :return:
+        """
+        for p in self.params:
+            if p.grad is None:
+                p.grad = torch.zeros_like(p)
+        grads = [p.grad for p in self.params]
+
+        # each rank receives the sums of the chunks of its shard
+        pending = list()
+        for dtype, device, shards, start, end in self._chunks():
+            size = end - start
+            flat_grads = torch.empty(size * self.world_size, dtype=dtype, device=device)
+            for rank, entries in enumerate(shards):
+                self._pack(flat_grads[rank * size:(rank + 1) * size], grads, entries, start, end)
+
+            reduced = flat_grads.new_empty(size)
+            work = dist.reduce_scatter_tensor(reduced, flat_grads, async_op=True)
+            pending.append((work, reduced, shards[self.rank], start, end))
+
+        for work, reduced, entries, start, end in pending:
+            work.wait()
+            self._unpack(reduced.div_(self.world_size), grads, entries, start, end)
+
+        # the gradients of the other partitions are never used
+        local_indices = set(self.local_indices)
+        for i, p in enumerate(self.params):
+            if i not in local_indices:
+                p.grad = None
+
+        for p, master in zip(self.local_params, self.master_params):
+            if master is not p:
+                master.grad = p.grad.float()
+                p.grad = None
+
+        # the GradScaler of each rank only checks the gradients of its partition for inf/nan:
+        # all ranks have to skip the update (and decrease the scale) together
+        grads = [p.grad for p in self.master_params]
+        found_inf = torch.stack([torch.isfinite(grad).all() for grad in grads]).logical_not().any().float()
+        dist.all_reduce(found_inf)
+        if found_inf.item() > 0:
+            grads[0].view(-1)[0] = float('nan')
+
+    @torch.no_grad()
+    def clip_grad_norm(self, max_norm):
+        """
+        Clip the norm of the (reduced) gradients of all partitions
+        :param max_norm: maximum norm of the gradients
+        :return: the total norm of the gradients
+        """
+        grads = [p.grad for p in self.master_params if p.grad is not None]
+        total_norm = torch.stack([grad.float().norm(2) for grad in grads]).pow(2).sum()
+        dist.all_reduce(total_norm)
+        total_norm = total_norm.sqrt()
+
+        clip_coef = torch.clamp(max_norm / (total_norm + 1e-6), max=1.0)
+        for grad in grads:
+            grad.mul_(clip_coef.to(grad.dtype))
+
+        return total_norm
+
+    @torch.no_grad()
+    def broadcast_parameters(self, src=None):
+        """
+        :param src: rank sending all parameters, or None to receive each partition from its owner (all-gather)
+        :return:
+        """
+        params = [p.data for p in self.params]
+
+        pending = list()
+        for dtype, device, shards, start, end in self._chunks():
+            size = end - start
+            gathered = torch.empty(size * self.world_size, dtype=dtype, device=device)
+
+            if src is None:
+                local = self._pack(gathered.new_empty(size), params, shards[self.rank], start, end)
+                work = dist.all_gather_into_tensor(gathered, local, async_op=True)
+            else:
+                if src == self.rank:
+                    for rank, entries in enumerate(shards):
+                        self._pack(gathered[rank * size:(rank + 1) * size], params, entries, start, end)
+                work = dist.broadcast(gathered, src=src, async_op=True)
+            pending.append((work, gathered, shards, start, end))
+
+        # the own partition is up to date (except when receiving all the parameters)
+        receiving = [rank for rank in range(self.world_size) if rank != self.rank] if src is None else \
+            ([] if src == self.rank else list(range(self.world_size)))
+
+        for work, gathered, shards, start, end in pending:
+            work.wait()
+            size = end - start
+            for rank in receiving:
+                self._unpack(gathered[rank * size:(rank + 1) * size], params, shards[rank], start, end)
+
+    def step(self, closure=None):
+
+        loss = self.optimizer.step() if closure is None else self.optimizer.step(closure)
+
+        with torch.no_grad():
+            for p, master in zip(self.local_params, self.master_params):
+                if master is not p:
+                    p.copy_(master)
+
+        self.broadcast_parameters()
+
+        return loss
+
+    def zero_grad(self, set_to_none=True):
+
+        for p in self.params + self.master_params:
+            if set_to_none:
+                p.grad = None
+            elif p.grad is not None:
+                p.grad.zero_()
+
+    def state_dict(self):
+        """
+        Collective (has to be called by every rank): the states of all partitions are gathered on CPU into
+        the state dict of the full (unsharded) optimizer, so the checkpoint can be loaded with any number of ranks
+        and also without the zero redundancy optimizer.
+        :return: the full state dict on rank 0, the state dict of the local partition on the other ranks
+        """
+        local_state_dict = self.optimizer.state_dict()
+        assert len(local_state_dict['param_groups']) == 1, "Only one parameter group is supported"
+
+        # the states are indexed by the position of the parameter in the full list
+        local_states = {self.local_indices[i]: _to_cpu(state) for i, state in local_state_dict['state'].items()}
+        param_group = dict(local_state_dict['param_groups'][0])
+
+        all_states = [None] * self.world_size if self.rank == 0 else None
+        dist.gather_object(local_states, all_states, dst=0)
+
+        if self.rank == 0:
+            states = dict()
+            for partition_states in all_states:
+                states.update(partition_states)
+            param_group['params'] = list(range(len(self.params)))
+        else:
+            states = local_states
+            param_group['params'] = list(self.local_indices)
+
+        return {'state': states, 'param_groups': [param_group]}
+
+    def load_state_dict(self, state_dict):
+        """
+        :param state_dict: state dict of the full optimizer (from state_dict() or from a normal optimizer)
+        :return:
+        """
+        param_group = state_dict['param_groups'][0]
+        saved_ids = param_group['params']
+        assert len(saved_ids) == len(self.params), \
+            "The optimizer state has %d parameters instead of %d" % (len(saved_ids), len(self.params))
+
+        states = dict()
+        for i, index in enumerate(self.local_indices):
+            if saved_ids[index] in state_dict['state']:
+                states[i] = state_dict['state'][saved_ids[index]]
+
+        param_group = dict(param_group)
+        param_group['params'] = list(range(len(self.local_indices)))
+        self.optimizer.load_state_dict({'state': states, 'param_groups': [param_group]})
+
+    def __repr__(self):
+
+        n_local = sum(p.numel() for p in self.local_params)
+        n_total = sum(p.numel() for p in self.params)
+        return "ShardedOptimizer(rank %d/%d: %d of %d parameters)\n%s" \
+               % (self.rank, self.world_size, n_local, n_total, repr(self.optimizer))
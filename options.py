@@ -6,12 +6,18 @@ def make_parser(parser):
     parser.add_argument('-data', required=True,
                         help='Path to the *-train.pt file from preprocess.py')
     parser.add_argument('-data_format', required=False, default='raw',
-                        help='Default data format: raw')
+                        help='Default data format: raw. '
+                             'text: read the segmented text files DATA.{train,valid}.{src,tgt} with the '
+                             'dictionaries DATA.dict.pt, without binarization')
     parser.add_argument('-engine', default="apex", type=str,
                         help="""Engine for training apex|deepspeed""")
 
     parser.add_argument('-multi_dataset', action='store_true',
                         help='Reading multiple datasets (sharing the same dictionary)')
+    parser.add_argument('-data_sampling_temperature', type=float, default=1.0,
+                        help="""Temperature of sampling the datasets with -multi_dataset:
+                        1.0 uses each mini-batch once per epoch, higher values sample the datasets
+                        more uniformly (with probability ~ size^(1/T), repeating the small datasets)""")
 
     parser.add_argument('-patch_vocab_multiplier', type=int, default=1,
                         help='Pad vocab so that the size divides by this multiplier')
@@ -21,8 +27,21 @@ def make_parser(parser):
                         help='The iterator fills the data buffer with this size')
     parser.add_argument('-num_workers', type=int, default=0,
                         help='Number of extra workers for data fetching. 0=uses the main process. ')
+    parser.add_argument('-shard_balance', default='none', choices=['none', 'tokens', 'padded'],
+                        help='How the mini-batches are distributed over the GPUs. none: round-robin. '
+                             'tokens/padded: the GPUs get mini-batches with a similar cost at every step, '
+                             'estimated with the number of source and target tokens or with the padded area.')
     parser.add_argument('-pin_memory', action="store_true",
                         help='The data loader pins memory into the GPU to reduce the bottleneck between GPU-CPU')
+    parser.add_argument('-wav_cache_size', type=int, default=0,
+                        help='Number of audio segments kept in a LRU cache by each worker for -data_format wav. '
+                             '0 = no cache. Use -data_format wavmem to avoid reading the audio files entirely.')
+    parser.add_argument('-text_cache_size', type=int, default=1024,
+                        help='Number of converted sentences kept in a LRU cache by each worker for -data_format text. '
+                             '0 = no cache.')
+    parser.add_argument('-text_index_workers', type=int, default=4,
+                        help='Number of processes scanning the text files to index their lines '
+                             'for -data_format text (only when the index is not saved yet).')
 
     parser.add_argument('-bayes_by_backprop', action='store_true',
                         help="""Using Bayes-By-Backprop models in training""")
@@ -34,6 +53,16 @@ def make_parser(parser):
                         help='Coefficient for the KL divergence term')
 
     # MODEL UTIL
+    parser.add_argument('-ema_decay', type=float, default=0.0,
+                        help='Keep an exponential moving average of the weights with this decay '
+                             '(e.g. 0.9999), also validated and saved in the checkpoints '
+                             '(see tools/export_ema.py). 0 = disabled.')
+    parser.add_argument('-ema_every', type=int, default=1,
+                        help='Number of optimizer steps between two updates of the moving average '
+                             '(the decay is applied once per update).')
+    parser.add_argument('-ema_on_cpu', action='store_true',
+                        help='Keep the moving average in CPU memory instead of the GPU memory.')
+
     parser.add_argument('-save_model', default='model',
                         help="""Model filename (the model will be saved as
                         <save_model>_epochN_PPL.pt where PPL is the
@@ -80,6 +109,13 @@ def make_parser(parser):
                         Default=0 (full softmax), increase to 100 to use 100 noise samples.""")
     parser.add_argument('-unidirectional', action='store_true',
                         help="""Unidirectional encoder""")
+    parser.add_argument('-chunk_size', type=int, default=0,
+                        help="""Number of encoder frames per chunk for chunk-wise (streaming) speech encoding. 
+                        Default=0 (full utterance)""")
+    parser.add_argument('-chunk_left_context', type=int, default=-1,
+                        help="""Number of frames before each chunk that can be attended. Default=-1 (all)""")
+    parser.add_argument('-chunk_right_context', type=int, default=0,
+                        help="""Number of look-ahead frames after each chunk. Default=0""")
     parser.add_argument('-reconstruct', action='store_true',
                         help='Apply reconstruction with an additional decoder')
     parser.add_argument('-mirror_loss', action='store_true',
@@ -154,6 +190,9 @@ def make_parser(parser):
                         help='Maximum memory size for buffering in transformer XL')
     parser.add_argument('-extra_context_size', type=int, default=32,
                         help='Extra context size in transformer Xl')
+    parser.add_argument('-reuse_past_encoding', action='store_true',
+                        help='Discourse models: reuse the encoder output of an utterance which is both the '
+                             'current and the past input of samples in the same mini-batch')
     parser.add_argument('-epochs', type=int, default=13,
                         help='Number of training epochs')
     parser.add_argument('-param_init', type=float, default=0.1,
@@ -162,7 +201,8 @@ def make_parser(parser):
     parser.add_argument('-optim', default='adam',
                         help="Optimization method. [sgd|adagrad|adadelta|adam]")
     parser.add_argument('-zeror_optim', action="store_true",
-                        help="""Use Zero redundancy optimizer""")
+                        help="""Use Zero redundancy optimizer: the optimizer states are sharded over the GPUs
+                        (multi-GPU training without DistributedDataParallel)""")
     parser.add_argument('-max_grad_norm', type=float, default=0,
                         help="""If the norm of the gradient vector exceeds this,
                         renormalize it to have the norm equal to max_grad_norm""")
@@ -262,6 +302,28 @@ def make_parser(parser):
                         help="Save every this interval.")
     parser.add_argument('-keep_save_files', type=int, default=5,
                         help="Save every this interval.")
+    parser.add_argument('-async_save', action='store_true',
+                        help='Write the checkpoints in a background thread. The training only waits for '
+                             'copying the states to (pinned) CPU memory, which needs one extra copy of the model '
+                             'and optimizer states in host memory per save in flight.')
+    parser.add_argument('-async_save_max_inflight', type=int, default=1,
+                        help='Maximum number of checkpoints being written in the background. '
+                             'A new save waits until one of them is finished.')
+    parser.add_argument('-profile_phases', action='store_true',
+                        help='Time the phases of each training iteration (data loading, host-to-device copy, '
+                             'forward, loss, backward, optimizer) and report them with the padding efficiency '
+                             'at every log interval. Synchronizes the GPU at every phase boundary.')
+    parser.add_argument('-profile_trace_dir', type=str, default='',
+                        help='Write a torch.profiler trace (for TensorBoard) of a few training steps '
+                             'to this directory.')
+    parser.add_argument('-profile_trace_start', type=int, default=10,
+                        help='First step of each epoch recorded in the profiler trace.')
+    parser.add_argument('-profile_trace_steps', type=int, default=5,
+                        help='Number of steps recorded in the profiler trace.')
+    parser.add_argument('-simulate_oom_tokens', type=int, default=0,
+                        help='(Debugging) Raise out-of-memory errors for the (micro-)batches with more padded '
+                             'source and target tokens than this, to exercise the splitting of the minibatches '
+                             'that do not fit in memory. 0 = disabled.')
     parser.add_argument('-copy_generator', action='store_true',
                         help='Use the copy_generator')
     parser.add_argument('-verbose', action='store_true',
@@ -295,9 +357,13 @@ def make_parser(parser):
     parser.add_argument('-concat', type=int, default=4,
                         help="Concatenate frames to downsample.")
     parser.add_argument('-input_feature_size', type=int, default=40,
-                        help="Input feature size.")
+                        help="Input feature size: the number of features per frame (before the frames are "
+                             "concatenated), the bands of the frequency masks of -augment_speech.")
     parser.add_argument('-augment_speech', action='store_true',
                         help='Use f/t augmentation for speech')
+    parser.add_argument('-augment_on_device', action='store_true',
+                        help='Apply the f/t augmentation on the GPU after the transfer of each batch '
+                             'instead of in the data loader workers')
     parser.add_argument('-upsampling', action='store_true',
                         help='In case the data is downsampled during preprocess. This option will upsample the '
                              'samples again')
@@ -432,6 +498,14 @@ def make_parser(parser):
 
     parser.add_argument('-find_unused_parameters', action='store_true',
                         help='find unused parameters for torch DistributedDataParallel')
+    parser.add_argument('-ddp_bucket_cap_mb', type=int, default=25,
+                        help='Size (in MB) of the gradient buckets of DistributedDataParallel. Each bucket is '
+                             'all-reduced asynchronously as soon as its gradients are ready, during the rest of '
+                             'the backward pass (with -update_frequency > 1 only in the last backward pass '
+                             'before an update). In the updates in which a GPU runs out of memory, the buckets '
+                             'are all-reduced after the backward passes.')
+    parser.add_argument('-dist_backend', default='nccl', choices=['nccl', 'gloo'],
+                        help='Backend of torch.distributed for multi-GPU training.')
 
     # special tokens
     parser.add_argument('-src_pad_word', type=str, default="<blank>",
@@ -577,6 +651,15 @@ def backward_compatible(opt):
     if not hasattr(opt, 'unidirectional'):
         opt.unidirectional = False
 
+    if not hasattr(opt, 'chunk_size'):
+        opt.chunk_size = 0
+
+    if not hasattr(opt, 'chunk_left_context'):
+        opt.chunk_left_context = -1
+
+    if not hasattr(opt, 'chunk_right_context'):
+        opt.chunk_right_context = 0
+
     if not hasattr(opt, 'lsh_src_attention'):
         opt.lsh_src_attention = False
 
@@ -734,4 +817,61 @@ def backward_compatible(opt):
     if not hasattr(opt, 'post_norm'):
         opt.post_norm = False
 
+    if not hasattr(opt, 'reuse_past_encoding'):
+        opt.reuse_past_encoding = False
+
+    if not hasattr(opt, 'data_sampling_temperature'):
+        opt.data_sampling_temperature = 1.0
+
+    if not hasattr(opt, 'zeror_optim'):
+        opt.zeror_optim = False
+
+    if not hasattr(opt, 'async_save'):
+        opt.async_save = False
+
+    if not hasattr(opt, 'async_save_max_inflight'):
+        opt.async_save_max_inflight = 1
+
+    if not hasattr(opt, 'profile_phases'):
+        opt.profile_phases = False
+
+    if not hasattr(opt, 'profile_trace_dir'):
+        opt.profile_trace_dir = ''
+
+    if not hasattr(opt, 'profile_trace_start'):
+        opt.profile_trace_start = 10
+
+    if not hasattr(opt, 'profile_trace_steps'):
+        opt.profile_trace_steps = 5
+
+    if not hasattr(opt, 'augment_on_device'):
+        opt.augment_on_device = False
+
+    if not hasattr(opt, 'text_cache_size'):
+        opt.text_cache_size = 1024
+
+    if not hasattr(opt, 'text_index_workers'):
+        opt.text_index_workers = 4
+
+    if not hasattr(opt, 'shard_balance'):
+        opt.shard_balance = 'none'
+
+    if not hasattr(opt, 'simulate_oom_tokens'):
+        opt.simulate_oom_tokens = 0
+
+    if not hasattr(opt, 'ema_decay'):
+        opt.ema_decay = 0.0
+
+    if not hasattr(opt, 'ema_every'):
+        opt.ema_every = 1
+
+    if not hasattr(opt, 'ema_on_cpu'):
+        opt.ema_on_cpu = False
+
+    if not hasattr(opt, 'ddp_bucket_cap_mb'):
+        opt.ddp_bucket_cap_mb = 25
+
+    if not hasattr(opt, 'dist_backend'):
+        opt.dist_backend = 'nccl'
+
     return opt
@@ -39,7 +39,8 @@ parser.add_argument('-input_type', default="word",
 parser.add_argument('-data_type', default="int64",
                     help="Input type for storing text (int64|int32|int|int16) to reduce memory load")
 parser.add_argument('-format', default="raw",
-                    help="Save data format: binary or raw. Binary should be used to load faster")
+                    help="Save data format: binary or raw. Binary should be used to load faster. "
+                         "For wav inputs, wavmem also decodes the audio once into int16 memory mapped files")
 parser.add_argument('-external_tokenizer', default="",
                     help="External tokenizer from Huggingface. Currently supports barts.")
 
@@ -698,7 +699,7 @@ def main():
         torch.save(save_data, opt.save_data + '.train.pt')
         print("Done")
 
-    elif opt.format in ['scp', 'scpmem', 'wav']:
+    elif opt.format in ['scp', 'scpmem', 'wav', 'wavmem']:
         print('Saving target data to memory indexed data files. Source data is stored only as scp path.')
         from onmt.data.mmap_indexed_dataset import MMapIndexedDatasetBuilder
 
@@ -781,11 +782,25 @@ def main():
             save_data['train_past'] = train['past_src']
             save_data['valid_past'] = valid['past_src']
 
-        if opt.format in ['wav']:
+        if opt.format in ['wav', 'wavmem']:
             torch.save(save_data, opt.save_data + '.wav_path.pt')
         else:
             torch.save(save_data, opt.save_data + '.scp_path.pt')
 
+        # decode the audio segments once into int16 memory mapped files
+        if opt.format in ['wavmem']:
+            from onmt.data.wav_dataset import MMapWavDatasetBuilder
+
+            for split_, wav_list in [('train', train['src']), ('valid', valid['src'])]:
+                if wav_list is None:
+                    continue
+                print('Decoding %s audio into %s ...' % (split_, opt.save_data + ".%s.wav.bin" % split_))
+                wav_data = MMapWavDatasetBuilder(opt.save_data + ".%s.wav.bin" % split_)
+                wav_data.add_wav_list(wav_list, verbose=opt.verbose)
+                wav_data.finalize(opt.save_data + ".%s.wav.idx" % split_)
+
+                del wav_data
+
         print("Done")
 
     elif opt.format in ['mmap', 'mmem']:
@@ -0,0 +1,87 @@
+""" Small synthetic models, checkpoints and translators shared by the tests """
+import argparse
+import contextlib
+import io
+
+import torch
+
+import onmt
+import options
+import translate
+from onmt.inference.fast_translator import FastTranslator
+from onmt.model_factory import build_model, init_model_parameters
+
+# a one-layer model, fast enough on the CPU
+SMALL_MODEL_ARGS = ['-data', 'none', '-layers', '1', '-model_size', '32', '-inner_size', '64', '-n_heads', '2']
+
+
+def synthetic_dict(size):
+    """
+    :param size: the size of the vocabulary: the special words and w0, w1, ...
+    :return: onmt.Dict
+    """
+    words = [onmt.constants.PAD_WORD, onmt.constants.UNK_WORD,
+             onmt.constants.BOS_WORD, onmt.constants.EOS_WORD]
+    return onmt.Dict(words + ['w%d' % i for i in range(size - len(words))], lower=False)
+
+
+def synthetic_dicts(size):
+
+    return {'src': synthetic_dict(size), 'tgt': synthetic_dict(size), 'langs': {'src': 0, 'tgt': 1}}
+
+
+def model_options(model='transformer', extra_args=()):
+    """
+    :param model: the -model option
+    :param extra_args: more training options (e.g. -dropout 0)
+    :return: the training options of a small model
+    """
+    args = SMALL_MODEL_ARGS + ['-model', model] + list(extra_args)
+    return options.backward_compatible(options.make_parser(argparse.ArgumentParser()).parse_args(args))
+
+
+def build_synthetic_model(opt, dicts, seed=None):
+    """
+    Build and initialize a model (without the messages of the model factory)
+    :param seed: the random seed of the initialization (None: the current random state)
+    :return: the model
+    """
+    if seed is not None:
+        torch.manual_seed(seed)
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        model = build_model(opt, dicts)
+        init_model_parameters(model, opt)
+
+    return model
+
+
+def save_checkpoint(path, model, dicts, opt):
+    """
+    Save the model as a checkpoint of train.py (without optimizer state)
+    """
+    torch.save({'model': model.state_dict(), 'dicts': dicts, 'opt': opt, 'epoch': 0,
+                'itr': None, 'optim': None, 'amp': None}, path)
+
+
+def build_translator(paths, extra_args=()):
+    """
+    :param paths: the checkpoints (several: an ensemble)
+    :param extra_args: the options of translate.py (e.g. -beam_size)
+    :return: a FastTranslator on the CPU
+    """
+    args = ['-model', '|'.join(paths), '-src', 'none', '-fast_translate'] + list(extra_args)
+    translate_opt = translate.parser.parse_args(args)
+    translate_opt.cuda = False
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        return FastTranslator(translate_opt)
+
+
+def translate_batch(translator, src):
+    """
+    :param src: list of tokenized sentences
+    :return: the output of translator.translate (without its messages)
+    """
+    with contextlib.redirect_stdout(io.StringIO()):
+        return translator.translate(src, None)
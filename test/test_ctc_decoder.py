@@ -0,0 +1,80 @@
+import itertools
+import math
+
+import torch
+
+from onmt.inference.ctc_decoder import ctc_greedy_search, ctc_prefix_beam_search
+
+BLANK = 0
+
+
+def collapse(path):
+    """ Label sequence of an alignment: repetitions collapsed, blanks removed """
+    return tuple(label for label, _ in itertools.groupby(path) if label != BLANK)
+
+
+def brute_force(log_probs, length):
+    """ Probability of every label sequence: the sum over all its alignments """
+    probs = dict()
+    for path in itertools.product(range(log_probs.size(-1)), repeat=length):
+        score = sum(log_probs[t, label].item() for t, label in enumerate(path))
+        labels = collapse(path)
+        probs[labels] = probs.get(labels, 0.) + math.exp(score)
+
+    return probs
+
+
+def random_log_probs(bsz, time, vocab_size, seed):
+
+    generator = torch.Generator().manual_seed(seed)
+    return torch.randn(bsz, time, vocab_size, generator=generator).mul(2).log_softmax(dim=-1)
+
+
+def test_ctc_greedy_search():
+
+    log_probs = random_log_probs(4, 12, 6, seed=1)
+    lengths = torch.LongTensor([12, 7, 1, 0])
+
+    for b, (tokens, score) in enumerate(ctc_greedy_search(log_probs, lengths, blank=BLANK)):
+        best_path = log_probs[b, :lengths[b]].argmax(dim=-1).tolist()
+        assert tuple(tokens) == collapse(best_path)
+        assert abs(score - log_probs[b, :lengths[b]].max(dim=-1)[0].sum().item()) < 1e-4
+
+
+def test_ctc_prefix_beam_search_exact():
+
+    # the beam holds every possible prefix: the probabilities are exact
+    log_probs = random_log_probs(3, 5, 3, seed=2)
+    lengths = torch.LongTensor([5, 3, 4])
+    beam_size = 31
+
+    results = ctc_prefix_beam_search(log_probs, lengths, beam_size, blank=BLANK)
+    for b, hypotheses in enumerate(results):
+        reference = brute_force(log_probs[b], lengths[b].item())
+        assert len(hypotheses) == len(reference)
+
+        for tokens, score in hypotheses:
+            assert abs(math.exp(score) - reference[tuple(tokens)]) < 1e-5, tokens
+
+        scores = [score for _, score in hypotheses]
+        assert scores == sorted(scores, reverse=True)
+
+
+def test_ctc_prefix_beam_search_batch():
+
+    # the sentences of a batch are decoded independently of each other (and of the padding)
+    log_probs = random_log_probs(4, 20, 10, seed=3)
+    lengths = torch.LongTensor([20, 13, 5, 17])
+
+    batched = ctc_prefix_beam_search(log_probs, lengths, 4, blank=BLANK)
+    for b in range(4):
+        single = ctc_prefix_beam_search(log_probs[b:b + 1, :lengths[b]], lengths[b:b + 1], 4, blank=BLANK)[0]
+        assert [tokens for tokens, _ in single] == [tokens for tokens, _ in batched[b]]
+        assert all(abs(s1 - s2) < 1e-4 for (_, s1), (_, s2) in zip(single, batched[b]))
+
+
+if __name__ == "__main__":
+    test_ctc_greedy_search()
+    test_ctc_prefix_beam_search_exact()
+    test_ctc_prefix_beam_search_batch()
+    print("The CTC decoding is correct.")
@@ -0,0 +1,139 @@
+import torch
+
+from synthetic_models import build_synthetic_model, model_options, synthetic_dicts
+
+INPUT_SIZE = 8
+
+
+def training(encoder):
+    """
+    The discourse encoder in training mode, its layers in evaluation mode
+    (the fused attention dropout only runs on the GPU, the dropout is zero anyway)
+    """
+    encoder.eval()
+    encoder.training = True
+    return encoder
+
+
+def build_encoder(extra_args=()):
+
+    opt = model_options('discourse_speech_transformer',
+                        ['-encoder_type', 'audio', '-input_size', str(INPUT_SIZE), '-dropout', '0',
+                         '-attn_dropout', '0', '-emb_dropout', '0'] + list(extra_args))
+    model = build_synthetic_model(opt, synthetic_dicts(20), seed=1)
+    return model.encoder
+
+
+def utterances(n, seed):
+
+    generator = torch.Generator().manual_seed(seed)
+    lengths = torch.randint(4, 10, (n,), generator=generator).tolist()
+    return [torch.randn(length, INPUT_SIZE, generator=generator) for length in lengths]
+
+
+def pad(samples):
+
+    return torch.nn.utils.rnn.pad_sequence(samples, batch_first=True), \
+        torch.LongTensor([sample.size(0) for sample in samples])
+
+
+def count_encodings(encoder):
+    """
+    :return: the batch sizes of the calls of the shared (present and past) encoder
+    """
+    sizes = list()
+    encoder.encoder.register_forward_hook(lambda module, args, kwargs, output: sizes.append(args[0].size(0)),
+                                          with_kwargs=True)
+    return sizes
+
+
+def encode(encoder, current, past, **kwargs):
+
+    input, lengths = pad(current)
+    past_input, past_lengths = pad(past)
+    return encoder(input, past_input=past_input, src_lengths=lengths, past_src_lengths=past_lengths,
+                   input_lang=torch.LongTensor([0]), **kwargs)['context']
+
+
+def test_match_current_inputs():
+
+    encoder = build_encoder()
+    samples = utterances(4, seed=1)
+    input, lengths = pad(samples)
+    # the same utterances, with another padded length, and an utterance which is not in the batch
+    past = [samples[2], utterances(1, seed=2)[0], samples[0], samples[2][:-1]]
+    past_input, past_lengths = pad(past + [torch.zeros(input.size(1) + 3, INPUT_SIZE)])
+
+    matches = encoder._match_current_inputs(input, lengths, past_input[:4], past_lengths[:4])
+    assert matches == [2, -1, 0, -1]
+
+
+def test_encode_past_sub_batch():
+
+    encoder = build_encoder()
+    encoder.eval()
+    past_input, past_lengths = pad(utterances(4, seed=3))
+
+    with torch.no_grad():
+        reference = encoder.encode_past(past_input, past_lengths, [None] * 4)
+        known = [reference[:past_lengths[b], b] for b in range(4)]
+
+        sizes = count_encodings(encoder)
+        past_context = encoder.encode_past(past_input, past_lengths, [known[0], None, known[2], None])
+
+    # only the missing past inputs are encoded, as a smaller batch
+    assert sizes == [2]
+    assert past_context.size() == reference.size()
+    for b, length in enumerate(past_lengths.tolist()):
+        assert torch.allclose(past_context[:length, b], reference[:length, b], atol=1e-5)
+        assert not past_context[length:, b].ne(0).any()
+
+
+def test_reuse_past_encoding():
+
+    samples = utterances(5, seed=4)
+    current, past = samples[1:], samples[:-1]
+
+    reference_encoder = training(build_encoder())
+    reference = encode(reference_encoder, current, past)
+
+    encoder = training(build_encoder(['-reuse_past_encoding']))
+    sizes = count_encodings(encoder)
+    context = encode(encoder, current, past)
+
+    # the current utterances and the only past utterance which is not a current one of the batch
+    assert sizes == [4, 1]
+    assert torch.allclose(context, reference, atol=1e-5)
+
+def test_past_cache():
+
+    samples = utterances(6, seed=5)
+    ids = ['u%d' % i for i in range(6)]
+
+    reference_encoder = build_encoder()
+    reference_encoder.eval()
+    encoder = build_encoder()
+    encoder.eval()
+    encoder.set_past_cache(2)
+    sizes = count_encodings(encoder)
+
+    with torch.no_grad():
+        for batch in [[1, 2], [3], [4, 5]]:
+            current = [samples[i] for i in batch]
+            past = [samples[i - 1] for i in batch]
+            context = encode(encoder, current, past, utterance_ids=[ids[i] for i in batch],
+                             past_utterance_ids=[ids[i - 1] for i in batch])
+            assert torch.allclose(context, encode(reference_encoder, current, past), atol=1e-5)
+
+    # u0 is not known, u1 (in the batch), u2 (cached) and u3, u4 are not encoded again
+    assert sizes == [2, 1, 1, 2]
+    # the least recently used utterances are dropped
+    assert list(encoder.past_cache.keys()) == ['u4', 'u5']
+
+
+if __name__ == "__main__":
+    test_match_current_inputs()
+    test_encode_past_sub_batch()
+    test_reuse_past_encoding()
+    test_past_cache()
+    print("The discourse encoder reuses the encodings of the past utterances.")
@@ -0,0 +1,97 @@
+import os
+import subprocess
+import sys
+import tempfile
+
+import torch
+
+from onmt.train_utils.ema import ExponentialMovingAverage, averaged_state_dict
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+
+def build_model():
+
+    torch.manual_seed(1)
+    return torch.nn.Sequential(torch.nn.Linear(4, 8), torch.nn.BatchNorm1d(8), torch.nn.Linear(8, 2))
+
+
+def train_steps(model, ema, n):
+
+    optimizer = torch.optim.SGD(model.parameters(), lr=0.01)
+    weights = list()
+    for step in range(1, n + 1):
+        optimizer.zero_grad()
+        model(torch.randn(16, 4)).pow(2).mean().backward()
+        optimizer.step()
+        ema.update(step)
+        weights.append({name: tensor.detach().clone() for name, tensor in model.state_dict().items()})
+
+    return weights
+
+
+def test_moving_average():
+
+    model = build_model()
+    initial = {name: tensor.detach().clone() for name, tensor in model.state_dict().items()}
+    ema = ExponentialMovingAverage(model, decay=0.9, every=2, device=torch.device('cpu'))
+    weights = train_steps(model, ema, 7)
+
+    # updated after the steps 2, 4 and 6
+    assert ema.num_updates == 3
+    for name, shadow in ema.shadow.items():
+        expected = initial[name].float()
+        for step in [2, 4, 6]:
+            expected = 0.9 * expected + 0.1 * weights[step - 1][name].float()
+        assert torch.allclose(shadow, expected, atol=1e-6)
+
+    # the integer buffer (number of batches of the batch norm) is not averaged
+    assert '1.num_batches_tracked' not in ema.shadow
+
+    # validation with the averaged weights, the training weights are restored afterwards
+    trained = {name: tensor.detach().clone() for name, tensor in model.state_dict().items()}
+    with ema.average_weights() as averaged_model:
+        for name, shadow in ema.shadow.items():
+            assert torch.equal(averaged_model.state_dict()[name], shadow)
+    for name, tensor in model.state_dict().items():
+        assert torch.equal(tensor, trained[name])
+
+
+def test_checkpoint():
+
+    model = build_model()
+    ema = ExponentialMovingAverage(model, decay=0.5)
+    train_steps(model, ema, 3)
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'model.pt')
+        torch.save({'model': model.state_dict(), 'ema': ema.state_dict(), 'optim': None, 'epoch': 1}, path)
+
+        # resumed training continues the same average
+        checkpoint = torch.load(path)
+        resumed = ExponentialMovingAverage(build_model(), decay=0.5)
+        resumed.load_state_dict(checkpoint['ema'])
+        assert resumed.num_updates == 3
+        for name, shadow in ema.shadow.items():
+            assert torch.equal(resumed.shadow[name], shadow)
+
+        # export: the model weights are replaced by the average
+        output = os.path.join(directory, 'model.ema.pt')
+        subprocess.check_call([sys.executable, os.path.join(ROOT, 'tools', 'export_ema.py'),
+                               '-model', path, '-output', output], stdout=subprocess.DEVNULL)
+        exported = torch.load(output)
+        assert 'ema' not in exported and 'optim' not in exported and exported['epoch'] == 1
+
+        exported_model = build_model()
+        exported_model.load_state_dict(exported['model'])
+        for name, tensor in exported_model.state_dict().items():
+            expected = ema.shadow.get(name, checkpoint['model'][name])
+            assert torch.equal(tensor, expected)
+        averaged = averaged_state_dict(model.state_dict(), ema.state_dict())
+        assert torch.equal(averaged['0.weight'], ema.shadow['0.weight'])
+
+
+if __name__ == "__main__":
+    test_moving_average()
+    test_checkpoint()
+    print("The moving average of the weights is correct.")
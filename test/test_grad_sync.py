@@ -0,0 +1,150 @@
+import os
+import tempfile
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from torch.nn.parallel import DistributedDataParallel
+
+from onmt.train_utils.mp_trainer import all_reduce_gradients, gradient_sync, no_rank_out_of_memory
+from onmt.train_utils.profiler import CommunicationTimer
+
+WORLD_SIZE = 2
+UPDATE_FREQUENCY = 3
+
+
+def build_model():
+
+    torch.manual_seed(1)
+    return torch.nn.Sequential(torch.nn.Linear(16, 64), torch.nn.ReLU(), torch.nn.Linear(64, 64),
+                               torch.nn.ReLU(), torch.nn.Linear(64, 4))
+
+
+def inputs(rank, step):
+
+    generator = torch.Generator().manual_seed(100 * rank + step)
+    return torch.randn(8, 16, generator=generator)
+
+
+def sync_in_backward(rank, init_file, output_file):
+
+    dist.init_process_group(backend='gloo', init_method='file://' + init_file, world_size=WORLD_SIZE, rank=rank)
+
+    # small buckets: several asynchronous all-reduces per backward pass
+    model = DistributedDataParallel(build_model(), bucket_cap_mb=0.001)
+    timer = CommunicationTimer(cuda=False)
+    events = list()
+
+    def hook(process_group, bucket):
+        events.append('all-reduce')
+        return timer.all_reduce(process_group, bucket)
+
+    model.register_comm_hook(state=None, hook=hook)
+
+    # the buckets are rebuilt in the order of the gradients after the first synchronized backward pass
+    model(inputs(rank, -1)).sum().backward()
+    model.zero_grad()
+    timer.pop()
+    del events[:]
+
+    num_all_reduces = list()
+    for step in range(UPDATE_FREQUENCY):
+        with gradient_sync(model, step == UPDATE_FREQUENCY - 1):
+            model(inputs(rank, step)).pow(2).sum().backward()
+        events.append('backward %d' % step)
+        num_all_reduces.append(timer.pop()[1])
+
+    if rank == 0:
+        torch.save({'grads': [p.grad for p in model.parameters()], 'num_all_reduces': num_all_reduces,
+                    'events': events}, output_file)
+
+    dist.destroy_process_group()
+
+
+def all_reduce_after_backward(rank, init_file, output_file):
+
+    dist.init_process_group(backend='gloo', init_method='file://' + init_file, world_size=WORLD_SIZE, rank=rank)
+
+    model = DistributedDataParallel(build_model())
+    timer = CommunicationTimer(cuda=False)
+
+    num_all_reduces = list()
+    for step in range(UPDATE_FREQUENCY):
+        with gradient_sync(model, False):
+            model(inputs(rank, step)).pow(2).sum().backward()
+        num_all_reduces.append(timer.pop()[1])
+
+    # small buckets: several asynchronous all-reduces per update
+    all_reduce_gradients(model.parameters(), bucket_cap_mb=0.001, comm_timer=timer)
+    num_all_reduces.append(timer.pop()[1])
+
+    # the ranks decide together whether the gradients are all-reduced in backward
+    no_oom = [no_rank_out_of_memory(rank == 1, device='cpu'), no_rank_out_of_memory(False, device='cpu')]
+
+    if rank == 0:
+        torch.save({'grads': [p.grad for p in model.parameters()], 'num_all_reduces': num_all_reduces,
+                    'no_oom': no_oom}, output_file)
+
+    dist.destroy_process_group()
+
+
+def run_ranks(worker):
+
+    with tempfile.TemporaryDirectory() as directory:
+        output_file = os.path.join(directory, 'grads.pt')
+        mp.spawn(worker, args=(os.path.join(directory, 'init'), output_file), nprocs=WORLD_SIZE)
+        return torch.load(output_file)
+
+
+def check_average(grads):
+
+    # same as the average over the ranks of the accumulated gradients
+    model = build_model()
+    for rank in range(WORLD_SIZE):
+        for step in range(UPDATE_FREQUENCY):
+            model(inputs(rank, step)).pow(2).sum().backward()
+    for grad, param in zip(grads, model.parameters()):
+        assert torch.allclose(grad, param.grad / WORLD_SIZE, atol=1e-4)
+
+
+def test_accumulation_with_one_sync():
+
+    result = run_ranks(sync_in_backward)
+
+    # the gradients are only all-reduced during the last backward pass, by the comm hook in several buckets
+    assert result['num_all_reduces'][:-1] == [0] * (UPDATE_FREQUENCY - 1)
+    assert result['num_all_reduces'][-1] > 1
+    last = 'backward %d' % (UPDATE_FREQUENCY - 1)
+    assert result['events'] == ['backward %d' % step for step in range(UPDATE_FREQUENCY - 1)] + \
+        ['all-reduce'] * result['num_all_reduces'][-1] + [last]
+
+    check_average(result['grads'])
+
+
+def test_all_reduce_after_backward():
+
+    result = run_ranks(all_reduce_after_backward)
+
+    # after an out-of-memory error: only after the last backward pass, in several buckets
+    assert result['num_all_reduces'][:-1] == [0] * UPDATE_FREQUENCY
+    assert result['num_all_reduces'][-1] > 1
+    assert result['no_oom'] == [False, True]
+
+    check_average(result['grads'])
+
+
+def test_communication_time():
+
+    timer = CommunicationTimer(cuda=False)
+    # overlapping intervals are counted once
+    timer.intervals = [(0.0, 1.0), (0.5, 2.0), (3.0, 3.5)]
+    comm_time, num_all_reduces = timer.pop()
+    assert abs(comm_time - 2.5) < 1e-9 and num_all_reduces == 3
+    assert timer.pop() == (0.0, 0)
+
+
+if __name__ == "__main__":
+    test_accumulation_with_one_sync()
+    test_all_reduce_after_backward()
+    test_communication_time()
+    print("The gradients are synchronized once per update.")
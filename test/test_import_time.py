@@ -0,0 +1,65 @@
+import json
+import os
+import subprocess
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+# seconds spent importing the command line tools of the text-only path, on top of torch itself
+IMPORT_TIME_BUDGET = 0.5
+
+# optional dependencies of the audio models and of the pretrained model families
+OPTIONAL_MODULES = ['torchaudio', 'soundfile', 'h5py', 'kaldiio', 'librosa',
+                    'pretrain_module', 'onmt.models.speech_recognizer', 'onmt.bayesian_factory']
+
+# imports the script (without running its main, or its argument parser exits on -h), reports the loaded modules
+IMPORT_SCRIPT = """
+import json, runpy, sys, time
+import torch
+start = time.perf_counter()
+sys.argv = [%(script)r, '-h']
+try:
+    runpy.run_path(%(script)r, run_name='imported')
+except SystemExit:
+    pass
+elapsed = time.perf_counter() - start
+print(json.dumps({'time': elapsed, 'modules': sorted(sys.modules)}))
+"""
+
+
+def import_script(script):
+
+    code = IMPORT_SCRIPT % {'script': script}
+    output = subprocess.check_output([sys.executable, '-W', 'ignore', '-c', code], cwd=ROOT,
+                                     env=dict(os.environ, PYTHONPATH=ROOT), stderr=subprocess.DEVNULL)
+
+    return json.loads(output.decode('utf-8').strip().splitlines()[-1])
+
+
+def optional_modules(modules):
+
+    return [m for m in modules if any(m == name or m.startswith(name + '.') for name in OPTIONAL_MODULES)]
+
+
+def test_translate_imports():
+
+    result = import_script('translate.py')
+
+    assert 'onmt.inference.fast_translator' in result['modules']
+    assert optional_modules(result['modules']) == []
+    assert result['time'] < IMPORT_TIME_BUDGET, "translate.py imports in %.2fs" % result['time']
+
+
+def test_train_imports():
+
+    result = import_script('train.py')
+
+    assert 'onmt.model_factory' in result['modules']
+    assert optional_modules(result['modules']) == []
+    assert result['time'] < IMPORT_TIME_BUDGET, "train.py imports in %.2fs" % result['time']
+
+
+if __name__ == "__main__":
+    test_translate_imports()
+    test_train_imports()
+    print("The text-only command line tools import no optional dependency.")
@@ -0,0 +1,205 @@
+import torch
+
+import onmt
+from onmt.data.dataset import collect_fn, rewrap
+from onmt.modules.loss import NMTLossFunc
+from onmt.train_utils.micro_batches import MicroBatchSplitter, MemoryLimitSimulator
+from synthetic_models import build_synthetic_model, model_options, synthetic_dicts
+
+VOCAB_SIZE = 30
+
+
+def synthetic_batch(n, seed, length=8):
+
+    generator = torch.Generator().manual_seed(seed)
+    lengths = torch.randint(length - 3, length + 1, (n,), generator=generator).tolist()
+    src = [torch.randint(4, VOCAB_SIZE, (l,), generator=generator) for l in lengths]
+    tgt = [torch.cat([torch.LongTensor([onmt.constants.BOS]),
+                      torch.randint(4, VOCAB_SIZE, (l,), generator=generator),
+                      torch.LongTensor([onmt.constants.EOS])]) for l in lengths]
+    langs = [torch.LongTensor([0])]
+
+    return rewrap(collect_fn(src, tgt, langs, langs, src_align_right=False, tgt_align_right=False))
+
+
+def build():
+
+    opt = model_options(extra_args=['-dropout', '0', '-attn_dropout', '0', '-emb_dropout', '0'])
+    model = build_synthetic_model(opt, synthetic_dicts(VOCAB_SIZE), seed=1)
+
+    return model, NMTLossFunc(opt.model_size, VOCAB_SIZE, label_smoothing=0.0)
+
+
+def gradients(model, loss_function, batch, splitter=None, accumulate=False):
+
+    if not accumulate:
+        model.zero_grad()
+    calls = list()
+
+    def forward_backward(micro_batch, last):
+        calls.append((micro_batch.size, last))
+        targets = micro_batch.get('target_output')
+        outputs = model(micro_batch, target_mask=targets.ne(onmt.constants.PAD))
+        loss_dict = loss_function(outputs, targets, model=model)
+        loss_dict['loss'].backward()
+        return loss_dict['data']
+
+    if splitter is None:
+        losses = [forward_backward(batch, True)]
+    else:
+        losses = splitter.run(batch, forward_backward, model.parameters())
+
+    return [p.grad.clone() for p in model.parameters() if p.grad is not None], sum(losses), calls
+
+
+def test_split_batch():
+
+    batch = synthetic_batch(11, seed=1)
+    micro_batches = batch.split(3)
+
+    assert [b.size for b in micro_batches] == [3, 4, 4]
+    for key in ['source', 'target', 'target_input', 'target_output']:
+        assert torch.equal(torch.cat([b.get(key) for b in micro_batches], dim=1), batch.get(key))
+    assert torch.equal(torch.cat([b.src_lengths for b in micro_batches]), batch.src_lengths)
+    assert sum([b.tgt_lengths for b in micro_batches], []) == batch.tgt_lengths
+    assert sum(b.src_size for b in micro_batches) == batch.src_size
+    assert sum(b.tgt_size for b in micro_batches) == batch.tgt_size
+    # one language for the whole minibatch
+    assert all(torch.equal(b.get('source_lang'), batch.get('source_lang')) for b in micro_batches)
+
+    assert batch.split(1) == [batch]
+    assert len(batch.split(20)) == 11
+
+
+def test_same_gradients():
+
+    model, loss_function = build()
+    batch = synthetic_batch(16, seed=2)
+    reference, reference_loss, _ = gradients(model, loss_function, batch)
+
+    # 16 x (8 + 10) padded tokens do not fit: 4 sentences per micro-batch
+    simulator = MemoryLimitSimulator(max_tokens=90)
+    splitter = MicroBatchSplitter(simulator=simulator)
+    grads, loss, calls = gradients(model, loss_function, batch, splitter)
+
+    assert [size for size, _ in calls] == [4, 4, 4, 4]
+    assert [last for _, last in calls] == [False, False, False, True]
+    assert abs(loss - reference_loss) < 1e-3
+    for grad, reference_grad in zip(grads, reference):
+        assert torch.allclose(grad, reference_grad, atol=1e-5)
+
+    # the shapes that did not fit are remembered: a similar batch is split before running
+    num_errors = simulator.num_errors
+    _, _, calls = gradients(model, loss_function, synthetic_batch(16, seed=3), splitter)
+    assert simulator.num_errors == num_errors
+    assert splitter.num_presplit == 1
+    assert all(size <= 8 for size, _ in calls)
+
+    # smaller batches run at once
+    _, _, calls = gradients(model, loss_function, synthetic_batch(4, seed=4), splitter)
+    assert calls == [(4, True)]
+
+
+def test_single_sequence_too_large():
+
+    model, loss_function = build()
+    splitter = MicroBatchSplitter(simulator=MemoryLimitSimulator(max_tokens=10))
+
+    try:
+        gradients(model, loss_function, synthetic_batch(4, seed=5), splitter)
+        assert False, "the out-of-memory error of a single sequence is raised"
+    except RuntimeError as e:
+        assert 'out of memory' in str(e)
+
+
+def test_out_of_memory_in_backward():
+
+    model, loss_function = build()
+    previous_batch, batch = synthetic_batch(16, seed=6), synthetic_batch(16, seed=7)
+
+    # the gradients of the previous minibatch (-update_frequency) and of the minibatch
+    previous, _, _ = gradients(model, loss_function, previous_batch)
+    current, reference_loss, _ = gradients(model, loss_function, batch)
+
+    # the passes running out of memory fail when half of the gradients are accumulated already
+    simulator = MemoryLimitSimulator(max_tokens=90, in_backward=True)
+    splitter = MicroBatchSplitter(simulator=simulator)
+    gradients(model, loss_function, previous_batch)
+    grads, loss, calls = gradients(model, loss_function, batch, splitter, accumulate=True)
+
+    assert simulator.num_errors == 2 and splitter.num_ooms == 2
+    # the whole minibatch runs again with more micro-batches, the outputs of the failed attempts are dropped
+    assert [size for size, _ in calls] == [16, 8, 4, 4, 4, 4]
+    assert abs(loss - reference_loss) < 1e-3
+    # the partial gradients of the failed passes are not counted
+    for grad, previous_grad, current_grad in zip(grads, previous, current):
+        assert torch.allclose(grad, previous_grad + current_grad, atol=1e-5)
+
+    # a single sequence too large: only the gradients of the previous minibatch remain
+    splitter = MicroBatchSplitter(simulator=MemoryLimitSimulator(max_tokens=10, in_backward=True))
+    gradients(model, loss_function, previous_batch)
+    try:
+        gradients(model, loss_function, synthetic_batch(4, seed=5), splitter, accumulate=True)
+        assert False, "the out-of-memory error of a single sequence is raised"
+    except RuntimeError as e:
+        assert 'out of memory' in str(e)
+    for p, previous_grad in zip([p for p in model.parameters() if p.grad is not None], previous):
+        assert torch.allclose(p.grad, previous_grad, atol=1e-6)
+
+
+def test_synchronized_last_micro_batch():
+
+    model, loss_function = build()
+    previous_batch, batch = synthetic_batch(16, seed=6), synthetic_batch(16, seed=7)
+    previous, _, _ = gradients(model, loss_function, previous_batch)
+    current, _, _ = gradients(model, loss_function, batch)
+
+    # 4 sentences per micro-batch, the last one all-reduces (DDP) the gradients in its backward pass
+    splitter = MicroBatchSplitter()
+    splitter.record_failure(synthetic_batch(8, seed=7))
+    synchronized = list()
+    calls = list()
+
+    def forward_backward(micro_batch, last):
+        calls.append((micro_batch.size, last))
+        targets = micro_batch.get('target_output')
+        outputs = model(micro_batch, target_mask=targets.ne(onmt.constants.PAD))
+        loss_function(outputs, targets, model=model)['loss'].backward()
+        if last:
+            synchronized.append([p.grad.clone() for p in model.parameters() if p.grad is not None])
+
+    gradients(model, loss_function, previous_batch)
+    splitter.run(batch, forward_backward, model.parameters(), synchronize=lambda: True)
+
+    assert calls == [(4, False), (4, False), (4, False), (4, True)]
+    # the all-reduced gradients include the earlier minibatches
+    for grad, previous_grad, current_grad in zip(synchronized[0], previous, current):
+        assert torch.allclose(grad, previous_grad + current_grad, atol=1e-5)
+
+    # the synchronized pass cannot run again: its out-of-memory error is raised
+    state = {'synchronized': False}
+
+    def synchronize():
+        state['synchronized'] = True
+        return True
+
+    def simulator(micro_batch):
+        if state['synchronized']:
+            raise RuntimeError("CUDA out of memory (simulated)")
+
+    splitter = MicroBatchSplitter(simulator=simulator)
+    try:
+        splitter.run(batch, forward_backward, model.parameters(), synchronize=synchronize)
+        assert False, "the out-of-memory error of the synchronized pass is raised"
+    except RuntimeError as e:
+        assert 'out of memory' in str(e)
+    assert splitter.num_ooms == 0
+
+
+if __name__ == "__main__":
+    test_split_batch()
+    test_same_gradients()
+    test_single_sequence_too_large()
+    test_out_of_memory_in_backward()
+    test_synchronized_last_micro_batch()
+    print("The micro-batches give the same gradients.")
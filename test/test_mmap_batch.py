@@ -0,0 +1,95 @@
+import os
+import tempfile
+
+import numpy as np
+import torch
+
+import onmt
+from onmt.data.dataset import Dataset, IndexedSamples, merge_data, collect_fn
+from onmt.data.mmap_indexed_dataset import MMapIndexedDataset, MMapIndexedDatasetBuilder, \
+    index_file_path, data_file_path
+
+
+def write_samples(prefix, samples, dtype):
+
+    builder = MMapIndexedDatasetBuilder(data_file_path(prefix), dtype=dtype)
+    for sample in samples:
+        builder.add_item(torch.LongTensor(sample))
+    builder.finalize(index_file_path(prefix))
+
+    return MMapIndexedDataset(prefix)
+
+
+def random_samples(n, seed, min_length=1, max_length=30, vocab_size=60000):
+
+    rng = np.random.RandomState(seed)
+    return [rng.randint(4, vocab_size, rng.randint(min_length, max_length)).tolist() for _ in range(n)]
+
+
+def test_batch_fetch():
+
+    samples = random_samples(300, seed=1)
+    with tempfile.TemporaryDirectory() as directory:
+        for dtype in [np.uint16, np.int32, np.int64]:
+            dataset = write_samples(os.path.join(directory, 'data'), samples, dtype)
+            rng = np.random.RandomState(2)
+
+            for batch_size in [1, 7, 64]:
+                indices = rng.choice(len(samples), batch_size, replace=False).tolist()
+                for align_right in [False, True]:
+                    tensor, lengths = dataset.get_batch(indices, onmt.constants.TGT_PAD, align_right=align_right)
+                    reference, _, reference_lengths = merge_data([dataset[i] for i in indices],
+                                                                 align_right=align_right, dataname="target")
+                    assert tensor.dtype == torch.long
+                    assert torch.equal(tensor, reference)
+                    assert lengths == reference_lengths == [len(samples[i]) for i in indices]
+            del dataset
+
+
+def test_collect_fn():
+
+    src_samples = random_samples(50, seed=3)
+    tgt_samples = [[onmt.constants.BOS] + sample + [onmt.constants.EOS]
+                   for sample in random_samples(50, seed=4, min_length=0)]
+    langs = [torch.Tensor([0])]
+
+    with tempfile.TemporaryDirectory() as directory:
+        src = write_samples(os.path.join(directory, 'src'), src_samples, np.int32)
+        tgt = write_samples(os.path.join(directory, 'tgt'), tgt_samples, np.int32)
+        indices = list(range(0, 50, 3))
+
+        batch = collect_fn(IndexedSamples(src, indices), IndexedSamples(tgt, indices), langs, langs,
+                           src_align_right=True, tgt_align_right=False)
+        reference = collect_fn([src[i] for i in indices], [tgt[i] for i in indices], langs, langs,
+                               src_align_right=True, tgt_align_right=False)
+
+        for key in ['source', 'target', 'target_input', 'target_output', 'src_lengths']:
+            assert torch.equal(batch.tensors[key], reference.tensors[key])
+        for key in ['src_size', 'tgt_size', 'size', 'tgt_lengths']:
+            assert batch.tensors[key] == reference.tensors[key]
+
+        # the datasets read the memory maps once per batch, with the same result as the lists of tensors
+        data = Dataset(src, tgt, src.sizes, tgt.sizes, langs, langs, batch_size_words=128, data_type='text',
+                       sorting=True, batch_size_sents=8)
+        list_data = Dataset([src[i] for i in range(50)], [tgt[i] for i in range(50)], src.sizes, tgt.sizes,
+                            langs, langs, batch_size_words=128, data_type='text', sorting=True, batch_size_sents=8)
+        assert data.src_batch_fetch and data.tgt_batch_fetch and not list_data.src_batch_fetch
+        assert data.batches == list_data.batches
+
+        for i, batch_ids in enumerate(data.batches):
+            samples = [data[j] for j in batch_ids]
+            assert all(sample['src'] is None and sample['tgt'] is None for sample in samples)
+            collated = data.collater(samples)[0]
+            reference = list_data.collater([list_data[j] for j in batch_ids])[0]
+            direct = data.get_batch(i)
+            for key in ['source', 'target', 'src_lengths']:
+                assert torch.equal(collated.tensors[key], reference.tensors[key])
+                assert torch.equal(direct.tensors[key], reference.tensors[key])
+            assert collated.tensors['tgt_size'] == reference.tensors['tgt_size']
+        del src, tgt, data
+
+
+if __name__ == "__main__":
+    test_batch_fetch()
+    test_collect_fn()
+    print("The batched memory map reads are correct.")
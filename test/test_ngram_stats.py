@@ -0,0 +1,79 @@
+from collections import Counter
+
+import numpy as np
+
+from onmt.metrics.gleu import sentence_gleu
+from onmt.metrics.sbleu import sentence_bleu
+from onmt.metrics.ngram_stats import batch_sentence_bleu, batch_sentence_gleu, ngram_statistics
+
+
+def random_sentences(n, vocab_size, seed, max_length=25):
+
+    rng = np.random.RandomState(seed)
+    return [['w%d' % i for i in rng.randint(0, vocab_size, rng.randint(0, max_length))] for _ in range(n)]
+
+
+def reference_gleu(reference, hypothesis, min_len=1, max_len=4):
+    """ The GLEU of nltk (sentence_gleu before the n-gram statistics engine) """
+    def everygrams(words):
+        return Counter(tuple(words[i:i + n]) for n in range(min_len, max_len + 1) for i in range(len(words) - n + 1))
+
+    hyp_ngrams, ref_ngrams = everygrams(hypothesis), everygrams(reference)
+    tp = sum((hyp_ngrams & ref_ngrams).values())
+    return tp / max(sum(hyp_ngrams.values()), sum(ref_ngrams.values()))
+
+
+def test_batch_sentence_bleu():
+
+    # a small vocabulary for many matches of the higher orders
+    hypotheses = random_sentences(300, 6, seed=1)
+    references = random_sentences(300, 6, seed=2)
+    hypotheses[0], references[1] = [], []
+
+    scores = batch_sentence_bleu(references, hypotheses)
+    for ref, hyp, score in zip(references, hypotheses, scores):
+        assert abs(score - sentence_bleu(ref, hyp)[0]) < 1e-12
+
+
+def test_batch_sentence_gleu():
+
+    hypotheses = random_sentences(300, 5, seed=3)
+    references = random_sentences(300, 5, seed=4)
+    references[0] = []
+
+    for min_len, max_len in [(1, 4), (2, 3)]:
+        scores = batch_sentence_gleu(references, hypotheses, min_len=min_len, max_len=max_len)
+        for ref, hyp, score in zip(references, hypotheses, scores):
+            if len(hyp) >= min_len or len(ref) >= min_len:
+                assert abs(score - reference_gleu(ref, hyp, min_len, max_len)) < 1e-12
+            # the single sentence version gives the same scores
+            assert abs(score - sentence_gleu(ref, hyp, min_len, max_len)[0]) < 1e-12
+
+
+def test_nbest_and_hashed_keys():
+
+    references = random_sentences(20, 8, seed=5)
+    rng = np.random.RandomState(6)
+    hyp_to_ref = rng.randint(0, len(references), 200)
+    hypotheses = [references[r][:rng.randint(0, 20)] + ['w1', 'w2'] for r in hyp_to_ref]
+
+    scores = batch_sentence_bleu(references, hypotheses, hyp_to_ref=hyp_to_ref)
+    for r, hyp, score in zip(hyp_to_ref, hypotheses, scores):
+        assert abs(score - sentence_bleu(references[r], hyp)[0]) < 1e-12
+
+    # token ids too large for exact keys: the n-grams are hashed
+    def to_ids(sentence):
+        return [int(word[1:]) * 10 ** 16 for word in sentence]
+
+    stats = ngram_statistics([to_ids(hyp) for hyp in hypotheses], [to_ids(ref) for ref in references],
+                             hyp_to_ref=hyp_to_ref)
+    exact = ngram_statistics(hypotheses, references, hyp_to_ref=hyp_to_ref)
+    for key in exact:
+        assert np.array_equal(stats[key], exact[key]), key
+
+
+if __name__ == "__main__":
+    test_batch_sentence_bleu()
+    test_batch_sentence_gleu()
+    test_nbest_and_hashed_keys()
+    print("The batch n-gram statistics are the same as the sentence level ones.")
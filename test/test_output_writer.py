@@ -0,0 +1,102 @@
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import torch
+
+from onmt.inference.output_writer import AsyncOutputWriter
+from synthetic_models import build_synthetic_model, model_options, save_checkpoint, synthetic_dicts
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+VOCAB_SIZE = 40
+
+
+def save_model(path):
+
+    model_opt = model_options()
+    dicts = synthetic_dicts(VOCAB_SIZE)
+    model = build_synthetic_model(model_opt, dicts, seed=1)
+    model.generator[0].linear.weight.data.mul_(20)
+    save_checkpoint(path, model, dicts, model_opt)
+
+
+def write_sentences(path, n, seed):
+
+    generator = torch.Generator().manual_seed(seed)
+    with open(path, 'w') as f:
+        for _ in range(n):
+            length = torch.randint(3, 9, (1,), generator=generator).item()
+            ids = torch.randint(4, VOCAB_SIZE, (length,), generator=generator).tolist()
+            f.write(' '.join('w%d' % (i - 4) for i in ids) + '\n')
+
+
+def run_translate(directory, output, extra_args):
+
+    args = ['-model', os.path.join(directory, 'model.pt'), '-src', os.path.join(directory, 'src.txt'),
+            '-tgt', os.path.join(directory, 'tgt.txt'), '-output', output, '-fast_translate',
+            '-batch_size', '3', '-beam_size', '3', '-max_sent_length', '12', '-verbose'] + list(extra_args)
+    stdout = subprocess.check_output([sys.executable, '-W', 'ignore', os.path.join(ROOT, 'translate.py')] + args,
+                                     cwd=ROOT, env=dict(os.environ, PYTHONPATH=ROOT),
+                                     stderr=subprocess.DEVNULL)
+    with open(output, 'rb') as f:
+        return f.read(), stdout
+
+
+def test_same_output():
+
+    with tempfile.TemporaryDirectory() as directory:
+        save_model(os.path.join(directory, 'model.pt'))
+        write_sentences(os.path.join(directory, 'src.txt'), 20, seed=1)
+        write_sentences(os.path.join(directory, 'tgt.txt'), 20, seed=2)
+
+        for extra_args in [[], ['-print_nbest']]:
+            reference, reference_stdout = run_translate(directory, os.path.join(directory, 'sync.txt'),
+                                                        ['-write_queue_size', '0'] + extra_args)
+            output, stdout = run_translate(directory, os.path.join(directory, 'async.txt'),
+                                           ['-write_queue_size', '2'] + extra_args)
+
+            assert len(reference.splitlines()) == 20 * (3 if extra_args else 1)
+            assert output == reference
+            assert stdout == reference_stdout
+
+
+def test_order_and_errors():
+
+    written = list()
+
+    def slow_write(i):
+        time.sleep(0.001 * (i % 3))
+        written.append(i)
+
+    writer = AsyncOutputWriter(max_queue=2)
+    for i in range(20):
+        writer.submit(slow_write, i)
+    writer.wait()
+    assert written == list(range(20))
+
+    def fail():
+        raise ValueError("disk full")
+
+    writer.submit(fail)
+    writer.submit(slow_write, 20)
+    try:
+        writer.close()
+        assert False, "the error of the writer thread is raised"
+    except RuntimeError as e:
+        assert isinstance(e.__cause__, ValueError)
+    # nothing is written after a failure
+    assert written == list(range(20))
+
+    # without queue the jobs run immediately
+    writer = AsyncOutputWriter(max_queue=0)
+    writer.submit(slow_write, 21)
+    assert written[-1] == 21
+    writer.close()
+
+
+if __name__ == "__main__":
+    test_same_output()
+    test_order_and_errors()
+    print("The translations written in the background are the same.")
@@ -0,0 +1,184 @@
+import copy
+import torch
+
+import onmt
+from onmt.data.data_iterator import DataIterator
+from onmt.data.multidata_iterator import MultiDataIterator
+from onmt.train_utils.mp_trainer import resume_point
+
+
+def make_dataset(n_samples, seed):
+
+    generator = torch.Generator().manual_seed(seed)
+    lengths = torch.randint(3, 30, (n_samples,), generator=generator)
+    src = [torch.randint(4, 50, (int(n),), generator=generator) for n in lengths]
+    tgt = [torch.randint(4, 50, (int(n),), generator=generator) for n in lengths]
+    lang = [torch.LongTensor([0])]
+
+    dataset = onmt.Dataset(src, tgt, src_langs=lang, tgt_langs=lang,
+                           batch_size_words=200, batch_size_sents=16, sorting=True)
+
+    # count the collated mini-batches to check that the skipped part of the epoch is never loaded
+    dataset.n_collated = 0
+    collater = dataset.collater
+
+    def counting_collater(samples):
+        dataset.n_collated += 1
+        return collater(samples)
+
+    dataset.collater = counting_collater
+
+    return dataset
+
+
+def batch_key(samples):
+    """ A mini-batch is identified by the content of its source tensor """
+    source = samples[0].tensors['source']
+    return tuple(source.flatten().tolist())
+
+
+def consume(data_iterator, epoch_iterator, n=None):
+
+    keys = list()
+    while not data_iterator.end_of_epoch() and (n is None or len(keys) < n):
+        keys.append(batch_key(next(epoch_iterator)))
+
+    return keys
+
+
+def check_resume(build_iterator, datasets, stop_at):
+
+    # the reference: one uninterrupted epoch (the second one, to check that the epoch is restored as well)
+    data_iterator = build_iterator()
+    consume(data_iterator, data_iterator.next_epoch_itr(True))
+    reference = consume(data_iterator, data_iterator.next_epoch_itr(True))
+
+    # the interrupted run
+    data_iterator = build_iterator()
+    consume(data_iterator, data_iterator.next_epoch_itr(True))
+    first_part = consume(data_iterator, data_iterator.next_epoch_itr(True), n=stop_at)
+    state_dict = copy.deepcopy(data_iterator.state_dict())
+    assert first_part == reference[:stop_at]
+
+    # the resumed run starts from scratch with the state dict (as after loading a checkpoint)
+    for dataset in datasets:
+        dataset.n_collated = 0
+    data_iterator = build_iterator()
+    data_iterator.load_state_dict(state_dict)
+    epoch_iterator = data_iterator.next_epoch_itr(True)
+    assert data_iterator.epoch == 2
+    second_part = consume(data_iterator, epoch_iterator)
+
+    assert first_part + second_part == reference
+    # only the remaining mini-batches are loaded
+    assert sum(dataset.n_collated for dataset in datasets) == len(reference) - stop_at
+
+
+def test_resume_data_iterator():
+
+    dataset = make_dataset(300, seed=1)
+
+    def build_iterator():
+        return DataIterator(dataset, dataset.collater, dataset.batches, seed=5, num_workers=0)
+
+    n_batches = len(dataset.batches)
+    for stop_at in [1, n_batches // 3, n_batches - 1]:
+        check_resume(build_iterator, [dataset], stop_at)
+
+
+def test_resume_data_iterator_sharded():
+
+    dataset = make_dataset(300, seed=2)
+
+    for shard_id in range(3):
+        def build_iterator():
+            return DataIterator(dataset, dataset.collater, dataset.batches, seed=5, num_workers=0,
+                                num_shards=3, shard_id=shard_id)
+
+        check_resume(build_iterator, [dataset], 4)
+
+
+def test_resume_data_iterator_balanced_shards():
+
+    dataset = make_dataset(300, seed=2)
+
+    for shard_id in range(3):
+        def build_iterator():
+            return DataIterator(dataset, dataset.collater, dataset.batches, seed=5, num_workers=0,
+                                num_shards=3, shard_id=shard_id, shard_balance='tokens')
+
+        check_resume(build_iterator, [dataset], 4)
+
+
+def test_resume_multi_data_iterator():
+
+    datasets = [make_dataset(300, seed=3), make_dataset(120, seed=4), make_dataset(60, seed=5)]
+
+    def build_iterator():
+        return MultiDataIterator(datasets, seed=5, num_workers=0)
+
+    n_batches = sum(len(dataset.batches) for dataset in datasets)
+    for stop_at in [1, n_batches // 2, n_batches - 1]:
+        check_resume(build_iterator, datasets, stop_at)
+
+
+def test_resume_multi_data_iterator_temperature():
+
+    datasets = [make_dataset(300, seed=3), make_dataset(120, seed=4), make_dataset(60, seed=5)]
+
+    # the small datasets are repeated within the epoch
+    def build_iterator():
+        return MultiDataIterator(datasets, seed=5, num_workers=0, temperature=5.0)
+
+    n_batches = sum(len(dataset.batches) for dataset in datasets)
+    for stop_at in [1, n_batches // 2, n_batches - 1]:
+        check_resume(build_iterator, datasets, stop_at)
+
+
+def check_resume_end_of_epoch(build_iterator):
+
+    data_iterator = build_iterator()
+    consume(data_iterator, data_iterator.next_epoch_itr(True))
+    reference = consume(data_iterator, data_iterator.next_epoch_itr(True))
+
+    # saved in the middle of the first epoch: resumed in the first epoch
+    data_iterator = build_iterator()
+    epoch_iterator = data_iterator.next_epoch_itr(True)
+    consume(data_iterator, epoch_iterator, n=2)
+    state_dict = copy.deepcopy(data_iterator.state_dict())
+    assert resume_point({'epoch': 0.5, 'itr': state_dict}) == (1, state_dict)
+
+    # saved after the last batch of the first epoch: the second epoch starts from its beginning
+    consume(data_iterator, epoch_iterator)
+    state_dict = copy.deepcopy(data_iterator.state_dict())
+    assert state_dict['end_of_epoch']
+    start_epoch, itr_progress = resume_point({'epoch': 0.99, 'itr': state_dict})
+    assert (start_epoch, itr_progress) == (2, None)
+
+    # the trainer creates the iterator of the epoch (and does not load a state)
+    data_iterator = build_iterator(epoch=start_epoch)
+    assert consume(data_iterator, data_iterator.next_epoch_itr(True)) == reference
+
+    # saved at the end of an epoch (without iterator state)
+    assert resume_point({'epoch': 1, 'itr': None}) == (2, None)
+    assert resume_point({'itr': None}) == (1, None)
+
+
+def test_resume_end_of_epoch():
+
+    dataset = make_dataset(300, seed=6)
+    check_resume_end_of_epoch(lambda epoch=1: DataIterator(dataset, dataset.collater, dataset.batches, seed=5,
+                                                           num_workers=0, epoch=epoch))
+
+    datasets = [make_dataset(120, seed=7), make_dataset(60, seed=8)]
+    check_resume_end_of_epoch(lambda epoch=1: MultiDataIterator(datasets, seed=5, num_workers=0, epoch=epoch))
+
+
+if __name__ == "__main__":
+    test_resume_data_iterator()
+    test_resume_data_iterator_sharded()
+    test_resume_data_iterator_balanced_shards()
+    test_resume_multi_data_iterator()
+    test_resume_multi_data_iterator_temperature()
+    test_resume_end_of_epoch()
+    print("Resuming the data iterators is exact.")
@@ -0,0 +1,146 @@
+import contextlib
+import io
+import os
+import tempfile
+
+import torch
+import torch.nn.functional as F
+
+from onmt.model_factory import build_language_model
+from synthetic_models import (build_synthetic_model, build_translator, model_options, save_checkpoint,
+                              synthetic_dicts)
+
+VOCAB_SIZE = 40
+
+
+def save_checkpoints(directory):
+
+    torch.manual_seed(1)
+    dicts = synthetic_dicts(VOCAB_SIZE)
+
+    for name, model_type in [('model', 'transformer'), ('lm', 'transformer_xl')]:
+        model_opt = model_options(model_type)
+        if name == 'lm':
+            with contextlib.redirect_stdout(io.StringIO()):
+                model = build_language_model(model_opt, dicts)
+            for p in model.parameters():
+                torch.nn.init.normal_(p, std=0.3)
+        else:
+            model = build_synthetic_model(model_opt, dicts)
+        model.generator[0].linear.weight.data.mul_(10)
+        save_checkpoint(os.path.join(directory, name + '.pt'), model, dicts, model_opt)
+
+
+def build_fusion_translator(directory, extra_args=()):
+
+    return build_translator([os.path.join(directory, 'model.pt')],
+                            ['-beam_size', '1', '-max_sent_length', '10'] + list(extra_args))
+
+
+def sentences(n, seed):
+
+    generator = torch.Generator().manual_seed(seed)
+    ids = torch.randint(4, VOCAB_SIZE, (n, 6), generator=generator)
+    return [['w%d' % (i - 4) for i in sent] for sent in ids.tolist()]
+
+
+class LanguageModelBatch(object):
+
+    def __init__(self, target_input):
+        self.target_input = target_input
+
+    def get(self, name):
+        return self.target_input if name == 'target_input' else None
+
+
+def test_fused_greedy_search():
+
+    src = sentences(4, seed=2)
+    weight, bonus = 0.5, 0.2
+
+    with tempfile.TemporaryDirectory() as directory:
+        save_checkpoints(directory)
+        lm_args = ['-lm', os.path.join(directory, 'lm.pt')]
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            plain = build_fusion_translator(directory).translate(src, None)
+            no_weight = build_fusion_translator(directory, lm_args + ['-lm_weight', '0']).translate(src, None)
+            translator = build_fusion_translator(directory, lm_args + ['-lm_weight', str(weight),
+                                                                '-lm_length_bonus', str(bonus)])
+            fused = translator.translate(src, None)
+
+        # a zero weight gives the same output and scores
+        assert plain[0] == no_weight[0]
+        for scores, no_weight_scores in zip(plain[1], no_weight[1]):
+            assert torch.allclose(torch.stack(scores), torch.stack(no_weight_scores), atol=1e-5)
+        assert fused[0] != plain[0]
+
+        # reference: the language model scores the whole output prefix at every step
+        model, lm = translator.models[0], translator.lm_model
+        eos = translator.tgt_eos
+        for sent, hyps, scores in zip(src, fused[0], fused[1]):
+            dataset = translator.build_data([sent], None)
+            batch = dataset.get_batch(0)
+            output = [translator.tgt_dict.lookup(word) for word in hyps[0]] + [eos]
+
+            total = 0.0
+            state = model.create_decoder_state(batch, 1, type=2, buffering=True)
+            for t in range(len(output)):
+                prefix = torch.LongTensor([[translator.tgt_bos] + output[:t]])
+                with torch.no_grad():
+                    nmt = model.step(prefix, state)['log_prob']
+                    lm_input = torch.LongTensor([[eos] + output[:t]]).t()
+                    lm_output = lm(LanguageModelBatch(lm_input))
+                    lm_lprobs = F.log_softmax(lm_output['logprobs']['logits'][-1, 0].float(), dim=-1)
+                fused_lprobs = nmt.view(-1) + weight * lm_lprobs + bonus
+                fused_lprobs[translator.tgt_pad] = float('-inf')
+                # EOS is forced after max_sent_length tokens
+                if t < 10:
+                    assert fused_lprobs.argmax().item() == output[t]
+                total += fused_lprobs[output[t]].item()
+
+            assert abs(total - scores[0].item()) < 1e-3
+
+        # the buffers of the language model are reordered with the beams and the finished sentences
+        with contextlib.redirect_stdout(io.StringIO()):
+            beam = build_fusion_translator(directory, lm_args + ['-beam_size', '3', '-n_best', '3'])
+            hyps = beam.translate(src, None)[0]
+        assert all(len(nbest) == 3 for nbest in hyps)
+
+
+def test_incremental_language_model():
+
+    with tempfile.TemporaryDirectory() as directory:
+        save_checkpoints(directory)
+        with contextlib.redirect_stdout(io.StringIO()):
+            lm = build_fusion_translator(directory, ['-lm', os.path.join(directory, 'lm.pt')]).lm_model
+
+    generator = torch.Generator().manual_seed(5)
+    tokens = torch.randint(4, VOCAB_SIZE, (3, 7), generator=generator)
+
+    def full_lprobs(tokens):
+        # all the positions at once: T x B x V
+        with torch.no_grad():
+            logits = lm(LanguageModelBatch(tokens.t()))['logprobs']['logits']
+        return F.log_softmax(logits.float(), dim=-1)
+
+    # the step of one token with the buffers of the previous ones gives the same log-probs as the whole sequence
+    reference = full_lprobs(tokens)
+    state = lm.create_decoder_state(LanguageModelBatch(None), 1)
+    with torch.no_grad():
+        for t in range(tokens.size(1)):
+            lprobs = lm.step(tokens[:, :t + 1], state)['log_prob']
+            assert torch.allclose(lprobs, reference[t], atol=1e-4)
+
+            # the buffers follow the reordering of the beams
+            if t == 3:
+                order = torch.LongTensor([2, 0, 0])
+                state._reorder_incremental_state(order)
+                tokens = tokens.index_select(0, order)
+                reference = full_lprobs(tokens)
+
+
+if __name__ == "__main__":
+    test_fused_greedy_search()
+    test_incremental_language_model()
+    print("The shallow fusion is correct.")
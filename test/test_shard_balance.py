@@ -0,0 +1,85 @@
+import numpy as np
+import torch
+
+import onmt
+from onmt.data.data_iterator import DataIterator, BalancedShardedIterator, ShardedIterator
+
+
+def make_dataset(n_samples, seed):
+
+    generator = torch.Generator().manual_seed(seed)
+    lengths = torch.randint(1, 80, (n_samples,), generator=generator)
+    src = [torch.randint(4, 50, (int(n),), generator=generator) for n in lengths]
+    tgt = [torch.randint(4, 50, (int(n) + 2,), generator=generator) for n in lengths]
+    lang = [torch.LongTensor([0])]
+
+    return onmt.Dataset(src, tgt, src_langs=lang, tgt_langs=lang,
+                        batch_size_words=400, batch_size_sents=8, sorting=True)
+
+
+def step_spread(shards, cost):
+    """ Mean over the steps of the difference between the most and the least expensive mini-batch """
+    steps = list(zip(*shards))
+    return np.mean([max(cost(b) for b in step) - min(cost(b) for b in step) for step in steps])
+
+
+def test_balanced_assignment():
+
+    rng = np.random.RandomState(1)
+    costs = rng.randint(1, 1000, 103)
+    batches = [[i] for i in range(len(costs))]
+
+    for num_shards in [1, 2, 4, 7]:
+        # every shard computes the same assignment (with the same PRNG state)
+        shards = list()
+        for shard_id in range(num_shards):
+            np.random.seed(3)
+            shards.append(list(BalancedShardedIterator(batches, costs, num_shards, shard_id)))
+
+        assert len(set(len(shard) for shard in shards)) == 1
+        visited = sorted(b[0] for shard in shards for b in shard if b is not None)
+        assert visited == list(range(len(costs)))
+
+        if num_shards > 1:
+            round_robin = [list(ShardedIterator(batches, num_shards, shard_id, fill_value=[0]))
+                           for shard_id in range(num_shards)]
+            cost = (lambda b: 0 if b is None else costs[b[0]])
+            assert step_spread(shards, cost) < step_spread(round_robin, cost) / 4
+
+            # the totals of the shards are close as well
+            totals = [sum(cost(b) for b in shard) for shard in shards]
+            assert max(totals) - min(totals) <= costs.max()
+
+
+def test_data_iterator_balance():
+
+    dataset = make_dataset(2000, seed=1)
+    num_shards = 4
+
+    def epoch_batches(shard_balance, epoch, pad_shards=True):
+        shards = list()
+        for shard_id in range(num_shards):
+            iterator = DataIterator(dataset, dataset.collater, dataset.batches, seed=5, num_shards=num_shards,
+                                    shard_id=shard_id, pad_shards=pad_shards, shard_balance=shard_balance)
+            shards.append(iterator.get_batches_for_epoch(epoch, True)[0])
+        return shards
+
+    def cost(batch):
+        return int(dataset.src_sizes[batch].sum() + dataset.tgt_sizes[batch].sum())
+
+    balanced = epoch_batches('tokens', 1)
+    assert step_spread(balanced, cost) < step_spread(epoch_batches('none', 1), cost) / 4
+
+    # deterministic for the same epoch, different for the next one
+    assert epoch_batches('tokens', 1) == balanced
+    assert epoch_batches('tokens', 2) != balanced
+
+    # without padding, every mini-batch is visited exactly once
+    visited = sorted(tuple(b) for shard in epoch_batches('padded', 1, pad_shards=False) for b in shard)
+    assert visited == sorted(tuple(b) for b in dataset.batches)
+
+
+if __name__ == "__main__":
+    test_balanced_assignment()
+    test_data_iterator_balance()
+    print("The mini-batches are balanced over the shards.")
@@ -0,0 +1,147 @@
+import os
+import tempfile
+
+import torch
+
+from onmt.inference.shared_encoder import EncoderCache, identical_modules
+from synthetic_models import (build_synthetic_model, build_translator, model_options, save_checkpoint,
+                              synthetic_dicts, translate_batch)
+
+VOCAB_SIZE = 40
+
+
+def save_models(directory):
+    """
+    a and b: the same encoder (e.g. frozen during training) and different decoders, c: another encoder
+    """
+    model_opt = model_options()
+    dicts = synthetic_dicts(VOCAB_SIZE)
+
+    models = list()
+    for seed in [1, 2, 3]:
+        model = build_synthetic_model(model_opt, dicts, seed=seed)
+        model.generator[0].linear.weight.data.mul_(20)
+        models.append(model)
+    models[1].encoder.load_state_dict(models[0].encoder.state_dict())
+
+    for name, model in zip(['a', 'b', 'c'], models):
+        save_checkpoint(os.path.join(directory, name + '.pt'), model, dicts, model_opt)
+
+
+def build_ensemble(directory, names, extra_args=()):
+
+    return build_translator([os.path.join(directory, name + '.pt') for name in names],
+                            ['-beam_size', '3', '-n_best', '3', '-max_sent_length', '12'] + list(extra_args))
+
+
+def count_calls(encoder):
+    """
+    :return: the number of times the encoder is computed (its __call__ also runs for the cached outputs)
+    """
+    calls = [0]
+
+    def hook(*args):
+        calls[0] += 1
+
+    encoder.layer_modules[0].register_forward_hook(hook)
+    return calls
+
+
+def translate_scores(translator, src):
+
+    pred_batch, pred_score = translate_batch(translator, src)[:2]
+    return pred_batch, [[float(score) for score in scores] for scores in pred_score]
+
+
+def test_identical_encoders():
+
+    src = [['w%d' % (i % 30) for i in range(n, n + 6)] for n in range(5)]
+
+    with tempfile.TemporaryDirectory() as directory:
+        save_models(directory)
+
+        translator = build_ensemble(directory, ['a', 'b', 'c'])
+        assert translator.encoder_cache.groups == [[0, 1]]
+        assert translator.models[0].encoder is translator.models[1].encoder
+        assert translator.models[2].encoder is not translator.models[0].encoder
+
+        shared_calls = count_calls(translator.models[0].encoder)
+        other_calls = count_calls(translator.models[2].encoder)
+        hyps, scores = translate_scores(translator, src)
+        # the shared encoder runs once for the batch
+        assert shared_calls[0] == 1 and other_calls[0] == 1
+        assert translator.encoder_cache.num_hits == 1
+
+        # the same translations as with the encoder of each model
+        reference = build_ensemble(directory, ['a', 'b', 'c'], ['-no_encoder_sharing'])
+        assert reference.encoder_cache.groups == []
+        reference_hyps, reference_scores = translate_scores(reference, src)
+        assert hyps == reference_hyps
+        for score, reference_score in zip(scores, reference_scores):
+            assert max(abs(x - y) for x, y in zip(score, reference_score)) < 1e-4
+
+        # different inputs (a new batch) are encoded again
+        translate_batch(translator, src[:2])
+        assert shared_calls[0] == 2 and translator.encoder_cache.num_hits == 2
+
+        # the cache is emptied after every batch: the first batch again gives the same output
+        assert translate_scores(translator, src) == (hyps, scores)
+        assert shared_calls[0] == 3
+
+        assert identical_modules(reference.models[0].encoder, reference.models[1].encoder)
+        assert not identical_modules(reference.models[0].encoder, reference.models[2].encoder)
+        assert not identical_modules(reference.models[0].encoder, reference.models[0].decoder)
+
+
+class Encoder(torch.nn.Module):
+
+    def __init__(self):
+        super().__init__()
+        self.linear = torch.nn.Linear(4, 4)
+        self.calls = 0
+
+    def forward(self, x, mask=None):
+        self.calls += 1
+        return {'context': self.linear(x), 'mask': mask}
+
+
+class Member(torch.nn.Module):
+
+    def __init__(self, encoder):
+        super().__init__()
+        self.encoder = encoder
+
+
+def test_encoder_cache():
+
+    torch.manual_seed(1)
+    encoders = [Encoder(), Encoder(), Encoder()]
+    encoders[1].load_state_dict(encoders[0].state_dict())
+    members = [Member(encoder) for encoder in encoders]
+    cache = EncoderCache(members)
+
+    assert cache.groups == [[0, 1]]
+    assert members[1].encoder is encoders[0] and members[2].encoder is encoders[2]
+
+    x = torch.randn(3, 4)
+    reference = encoders[0].linear(x)
+    with cache.caching():
+        outputs = [member.encoder(x.clone(), mask=None) for member in members[:2]]
+        # other inputs are encoded again
+        other = members[0].encoder(x + 1, mask=None)
+    assert encoders[0].calls == 2 and cache.num_hits == 1
+    assert all(torch.equal(output['context'], reference) for output in outputs)
+    # the members get their own output dictionaries
+    assert outputs[0] is not outputs[1]
+    assert torch.equal(other['context'], encoders[0].linear(x + 1))
+
+    # outside of caching() every call is computed
+    members[1].encoder(x)
+    members[1].encoder(x)
+    assert encoders[0].calls == 4 and cache.num_hits == 1
+
+
+if __name__ == "__main__":
+    test_identical_encoders()
+    test_encoder_cache()
+    print("The ensemble members with identical encoders share the encoder outputs.")
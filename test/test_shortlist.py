@@ -0,0 +1,130 @@
+import contextlib
+import io
+import os
+import tempfile
+
+import torch
+
+from onmt.inference.shortlist import Shortlist
+from synthetic_models import (build_synthetic_model, build_translator, model_options, save_checkpoint,
+                              synthetic_dict, synthetic_dicts, translate_batch)
+
+VOCAB_SIZE = 60
+
+
+def build_shortlist_translator(directory, beam_size, extra_args=()):
+
+    path = os.path.join(directory, 'model.pt')
+    if not os.path.exists(path):
+        model_opt = model_options()
+        dicts = synthetic_dicts(VOCAB_SIZE)
+        model = build_synthetic_model(model_opt, dicts, seed=1)
+        # larger logits: more peaked distributions than the initialization
+        model.generator[0].linear.weight.data.mul_(20)
+        save_checkpoint(path, model, dicts, model_opt)
+
+    return build_translator([path], ['-beam_size', str(beam_size), '-n_best', str(beam_size),
+                                     '-max_sent_length', '12'] + list(extra_args))
+
+
+def sentences(n, seed):
+
+    generator = torch.Generator().manual_seed(seed)
+    ids = torch.randint(4, VOCAB_SIZE, (n, 7), generator=generator)
+    return [['w%d' % (i - 4) for i in sent] for sent in ids.tolist()]
+
+
+def test_shortlist_candidates():
+
+    tgt_dict = synthetic_dict(VOCAB_SIZE)
+    for i, word in enumerate(['w7', 'w3', 'w3', 'w9']):
+        tgt_dict.add(word, num=10 - i)
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'lex.txt')
+        with open(path, 'w') as f:
+            f.write('w1 w20 0.5\nw1 w21 0.2\nw1 w22 0.9\nw2 w30 1.0\nunknown w40 1.0\nw1 unknown 1.0\n')
+        shortlist = Shortlist(tgt_dict, path=path, src_dict=synthetic_dict(VOCAB_SIZE), first=2, per_word=2,
+                              always=[3])
+
+    src_dict = synthetic_dict(VOCAB_SIZE)
+    w = tgt_dict.lookup
+    # the most frequent words, the best two translations of w1 and EOS
+    expected = sorted([w('w3'), w('w7'), w('w22'), w('w20'), 3])
+    assert shortlist(torch.LongTensor([[src_dict.lookup('w1')], [src_dict.lookup('w5')]])).tolist() == expected
+    assert shortlist().tolist() == sorted([w('w3'), w('w7'), 3])
+
+
+def test_full_shortlist_is_exact():
+
+    src = sentences(5, seed=2)
+    with tempfile.TemporaryDirectory() as directory:
+        full = translate_batch(build_shortlist_translator(directory, 4), src)
+        # every word of the vocabulary is in the shortlist
+        shortlisted = translate_batch(build_shortlist_translator(directory, 4, ['-shortlist_first', str(VOCAB_SIZE)]), src)
+
+    for hyps, shortlisted_hyps, scores, shortlisted_scores in zip(full[0], shortlisted[0], full[1], shortlisted[1]):
+        assert hyps == shortlisted_hyps
+        for score, shortlisted_score in zip(scores, shortlisted_scores):
+            assert torch.allclose(score, shortlisted_score, atol=1e-5)
+
+
+def test_greedy_output_in_shortlist():
+
+    src = sentences(6, seed=3)
+    with tempfile.TemporaryDirectory() as directory:
+        hyps = translate_batch(build_shortlist_translator(directory, 1), src)[0]
+
+        # the source words are translated into the words of the full vocabulary output and a few others
+        path = os.path.join(directory, 'lex.txt')
+        with open(path, 'w') as f:
+            for sent, hyp in zip(src, hyps):
+                for word in set(sent):
+                    for target in hyp[0] + ['w50', 'w51']:
+                        f.write('%s %s 1.0\n' % (word, target))
+
+        translator = build_shortlist_translator(directory, 1, ['-shortlist', path])
+        shortlisted_hyps = translate_batch(translator, src)[0]
+        assert len(translator.shortlist(torch.LongTensor([[4, 5, 6]]))) < VOCAB_SIZE
+
+    assert hyps == shortlisted_hyps
+
+
+def test_audio_input():
+
+    model_opt = model_options(extra_args=['-encoder_type', 'audio', '-input_size', '8', '-concat', '1'])
+    dicts = synthetic_dicts(VOCAB_SIZE)
+    model = build_synthetic_model(model_opt, dicts, seed=1)
+    model.generator[0].linear.weight.data.mul_(20)
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'model.pt')
+        save_checkpoint(path, model, dicts, model_opt)
+        translator = build_translator([path], ['-beam_size', '2', '-max_sent_length', '8', '-encoder_type', 'audio',
+                                               '-shortlist_first', '10'])
+
+    # without source words: the frequent words, on the device of the batch (of the output layers)
+    devices = list()
+    shortlist = translator.shortlist
+
+    def record(src=None, device=None):
+        devices.append((src, device))
+        return shortlist(src, device=device)
+
+    translator.shortlist = record
+    generator = torch.Generator().manual_seed(4)
+    features = [torch.randn(length, 8, generator=generator) for length in [12, 9, 15]]
+    with contextlib.redirect_stdout(io.StringIO()):
+        hyps = translator.translate(features, None, type='asr')[0]
+
+    assert devices == [(None, torch.device('cpu'))]
+    words = set(dicts['tgt'].getLabel(i) for i in shortlist().tolist())
+    assert all(word in words for hyp in hyps for word in hyp[0])
+
+
+if __name__ == "__main__":
+    test_shortlist_candidates()
+    test_full_shortlist_is_exact()
+    test_greedy_output_in_shortlist()
+    test_audio_input()
+    print("The shortlist decoding is correct.")
@@ -0,0 +1,131 @@
+import contextlib
+import io
+import types
+
+import torch
+
+import onmt
+from onmt.data.dataset import merge_data, rewrap
+from onmt.data.multidata_iterator import MultiDataset
+from onmt.train_utils.mp_trainer import Trainer
+from onmt.speech.Augmenter import BatchAugmenter
+
+
+def make_batch(lengths, feature_size=80, seed=1):
+
+    generator = torch.Generator().manual_seed(seed)
+    return [torch.rand(length, feature_size, generator=generator) + 0.5 for length in lengths]
+
+
+def test_masks_within_lengths():
+
+    augmenter = BatchAugmenter(F=8, mf=2, T=20, max_t=0.2, mt=2, input_size=40, seed=3)
+    lengths = torch.LongTensor([100, 37, 5, 64])
+    time_mask, freq_mask = augmenter.masks(lengths, 100, 80)
+
+    for b, length in enumerate(lengths.tolist()):
+        # at most mt masks of at most min(T, max_t * length) frames, all within the sample
+        assert not time_mask[b, length:].any()
+        assert time_mask[b].sum() <= 2 * min(20, int(0.2 * length))
+
+    # the stacked frames (2 x 40 features) are masked in the same bands
+    assert torch.equal(freq_mask[:, :40], freq_mask[:, 40:])
+    assert (freq_mask[:, :40].sum(dim=1) <= 2 * 7).all()
+
+
+def test_merge_data_augmentation():
+
+    samples = make_batch([50, 20, 35])
+    augmenter = BatchAugmenter(F=8, T=10, input_size=40, seed=5)
+    tensor, _, lengths = merge_data(samples, type='audio', augmenter=augmenter)
+    reference, _, _ = merge_data(samples, type='audio')
+
+    for b, length in enumerate(lengths):
+        # the features are either kept or zeroed, the padding stays zero
+        kept = tensor[b, :length].ne(0)
+        assert torch.equal(tensor[b, :length][kept], reference[b, :length][kept])
+        assert not tensor[b, length:].ne(0).any()
+    assert tensor.eq(0).sum() > reference.eq(0).sum()
+
+
+def test_reproducible_and_time_first():
+
+    samples = make_batch([40, 30, 25, 12])
+    padded, _, lengths = merge_data(samples, type='audio')
+    lengths = torch.LongTensor(lengths)
+
+    def augment(epoch, time_first=False):
+        augmenter = BatchAugmenter(F=8, T=10, input_size=40, seed=7)
+        augmenter.set_epoch(epoch)
+        if time_first:
+            return augmenter.augment_batch(padded.transpose(0, 1).clone(), lengths, time_first=True).transpose(0, 1)
+        return augmenter.augment_batch(padded.clone(), lengths)
+
+    assert torch.equal(augment(1), augment(1))
+    assert torch.equal(augment(1), augment(1, time_first=True))
+    assert not torch.equal(augment(1), augment(2))
+
+
+def test_dataset_feature_size():
+
+    samples = make_batch([50, 20, 35, 12], feature_size=80)
+    tgt = [torch.LongTensor([onmt.constants.BOS, 5, 6, onmt.constants.EOS]) for _ in samples]
+    langs = [torch.LongTensor([0])]
+
+    def augmenter(**kwargs):
+        with contextlib.redirect_stdout(io.StringIO()):
+            dataset = onmt.Dataset(samples, tgt, src_langs=langs, tgt_langs=langs, data_type='audio',
+                                   augment=True, **kwargs)
+        return dataset.augmenter
+
+    # the frames of the options (2 stacked frames of 40 features), or the features of the data
+    assert augmenter(sa_input_size=40).input_size == 40
+    assert augmenter().input_size == 80
+    # the features are not frames of this size: all the features are one band
+    assert augmenter(sa_input_size=30).input_size == 80
+
+
+class RecordingAugmenter(object):
+
+    def __init__(self, name, calls):
+        self.name = name
+        self.calls = calls
+
+    def augment_batch(self, tensor, lengths, time_first=False):
+        self.calls.append((self.name, tensor.size(-1)))
+        return tensor
+
+
+def test_augmenter_of_the_dataset():
+
+    langs = [torch.LongTensor([0])]
+    datasets = list()
+    for feature_size in [80, 40]:
+        samples = make_batch([50, 20, 35, 12], feature_size=feature_size)
+        tgt = [torch.LongTensor([onmt.constants.BOS, 5, 6, onmt.constants.EOS]) for _ in samples]
+        with contextlib.redirect_stdout(io.StringIO()):
+            datasets.append(onmt.Dataset(samples, tgt, src_langs=langs, tgt_langs=langs, data_type='audio',
+                                         augment=True, sa_f=feature_size // 10))
+        datasets[-1].augmenter.on_device = True
+
+    # the batches of several training sets keep the id of their dataset
+    multi_dataset = MultiDataset(datasets)
+    batch = rewrap(multi_dataset.collater([(1, datasets[1][0]), (1, datasets[1][2])])[0])
+    assert batch.get('dataset_id') == 1
+
+    # on the device, each batch is augmented with the options of its dataset
+    calls = list()
+    trainer = types.SimpleNamespace(augmenters={0: RecordingAugmenter(0, calls), 1: RecordingAugmenter(1, calls)})
+    Trainer.augment_batch(trainer, batch)
+    single = rewrap(datasets[0].collater([datasets[0][1]])[0])
+    Trainer.augment_batch(trainer, single)
+    assert calls == [(1, 40), (0, 80)]
+
+
+if __name__ == "__main__":
+    test_masks_within_lengths()
+    test_merge_data_augmentation()
+    test_reproducible_and_time_first()
+    test_dataset_feature_size()
+    test_augmenter_of_the_dataset()
+    print("The batch spec augmentation is correct.")
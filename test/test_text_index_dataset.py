@@ -0,0 +1,98 @@
+import os
+import pickle
+import tempfile
+
+import numpy as np
+import torch
+
+import onmt
+from onmt.data.dataset import Dataset
+from onmt.data.text_index_dataset import TextIndexDataset, build_line_index, index_file_path
+
+
+def make_corpus(directory, n=200, seed=1):
+
+    rng = np.random.RandomState(seed)
+    words = ['a', 'b@@', 'c', 'ü@@', 'ß', '日本', 'x']
+    lines = [' '.join(rng.choice(words, rng.randint(0, 12))) for _ in range(n)]
+    # unicode and repeated whitespace, an empty line and no final newline
+    lines[3] = 'a　b@@  c\t x'
+    lines[4] = ''
+    path = os.path.join(directory, 'corpus.txt')
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('\n'.join(lines))
+
+    vocab = onmt.Dict([onmt.constants.PAD_WORD, onmt.constants.UNK_WORD,
+                       onmt.constants.BOS_WORD, onmt.constants.EOS_WORD])
+    for word in words[:-1]:
+        vocab.add(word)
+
+    return path, lines, vocab
+
+
+def test_lazy_conversion():
+
+    with tempfile.TemporaryDirectory() as directory:
+        path, lines, vocab = make_corpus(directory)
+        dataset = TextIndexDataset(path, vocab, bos_word=onmt.constants.BOS_WORD,
+                                   eos_word=onmt.constants.EOS_WORD, cache_size=16)
+
+        assert len(dataset) == len(lines)
+        for i in np.random.RandomState(2).permutation(len(lines)).tolist() * 2:
+            reference = vocab.convertToIdx(lines[i].split(), onmt.constants.UNK_WORD,
+                                           bos_word=onmt.constants.BOS_WORD, eos_word=onmt.constants.EOS_WORD)
+            assert torch.equal(dataset[i], reference)
+            assert dataset.sizes[i] == reference.size(0)
+        assert len(dataset.cache) == 16
+
+        # the workers start with an empty cache and their own file
+        copy = pickle.loads(pickle.dumps(dataset))
+        assert len(copy.cache) == 0 and copy._file is None
+        assert torch.equal(copy[3], dataset[3])
+
+
+def test_parallel_index():
+
+    with tempfile.TemporaryDirectory() as directory:
+        path, lines, vocab = make_corpus(directory, n=1000)
+        offsets, sizes = build_line_index(path, num_workers=1)
+
+        for num_workers in [2, 3, 7]:
+            parallel_offsets, parallel_sizes = build_line_index(path, num_workers=num_workers)
+            assert np.array_equal(offsets, parallel_offsets)
+            assert np.array_equal(sizes, parallel_sizes)
+
+        assert sizes.tolist() == [len(line.split()) for line in lines]
+        assert offsets[-1] == os.path.getsize(path)
+
+        # the saved index is reused, and rebuilt after the file changes
+        TextIndexDataset(path, vocab)
+        assert os.path.exists(index_file_path(path))
+        assert len(TextIndexDataset(path, vocab, num_workers=2)) == len(lines)
+        with open(path, 'a', encoding='utf-8') as f:
+            f.write('\nc c c')
+        dataset = TextIndexDataset(path, vocab)
+        assert len(dataset) == len(lines) + 1 and dataset.sizes[-1] == 3
+
+
+def test_dataset_batches():
+
+    with tempfile.TemporaryDirectory() as directory:
+        path, lines, vocab = make_corpus(directory)
+        src = TextIndexDataset(path, vocab)
+        tgt = TextIndexDataset(path, vocab, bos_word=onmt.constants.BOS_WORD, eos_word=onmt.constants.EOS_WORD)
+        langs = [torch.Tensor([0])]
+
+        data = Dataset(src, tgt, src.sizes, tgt.sizes, langs, langs, batch_size_words=64, data_type='text',
+                       sorting=True, batch_size_sents=16, cleaning=True)
+
+        for batch in data.batches:
+            assert len(batch) <= 16
+            assert sum(len(lines[i].split()) for i in batch) <= 64
+
+
+if __name__ == "__main__":
+    test_lazy_conversion()
+    test_parallel_index()
+    test_dataset_batches()
+    print("The text index dataset is correct.")
@@ -0,0 +1,105 @@
+import os
+import pickle
+import tempfile
+
+import torch
+
+import onmt.data.wav_dataset as wav_dataset
+from onmt.data.wav_dataset import INT16_SCALE, MMapWavDataset, MMapWavDatasetBuilder, WavDataset
+
+
+def synthetic_segments(lengths, seed=1):
+    """
+    :return: int16 tensors [length] covering the whole int16 range
+    """
+    generator = torch.Generator().manual_seed(seed)
+    segments = [torch.randint(-32768, 32768, (length,), generator=generator, dtype=torch.int32).short()
+                for length in lengths]
+    segments[0][:2] = torch.tensor([-32768, 32767], dtype=torch.int16)
+
+    return segments
+
+
+def test_mmap_round_trip():
+
+    lengths = [5, 1, 37, 16]
+    sample_rates = [16000, 8000, 16000, 44100]
+    segments = synthetic_segments(lengths)
+
+    with tempfile.TemporaryDirectory() as directory:
+        prefix = os.path.join(directory, 'train.src')
+        assert not MMapWavDataset.exists(prefix)
+
+        builder = MMapWavDatasetBuilder(wav_dataset.data_file_path(prefix))
+        for segment, sample_rate in zip(segments, sample_rates):
+            # the builder takes the normalized samples, as read by torchaudio
+            builder.add_item(segment.float() / INT16_SCALE, sample_rate=sample_rate)
+        builder.finalize(wav_dataset.index_file_path(prefix))
+        assert MMapWavDataset.exists(prefix)
+
+        dataset = MMapWavDataset(prefix)
+        assert len(dataset) == len(segments)
+        assert dataset.sizes.tolist() == lengths
+
+        for i, segment in enumerate(segments):
+            assert torch.equal(dataset.get_int16(i), segment)
+            assert dataset.sample_rate(i) == sample_rates[i]
+
+            # the same [length x 1] float tensor as safe_readaudio
+            data = dataset[i]
+            assert data.size() == (lengths[i], 1) and data.dtype == torch.float32
+            assert torch.equal(data[:, 0], segment.float() / INT16_SCALE)
+
+        # the data loader workers reopen the memory map from the path
+        copy = pickle.loads(pickle.dumps(dataset))
+        assert torch.equal(copy[2], dataset[2])
+        del copy, dataset
+
+
+def test_lru_cache():
+
+    segments = [torch.full((i + 1, 1), float(i)) for i in range(4)]
+    wav_list = [('recording%d.wav' % i, 0.0, 0.0, 16000) for i in range(len(segments))]
+    reads = list()
+
+    def readaudio(wav_path, start=0.0, end=0.0, sample_rate=16000):
+        i = int(wav_path[len('recording'):-len('.wav')])
+        reads.append(i)
+        return segments[i]
+
+    safe_readaudio = wav_dataset.safe_readaudio
+    wav_dataset.safe_readaudio = readaudio
+    try:
+        dataset = WavDataset(wav_list, cache=True, cache_size=2)
+        for i in [0, 1, 0, 2]:
+            assert torch.equal(dataset[i], segments[i])
+        # 0 was used more recently than 1, so 1 is evicted when 2 is read
+        assert reads == [0, 1, 2]
+        assert list(dataset.cache.keys()) == [wav_list[0], wav_list[2]]
+
+        dataset[1]
+        dataset[2]
+        assert reads == [0, 1, 2, 1]
+        assert list(dataset.cache.keys()) == [wav_list[1], wav_list[2]]
+
+        # unbounded cache
+        reads.clear()
+        dataset = WavDataset(wav_list, cache=True, cache_size=0)
+        for i in [0, 1, 2, 3, 0, 1, 2, 3]:
+            dataset[i]
+        assert reads == [0, 1, 2, 3] and len(dataset.cache) == 4
+
+        # without cache every access reads the file
+        reads.clear()
+        dataset = WavDataset(wav_list, cache=False)
+        for i in [0, 0, 1]:
+            dataset[i]
+        assert reads == [0, 0, 1] and dataset.cache is None
+    finally:
+        wav_dataset.safe_readaudio = safe_readaudio
+
+
+if __name__ == "__main__":
+    test_mmap_round_trip()
+    test_lru_cache()
+    print("The memory-mapped wav dataset returns the stored samples, the wav cache evicts the oldest segments.")
@@ -0,0 +1,230 @@
+import argparse
+import copy
+import os
+import tempfile
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+import onmt
+from onmt.zero_optim import ShardedOptimizer
+
+WORLD_SIZE = 2
+N_STEPS = 6
+
+
+def make_opt(update_method):
+
+    return argparse.Namespace(learning_rate=1.0, model_size=16, max_grad_norm=1.0, update_method=update_method,
+                              optim='adam', zeror_optim=True, warmup_steps=3, beta1=0.9, beta2=0.98,
+                              weight_decay=0.0, amsgrad=False, max_steps=100, max_step=10)
+
+
+def make_model():
+
+    torch.manual_seed(1)
+    return torch.nn.Sequential(torch.nn.Linear(8, 16), torch.nn.Tanh(),
+                               torch.nn.Linear(16, 16), torch.nn.Tanh(), torch.nn.Linear(16, 4))
+
+
+def make_batch(step, rank):
+
+    generator = torch.Generator().manual_seed(1000 * step + rank)
+    return torch.randn(5, 8, generator=generator), torch.randn(5, 4, generator=generator)
+
+
+def train_step(model, optim, step, ranks, scale=1.0):
+
+    for rank in ranks:
+        inputs, targets = make_batch(step, rank)
+        loss = (model(inputs) - targets).pow(2).sum()
+        loss.mul(scale).backward()
+
+    optim.reduce_gradients()
+    optim.clip_grad_norm(optim.max_grad_norm)
+    optim.step()
+    optim.zero_grad()
+
+
+def reference_training(update_method):
+    """ One process accumulates the gradients of the mini-batches of all ranks """
+    model = make_model()
+    opt = make_opt(update_method)
+    opt.zeror_optim = False
+    optim = onmt.Optim(opt)
+    optim.set_parameters(model.parameters())
+
+    # the gradients are averaged over the ranks
+    for step in range(N_STEPS):
+        train_step(model, optim, step, range(WORLD_SIZE), scale=1.0 / WORLD_SIZE)
+
+    return model, optim
+
+
+def worker(rank, update_method, init_file, result_file):
+
+    dist.init_process_group('gloo', init_method='file://' + init_file, rank=rank, world_size=WORLD_SIZE)
+
+    # different initialization on each rank: the parameters of rank 0 are used
+    model = make_model()
+    if rank > 0:
+        with torch.no_grad():
+            for p in model.parameters():
+                p.add_(1)
+
+    opt = make_opt(update_method)
+    optim = onmt.Optim(opt)
+    optim.set_parameters(model.parameters())
+
+    for step in range(N_STEPS):
+        train_step(model, optim, step, [rank])
+
+    state_dict = optim.state_dict()
+
+    # every rank loads the checkpoint (with the consolidated states) written by rank 0
+    checkpoint = [state_dict]
+    dist.broadcast_object_list(checkpoint, src=0)
+    resumed_optim = onmt.Optim(opt)
+    resumed_optim.set_parameters(model.parameters())
+    resumed_optim.load_state_dict(copy.deepcopy(checkpoint[0]))
+    resumed_state_dict = resumed_optim.state_dict()
+
+    if rank == 0:
+        torch.save({'model': model.state_dict(), 'optim': state_dict, 'resumed_optim': resumed_state_dict,
+                    'lr': optim.getLearningRate()}, result_file)
+    else:
+        torch.save({'model': model.state_dict()}, result_file + '.%d' % rank)
+
+    dist.destroy_process_group()
+
+
+def check_zero_optim(update_method):
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        init_file = os.path.join(tmp_dir, 'init')
+        result_file = os.path.join(tmp_dir, 'result.pt')
+        mp.spawn(worker, args=(update_method, init_file, result_file), nprocs=WORLD_SIZE)
+
+        result = torch.load(result_file, weights_only=False)
+        result_1 = torch.load(result_file + '.1', weights_only=False)
+
+    model, optim = reference_training(update_method)
+    reference_optim = optim.state_dict()
+
+    for name, p in model.state_dict().items():
+        # all ranks have the same parameters as the unsharded training
+        assert torch.allclose(result['model'][name], p, atol=1e-5), name
+        assert torch.equal(result['model'][name], result_1['model'][name]), name
+
+    assert abs(result['lr'] - optim.getLearningRate()) < 1e-12
+    assert result['optim']['_step'] == reference_optim['_step'] == N_STEPS
+
+    # the gathered states are the ones of the unsharded optimizer
+    for saved in [result['optim'], result['resumed_optim']]:
+        assert sorted(saved['state'].keys()) == sorted(reference_optim['state'].keys())
+        for index, state in reference_optim['state'].items():
+            for key, value in state.items():
+                assert torch.allclose(saved['state'][index][key], value, atol=1e-5), (index, key)
+
+
+def normalize_worker(rank, init_file, result_file):
+
+    dist.init_process_group('gloo', init_method='file://' + init_file, rank=rank, world_size=WORLD_SIZE)
+
+    # a half precision parameter (fp32 master copy) and a fp32 parameter, one per rank
+    params = [torch.nn.Parameter(torch.ones(4, dtype=torch.half)), torch.nn.Parameter(torch.ones(3))]
+    for p in params:
+        p.grad = torch.full_like(p, rank + 1)
+
+    optim = onmt.Optim(make_opt('noam'))
+    optim.set_parameters(params)
+    optim.reduce_gradients()
+    optim.normalize_grad(4)
+
+    grads = [p.grad for group in optim.optimizer.param_groups for p in group['params']]
+    torch.save(grads, result_file + '.%d' % rank)
+
+    dist.destroy_process_group()
+
+
+def test_zero_optim_normalize_gradients():
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        result_file = os.path.join(tmp_dir, 'grads.pt')
+        mp.spawn(normalize_worker, args=(os.path.join(tmp_dir, 'init'), result_file), nprocs=WORLD_SIZE)
+        grads = [grad for rank in range(WORLD_SIZE)
+                 for grad in torch.load(result_file + '.%d' % rank, weights_only=False)]
+
+    # the gradients of the optimizer (also the fp32 master gradients) are averaged over the ranks and divided
+    assert sorted(grad.numel() for grad in grads) == [3, 4]
+    for grad in grads:
+        assert grad.dtype == torch.float32
+        assert torch.allclose(grad, torch.full_like(grad, 1.5 / 4))
+
+
+def chunks_worker(rank, init_file, result_file):
+
+    dist.init_process_group('gloo', init_method='file://' + init_file, rank=rank, world_size=WORLD_SIZE)
+
+    # a few elements per collective: the chunks of the shards span several parameters (of both dtypes)
+    torch.manual_seed(1)
+    params = [torch.nn.Parameter(torch.randn(size, dtype=dtype))
+              for size, dtype in [(5, torch.float32), (2, torch.half), (7, torch.float32), (1, torch.float32),
+                                  (4, torch.half), (3, torch.float32)]]
+    for i, p in enumerate(params):
+        p.grad = torch.arange(p.numel(), dtype=p.dtype) * (rank + 1) + i
+
+    optim = ShardedOptimizer(params, lambda master_params: torch.optim.SGD(master_params, lr=1.0),
+                             bucket_size=6)
+    optim.reduce_gradients()
+    grads = {i: master.grad.clone() for i, master in zip(optim.local_indices, optim.master_params)}
+    optim.step()
+
+    torch.save({'grads': grads, 'params': [p.detach().float() for p in params]}, result_file + '.%d' % rank)
+
+    dist.destroy_process_group()
+
+
+def test_zero_optim_chunks():
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        result_file = os.path.join(tmp_dir, 'result.pt')
+        mp.spawn(chunks_worker, args=(os.path.join(tmp_dir, 'init'), result_file), nprocs=WORLD_SIZE)
+        results = [torch.load(result_file + '.%d' % rank, weights_only=False) for rank in range(WORLD_SIZE)]
+
+    # every parameter is in one partition, with the gradients averaged over the ranks
+    assert sorted(i for result in results for i in result['grads']) == list(range(6))
+    torch.manual_seed(1)
+    sizes = [5, 2, 7, 1, 4, 3]
+    initial = [torch.randn(size, dtype=dtype).float()
+               for size, dtype in zip(sizes, [torch.float32, torch.half, torch.float32, torch.float32,
+                                              torch.half, torch.float32])]
+    for result in results:
+        for i, grad in result['grads'].items():
+            expected = torch.arange(sizes[i]).float() * (1 + WORLD_SIZE) / 2 + i
+            assert torch.allclose(grad, expected), i
+
+    # all the ranks hold the updated parameters
+    for i, size in enumerate(sizes):
+        expected = initial[i] - (torch.arange(size).float() * (1 + WORLD_SIZE) / 2 + i)
+        for result in results:
+            assert torch.allclose(result['params'][i], expected, atol=1e-2), i
+
+
+def test_zero_optim_noam():
+
+    check_zero_optim('noam')
+
+
+def test_zero_optim_cosine():
+
+    check_zero_optim('cosine')
+
+
+if __name__ == "__main__":
+    test_zero_optim_noam()
+    test_zero_optim_cosine()
+    test_zero_optim_normalize_gradients()
+    test_zero_optim_chunks()
+    print("The zero redundancy optimizer matches the unsharded optimizer.")
@@ -0,0 +1,46 @@
+from __future__ import division
+
+import argparse
+import os
+import sys
+
+import torch
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from onmt.train_utils.ema import averaged_state_dict
+
+
+parser = argparse.ArgumentParser(description='export_ema.py')
+
+parser.add_argument('-model', required=True,
+                    help='Path to a checkpoint trained with -ema_decay')
+parser.add_argument('-output', default='model.ema.pt',
+                    help="""Path to the output checkpoint, with the averaged weights as model weights""")
+
+
+def main():
+
+    opt = parser.parse_args()
+
+    checkpoint = torch.load(opt.model, map_location=lambda storage, loc: storage)
+
+    if checkpoint.get('ema', None) is None:
+        print("The checkpoint %s has no moving average of the weights (trained without -ema_decay)" % opt.model)
+        sys.exit(1)
+
+    ema = checkpoint['ema']
+    print("Moving average of %d updates (decay %g, every %d steps)" % (ema['num_updates'], ema['decay'],
+                                                                       ema['every']))
+
+    # the same format as the averaged checkpoints (see average_checkpoints.py): no training states
+    checkpoint['model'] = averaged_state_dict(checkpoint['model'], ema)
+    for key in ['ema', 'optim', 'itr', 'scaler']:
+        checkpoint.pop(key, None)
+
+    print("Saving the averaged model to %s ..." % opt.output)
+    torch.save(checkpoint, opt.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -7,11 +7,8 @@ import argparse
 import torch
 import time, datetime
 from onmt.data.mmap_indexed_dataset import MMapIndexedDataset
-from onmt.data.scp_dataset import SCPIndexDataset
-from onmt.data.wav_dataset import WavDataset
 from onmt.modules.loss import NMTLossFunc, NMTAndCTCLossFunc
 from onmt.model_factory import build_model, optimize_model, init_model_parameters
-from onmt.bayesian_factory import build_model as build_bayesian_model
 from options import make_parser
 from collections import defaultdict
 from onmt.constants import add_tokenidx
@@ -109,6 +106,7 @@ def main():
                                           batch_size_sents=opt.batch_size_sents,
                                           multiplier=opt.batch_size_multiplier,
                                           augment=opt.augment_speech, sa_f=opt.sa_f, sa_t = opt.sa_t,
+                                          sa_input_size=opt.input_feature_size,
                                           upsampling=opt.upsampling,
                                           num_split=1)
             else:
@@ -156,18 +154,19 @@ def main():
             print(' * maximum batch size (words per batch). %d' % opt.batch_size_words)
 
         # Loading asr data structures
-        elif opt.data_format in ['scp', 'scpmem', 'mmem', 'wav']:
+        elif opt.data_format in ['scp', 'scpmem', 'mmem', 'wav', 'wavmem']:
             print("Loading memory mapped data files ....")
             start = time.time()
             from onmt.data.mmap_indexed_dataset import MMapIndexedDataset
             from onmt.data.scp_dataset import SCPIndexDataset
+            from onmt.data.wav_dataset import WavDataset, MMapWavDataset
 
             dicts = torch.load(opt.data + ".dict.pt")
             onmt.constants = add_tokenidx(opt, onmt.constants, dicts)
 
             if opt.data_format in ['scp', 'scpmem']:
                 audio_data = torch.load(opt.data + ".scp_path.pt")
-            elif opt.data_format in ['wav']:
+            elif opt.data_format in ['wav', 'wavmem']:
                 audio_data = torch.load(opt.data + ".wav_path.pt")
                 # # TODO: maybe having another option like -past_context
                 # if os.path.exists(opt.data + '.prev_src_path.pt'):
@@ -190,7 +189,11 @@ def main():
                 else:
                     past_train_src = None
             elif opt.data_format in ['wav']:
-                train_src = WavDataset(audio_data['train'])
+                train_src = WavDataset(audio_data['train'], cache=opt.wav_cache_size > 0,
+                                       cache_size=opt.wav_cache_size)
+                past_train_src = None
+            elif opt.data_format in ['wavmem']:
+                train_src = MMapWavDataset(train_path + '.wav')
                 past_train_src = None
             else:
                 train_src = MMapIndexedDataset(train_path + '.src')
@@ -242,6 +245,7 @@ def main():
                                           src_align_right=opt.src_align_right,
                                           upsampling=opt.upsampling,
                                           augment=opt.augment_speech, sa_f=opt.sa_f, sa_t = opt.sa_t,
+                                          sa_input_size=opt.input_feature_size,
                                           cleaning=True, verbose=True,
                                           num_split=1,
                                           past_src_data=past_train_src,
@@ -265,7 +269,11 @@ def main():
                 else:
                     past_valid_src = None
             elif opt.data_format in ['wav']:
-                valid_src = WavDataset(audio_data['valid'])
+                valid_src = WavDataset(audio_data['valid'], cache=opt.wav_cache_size > 0,
+                                       cache_size=opt.wav_cache_size)
+                past_valid_src = None
+            elif opt.data_format in ['wavmem']:
+                valid_src = MMapWavDataset(valid_path + '.wav')
                 past_valid_src = None
             else:
                 valid_src = MMapIndexedDataset(valid_path + '.src')
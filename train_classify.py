@@ -107,6 +107,7 @@ def main():
                                           batch_size_sents=opt.batch_size_sents,
                                           multiplier=opt.batch_size_multiplier,
                                           augment=opt.augment_speech, sa_f=opt.sa_f, sa_t = opt.sa_t,
+                                          sa_input_size=opt.input_feature_size,
                                           upsampling=opt.upsampling,
                                           num_split=1)
             else:
@@ -233,6 +234,7 @@ def main():
                                           src_align_right=opt.src_align_right,
                                           upsampling=opt.upsampling,
                                           augment=opt.augment_speech, sa_f=opt.sa_f, sa_t = opt.sa_t,
+                                          sa_input_size=opt.input_feature_size,
                                           cleaning=True, verbose=True,
                                           num_split=1,
                                           past_src_data=past_train_src,
@@ -8,7 +8,7 @@ import argparse
 import time, datetime
 from onmt.data.mmap_indexed_dataset import MMapIndexedDataset
 from onmt.data.scp_dataset import SCPIndexDataset
-from onmt.data.wav_dataset import WavDataset
+from onmt.data.wav_dataset import WavDataset, MMapWavDataset
 from onmt.modules.loss import NMTLossFunc, NMTAndCTCLossFunc
 from onmt.model_factory import build_model, optimize_model, init_model_parameters
 from onmt.bayesian_factory import build_model as build_bayesian_model
@@ -109,6 +109,7 @@ def main():
                                           batch_size_sents=opt.batch_size_sents,
                                           multiplier=opt.batch_size_multiplier,
                                           augment=opt.augment_speech, sa_f=opt.sa_f, sa_t = opt.sa_t,
+                                          sa_input_size=opt.input_feature_size,
                                           upsampling=opt.upsampling,
                                           num_split=1)
             else:
@@ -156,7 +157,7 @@ def main():
             print(' * maximum batch size (words per batch). %d' % opt.batch_size_words)
 
         # Loading asr data structures
-        elif opt.data_format in ['scp', 'scpmem', 'mmem', 'wav']:
+        elif opt.data_format in ['scp', 'scpmem', 'mmem', 'wav', 'wavmem']:
             print("Loading memory mapped data files ....")
             start = time.time()
             from onmt.data.mmap_indexed_dataset import MMapIndexedDataset
@@ -167,7 +168,7 @@ def main():
 
             if opt.data_format in ['scp', 'scpmem']:
                 audio_data = torch.load(opt.data + ".scp_path.pt")
-            elif opt.data_format in ['wav']:
+            elif opt.data_format in ['wav', 'wavmem']:
                 audio_data = torch.load(opt.data + ".wav_path.pt")
                 # # TODO: maybe having another option like -past_context
                 # if os.path.exists(opt.data + '.prev_src_path.pt'):
@@ -190,7 +191,11 @@ def main():
                 else:
                     past_train_src = None
             elif opt.data_format in ['wav']:
-                train_src = WavDataset(audio_data['train'])
+                train_src = WavDataset(audio_data['train'], cache=opt.wav_cache_size > 0,
+                                       cache_size=opt.wav_cache_size)
+                past_train_src = None
+            elif opt.data_format in ['wavmem']:
+                train_src = MMapWavDataset(train_path + '.wav')
                 past_train_src = None
             else:
                 train_src = MMapIndexedDataset(train_path + '.src')
@@ -242,6 +247,7 @@ def main():
                                           src_align_right=opt.src_align_right,
                                           upsampling=opt.upsampling,
                                           augment=opt.augment_speech, sa_f=opt.sa_f, sa_t = opt.sa_t,
+                                          sa_input_size=opt.input_feature_size,
                                           cleaning=True, verbose=True,
                                           num_split=1,
                                           past_src_data=past_train_src,
@@ -265,7 +271,11 @@ def main():
                 else:
                     past_valid_src = None
             elif opt.data_format in ['wav']:
-                valid_src = WavDataset(audio_data['valid'])
+                valid_src = WavDataset(audio_data['valid'], cache=opt.wav_cache_size > 0,
+                                       cache_size=opt.wav_cache_size)
+                past_valid_src = None
+            elif opt.data_format in ['wavmem']:
+                valid_src = MMapWavDataset(valid_path + '.wav')
                 past_valid_src = None
             else:
                 valid_src = MMapIndexedDataset(valid_path + '.src')
@@ -321,6 +331,58 @@ def main():
             elapse = str(datetime.timedelta(seconds=int(time.time() - start)))
             print("Done after %s" % elapse)
 
+        # raw (already segmented) text files indexed on the fly instead of preprocess.py
+        elif opt.data_format in ['text']:
+            print("Loading text files ....")
+            start = time.time()
+            from onmt.data.text_index_dataset import TextIndexDataset
+
+            dicts = torch.load(opt.data + ".dict.pt")
+            onmt.constants = add_tokenidx(opt, onmt.constants, dicts)
+
+            if 'langs' not in dicts:
+                dicts['langs'] = {'src': 0, 'tgt': 1}
+            src_langs = [torch.Tensor([dicts['langs']['src']])]
+            tgt_langs = [torch.Tensor([dicts['langs']['tgt']])]
+
+            def load_text_data(path):
+                src = TextIndexDataset(path + '.src', dicts['src'],
+                                       cache_size=opt.text_cache_size, num_workers=opt.text_index_workers,
+                                       verbose=True)
+                tgt = TextIndexDataset(path + '.tgt', dicts['tgt'],
+                                       bos_word=onmt.constants.TGT_BOS_WORD, eos_word=onmt.constants.TGT_EOS_WORD,
+                                       cache_size=opt.text_cache_size, num_workers=opt.text_index_workers,
+                                       verbose=True)
+                assert len(src) == len(tgt), "%s.src and %s.tgt have different numbers of lines" % (path, path)
+                return src, tgt
+
+            train_src, train_tgt = load_text_data(opt.data + '.train')
+            train_data = onmt.Dataset(train_src, train_tgt,
+                                      train_src.sizes, train_tgt.sizes,
+                                      src_langs, tgt_langs,
+                                      batch_size_words=opt.batch_size_words,
+                                      data_type='text', sorting=True,
+                                      batch_size_sents=opt.batch_size_sents,
+                                      multiplier=opt.batch_size_multiplier,
+                                      src_align_right=opt.src_align_right,
+                                      upsampling=opt.upsampling,
+                                      cleaning=True, verbose=True,
+                                      num_split=1)
+
+            valid_src, valid_tgt = load_text_data(opt.data + '.valid')
+            valid_data = onmt.Dataset(valid_src, valid_tgt,
+                                      valid_src.sizes, valid_tgt.sizes,
+                                      src_langs, tgt_langs,
+                                      batch_size_words=opt.batch_size_words,
+                                      multiplier=opt.batch_size_multiplier,
+                                      data_type='text', sorting=True,
+                                      batch_size_sents=opt.batch_size_sents,
+                                      src_align_right=opt.src_align_right,
+                                      cleaning=True, verbose=True)
+
+            elapse = str(datetime.timedelta(seconds=int(time.time() - start)))
+            print("Done after %s" % elapse)
+
         else:
             raise NotImplementedError
 
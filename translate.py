@@ -9,10 +9,10 @@ import argparse
 import math
 import numpy
 import sys
-import h5py as h5
 import numpy as np
 from onmt.inference.fast_translator import FastTranslator
 from onmt.inference.stream_translator import StreamTranslator
+from onmt.inference.output_writer import AsyncOutputWriter
 
 parser = argparse.ArgumentParser(description='translate.py')
 onmt.markdown.add_md_help_argument(parser)
@@ -26,9 +26,24 @@ parser.add_argument('-pretrained_classifier', required=False, default="",
 parser.add_argument('-streaming', action="store_true",
                     help="""Use streaming mode (for model with streaming)""")
 parser.add_argument('-lm', required=False,
-                    help='Path to language model .pt file. Used for cold fusion')
+                    help='Path to language model .pt file (train_language_model.py, the same target dictionary). '
+                         'Used for shallow fusion with -fast_translate')
+parser.add_argument('-lm_weight', type=float, default=0.3,
+                    help='Weight of the language model log-probs added to the model scores in shallow fusion')
+parser.add_argument('-lm_length_bonus', type=float, default=0.0,
+                    help='Score added for every generated token in shallow fusion, against the preference of the '
+                         'language model for short outputs (applied before the -normalize -alpha normalization)')
 parser.add_argument('-vocab_list', default="",
                     help='A Vocabulary list (1 word per line). Only are these words generated during translation.')
+parser.add_argument('-shortlist', default="",
+                    help='Lexical table (lines "source_word target_word score") for vocabulary shortlisting: '
+                         'the output layer only projects onto the translations of the source words of each batch, '
+                         'the -shortlist_first most frequent target words, EOS and UNK (-fast_translate only).')
+parser.add_argument('-shortlist_first', type=int, default=0,
+                    help='Number of the most frequent target words always in the shortlist. '
+                         'Without -shortlist, decode with these words only. Default=0 (no shortlist)')
+parser.add_argument('-shortlist_per_word', type=int, default=50,
+                    help='Maximum number of target words of the lexical table for each source word')
 parser.add_argument('-autoencoder', required=False,
                     help='Path to autoencoder .pt file')
 parser.add_argument('-input_type', default="word",
@@ -39,6 +54,9 @@ parser.add_argument('-sub_src', required=False, default="",
                     help='Source sequence to decode (one line per sequence)')
 parser.add_argument('-past_src', required=False, default="",
                     help='Past Source sequence to decode (one line per sequence)')
+parser.add_argument('-past_cache_size', type=int, default=64,
+                    help='Number of encoded utterances kept (by utterance id) to be reused as the past context '
+                         'of the following utterances with -past_src. 0 to disable')
 parser.add_argument('-src_lang', default='src',
                     help='Source language')
 parser.add_argument('-tgt_lang', default='tgt',
@@ -109,8 +127,15 @@ parser.add_argument('-beta', type=float, default=0.0,
 parser.add_argument('-print_nbest', action='store_true',
                     help='Output the n-best list instead of a single sentence')
 parser.add_argument('-ensemble_op', default='mean', help="""Ensembling operator""")
+parser.add_argument('-no_encoder_sharing', action='store_true',
+                    help='Run the encoder of every model of an ensemble, even when models have identical encoders '
+                         '(by default these share one encoder, computed once per batch)')
 parser.add_argument('-normalize', action='store_true',
                     help='To normalize the scores based on output length')
+parser.add_argument('-write_queue_size', type=int, default=16,
+                    help='Maximum number of outputs (translated batches and messages printed to stdout) waiting '
+                         'to be written by a background thread, in order, while the next batches are decoded. '
+                         '0: each batch is written before decoding the next one.')
 parser.add_argument('-no_buffering', action='store_true',
                     help='To remove buffering for transformer models (slower but more memory)')
 parser.add_argument('-src_align_right', action='store_true',
@@ -131,6 +156,20 @@ parser.add_argument('-dynamic_max_len_scale', type=float, default=5.0,
                     help='Using the fast decoder')
 parser.add_argument('-dynamic_min_len_scale', type=float, default=0.0,
                     help='Using the fast decoder')
+parser.add_argument('-encoder_chunk_size', type=int, default=0,
+                    help='Encode the speech input chunk by chunk with this number of encoder frames per chunk. '
+                         'Default=0 (use the chunk size from training if any)')
+parser.add_argument('-encoder_left_context', type=int, default=-1,
+                    help='Number of frames before each chunk that can be attended. Default=-1 (all)')
+parser.add_argument('-encoder_right_context', type=int, default=0,
+                    help='Number of look-ahead frames after each chunk')
+parser.add_argument('-encoder_cached_chunks', action='store_true',
+                    help='Encode the chunks one after another, reusing the cached states of the left context '
+                         '(streaming) instead of masking the whole utterance. Only without look-ahead frames.')
+parser.add_argument('-ctc_decode', default='none', choices=['none', 'greedy', 'prefix_beam'],
+                    help='Decode speech models trained with -ctc_loss with their CTC layer only (the attention '
+                         'decoder is skipped): greedy (best path) or prefix_beam (prefix beam search with '
+                         '-beam_size). Default=none (attention beam search)')
 
 
 def _is_oversized(batch, new_sent_size, batch_size):
@@ -198,6 +237,9 @@ def main():
 
     pred_score_total, pred_words_total, gold_score_total, gold_words_total = 0, 0, 0, 0
 
+    # (until it is closed, the messages printed to stdout are also written in order by the writer thread)
+    writer = AsyncOutputWriter(max_queue=opt.write_queue_size)
+
     src_batches = []
     src_batch, tgt_batch = [], []
 
@@ -211,6 +253,7 @@ def main():
         in_file = sys.stdin
         opt.batch_size = 1
     elif opt.encoder_type == "audio" and opt.asr_format == "h5":
+        import h5py as h5
         in_file = h5.File(opt.src, 'r')
     elif opt.encoder_type == "audio" and opt.asr_format == "scp":
         # import kaldiio
@@ -268,14 +311,16 @@ def main():
 
         sub_src = open(opt.sub_src) if opt.sub_src else None
         sub_src_batch = list()
+        # the utterance ids let the model reuse the encoder output of an utterance as the next past context
+        utterance_ids, past_utterance_ids = list(), list()
 
         while True:
             try:
-                scp_path = next(audio_data).strip().split()[1]
+                utterance_id, scp_path = next(audio_data).strip().split()[:2]
                 line = scp_reader.load_mat(scp_path)
 
                 if past_audio_data:
-                    scp_path = next(past_audio_data).strip().split()[1]
+                    past_utterance_id, scp_path = next(past_audio_data).strip().split()[:2]
                     past_line = scp_reader.load_mat(scp_path)
                 else:
                     past_line = None
@@ -306,7 +351,8 @@ def main():
                 else:
                     print("Batch sizes :", len(src_batches[0]), len(tgt_batch), len(sub_src_batch))
                 pred_batch, pred_score, pred_length, gold_score, num_gold_words, all_gold_scores = translator.translate(
-                    src_batches, tgt_batch, sub_src_data=sub_src_batch, past_src_data=past_src_batches, type='asr')
+                    src_batches, tgt_batch, sub_src_data=sub_src_batch, past_src_data=past_src_batches, type='asr',
+                    utterance_ids=utterance_ids, past_utterance_ids=past_utterance_ids)
                 print("Result:", len(pred_batch))
                 count, pred_score, pred_words, gold_score, goldWords = \
                     translate_batch(opt, tgtF, count, outF, translator,
@@ -314,17 +360,21 @@ def main():
                                     pred_score,
                                     pred_length, gold_score,
                                     num_gold_words,
-                                    all_gold_scores, opt.input_type)
+                                    all_gold_scores, opt.input_type, writer=writer)
 
                 pred_score_total += pred_score
                 pred_words_total += pred_words
                 gold_score_total += gold_score
                 gold_words_total += goldWords
                 src_batch, tgt_batch, sub_src_batch = [], [], []
+                utterance_ids, past_utterance_ids = [], []
                 for j, _ in enumerate(src_batches):
                     src_batches[j] = []
                     if past_audio_data: past_src_batches[j] = []
 
+            utterance_ids.append(utterance_id)
+            if past_audio_data: past_utterance_ids.append(past_utterance_id)
+
             # handling different concatenation settings (for example 4|1|4)
             for j, concat_ in enumerate(concats):
                 concat = int(concat_)
@@ -384,7 +434,8 @@ def main():
                 src_batches,
                 tgt_batch,
                 past_src_data=past_src_batches,
-                sub_src_data=sub_src_batch, type='asr')
+                sub_src_data=sub_src_batch, type='asr',
+                utterance_ids=utterance_ids, past_utterance_ids=past_utterance_ids)
             print("Result:", len(pred_batch))
             count, pred_score, pred_words, gold_score, goldWords \
                 = translate_batch(opt, tgtF, count, outF, translator,
@@ -392,7 +443,7 @@ def main():
                                   pred_score,
                                   pred_length, gold_score,
                                   num_gold_words,
-                                  all_gold_scores, opt.input_type)
+                                  all_gold_scores, opt.input_type, writer=writer)
 
             pred_score_total += pred_score
             pred_words_total += pred_words
@@ -464,7 +515,7 @@ def main():
                                     pred_score,
                                     pred_length, gold_score,
                                     num_gold_words,
-                                    all_gold_scores, opt.input_type)
+                                    all_gold_scores, opt.input_type, writer=writer)
 
                 pred_score_total += pred_score
                 pred_words_total += pred_words
@@ -528,7 +579,7 @@ def main():
                                   pred_score,
                                   pred_length, gold_score,
                                   num_gold_words,
-                                  all_gold_scores, opt.input_type)
+                                  all_gold_scores, opt.input_type, writer=writer)
 
             pred_score_total += pred_score
             pred_words_total += pred_words
@@ -582,13 +633,16 @@ def main():
                                                                                    src_batch, tgt_batch,
                                                                                    pred_batch, pred_score, pred_length,
                                                                                    gold_score, num_gold_words,
-                                                                                   all_gold_scores, opt.input_type)
+                                                                                   all_gold_scores, opt.input_type,
+                                                                                   writer=writer)
             pred_score_total += pred_score
             pred_words_total += pred_words
             gold_score_total += gold_score
             gold_words_total += goldWords
             src_batch, tgt_batch = [], []
 
+    writer.close()
+
     if opt.verbose:
         report_score('PRED', pred_score_total, pred_words_total)
         if tgtF: report_score('GOLD', gold_score_total, gold_words_total)
@@ -602,7 +656,12 @@ def main():
 
 def translate_batch(opt, tgtF, count, outF, translator, src_batch, tgt_batch, pred_batch, pred_score, pred_length,
                     gold_score,
-                    num_gold_words, all_gold_scores, input_type):
+                    num_gold_words, all_gold_scores, input_type, writer=None):
+    """
+    Reorders the hypotheses and sums the scores of a translated batch, the output is written by the writer
+    (in the background, in the order of the batches) or immediately without writer
+    :return: the number of sentences written so far and the sums of the scores and lengths of the batch
+    """
     original_pred_batch = pred_batch
     original_pred_score = pred_score
 
@@ -633,6 +692,25 @@ def translate_batch(opt, tgtF, count, outF, translator, src_batch, tgt_batch, pr
         gold_score_total = sum(gold_score).item()
         gold_words_total = num_gold_words
 
+    args = (opt, tgtF is not None, count, outF, translator.tgt_dict.lower, src_batch, tgt_batch, pred_batch,
+            pred_score, gold_score, input_type)
+    if writer is None:
+        write_batch(*args)
+    else:
+        writer.submit(write_batch, *args)
+    count += len(pred_batch)
+
+    return count, pred_score_total, pred_words_total, gold_score_total, gold_words_total
+
+
+def write_batch(opt, has_gold, count, outF, lower_gold, src_batch, tgt_batch, pred_batch, pred_score, gold_score,
+                input_type):
+    """
+    Writes the hypotheses of a batch into outF (and the details to stdout with -verbose)
+    :param has_gold: the gold translations are given (-tgt)
+    :param count: number of sentences written before the batch
+    :param lower_gold: the gold translations are lowercased (as the target dictionary)
+    """
     for b in range(len(pred_batch)):
 
         count += 1
@@ -655,9 +733,9 @@ def translate_batch(opt, tgtF, count, outF, translator, src_batch, tgt_batch, pr
             print('PRED %d: %s' % (count, get_sentence_from_tokens(pred_batch[b][0], input_type)))
             print("PRED SCORE: %.4f" % pred_score[b][0])
 
-            if tgtF is not None:
+            if has_gold:
                 tgt_sent = get_sentence_from_tokens(tgt_batch[b], input_type)
-                if translator.tgt_dict.lower:
+                if lower_gold:
                     tgt_sent = tgt_sent.lower()
                 print('GOLD %d: %s ' % (count, tgt_sent))
                 print("GOLD SCORE: %.4f" % gold_score[b])
@@ -670,8 +748,6 @@ def translate_batch(opt, tgtF, count, outF, translator, src_batch, tgt_batch, pr
                     print(out_str)
             print('')
 
-    return count, pred_score_total, pred_words_total, gold_score_total, gold_words_total
-
 
 if __name__ == "__main__":
     main()